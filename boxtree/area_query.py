@@ -26,6 +26,7 @@ THE SOFTWARE.
 """
 
 
+import weakref
 import numpy as np
 import pyopencl as cl
 import pyopencl.cltypes  # noqa
@@ -46,6 +47,8 @@ Area queries (Balls -> overlapping leaves)
 
 .. autoclass:: AreaQueryResult
 
+.. autoclass:: AreaQueryCounts
+
 
 Inverse of area query (Leaves -> overlapping balls)
 ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
@@ -55,6 +58,36 @@ Inverse of area query (Leaves -> overlapping balls)
 .. autoclass:: LeavesToBallsLookup
 
 
+k-nearest-neighbor queries
+^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+.. autoclass:: KNearestNeighborQueryBuilder
+
+.. autoclass:: KNearestNeighborQueryResult
+
+
+Range queries (Axis-aligned boxes -> overlapping leaves)
+^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+
+.. autoclass:: RangeQueryBuilder
+
+.. autoclass:: RangeQueryResult
+
+
+Radius neighbor queries
+^^^^^^^^^^^^^^^^^^^^^^^
+
+.. autoclass:: RadiusNeighborQueryBuilder
+
+.. autoclass:: RadiusNeighborQueryResult
+
+
+Point location
+^^^^^^^^^^^^^^
+
+.. autoclass:: LeafBoxFinder
+
+
 Space invader queries
 ^^^^^^^^^^^^^^^^^^^^^
 
@@ -116,6 +149,143 @@ class AreaQueryResult(DeviceDataRecord):
     """
 
 
+class RangeQueryResult(DeviceDataRecord):
+    """
+    .. attribute:: tree
+
+        The :class:`boxtree.Tree` instance used to build this lookup.
+
+    .. attribute:: leaves_in_range_starts
+
+        Indices into :attr:`leaves_in_range_lists`.
+        ``leaves_in_range_lists[leaves_in_range_starts[range_nr]:
+        leaves_in_range_starts[range_nr+1]]``
+        results in a list of leaf boxes that intersect range `range_nr`.
+
+    .. attribute:: leaves_in_range_lists
+
+    .. attribute:: source_order
+
+        Either ``"user"`` or ``"tree"``, the order in which the source
+        indices in :attr:`sources_in_range_lists` are given, or *None* if
+        sources were not requested.
+
+    .. attribute:: sources_in_range_starts
+
+        Indices into :attr:`sources_in_range_lists`, or *None* if sources
+        were not requested.
+        ``sources_in_range_lists[sources_in_range_starts[range_nr]:
+        sources_in_range_starts[range_nr+1]]``
+        results in a list of the sources contained in range `range_nr`.
+
+    .. attribute:: sources_in_range_lists
+
+    .. automethod:: get
+
+    .. versionadded:: 2019.1
+    """
+
+
+class AreaQueryCounts(DeviceDataRecord):
+    """
+    .. attribute:: tree
+
+        The :class:`boxtree.Tree` instance used to build this lookup.
+
+    .. attribute:: leaf_counts
+
+        ``box_id_t [nballs]``. The number of leaf boxes that intersect
+        each ball, i.e. the length of its list in :class:`AreaQueryResult`.
+
+    .. attribute:: source_counts
+
+        ``particle_id_t [nballs]``. The total number of sources in the
+        leaf boxes that intersect each ball.
+
+    .. attribute:: target_counts
+
+        ``particle_id_t [nballs]``. The total number of targets in the
+        leaf boxes that intersect each ball.
+
+    .. automethod:: get
+
+    .. versionadded:: 2019.1
+    """
+
+
+class KNearestNeighborQueryResult(DeviceDataRecord):
+    """
+    .. attribute:: tree
+
+        The :class:`boxtree.Tree` instance used to build this lookup.
+
+    .. attribute:: nneighbors
+
+        The number of neighbors found for each point, the smaller of
+        the requested number and :attr:`boxtree.Tree.nsources`.
+
+    .. attribute:: source_order
+
+        Either ``"user"`` or ``"tree"``, the order in which the source
+        indices in :attr:`neighbor_lists` are given.
+
+    .. attribute:: neighbor_starts
+
+        Indices into :attr:`neighbor_lists` and :attr:`neighbor_distances`.
+        ``neighbor_lists[neighbor_starts[point_nr]:
+        neighbor_starts[point_nr+1]]`` contains the indices of the sources
+        closest to point `point_nr`, by increasing distance. All lists
+        have length :attr:`nneighbors`.
+
+    .. attribute:: neighbor_lists
+
+    .. attribute:: neighbor_distances
+
+        The :math:`l^2` distances between the points and the sources in
+        :attr:`neighbor_lists`.
+
+    .. automethod:: get
+
+    .. versionadded:: 2019.1
+    """
+
+
+class RadiusNeighborQueryResult(DeviceDataRecord):
+    """
+    .. attribute:: tree
+
+        The :class:`boxtree.Tree` instance used to build this lookup.
+
+    .. attribute:: radius
+
+        The :math:`l^2` radius used to find the neighbors.
+
+    .. attribute:: half_list
+
+        If *True*, each pair of neighbors is only stored once, in the list
+        of the particle with the smaller index.
+
+    .. attribute:: source_order
+
+        Either ``"user"`` or ``"tree"``, the order in which the sources
+        are numbered, both as indices of the lists and within the lists.
+
+    .. attribute:: neighbor_starts
+
+        Indices into :attr:`neighbor_lists`.
+        ``neighbor_lists[neighbor_starts[isrc]:neighbor_starts[isrc+1]]``
+        contains the indices of the sources other than `isrc` (and larger
+        than `isrc`, if :attr:`half_list` is set) within :attr:`radius` of
+        source `isrc`, in no particular order.
+
+    .. attribute:: neighbor_lists
+
+    .. automethod:: get
+
+    .. versionadded:: 2019.1
+    """
+
+
 class LeavesToBallsLookup(DeviceDataRecord):
     """
     .. attribute:: tree
@@ -134,6 +304,10 @@ class LeavesToBallsLookup(DeviceDataRecord):
 
     .. attribute:: balls_near_box_lists
 
+        Each list is sorted by increasing ball number, unless requested
+        otherwise via the *sort_by* argument of
+        :meth:`LeavesToBallsLookupBuilder.__call__`.
+
     .. automethod:: get
     """
 
@@ -350,7 +524,143 @@ AREA_QUERY_TEMPLATE = (
     </%def>
 
     <%def name="leaf_found_op(leaf_box_id, ball_center, ball_radius)">
-        APPEND_leaves(${leaf_box_id});
+        %if norm == "l2":
+        {
+            bool is_overlapping_l2;
+
+            ${check_l2_ball_overlap(
+                "is_overlapping_l2", leaf_box_id, ball_radius, ball_center)}
+
+            if (is_overlapping_l2)
+                APPEND_leaves(${leaf_box_id});
+        }
+        %else:
+            APPEND_leaves(${leaf_box_id});
+        %endif
+    </%def>
+
+    void generate(LIST_ARG_DECL USER_ARG_DECL ball_id_t i)
+    {
+    """
+    + AREA_QUERY_WALKER_BODY
+    + """
+    }
+    """)
+
+
+RADIUS_NEIGHBOR_QUERY_TEMPLATE = (
+    GUIDING_BOX_FINDER_MACRO + r"""//CL//
+    typedef ${dtype_to_ctype(peer_list_idx_dtype)} peer_list_idx_t;
+
+    <%def name="get_ball_center_and_radius(ball_center, ball_radius, i)">
+        %for ax in AXIS_NAMES[:dimensions]:
+            ${ball_center}.${ax} = source_${ax}[tree_i];
+        %endfor
+        ${ball_radius} = radius;
+    </%def>
+
+    <%def name="leaf_found_op(leaf_box_id, ball_center, ball_radius)">
+        for (particle_id_t j = box_source_starts[${leaf_box_id}],
+             j_end = j + box_source_counts_nonchild[${leaf_box_id}];
+             j < j_end; ++j)
+        {
+            %if source_order == "user":
+                particle_id_t out_j = user_source_ids[j];
+            %else:
+                particle_id_t out_j = j;
+            %endif
+
+            %if half_list:
+                if (out_j <= i)
+                    continue;
+            %else:
+                if (out_j == i)
+                    continue;
+            %endif
+
+            coord_t dist_sq = 0;
+            %for ax in AXIS_NAMES[:dimensions]:
+            {
+                coord_t d = source_${ax}[j] - ${ball_center}.${ax};
+                dist_sq += d * d;
+            }
+            %endfor
+
+            if (dist_sq <= ${ball_radius} * ${ball_radius})
+                APPEND_neighbors(out_j);
+        }
+    </%def>
+
+    void generate(LIST_ARG_DECL USER_ARG_DECL particle_id_t i)
+    {
+        %if source_order == "user":
+            particle_id_t tree_i = tree_source_ids[i];
+        %else:
+            particle_id_t tree_i = i;
+        %endif
+    """
+    + AREA_QUERY_WALKER_BODY
+    + """
+    }
+    """)
+
+
+# The walk uses the smallest l^inf ball containing each range. The leaves
+# found this way are then checked against the range itself.
+
+RANGE_QUERY_TEMPLATE = (
+    GUIDING_BOX_FINDER_MACRO + r"""//CL//
+    typedef ${dtype_to_ctype(ball_id_dtype)} ball_id_t;
+    typedef ${dtype_to_ctype(peer_list_idx_dtype)} peer_list_idx_t;
+
+    <%def name="get_ball_center_and_radius(ball_center, ball_radius, i)">
+        ${ball_radius} = 0;
+        %for ax in AXIS_NAMES[:dimensions]:
+            ${ball_center}.${ax} =
+                (range_min_${ax}[${i}] + range_max_${ax}[${i}]) / 2;
+            ${ball_radius} = fmax(${ball_radius},
+                (range_max_${ax}[${i}] - range_min_${ax}[${i}]) / 2);
+        %endfor
+    </%def>
+
+    <%def name="leaf_found_op(leaf_box_id, ball_center, ball_radius)">
+    {
+        ${load_center("leaf_center", leaf_box_id)}
+        coord_t leaf_rad = LEVEL_TO_RAD(box_levels[${leaf_box_id}]);
+
+        bool is_in_range = true
+        %for iax, ax in enumerate(AXIS_NAMES[:dimensions]):
+            && range_min_${ax}[i] <= leaf_center.s${iax} + leaf_rad
+            && leaf_center.s${iax} - leaf_rad <= range_max_${ax}[i]
+        %endfor
+            ;
+
+        if (is_in_range)
+        {
+            APPEND_leaves(${leaf_box_id});
+
+            %if return_sources:
+            for (particle_id_t j = box_source_starts[${leaf_box_id}],
+                 j_end = j + box_source_counts_nonchild[${leaf_box_id}];
+                 j < j_end; ++j)
+            {
+                if (true
+                    %for ax in AXIS_NAMES[:dimensions]:
+                        && range_min_${ax}[i] <= source_${ax}[j]
+                        && source_${ax}[j] <= range_max_${ax}[i]
+                    %endfor
+                    )
+                {
+                    %if source_order == "user":
+                        APPEND_sources(user_source_ids[j]);
+                    %else:
+                        APPEND_sources(j);
+                    %endif
+                }
+            }
+            %endif
+        }
+    }
     </%def>
 
     void generate(LIST_ARG_DECL USER_ARG_DECL ball_id_t i)
@@ -463,6 +773,152 @@ STARTS_EXPANDER_TEMPLATE = ElementwiseTemplate(
     name="starts_expander",
     preamble=str(InlineBinarySearch("idx_t")))
 
+
+LEAF_BOX_FINDER_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        coord_t root_extent,
+        box_id_t aligned_nboxes,
+        box_id_t *box_child_ids,
+        %for ax in AXIS_NAMES[:dimensions]:
+            coord_t bbox_min_${ax},
+        %endfor
+        %for ax in AXIS_NAMES[:dimensions]:
+            coord_t *point_${ax},
+        %endfor
+        box_id_t *box_ids
+    """,
+    operation=r"""//CL:mako//
+    %for ax in AXIS_NAMES[:dimensions]:
+        coord_t offset_scaled_${ax} = (point_${ax}[i] - bbox_min_${ax})
+            / root_extent;
+    %endfor
+
+    /* Points outside the root box are not located. */
+    if (0
+        %for ax in AXIS_NAMES[:dimensions]:
+            || !(0 <= offset_scaled_${ax} && offset_scaled_${ax} < 1)
+        %endfor
+        )
+    {
+        box_ids[i] = -1;
+        PYOPENCL_ELWISE_CONTINUE;
+    }
+
+    box_id_t box_id = 0;
+
+    for (unsigned box_level = 0;; ++box_level)
+    {
+        // Logic intended to match the morton nr scan kernel.
+        %for ax in AXIS_NAMES[:dimensions]:
+            unsigned ${ax}_bits = (unsigned) (
+                offset_scaled_${ax} * (1U << (1 + box_level)));
+        %endfor
+
+        int level_morton_number = 0
+        %for iax, ax in enumerate(AXIS_NAMES[:dimensions]):
+            | (${ax}_bits & 1U) << (${dimensions-1-iax})
+        %endfor
+            ;
+
+        box_id_t next_box = box_child_ids[
+            level_morton_number * aligned_nboxes + box_id];
+
+        /* Either a leaf or a part of the box without particles. */
+        if (!next_box)
+            break;
+
+        box_id = next_box;
+    }
+
+    box_ids[i] = box_id;
+    """,
+    name="find_leaf_boxes")
+
+
+# Each work item sorts the list of one box by (squared distance, ball number)
+# using heap sort, which takes O(n log n) time even for long lists. The
+# squared distances are kept in a scratch array alongside the lists.
+
+LEAF_BALL_LIST_DISTANCE_SORTER_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        coord_t *box_centers,
+        box_id_t aligned_nboxes,
+        idx_t *balls_near_box_starts,
+        idx_t *balls_near_box_lists,
+        %for ax in AXIS_NAMES[:dimensions]:
+            coord_t *ball_${ax},
+        %endfor
+        coord_t *dist_squared
+    """,
+    operation=r"""//CL:mako//
+    idx_t start = balls_near_box_starts[i];
+    idx_t n = balls_near_box_starts[i + 1] - start;
+
+    __global idx_t *balls = balls_near_box_lists + start;
+    __global coord_t *keys = dist_squared + start;
+
+    for (idx_t j = 0; j < n; ++j)
+    {
+        coord_t key = 0;
+        %for iax, ax in enumerate(AXIS_NAMES[:dimensions]):
+        {
+            coord_t d = ball_${ax}[balls[j]]
+                - box_centers[${iax} * aligned_nboxes + i];
+            key += d * d;
+        }
+        %endfor
+        keys[j] = key;
+    }
+
+    // Build a max-heap, then move its top to the end one entry at a time.
+    for (idx_t root = n / 2; root > 0; --root)
+        sift_down(keys, balls, root - 1, n);
+
+    for (idx_t end = n - 1; end > 0; --end)
+    {
+        swap_entries(keys, balls, 0, end);
+        sift_down(keys, balls, 0, end);
+    }
+    """,
+    name="sort_leaf_ball_lists_by_distance",
+    preamble=r"""//CL//
+    // Ties are broken by ball number.
+    #define ENTRY_LESS(a, b) \
+        (keys[a] < keys[b] || (keys[a] == keys[b] && balls[a] < balls[b]))
+
+    inline void swap_entries(
+        __global coord_t *keys, __global idx_t *balls, idx_t a, idx_t b)
+    {
+        coord_t key = keys[a];
+        keys[a] = keys[b];
+        keys[b] = key;
+
+        idx_t ball = balls[a];
+        balls[a] = balls[b];
+        balls[b] = ball;
+    }
+
+    inline void sift_down(
+        __global coord_t *keys, __global idx_t *balls, idx_t root, idx_t n)
+    {
+        while (true)
+        {
+            idx_t child = 2 * root + 1;
+            if (child >= n)
+                break;
+
+            if (child + 1 < n && ENTRY_LESS(child, child + 1))
+                ++child;
+
+            if (!ENTRY_LESS(root, child))
+                break;
+
+            swap_entries(keys, balls, root, child);
+            root = child;
+        }
+    }
+    """)
+
 # }}}
 
 
@@ -486,7 +942,8 @@ class AreaQueryElementwiseTemplate(object):
                 peer_lists.peer_lists) + tuple(tree.bounding_box[0]) + args
 
     def __init__(self, extra_args, ball_center_and_radius_expr,
-                 leaf_found_op, preamble="", name="area_query_elwise"):
+                 leaf_found_op, preamble="", name="area_query_elwise",
+                 query_done_op=""):
 
         def wrap_in_macro(decl, expr):
             return """
@@ -520,7 +977,8 @@ class AreaQueryElementwiseTemplate(object):
                 leaf_found_op)
             + TRAVERSAL_PREAMBLE_MAKO_DEFS
             + GUIDING_BOX_FINDER_MACRO
-            + AREA_QUERY_WALKER_BODY,
+            + AREA_QUERY_WALKER_BODY
+            + query_done_op,
             name=name,
             preamble=preamble)
 
@@ -575,16 +1033,24 @@ class AreaQueryElementwiseTemplate(object):
                 more_preamble=preamble + extra_preamble)
 
 
+# With several sets of radii, each ball is walked once with its largest
+# radius, and the leaves found are checked against the radius of each set.
+
 SPACE_INVADER_QUERY_TEMPLATE = AreaQueryElementwiseTemplate(
     extra_args="""
-    coord_t *ball_radii,
-    float *outer_space_invader_dists,
+    %for iset in range(nradius_sets):
+        coord_t *ball_radii_${iset},
+        float *outer_space_invader_dists_${iset},
+    %endfor
     %for ax in AXIS_NAMES[:dimensions]:
         coord_t *ball_${ax},
     %endfor
     """,
     ball_center_and_radius_expr=r"""
-    ${ball_radius} = ball_radii[${i}];
+    ${ball_radius} = ball_radii_0[${i}];
+    %for iset in range(1, nradius_sets):
+        ${ball_radius} = fmax(${ball_radius}, ball_radii_${iset}[${i}]);
+    %endfor
     %for ax in AXIS_NAMES[:dimensions]:
         ${ball_center}.${ax} = ball_${ax}[${i}];
     %endfor
@@ -599,45 +1065,245 @@ SPACE_INVADER_QUERY_TEMPLATE = AreaQueryElementwiseTemplate(
                 distance(${ball_center}.s${i}, leaf_center.s${i}));
         %endfor
 
+        %if nradius_sets > 1:
+            coord_t leaf_rad = LEVEL_TO_RAD(box_levels[${leaf_box_id}]);
+        %endif
+
         // The atomic max operation supports only integer types.
         // However, max_dist is of a floating point type.
         // For comparison purposes we reinterpret the bits of max_dist
         // as an integer. The comparison result is the same as for positive
         // IEEE floating point numbers, so long as the float/int endianness
         // matches (fingers crossed).
-        atomic_max(
-            (volatile __global int *)
-                &outer_space_invader_dists[${leaf_box_id}],
-            as_int((float) max_dist));
+        %for iset in range(nradius_sets):
+            %if nradius_sets > 1:
+            if (max_dist <= leaf_rad + ball_radii_${iset}[i])
+            %endif
+            atomic_max(
+                (volatile __global int *)
+                    &outer_space_invader_dists_${iset}[${leaf_box_id}],
+                as_int((float) max_dist));
+        %endfor
     }""",
     name="space_invader_query")
 
-# }}}
-
 
-# {{{ area query build
+AREA_QUERY_COUNT_TEMPLATE = AreaQueryElementwiseTemplate(
+    extra_args="""
+    coord_t *ball_radii,
+    %for ax in AXIS_NAMES[:dimensions]:
+        coord_t *ball_${ax},
+    %endfor
+    particle_id_t *box_source_counts_nonchild,
+    particle_id_t *box_target_counts_nonchild,
+    box_id_t *leaf_counts,
+    particle_id_t *source_counts,
+    particle_id_t *target_counts,
+    """,
+    ball_center_and_radius_expr=r"""
+    ${ball_radius} = ball_radii[${i}];
+    %for ax in AXIS_NAMES[:dimensions]:
+        ${ball_center}.${ax} = ball_${ax}[${i}];
+    %endfor
 
-class AreaQueryBuilder(object):
-    r"""Given a set of :math:`l^\infty` "balls", this class helps build a
-    look-up table from ball to leaf boxes that intersect with the ball.
+    box_id_t nleaves = 0;
+    particle_id_t nsources = 0;
+    particle_id_t ntargets = 0;
+    """,
+    leaf_found_op=r"""
+    {
+        %if norm == "l2":
+            bool is_overlapping_l2;
 
-    .. versionadded:: 2016.1
+            ${check_l2_ball_overlap(
+                "is_overlapping_l2", leaf_box_id, ball_radius, ball_center)}
+        %else:
+            bool is_overlapping_l2 = true;
+        %endif
 
-    .. automethod:: __call__
-    """
-    def __init__(self, context):
-        self.context = context
-        self.peer_list_finder = PeerListFinder(self.context)
+        if (is_overlapping_l2)
+        {
+            ++nleaves;
+            nsources += box_source_counts_nonchild[${leaf_box_id}];
+            ntargets += box_target_counts_nonchild[${leaf_box_id}];
+        }
+    }""",
+    query_done_op=r"""
+    leaf_counts[i] = nleaves;
+    source_counts[i] = nsources;
+    target_counts[i] = ntargets;
+    """,
+    name="area_query_count")
 
-    # {{{ Kernel generation
 
-    @memoize_method
-    def get_area_query_kernel(self, dimensions, coord_dtype, box_id_dtype,
-                              ball_id_dtype, peer_list_idx_dtype, max_levels):
-        from pyopencl.tools import dtype_to_ctype
-        from boxtree import box_flags_enum
+# The query ball of each point is chosen to contain the smallest box
+# around the point that has at least *nneighbors* sources. The leaves
+# overlapping it are then scanned while keeping the closest sources found
+# so far in a sorted private array.
 
-        logger.debug("start building area query kernel")
+K_NEAREST_NEIGHBOR_QUERY_TEMPLATE = AreaQueryElementwiseTemplate(
+    extra_args="""
+    %for ax in AXIS_NAMES[:dimensions]:
+        coord_t *point_${ax},
+    %endfor
+    particle_id_t *box_source_starts,
+    particle_id_t *box_source_counts_nonchild,
+    particle_id_t *box_source_counts_cumul,
+    %for ax in AXIS_NAMES[:dimensions]:
+        coord_t *source_${ax},
+    %endfor
+    particle_id_t *neighbor_lists,
+    coord_t *neighbor_distances,
+    """,
+    ball_center_and_radius_expr=r"""
+    %for ax in AXIS_NAMES[:dimensions]:
+        ${ball_center}.${ax} = point_${ax}[${i}];
+    %endfor
+
+    // sorted by increasing distance
+    coord_t knn_dists_sq[${nneighbors}];
+    particle_id_t knn_ids[${nneighbors}];
+    int knn_nfound = 0;
+
+    {
+        // Find the smallest box containing the point (or, if the point is
+        // outside the tree, its closest point in the tree) with at least
+        // nneighbors sources.
+        coord_vec_t bbox_min, bbox_max, query_point;
+
+        ${initialize_coord_vec(
+            "bbox_min", ["bbox_min_" + ax for ax in AXIS_NAMES[:dimensions]])}
+        bbox_max = bbox_min + (coord_t) (
+            root_extent / (1 + ${root_extent_stretch_factor}));
+        query_point = min(bbox_max, max(bbox_min, ${ball_center}));
+
+        coord_vec_t offset_scaled = (query_point - bbox_min) / root_extent;
+
+        box_id_t knn_box = 0;
+        for (unsigned box_level = 0;
+                box_flags[knn_box] & BOX_HAS_CHILDREN; ++box_level)
+        {
+            %for ax in AXIS_NAMES[:dimensions]:
+                unsigned ${ax}_bits = (unsigned) (
+                    offset_scaled.${ax} * (1U << (1 + box_level)));
+            %endfor
+
+            int level_morton_number = 0
+            %for iax, ax in enumerate(AXIS_NAMES[:dimensions]):
+                | (${ax}_bits & 1U) << (${dimensions-1-iax})
+            %endfor
+                ;
+
+            box_id_t child_box = box_child_ids[
+                level_morton_number * aligned_nboxes + knn_box];
+
+            if (!child_box
+                    || box_source_counts_cumul[child_box] < ${nneighbors})
+                break;
+
+            knn_box = child_box;
+        }
+
+        // The ball must contain all of the box.
+        ${load_center("knn_box_center", "knn_box")}
+        coord_t knn_box_rad = LEVEL_TO_RAD(box_levels[knn_box]);
+
+        coord_t radius_sq = 0;
+        %for i in range(dimensions):
+            radius_sq += square(
+                fabs(${ball_center}.s${i} - knn_box_center.s${i})
+                + knn_box_rad);
+        %endfor
+
+        ${ball_radius} = sqrt(radius_sq) * (1 + 8 * COORD_T_MACH_EPS);
+    }
+    """,
+    leaf_found_op=r"""
+    {
+        // Skip leaves that cannot contain any closer sources.
+        ${load_center("leaf_center", leaf_box_id)}
+        coord_t leaf_rad = LEVEL_TO_RAD(box_levels[${leaf_box_id}]);
+
+        coord_t leaf_dist_sq = 0;
+        %for i in range(dimensions):
+            leaf_dist_sq += square(fmax((coord_t) 0,
+                fabs(${ball_center}.s${i} - leaf_center.s${i}) - leaf_rad));
+        %endfor
+
+        if (knn_nfound < ${nneighbors}
+                || leaf_dist_sq < knn_dists_sq[${nneighbors} - 1])
+        {
+            particle_id_t start = box_source_starts[${leaf_box_id}];
+            particle_id_t stop =
+                start + box_source_counts_nonchild[${leaf_box_id}];
+
+            for (particle_id_t isrc = start; isrc < stop; ++isrc)
+            {
+                coord_t dist_sq = 0;
+                %for i, ax in enumerate(AXIS_NAMES[:dimensions]):
+                    dist_sq += square(${ball_center}.s${i} - source_${ax}[isrc]);
+                %endfor
+
+                if (knn_nfound == ${nneighbors}
+                        && dist_sq >= knn_dists_sq[${nneighbors} - 1])
+                    continue;
+
+                // insertion sort step
+                int j = (knn_nfound < ${nneighbors})
+                    ? knn_nfound++ : ${nneighbors} - 1;
+                for (; j > 0 && knn_dists_sq[j-1] > dist_sq; --j)
+                {
+                    knn_dists_sq[j] = knn_dists_sq[j-1];
+                    knn_ids[j] = knn_ids[j-1];
+                }
+                knn_dists_sq[j] = dist_sq;
+                knn_ids[j] = isrc;
+            }
+        }
+    }
+    """,
+    query_done_op=r"""
+    for (int j = 0; j < ${nneighbors}; ++j)
+    {
+        neighbor_lists[i * ${nneighbors} + j] = knn_ids[j];
+        neighbor_distances[i * ${nneighbors} + j] = sqrt(knn_dists_sq[j]);
+    }
+    """,
+    name="k_nearest_neighbor_query")
+
+# }}}
+
+
+# {{{ area query build
+
+class AreaQueryBuilder(object):
+    r"""Given a set of :math:`l^\infty` "balls", this class helps build a
+    look-up table from ball to leaf boxes that intersect with the ball.
+    Optionally, the balls may instead be taken to be :math:`l^2` balls,
+    in which case only leaves intersecting the actual sphere are returned.
+
+    .. versionadded:: 2016.1
+
+    .. automethod:: __call__
+
+    .. automethod:: iter_chunks
+
+    .. automethod:: count
+    """
+    def __init__(self, context):
+        self.context = context
+        self.peer_list_finder = PeerListFinder(self.context)
+
+    # {{{ Kernel generation
+
+    @memoize_method
+    def get_area_query_kernel(self, dimensions, coord_dtype, box_id_dtype,
+                              ball_id_dtype, peer_list_idx_dtype, max_levels,
+                              norm="linf"):
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree import box_flags_enum
+
+        logger.debug("start building area query kernel")
 
         from boxtree.traversal import TRAVERSAL_PREAMBLE_TEMPLATE
         from boxtree.tree_build import TreeBuilder
@@ -660,6 +1326,7 @@ class AreaQueryBuilder(object):
             box_flags_enum=box_flags_enum,
             peer_list_idx_dtype=peer_list_idx_dtype,
             ball_id_dtype=ball_id_dtype,
+            norm=norm,
             debug=False,
             root_extent_stretch_factor=TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR)
 
@@ -694,10 +1361,24 @@ class AreaQueryBuilder(object):
         logger.debug("done building area query kernel")
         return area_query_kernel
 
+    @memoize_method
+    def get_area_query_count_kernel(self, dimensions, coord_dtype,
+            box_id_dtype, particle_id_dtype, peer_list_idx_dtype, max_levels,
+            norm):
+        return AREA_QUERY_COUNT_TEMPLATE.generate(
+                self.context,
+                dimensions,
+                coord_dtype,
+                box_id_dtype,
+                peer_list_idx_dtype,
+                max_levels,
+                extra_var_values=(("norm", norm),),
+                extra_type_aliases=(("particle_id_t", particle_id_dtype),))
+
     # }}}
 
     def __call__(self, queue, tree, ball_centers, ball_radii, peer_lists=None,
-                 wait_for=None):
+                 wait_for=None, norm="linf"):
         """
         :arg queue: a :class:`pyopencl.CommandQueue`
         :arg tree: a :class:`boxtree.Tree`.
@@ -715,6 +1396,10 @@ class AreaQueryBuilder(object):
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             exeuction.
+        :arg norm: Either ``"linf"`` or ``"l2"``, the norm in which the balls
+            are taken.
+
+            .. versionadded:: 2019.1
         :returns: a tuple *(aq, event)*, where *aq* is an instance of
             :class:`AreaQueryResult`, and *event* is a :class:`pyopencl.Event`
             for dependency management.
@@ -728,6 +1413,9 @@ class AreaQueryBuilder(object):
 
         ball_id_dtype = tree.particle_id_dtype  # ?
 
+        if norm not in ["linf", "l2"]:
+            raise ValueError("unsupported norm: %s" % norm)
+
         from pytools import div_ceil
         # Avoid generating too many kernels.
         max_levels = div_ceil(tree.nlevels, 10) * 10
@@ -741,7 +1429,7 @@ class AreaQueryBuilder(object):
 
         area_query_kernel = self.get_area_query_kernel(tree.dimensions,
             tree.coord_dtype, tree.box_id_dtype, ball_id_dtype,
-            peer_lists.peer_list_starts.dtype, max_levels)
+            peer_lists.peer_list_starts.dtype, max_levels, norm)
 
         aq_plog = ProcessLogger(logger, "area query")
 
@@ -763,14 +1451,356 @@ class AreaQueryBuilder(object):
                 leaves_near_ball_starts=result["leaves"].starts,
                 leaves_near_ball_lists=result["leaves"].lists).with_queue(None), evt
 
+    def iter_chunks(self, queue, tree, ball_centers, ball_radii, chunk_size,
+            peer_lists=None, wait_for=None, norm="linf"):
+        """Perform the area query in chunks of *chunk_size* consecutive balls,
+        so that the memory needed at any one time is bounded by the size of
+        a chunk rather than the number of balls.
+
+        The peer lists are only built once (if not given), and are shared
+        by all chunks. The balls may be given on the host, in which case
+        each chunk is uploaded on a separate queue while the previous chunk
+        is being processed.
+
+        :arg ball_centers: an object array of coordinate arrays, either all
+            :class:`pyopencl.array.Array` or all :class:`numpy.ndarray`
+            instances.
+        :arg ball_radii: an array of the same kind as *ball_centers*.
+        :arg chunk_size: the number of balls per chunk.
+
+        See :meth:`__call__` for the remaining arguments.
+
+        :returns: a generator of tuples *(chunk, aq, event)*, where *chunk*
+            is a :class:`slice` of the balls processed, *aq* an instance of
+            :class:`AreaQueryResult` for these balls (indexed relative to
+            *chunk.start*), and *event* a :class:`pyopencl.Event` for
+            dependency management.
+
+        .. versionadded:: 2019.1
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+
+        if peer_lists is None:
+            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for)
+            wait_for = [evt]
+
+        wait_for = list(wait_for or [])
+
+        nballs = len(ball_radii)
+        chunks = [
+                slice(start, min(start + chunk_size, nballs))
+                for start in range(0, nballs, chunk_size)]
+
+        balls_on_host = not isinstance(ball_radii, cl.array.Array)
+        if balls_on_host:
+            upload_queue = cl.CommandQueue(queue.context, queue.device)
+
+        def upload(chunk):
+            if not balls_on_host:
+                return [bc[chunk] for bc in ball_centers], ball_radii[chunk], []
+
+            def to_device(ary):
+                result = cl.array.to_device(upload_queue,
+                        np.ascontiguousarray(ary[chunk]), async_=True)
+                return result.with_queue(queue)
+
+            return (
+                    [to_device(bc) for bc in ball_centers],
+                    to_device(ball_radii),
+                    [cl.enqueue_marker(upload_queue)])
+
+        next_chunk_data = upload(chunks[0]) if chunks else None
+
+        for ichunk, chunk in enumerate(chunks):
+            chunk_centers, chunk_radii, upload_wait_for = next_chunk_data
+
+            # Start uploading the next chunk before processing this one.
+            if ichunk + 1 < len(chunks):
+                next_chunk_data = upload(chunks[ichunk + 1])
+
+            aq, evt = self(queue, tree, chunk_centers, chunk_radii,
+                    peer_lists=peer_lists, wait_for=wait_for + upload_wait_for,
+                    norm=norm)
+
+            yield chunk, aq, evt
+
+    def count(self, queue, tree, ball_centers, ball_radii, peer_lists=None,
+            wait_for=None, norm="linf"):
+        """Only count the leaves that intersect each ball, and the particles
+        in them, without building the lists. This runs a single pass over
+        the balls, while :meth:`__call__` needs one pass to count and
+        one to write the lists.
+
+        See :meth:`__call__` for the arguments.
+
+        :returns: a tuple *(counts, event)*, where *counts* is an instance of
+            :class:`AreaQueryCounts`, and *event* is a :class:`pyopencl.Event`
+            for dependency management.
+
+        .. versionadded:: 2019.1
+        """
+
+        from pytools import single_valued
+        if single_valued(bc.dtype for bc in ball_centers) != tree.coord_dtype:
+            raise TypeError("ball_centers dtype must match tree.coord_dtype")
+        if ball_radii.dtype != tree.coord_dtype:
+            raise TypeError("ball_radii dtype must match tree.coord_dtype")
+
+        if norm not in ["linf", "l2"]:
+            raise ValueError("unsupported norm: %s" % norm)
+
+        from pytools import div_ceil
+        # Avoid generating too many kernels.
+        max_levels = div_ceil(tree.nlevels, 10) * 10
+
+        if peer_lists is None:
+            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for)
+            wait_for = [evt]
+
+        if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
+            raise ValueError("size of peer lists must match with number of boxes")
+
+        area_query_count_kernel = self.get_area_query_count_kernel(
+                tree.dimensions, tree.coord_dtype, tree.box_id_dtype,
+                tree.particle_id_dtype, peer_lists.peer_list_starts.dtype,
+                max_levels, norm)
+
+        aqc_plog = ProcessLogger(logger, "area query (counts only)")
+
+        nballs = len(ball_radii)
+        leaf_counts = cl.array.empty(queue, nballs, tree.box_id_dtype)
+        source_counts = cl.array.empty(queue, nballs, tree.particle_id_dtype)
+        target_counts = cl.array.empty(queue, nballs, tree.particle_id_dtype)
+
+        evt = area_query_count_kernel(
+                *AREA_QUERY_COUNT_TEMPLATE.unwrap_args(
+                    tree, peer_lists,
+                    *((ball_radii,)
+                        + tuple(ball_centers)
+                        + (tree.box_source_counts_nonchild,
+                            tree.box_target_counts_nonchild,
+                            leaf_counts, source_counts, target_counts))),
+                range=slice(nballs),
+                queue=queue,
+                wait_for=wait_for)
+
+        aqc_plog.done()
+
+        return AreaQueryCounts(
+                tree=tree,
+                leaf_counts=leaf_counts,
+                source_counts=source_counts,
+                target_counts=target_counts).with_queue(None), evt
+
+# }}}
+
+
+# {{{ range query build
+
+class RangeQueryBuilder(object):
+    r"""Given a set of axis-aligned boxes ("ranges"), each given by its
+    minimum and maximum corner, this class helps build a look-up table from
+    ranges to the leaf boxes that intersect them, and, optionally, to the
+    sources contained in them. This uses the same peer-list-accelerated
+    walk as :class:`AreaQueryBuilder`.
+
+    .. versionadded:: 2019.1
+
+    .. automethod:: __call__
+    """
+    def __init__(self, context):
+        self.context = context
+        self.peer_list_finder = PeerListFinder(self.context)
+
+    # {{{ Kernel generation
+
+    @memoize_method
+    def get_range_query_kernel(self, dimensions, coord_dtype, box_id_dtype,
+            particle_id_dtype, peer_list_idx_dtype, max_levels,
+            return_sources, source_order):
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree import box_flags_enum
+
+        logger.debug("start building range query kernel")
+
+        from boxtree.traversal import TRAVERSAL_PREAMBLE_TEMPLATE
+        from boxtree.tree_build import TreeBuilder
+
+        template = Template(
+            TRAVERSAL_PREAMBLE_TEMPLATE
+            + RANGE_QUERY_TEMPLATE,
+            strict_undefined=True)
+
+        render_vars = dict(
+            np=np,
+            dimensions=dimensions,
+            dtype_to_ctype=dtype_to_ctype,
+            box_id_dtype=box_id_dtype,
+            particle_id_dtype=particle_id_dtype,
+            coord_dtype=coord_dtype,
+            vec_types=cl.cltypes.vec_types,
+            max_levels=max_levels,
+            AXIS_NAMES=AXIS_NAMES,
+            box_flags_enum=box_flags_enum,
+            peer_list_idx_dtype=peer_list_idx_dtype,
+            ball_id_dtype=particle_id_dtype,
+            return_sources=return_sources,
+            source_order=source_order,
+            debug=False,
+            root_extent_stretch_factor=TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR)
+
+        from boxtree.tools import VectorArg, ScalarArg
+        arg_decls = [
+            VectorArg(coord_dtype, "box_centers", with_offset=False),
+            ScalarArg(coord_dtype, "root_extent"),
+            VectorArg(np.uint8, "box_levels"),
+            ScalarArg(box_id_dtype, "aligned_nboxes"),
+            VectorArg(box_id_dtype, "box_child_ids", with_offset=False),
+            VectorArg(box_flags_enum.dtype, "box_flags"),
+            VectorArg(peer_list_idx_dtype, "peer_list_starts"),
+            VectorArg(box_id_dtype, "peer_lists"),
+            VectorArg(particle_id_dtype, "box_source_starts"),
+            VectorArg(particle_id_dtype, "box_source_counts_nonchild"),
+            VectorArg(particle_id_dtype, "user_source_ids"),
+            ] + [
+            ScalarArg(coord_dtype, "bbox_min_"+ax)
+            for ax in AXIS_NAMES[:dimensions]
+            ] + [
+            VectorArg(coord_dtype, "range_min_"+ax)
+            for ax in AXIS_NAMES[:dimensions]
+            ] + [
+            VectorArg(coord_dtype, "range_max_"+ax)
+            for ax in AXIS_NAMES[:dimensions]
+            ] + [
+            VectorArg(coord_dtype, "source_"+ax)
+            for ax in AXIS_NAMES[:dimensions]]
+
+        list_names_and_dtypes = [("leaves", box_id_dtype)]
+        if return_sources:
+            list_names_and_dtypes.append(("sources", particle_id_dtype))
+
+        from pyopencl.algorithm import ListOfListsBuilder
+        range_query_kernel = ListOfListsBuilder(
+            self.context,
+            list_names_and_dtypes,
+            str(template.render(**render_vars)),
+            arg_decls=arg_decls,
+            name_prefix="range_query",
+            count_sharing={},
+            complex_kernel=True)
+
+        logger.debug("done building range query kernel")
+        return range_query_kernel
+
+    # }}}
+
+    def __call__(self, queue, tree, range_mins, range_maxs,
+            return_sources=False, source_order="user", peer_lists=None,
+            wait_for=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree`.
+        :arg range_mins: an object array of coordinate
+            :class:`pyopencl.array.Array` instances, the minimum corners
+            of the ranges.
+            Their *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg range_maxs: the maximum corners of the ranges, in the same
+            format as *range_mins*. Each entry must be at least the
+            corresponding entry of *range_mins*.
+        :arg return_sources: if *True*, also find the sources contained in
+            each range (including its boundary). Not supported if the
+            sources of *tree* have extent.
+        :arg source_order: Either ``"user"`` or ``"tree"``, the order in
+            which source indices are returned.
+        :arg peer_lists: may either be *None* or an instance of
+            :class:`PeerListLookup` associated with `tree`.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :returns: a tuple *(rq, event)*, where *rq* is an instance of
+            :class:`RangeQueryResult`, and *event* is a :class:`pyopencl.Event`
+            for dependency management.
+        """
+
+        from pytools import single_valued
+        if single_valued(
+                ary.dtype for ary in tuple(range_mins) + tuple(range_maxs)) \
+                        != tree.coord_dtype:
+            raise TypeError("range_mins and range_maxs dtype must match "
+                    "tree.coord_dtype")
+
+        if return_sources and tree.sources_have_extent:
+            raise NotImplementedError(
+                    "range queries for sources with extent")
+
+        if source_order not in ["user", "tree"]:
+            raise ValueError("unknown source_order: %s" % source_order)
+
+        from pytools import div_ceil
+        # Avoid generating too many kernels.
+        max_levels = div_ceil(tree.nlevels, 10) * 10
+
+        if peer_lists is None:
+            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for)
+            wait_for = [evt]
+
+        if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
+            raise ValueError("size of peer lists must match with number of boxes")
+
+        return_sources = bool(return_sources)
+        range_query_kernel = self.get_range_query_kernel(tree.dimensions,
+            tree.coord_dtype, tree.box_id_dtype, tree.particle_id_dtype,
+            peer_lists.peer_list_starts.dtype, max_levels,
+            return_sources, source_order if return_sources else None)
+
+        rq_plog = ProcessLogger(logger, "range query")
+
+        result, evt = range_query_kernel(
+                queue, len(range_mins[0]),
+                tree.box_centers.data, tree.root_extent,
+                tree.box_levels, tree.aligned_nboxes,
+                tree.box_child_ids.data, tree.box_flags,
+                peer_lists.peer_list_starts,
+                peer_lists.peer_lists,
+                tree.box_source_starts,
+                tree.box_source_counts_nonchild,
+                tree.user_source_ids,
+                *(tuple(tree.bounding_box[0])
+                    + tuple(range_mins)
+                    + tuple(range_maxs)
+                    + tuple(tree.sources)),
+                wait_for=wait_for)
+
+        rq_plog.done()
+
+        if return_sources:
+            sources_in_range_starts = result["sources"].starts
+            sources_in_range_lists = result["sources"].lists
+        else:
+            source_order = None
+            sources_in_range_starts = None
+            sources_in_range_lists = None
+
+        return RangeQueryResult(
+                tree=tree,
+                leaves_in_range_starts=result["leaves"].starts,
+                leaves_in_range_lists=result["leaves"].lists,
+                source_order=source_order,
+                sources_in_range_starts=sources_in_range_starts,
+                sources_in_range_lists=sources_in_range_lists
+                ).with_queue(None), evt
+
 # }}}
 
 
 # {{{ area query transpose (leaves-to-balls) lookup build
 
 class LeavesToBallsLookupBuilder(object):
-    r"""Given a set of :math:`l^\infty` "balls", this class helps build a
-    look-up table from leaf boxes to balls that overlap with each leaf box.
+    r"""Given a set of :math:`l^\infty` (or, optionally, :math:`l^2`)
+    "balls", this class helps build a look-up table from leaf boxes to balls
+    that overlap with each leaf box.
 
     .. automethod:: __call__
 
@@ -782,6 +1812,21 @@ class LeavesToBallsLookupBuilder(object):
         self.key_value_sorter = KeyValueSorter(context)
         self.area_query_builder = AreaQueryBuilder(context)
 
+    @memoize_method
+    def get_leaf_ball_list_distance_sorter_kernel(self, dimensions,
+            coord_dtype, box_id_dtype, idx_dtype):
+        return LEAF_BALL_LIST_DISTANCE_SORTER_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("coord_t", coord_dtype),
+                    ("box_id_t", box_id_dtype),
+                    ("idx_t", idx_dtype),
+                    ),
+                var_values=(
+                    ("dimensions", dimensions),
+                    ("AXIS_NAMES", AXIS_NAMES),
+                    ))
+
     @memoize_method
     def get_starts_expander_kernel(self, idx_dtype):
         """
@@ -796,7 +1841,7 @@ class LeavesToBallsLookupBuilder(object):
                 type_aliases=(("idx_t", idx_dtype),))
 
     def __call__(self, queue, tree, ball_centers, ball_radii, peer_lists=None,
-                 wait_for=None):
+                 wait_for=None, norm="linf", sort_by=None):
         """
         :arg queue: a :class:`pyopencl.CommandQueue`
         :arg tree: a :class:`boxtree.Tree`.
@@ -814,6 +1859,16 @@ class LeavesToBallsLookupBuilder(object):
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             execution.
+        :arg norm: Either ``"linf"`` or ``"l2"``, the norm in which the balls
+            are taken.
+
+            .. versionadded:: 2019.1
+        :arg sort_by: If *None*, the balls in each leaf's list are sorted by
+            increasing ball number. If ``"distance"``, they are sorted by
+            increasing :math:`l^2` distance between the ball center and the
+            leaf center, with ties broken by ball number.
+
+            .. versionadded:: 2019.1
         :returns: a tuple *(lbl, event)*, where *lbl* is an instance of
             :class:`LeavesToBallsLookup`, and *event* is a :class:`pyopencl.Event`
             for dependency management.
@@ -824,11 +1879,14 @@ class LeavesToBallsLookupBuilder(object):
             raise TypeError("ball_centers dtype must match tree.coord_dtype")
         if ball_radii.dtype != tree.coord_dtype:
             raise TypeError("ball_radii dtype must match tree.coord_dtype")
+        if sort_by not in [None, "distance"]:
+            raise ValueError("unknown sort_by: %s" % sort_by)
 
         ltb_plog = ProcessLogger(logger, "leaves-to-balls lookup: run area query")
 
         area_query, evt = self.area_query_builder(
-                queue, tree, ball_centers, ball_radii, peer_lists, wait_for)
+                queue, tree, ball_centers, ball_radii, peer_lists, wait_for,
+                norm=norm)
         wait_for = [evt]
 
         logger.debug("leaves-to-balls lookup: expand starts")
@@ -843,6 +1901,11 @@ class LeavesToBallsLookupBuilder(object):
         #    This is done in the "starts expander kernel."
         #
         # 2. Key-value sort the (ball number, box number) pairs by box number.
+        #
+        # The pairs are generated in order of ball number, and the key-value
+        # sort is stable, so each box's list ends up sorted by ball number.
+        # To sort by distance instead, each box's list is then sorted on its
+        # own.
 
         starts_expander_knl = self.get_starts_expander_kernel(tree.box_id_dtype)
         expanded_starts = cl.array.empty(
@@ -853,18 +1916,41 @@ class LeavesToBallsLookupBuilder(object):
                 nballs_p_1)
         wait_for = [evt]
 
+        leaves_near_ball_lists = area_query.leaves_near_ball_lists.with_queue(
+                queue)
+
         logger.debug("leaves-to-balls lookup: key-value sort")
 
         balls_near_box_starts, balls_near_box_lists, evt \
                 = self.key_value_sorter(
                         queue,
                         # keys
-                        area_query.leaves_near_ball_lists.with_queue(queue),
+                        leaves_near_ball_lists,
                         # values
                         expanded_starts,
                         nkeys, starts_dtype=tree.box_id_dtype,
                         wait_for=wait_for)
 
+        if sort_by == "distance":
+            logger.debug("leaves-to-balls lookup: sort lists by distance")
+
+            sorter_knl = self.get_leaf_ball_list_distance_sorter_kernel(
+                    tree.dimensions, tree.coord_dtype, tree.box_id_dtype,
+                    balls_near_box_lists.dtype)
+
+            dist_squared = cl.array.empty(
+                    queue, len(balls_near_box_lists), tree.coord_dtype)
+
+            evt = sorter_knl(
+                    tree.box_centers,
+                    tree.aligned_nboxes,
+                    balls_near_box_starts,
+                    balls_near_box_lists,
+                    *(tuple(ball_centers) + (dist_squared,)),
+                    range=slice(tree.nboxes),
+                    queue=queue,
+                    wait_for=[evt])
+
         ltb_plog.done()
 
         return LeavesToBallsLookup(
@@ -906,14 +1992,16 @@ class SpaceInvaderQueryBuilder(object):
 
     @memoize_method
     def get_space_invader_query_kernel(self, dimensions, coord_dtype,
-                box_id_dtype, peer_list_idx_dtype, max_levels):
+                box_id_dtype, peer_list_idx_dtype, max_levels,
+                nradius_sets=1):
         return SPACE_INVADER_QUERY_TEMPLATE.generate(
                 self.context,
                 dimensions,
                 coord_dtype,
                 box_id_dtype,
                 peer_list_idx_dtype,
-                max_levels)
+                max_levels,
+                extra_var_values=(("nradius_sets", nradius_sets),))
 
     # }}}
 
@@ -931,6 +2019,9 @@ class SpaceInvaderQueryBuilder(object):
             of positive numbers.
             Its *dtype* must match *tree*'s
             :attr:`boxtree.Tree.coord_dtype`.
+            It may also have shape *(nsets, nballs)*, holding several sets of
+            radii for the same balls. The outer space invader distances for
+            all sets are then found in a single walk over the tree.
         :arg peer_lists: may either be *None* or an instance of
             :class:`PeerListLookup` associated with `tree`.
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
@@ -947,6 +2038,14 @@ class SpaceInvaderQueryBuilder(object):
             * if *i* is not the index of a leaf box, *sqi[i] = 0*.
             * if *i* is the index of a leaf box, *sqi[i]* is the
               outer space invader distance for *i*.
+
+            If *ball_radii* has shape *(nsets, nballs)*, *sqi* has shape
+            *(nsets, tree.nboxes)*, and *sqi[k]* holds the distances for the
+            radii *ball_radii[k]*.
+
+        .. versionchanged:: 2019.1
+
+            Added support for several sets of radii.
         """
 
         from pytools import single_valued
@@ -955,6 +2054,17 @@ class SpaceInvaderQueryBuilder(object):
         if ball_radii.dtype != tree.coord_dtype:
             raise TypeError("ball_radii dtype must match tree.coord_dtype")
 
+        if ball_radii.ndim == 1:
+            ball_radii_sets = [ball_radii]
+        elif ball_radii.ndim == 2:
+            ball_radii_sets = [ball_radii[iset]
+                    for iset in range(ball_radii.shape[0])]
+        else:
+            raise ValueError("ball_radii must be one- or two-dimensional")
+
+        nradius_sets = len(ball_radii_sets)
+        nballs = ball_radii.shape[-1]
+
         from pytools import div_ceil
         # Avoid generating too many kernels.
         max_levels = div_ceil(tree.nlevels, 10) * 10
@@ -968,11 +2078,18 @@ class SpaceInvaderQueryBuilder(object):
 
         space_invader_query_kernel = self.get_space_invader_query_kernel(
             tree.dimensions, tree.coord_dtype, tree.box_id_dtype,
-            peer_lists.peer_list_starts.dtype, max_levels)
+            peer_lists.peer_list_starts.dtype, max_levels, nradius_sets)
 
         si_plog = ProcessLogger(logger, "space invader query")
 
-        outer_space_invader_dists = cl.array.zeros(queue, tree.nboxes, np.float32)
+        outer_space_invader_dists = cl.array.zeros(
+                queue, ball_radii.shape[:-1] + (tree.nboxes,), np.float32)
+        if ball_radii.ndim == 1:
+            outer_space_invader_dists_sets = [outer_space_invader_dists]
+        else:
+            outer_space_invader_dists_sets = [outer_space_invader_dists[iset]
+                    for iset in range(nradius_sets)]
+
         if not wait_for:
             wait_for = []
         wait_for = (wait_for
@@ -980,15 +2097,18 @@ class SpaceInvaderQueryBuilder(object):
                 + ball_radii.events
                 + [evt for bc in ball_centers for evt in bc.events])
 
+        radii_and_dists = []
+        for radii, dists in zip(ball_radii_sets, outer_space_invader_dists_sets):
+            radii_and_dists.extend([radii, dists])
+
         evt = space_invader_query_kernel(
                 *SPACE_INVADER_QUERY_TEMPLATE.unwrap_args(
                     tree, peer_lists,
-                    ball_radii,
-                    outer_space_invader_dists,
-                    *tuple(bc for bc in ball_centers)),
+                    *(tuple(radii_and_dists)
+                        + tuple(bc for bc in ball_centers))),
                 wait_for=wait_for,
                 queue=queue,
-                range=slice(len(ball_radii)))
+                range=slice(nballs))
 
         if tree.coord_dtype != np.dtype(np.float32):
             # The kernel output is always an array of float32 due to limited
@@ -1006,6 +2126,409 @@ class SpaceInvaderQueryBuilder(object):
 # }}}
 
 
+# {{{ k-nearest-neighbor query build
+
+class KNearestNeighborQueryBuilder(object):
+    r"""Given a set of points, this class helps find the sources of a tree
+    that are closest to each point in the :math:`l^2` sense.
+
+    .. versionadded:: 2019.1
+
+    .. automethod:: __call__
+    """
+    def __init__(self, context):
+        self.context = context
+        self.peer_list_finder = PeerListFinder(self.context)
+
+    # {{{ Kernel generation
+
+    @memoize_method
+    def get_k_nearest_neighbor_query_kernel(self, dimensions, coord_dtype,
+            box_id_dtype, particle_id_dtype, peer_list_idx_dtype, max_levels,
+            nneighbors):
+        return K_NEAREST_NEIGHBOR_QUERY_TEMPLATE.generate(
+                self.context,
+                dimensions,
+                coord_dtype,
+                box_id_dtype,
+                peer_list_idx_dtype,
+                max_levels,
+                extra_var_values=(("nneighbors", nneighbors),),
+                extra_type_aliases=(("particle_id_t", particle_id_dtype),))
+
+    # }}}
+
+    def __call__(self, queue, tree, points, nneighbors, source_order="user",
+            peer_lists=None, wait_for=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree` whose sources do not have extent.
+        :arg points: an object array of coordinate
+            :class:`pyopencl.array.Array` instances.
+            Their *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg nneighbors: the number of sources to find for each point. Since
+            these are kept in private memory during the search, this should
+            be moderate (up to about 64). If *tree* has fewer sources, all
+            of them are found, so that the lists are empty if it has none.
+        :arg source_order: Either ``"user"`` or ``"tree"``, the order in
+            which source indices are returned.
+        :arg peer_lists: may either be *None* or an instance of
+            :class:`PeerListLookup` associated with `tree`.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :returns: a tuple *(knn, event)*, where *knn* is an instance of
+            :class:`KNearestNeighborQueryResult`, and *event* is a
+            :class:`pyopencl.Event` for dependency management.
+        """
+
+        from pytools import single_valued
+        if single_valued(pt.dtype for pt in points) != tree.coord_dtype:
+            raise TypeError("points dtype must match tree.coord_dtype")
+
+        if tree.sources_have_extent:
+            raise NotImplementedError(
+                    "nearest neighbor queries for sources with extent")
+
+        if nneighbors <= 0:
+            raise ValueError("nneighbors must be positive")
+
+        if source_order not in ["user", "tree"]:
+            raise ValueError("unknown source_order: %s" % source_order)
+
+        nneighbors = min(nneighbors, tree.nsources)
+        npoints = len(points[0])
+
+        if nneighbors == 0:
+            # Without sources, all neighbor lists are empty.
+            return KNearestNeighborQueryResult(
+                    tree=tree,
+                    nneighbors=0,
+                    source_order=source_order,
+                    neighbor_starts=cl.array.zeros(
+                        queue, npoints + 1, tree.particle_id_dtype),
+                    neighbor_lists=cl.array.empty(
+                        queue, 0, tree.particle_id_dtype),
+                    neighbor_distances=cl.array.empty(
+                        queue, 0, tree.coord_dtype),
+                    ).with_queue(None), \
+                            cl.enqueue_marker(queue, wait_for=wait_for)
+
+        from pytools import div_ceil
+        # Avoid generating too many kernels.
+        max_levels = div_ceil(tree.nlevels, 10) * 10
+
+        if peer_lists is None:
+            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for)
+            wait_for = [evt]
+
+        if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
+            raise ValueError("size of peer lists must match with number of boxes")
+
+        knn_kernel = self.get_k_nearest_neighbor_query_kernel(
+                tree.dimensions, tree.coord_dtype, tree.box_id_dtype,
+                tree.particle_id_dtype, peer_lists.peer_list_starts.dtype,
+                max_levels, nneighbors)
+
+        knn_plog = ProcessLogger(logger, "k-nearest-neighbor query")
+
+        neighbor_lists = cl.array.empty(
+                queue, npoints * nneighbors, tree.particle_id_dtype)
+        neighbor_distances = cl.array.empty(
+                queue, npoints * nneighbors, tree.coord_dtype)
+
+        evt = knn_kernel(
+                *K_NEAREST_NEIGHBOR_QUERY_TEMPLATE.unwrap_args(
+                    tree, peer_lists,
+                    *(tuple(points)
+                        + (tree.box_source_starts,
+                            tree.box_source_counts_nonchild,
+                            tree.box_source_counts_cumul)
+                        + tuple(tree.sources)
+                        + (neighbor_lists, neighbor_distances))),
+                range=slice(npoints),
+                queue=queue,
+                wait_for=wait_for)
+
+        if source_order == "user":
+            neighbor_lists = cl.array.take(
+                    tree.user_source_ids.with_queue(queue), neighbor_lists,
+                    queue=queue, wait_for=[evt])
+            evt = cl.enqueue_marker(queue, wait_for=neighbor_lists.events)
+
+        neighbor_starts = cl.array.arange(
+                queue, 0, (npoints + 1) * nneighbors, nneighbors,
+                dtype=tree.particle_id_dtype)
+
+        knn_plog.done()
+
+        return KNearestNeighborQueryResult(
+                tree=tree,
+                nneighbors=nneighbors,
+                source_order=source_order,
+                neighbor_starts=neighbor_starts,
+                neighbor_lists=neighbor_lists,
+                neighbor_distances=neighbor_distances).with_queue(None), evt
+
+# }}}
+
+
+# {{{ radius neighbor query build
+
+class RadiusNeighborQueryBuilder(object):
+    r"""Given a radius, this class finds, for each source of a tree, all
+    other sources within that :math:`l^2` distance. The candidate leaves are
+    found by an area query, and the distances are checked on the device
+    while walking them, so that only particle-level neighbors are stored.
+
+    .. versionadded:: 2019.1
+
+    .. automethod:: __call__
+    """
+    def __init__(self, context):
+        self.context = context
+        self.peer_list_finder = PeerListFinder(self.context)
+
+    # {{{ Kernel generation
+
+    @memoize_method
+    def get_radius_neighbor_query_kernel(self, dimensions, coord_dtype,
+            box_id_dtype, particle_id_dtype, peer_list_idx_dtype, max_levels,
+            source_order, half_list):
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree import box_flags_enum
+
+        logger.debug("start building radius neighbor query kernel")
+
+        from boxtree.traversal import TRAVERSAL_PREAMBLE_TEMPLATE
+        from boxtree.tree_build import TreeBuilder
+
+        template = Template(
+            TRAVERSAL_PREAMBLE_TEMPLATE
+            + RADIUS_NEIGHBOR_QUERY_TEMPLATE,
+            strict_undefined=True)
+
+        render_vars = dict(
+            np=np,
+            dimensions=dimensions,
+            dtype_to_ctype=dtype_to_ctype,
+            box_id_dtype=box_id_dtype,
+            particle_id_dtype=particle_id_dtype,
+            coord_dtype=coord_dtype,
+            vec_types=cl.cltypes.vec_types,
+            max_levels=max_levels,
+            AXIS_NAMES=AXIS_NAMES,
+            box_flags_enum=box_flags_enum,
+            peer_list_idx_dtype=peer_list_idx_dtype,
+            source_order=source_order,
+            half_list=half_list,
+            debug=False,
+            root_extent_stretch_factor=TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR)
+
+        from boxtree.tools import VectorArg, ScalarArg
+        arg_decls = [
+            VectorArg(coord_dtype, "box_centers", with_offset=False),
+            ScalarArg(coord_dtype, "root_extent"),
+            VectorArg(np.uint8, "box_levels"),
+            ScalarArg(box_id_dtype, "aligned_nboxes"),
+            VectorArg(box_id_dtype, "box_child_ids", with_offset=False),
+            VectorArg(box_flags_enum.dtype, "box_flags"),
+            VectorArg(peer_list_idx_dtype, "peer_list_starts"),
+            VectorArg(box_id_dtype, "peer_lists"),
+            VectorArg(particle_id_dtype, "box_source_starts"),
+            VectorArg(particle_id_dtype, "box_source_counts_nonchild"),
+            VectorArg(particle_id_dtype, "user_source_ids"),
+            VectorArg(particle_id_dtype, "tree_source_ids"),
+            ScalarArg(coord_dtype, "radius"),
+            ] + [
+            ScalarArg(coord_dtype, "bbox_min_"+ax)
+            for ax in AXIS_NAMES[:dimensions]
+            ] + [
+            VectorArg(coord_dtype, "source_"+ax)
+            for ax in AXIS_NAMES[:dimensions]]
+
+        from pyopencl.algorithm import ListOfListsBuilder
+        radius_neighbor_query_kernel = ListOfListsBuilder(
+            self.context,
+            [("neighbors", particle_id_dtype)],
+            str(template.render(**render_vars)),
+            arg_decls=arg_decls,
+            name_prefix="radius_neighbor_query",
+            count_sharing={},
+            complex_kernel=True)
+
+        logger.debug("done building radius neighbor query kernel")
+        return radius_neighbor_query_kernel
+
+    # }}}
+
+    def __call__(self, queue, tree, radius, half_list=False,
+            source_order="user", peer_lists=None, wait_for=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree` whose sources do not have extent.
+        :arg radius: a positive number, the :math:`l^2` distance up to
+            which (inclusively) sources are considered neighbors.
+        :arg half_list: if *True*, only store each pair of neighbors once,
+            in the list of the source with the smaller index.
+        :arg source_order: Either ``"user"`` or ``"tree"``, the order in
+            which sources are numbered in the result.
+        :arg peer_lists: may either be *None* or an instance of
+            :class:`PeerListLookup` associated with `tree`.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :returns: a tuple *(rnn, event)*, where *rnn* is an instance of
+            :class:`RadiusNeighborQueryResult`, and *event* is a
+            :class:`pyopencl.Event` for dependency management.
+        """
+
+        if tree.sources_have_extent:
+            raise NotImplementedError(
+                    "radius neighbor queries for sources with extent")
+
+        if radius <= 0:
+            raise ValueError("radius must be positive")
+
+        if source_order not in ["user", "tree"]:
+            raise ValueError("unknown source_order: %s" % source_order)
+
+        from pytools import div_ceil
+        # Avoid generating too many kernels.
+        max_levels = div_ceil(tree.nlevels, 10) * 10
+
+        if peer_lists is None:
+            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for)
+            wait_for = [evt]
+
+        if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
+            raise ValueError("size of peer lists must match with number of boxes")
+
+        radius_neighbor_query_kernel = self.get_radius_neighbor_query_kernel(
+                tree.dimensions, tree.coord_dtype, tree.box_id_dtype,
+                tree.particle_id_dtype, peer_lists.peer_list_starts.dtype,
+                max_levels, source_order, bool(half_list))
+
+        rnn_plog = ProcessLogger(logger, "radius neighbor query")
+
+        user_source_ids = tree.user_source_ids.with_queue(queue)
+        if source_order == "user":
+            from boxtree.tools import reverse_index_array
+            tree_source_ids = reverse_index_array(user_source_ids)
+        else:
+            # unused
+            tree_source_ids = user_source_ids
+
+        result, evt = radius_neighbor_query_kernel(
+                queue, tree.nsources,
+                tree.box_centers.data, tree.root_extent,
+                tree.box_levels, tree.aligned_nboxes,
+                tree.box_child_ids.data, tree.box_flags,
+                peer_lists.peer_list_starts,
+                peer_lists.peer_lists,
+                tree.box_source_starts,
+                tree.box_source_counts_nonchild,
+                user_source_ids,
+                tree_source_ids,
+                radius,
+                *(tuple(tree.bounding_box[0])
+                    + tuple(tree.sources)),
+                wait_for=wait_for)
+
+        rnn_plog.done()
+
+        return RadiusNeighborQueryResult(
+                tree=tree,
+                radius=radius,
+                half_list=bool(half_list),
+                source_order=source_order,
+                neighbor_starts=result["neighbors"].starts,
+                neighbor_lists=result["neighbors"].lists).with_queue(None), evt
+
+# }}}
+
+
+# {{{ leaf box finder
+
+class LeafBoxFinder(object):
+    """Given a set of points, this class finds the box of a tree that
+    contains each point by descending through
+    :attr:`boxtree.Tree.box_child_ids` from the root. The points need not
+    be particles of the tree, so that, e.g., local expansions may be
+    evaluated at new points without rebuilding the tree.
+
+    .. versionadded:: 2019.1
+
+    .. automethod:: __call__
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    @memoize_method
+    def get_leaf_box_finder_kernel(self, dimensions, coord_dtype, box_id_dtype):
+        return LEAF_BOX_FINDER_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("coord_t", coord_dtype),
+                    ("box_id_t", box_id_dtype),
+                    ),
+                var_values=(
+                    ("dimensions", dimensions),
+                    ("AXIS_NAMES", AXIS_NAMES),
+                    ))
+
+    def __call__(self, queue, tree, points, wait_for=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree`.
+        :arg points: an object array of coordinate
+            :class:`pyopencl.array.Array` instances.
+            Their *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :returns: a tuple *(box_ids, event)*, where *box_ids* is a
+            :class:`pyopencl.array.Array` of :attr:`boxtree.Tree.box_id_dtype`
+            containing, for each point, the deepest box of *tree* that
+            contains it. This is a leaf box unless the point lies in a part
+            of a box that was pruned for having no particles. Points outside
+            the root box get a box id of ``-1``. *event* is a
+            :class:`pyopencl.Event` for dependency management.
+        """
+
+        from pytools import single_valued
+        if single_valued(pt.dtype for pt in points) != tree.coord_dtype:
+            raise TypeError("points dtype must match tree.coord_dtype")
+
+        if len(points) != tree.dimensions:
+            raise ValueError("points must have as many coordinates as "
+                    "the tree has dimensions")
+
+        leaf_box_finder_kernel = self.get_leaf_box_finder_kernel(
+                tree.dimensions, tree.coord_dtype, tree.box_id_dtype)
+
+        npoints = len(points[0])
+        box_ids = cl.array.empty(queue, npoints, tree.box_id_dtype)
+
+        evt = leaf_box_finder_kernel(
+                tree.root_extent,
+                tree.aligned_nboxes,
+                tree.box_child_ids,
+                *(tuple(tree.bounding_box[0])
+                    + tuple(points)
+                    + (box_ids,)),
+                range=slice(npoints),
+                queue=queue,
+                wait_for=wait_for)
+
+        return box_ids.with_queue(None), evt
+
+# }}}
+
+
 # {{{ peer list build
 
 
@@ -1026,14 +2549,39 @@ class PeerListFinder(object):
     .. [1] Rachh, Manas, Andreas Klöckner, and Michael O'Neil. "Fast
        algorithms for Quadrature by Expansion I: Globally valid expansions."
 
+    Peer lists only depend on the tree, so each instance of this class
+    remembers the ones it built for as long as their :class:`boxtree.Tree`
+    object is alive, without keeping the tree alive. Copies of the tree do
+    not share them. If the arrays of a tree are modified in place, a new
+    instance of this class must be used to find its peer lists.
+
     .. versionadded:: 2016.1
 
+    .. versionchanged:: 2019.1
+
+        Peer lists are cached per tree.
+
     .. automethod:: __call__
     """
 
     def __init__(self, context):
         self.context = context
 
+        # id(tree) -> (weakref(tree), peer_list_starts, peer_lists, event).
+        # Trees are not hashable, so they cannot be used as keys directly.
+        self._peer_list_cache = {}
+
+    def _remember_peer_lists(self, tree, peer_list_starts, peer_lists, evt):
+        tree_id = id(tree)
+
+        def forget(ref):
+            entry = self._peer_list_cache.get(tree_id)
+            if entry is not None and entry[0] is ref:
+                del self._peer_list_cache[tree_id]
+
+        self._peer_list_cache[tree_id] = (
+                weakref.ref(tree, forget), peer_list_starts, peer_lists, evt)
+
     # {{{ Kernel generation
 
     @memoize_method
@@ -1105,6 +2653,17 @@ class PeerListFinder(object):
             :class:`PeerListLookup`, and *event* is a :class:`pyopencl.Event`
             for dependency management.
         """
+        cached = self._peer_list_cache.get(id(tree))
+        if cached is not None and cached[0]() is tree:
+            _, peer_list_starts, peer_lists, build_evt = cached
+            logger.debug("find peer lists: cache hit")
+
+            return PeerListLookup(
+                    tree=tree,
+                    peer_list_starts=peer_list_starts,
+                    peer_lists=peer_lists), cl.enqueue_marker(
+                            queue, wait_for=list(wait_for or []) + [build_evt])
+
         from pytools import div_ceil
 
         # Round up level count--this gets included in the kernel as
@@ -1125,10 +2684,17 @@ class PeerListFinder(object):
 
         pl_plog.done()
 
-        return PeerListLookup(
+        peer_lists = PeerListLookup(
                 tree=tree,
                 peer_list_starts=result["peers"].starts,
-                peer_lists=result["peers"].lists).with_queue(None), evt
+                peer_lists=result["peers"].lists).with_queue(None)
+
+        # Only the arrays are stored, so that the cache does not keep the
+        # tree alive.
+        self._remember_peer_lists(tree,
+                peer_lists.peer_list_starts, peer_lists.peer_lists, evt)
+
+        return peer_lists, evt
 
 # }}}
 
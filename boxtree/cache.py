@@ -0,0 +1,467 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2019 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import weakref
+from collections import OrderedDict
+
+import six
+import numpy as np
+from pytools import Record
+import pyopencl as cl
+import pyopencl.array  # noqa
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Bump this whenever the layout of the cached objects changes in a way not
+# reflected in the version of boxtree, to invalidate entries on disk.
+_CACHE_FORMAT_VERSION = 1
+
+
+__doc__ = """
+Geometric data structures only depend on the particle geometry and on the
+build parameters. When the same geometry is processed repeatedly (e.g. with
+different densities), rebuilding them can be avoided by wrapping the builders
+in the classes below, all of which share a :class:`BuildCache`. Cache entries
+are keyed on a hash of the contents of all inputs and on the version of
+boxtree.
+
+.. autoclass:: BuildCache
+
+.. autoclass:: CachedTreeBuilder
+
+.. autoclass:: CachedFMMTraversalBuilder
+
+.. autoclass:: CachedPeerListFinder
+"""
+
+
+# {{{ content hashing
+
+def _update_hash(h, val, queue, object_keys):
+    if val is None:
+        h.update(b"<None>")
+
+    elif isinstance(val, cl.array.Array):
+        _update_hash(h, val.get(queue=queue), queue, object_keys)
+
+    elif isinstance(val, np.ndarray):
+        if val.dtype == object:
+            h.update(("<objarray %s>" % (val.shape,)).encode())
+            for subval in val.flat:
+                _update_hash(h, subval, queue, object_keys)
+        else:
+            h.update(("<array %s %s>" % (val.dtype.str, val.shape)).encode())
+            h.update(np.ascontiguousarray(val).tobytes())
+
+    elif isinstance(val, (list, tuple)):
+        h.update(("<seq %d>" % len(val)).encode())
+        for subval in val:
+            _update_hash(h, subval, queue, object_keys)
+
+    elif isinstance(val, Record):
+        key = object_keys.get(id(val))
+        if key is not None and key[0]() is val:
+            # produced by the cache, its key identifies its content
+            h.update(("<cached %s>" % key[1]).encode())
+        else:
+            h.update(("<record %s>" % type(val).__name__).encode())
+            for field_name in sorted(val.__class__.fields):
+                h.update(field_name.encode())
+                _update_hash(h, getattr(val, field_name, None), queue,
+                        object_keys)
+
+    elif isinstance(val, (bool, float, np.dtype, np.generic)
+            + six.integer_types + six.string_types):
+        h.update(("<%s %r>" % (type(val).__name__, val)).encode())
+
+    else:
+        raise TypeError("cannot hash values of type '%s'" % type(val).__name__)
+
+# }}}
+
+
+# {{{ host round trip
+
+class _DeviceArrayOnHost(object):
+    """Marks arrays that live on the device in the cached object."""
+
+    def __init__(self, ary):
+        self.ary = ary
+
+
+def _map_arrays(val, f, memo):
+    """Apply *f* to all arrays in *val*, recursing into (nested) records,
+    lists and object arrays. Objects occurring multiple times are mapped
+    once, preserving aliasing.
+    """
+    try:
+        return memo[id(val)]
+    except KeyError:
+        pass
+
+    from pyopencl.algorithm import BuiltList
+
+    if isinstance(val, (cl.array.Array, _DeviceArrayOnHost)):
+        result = f(val)
+    elif isinstance(val, np.ndarray) and val.dtype == object:
+        result = np.empty(val.shape, dtype=object)
+        for i, subval in enumerate(val.flat):
+            result.flat[i] = _map_arrays(subval, f, memo)
+    elif isinstance(val, list):
+        result = [_map_arrays(subval, f, memo) for subval in val]
+    elif isinstance(val, BuiltList):
+        result = BuiltList(count=val.count, **dict(
+            (field, _map_arrays(getattr(val, field), f, memo))
+            for field in val.__dict__
+            if field != "count" and not field.startswith("_")))
+    elif isinstance(val, Record):
+        result = val.copy(**dict(
+            (field_name, _map_arrays(getattr(val, field_name), f, memo))
+            for field_name in val.__class__.fields
+            if hasattr(val, field_name)))
+    else:
+        result = val
+
+    memo[id(val)] = result
+    return result
+
+
+def _device_to_host(val, queue):
+    return _map_arrays(val,
+            lambda ary: _DeviceArrayOnHost(ary.get(queue=queue)), {})
+
+
+def _host_to_device(val, queue):
+    return _map_arrays(val,
+            lambda ary: cl.array.to_device(queue, ary.ary).with_queue(None), {})
+
+
+def _device_nbytes(val):
+    arrays = {}
+
+    def record(ary):
+        arrays[id(ary)] = ary.nbytes
+        return ary
+
+    _map_arrays(val, record, {})
+    return sum(arrays.values())
+
+# }}}
+
+
+# {{{ build cache
+
+class BuildCache(object):
+    """A least-recently-used cache of geometric data structures on the
+    device, with an optional on-disk tier.
+
+    .. versionadded:: 2019.1
+
+    .. attribute:: nhits
+
+    .. attribute:: nmisses
+
+    .. automethod:: __init__
+    .. automethod:: clear
+    """
+
+    def __init__(self, max_nbytes=2**30, persistent_dir=None):
+        """
+        :arg max_nbytes: Upper bound for the total size of the device arrays
+            held in memory. Least recently used entries are evicted to stay
+            below it.
+        :arg persistent_dir: If not *None*, a directory in which entries are
+            also stored on disk, so that they can be shared between processes.
+        """
+        self.max_nbytes = max_nbytes
+        self.persistent_dir = persistent_dir
+
+        self._entries = OrderedDict()
+        self._nbytes = 0
+
+        # id(obj) -> (weakref(obj), key) for objects handed out by the cache
+        self._object_keys = {}
+
+        self.nhits = 0
+        self.nmisses = 0
+
+        if persistent_dir is not None and not os.path.isdir(persistent_dir):
+            os.makedirs(persistent_dir)
+
+    def clear(self):
+        """Remove all in-memory entries. Entries on disk remain."""
+        self._entries.clear()
+        self._nbytes = 0
+
+    # {{{ keys
+
+    def get_key(self, queue, *key_parts):
+        from boxtree.version import VERSION_TEXT
+
+        import hashlib
+        h = hashlib.sha256()
+        _update_hash(h,
+                ("boxtree", VERSION_TEXT, _CACHE_FORMAT_VERSION) + key_parts,
+                queue, self._object_keys)
+        return h.hexdigest()
+
+    def _remember_key(self, obj, key):
+        obj_id = id(obj)
+
+        def forget(ref):
+            entry = self._object_keys.get(obj_id)
+            if entry is not None and entry[0] is ref:
+                del self._object_keys[obj_id]
+
+        self._object_keys[obj_id] = (weakref.ref(obj, forget), key)
+
+    # }}}
+
+    # {{{ disk tier
+
+    def _get_persistent_path(self, key):
+        return os.path.join(self.persistent_dir, key + ".pkl")
+
+    def _load_persistent(self, key):
+        from six.moves import cPickle as pickle
+
+        try:
+            with open(self._get_persistent_path(key), "rb") as inf:
+                return pickle.load(inf)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            logger.warning("could not load cache entry '%s'", key,
+                    exc_info=True)
+            return None
+
+    def _store_persistent(self, key, host_obj):
+        from six.moves import cPickle as pickle
+        import tempfile
+
+        fd, temp_path = tempfile.mkstemp(dir=self.persistent_dir,
+                suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as outf:
+                pickle.dump(host_obj, outf, protocol=pickle.HIGHEST_PROTOCOL)
+
+            # atomic on POSIX, so concurrent readers never see partial entries
+            os.rename(temp_path, self._get_persistent_path(key))
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+    # }}}
+
+    def _insert(self, key, obj, evt):
+        nbytes = _device_nbytes(obj)
+        if nbytes > self.max_nbytes:
+            return
+
+        self._entries[key] = (obj, nbytes, evt)
+        self._nbytes += nbytes
+
+        while self._nbytes > self.max_nbytes:
+            _, (_, evicted_nbytes, _) = self._entries.popitem(last=False)
+            self._nbytes -= evicted_nbytes
+
+    def get_or_build(self, queue, key, build, wait_for=None):
+        """
+        :arg build: a function returning a tuple *(obj, event)*, called if
+            no entry for *key* exists.
+        :returns: a tuple *(obj, event)*.
+        """
+        # In-memory entries are specific to a context.
+        memory_key = (key, queue.context.int_ptr)
+
+        try:
+            entry = self._entries.pop(memory_key)
+        except KeyError:
+            pass
+        else:
+            # move to the most recently used end
+            self._entries[memory_key] = entry
+            self.nhits += 1
+
+            # The entry may still be under construction, possibly on another
+            # queue.
+            obj, _, build_evt = entry
+            return obj, cl.enqueue_marker(queue,
+                    wait_for=list(wait_for or []) + [build_evt])
+
+        if self.persistent_dir is not None:
+            host_obj = self._load_persistent(key)
+            if host_obj is not None:
+                obj = _host_to_device(host_obj, queue)
+                evt = cl.enqueue_marker(queue, wait_for=wait_for)
+                self._remember_key(obj, key)
+                self._insert(memory_key, obj, evt)
+                self.nhits += 1
+                return obj, evt
+
+        self.nmisses += 1
+        obj, evt = build()
+
+        self._remember_key(obj, key)
+        self._insert(memory_key, obj, evt)
+
+        if self.persistent_dir is not None:
+            self._store_persistent(key, _device_to_host(obj, queue))
+
+        return obj, evt
+
+# }}}
+
+
+# {{{ cached builders
+
+class _CachedBuilderBase(object):
+    def __init__(self, builder, cache):
+        self.builder = builder
+        self.cache = cache
+
+    def get_builder_key(self):
+        raise NotImplementedError
+
+    def _call_cached(self, queue, key_args, wait_for, build):
+        key = self.cache.get_key(queue,
+                type(self.builder).__name__, self.get_builder_key(), key_args)
+        return self.cache.get_or_build(queue, key, build, wait_for=wait_for)
+
+
+class CachedTreeBuilder(_CachedBuilderBase):
+    """Wraps a :class:`boxtree.TreeBuilder`.
+
+    .. automethod:: __init__
+    .. automethod:: __call__
+    """
+
+    def __init__(self, builder, cache):
+        """
+        :arg builder: a :class:`boxtree.TreeBuilder`.
+        :arg cache: a :class:`BuildCache`.
+        """
+        super(CachedTreeBuilder, self).__init__(builder, cache)
+
+    def get_builder_key(self):
+        return (self.builder.morton_nr_dtype, self.builder.box_level_dtype)
+
+    def __call__(self, queue, particles, wait_for=None, **kwargs):
+        """Like :meth:`boxtree.TreeBuilder.__call__`."""
+        key_kwargs = tuple(sorted(
+            (name, value) for name, value in kwargs.items()
+            if name not in ["allocator", "debug"]))
+
+        return self._call_cached(queue, (particles, key_kwargs), wait_for,
+                lambda: self.builder(queue, particles, wait_for=wait_for,
+                    **kwargs))
+
+
+class CachedFMMTraversalBuilder(_CachedBuilderBase):
+    """Wraps a :class:`boxtree.traversal.FMMTraversalBuilder`.
+
+    .. automethod:: __init__
+    .. automethod:: __call__
+    """
+
+    def __init__(self, builder, cache):
+        """
+        :arg builder: a :class:`boxtree.traversal.FMMTraversalBuilder`.
+        :arg cache: a :class:`BuildCache`.
+        """
+        super(CachedFMMTraversalBuilder, self).__init__(builder, cache)
+
+    def get_builder_key(self):
+        return (
+                self.builder.well_sep_is_n_away,
+                self.builder.from_sep_smaller_crit,
+                self.builder.mac_theta,
+                self.builder.mac_extent,
+                self.builder.stencil_min_occupancy)
+
+    def __call__(self, queue, tree, wait_for=None, debug=False,
+            from_sep_smaller_min_nsources_cumul=None, cost_model=None,
+            level_to_order=None, calibration_params=None, **kwargs):
+        """Like :meth:`boxtree.traversal.FMMTraversalBuilder.__call__`.
+
+        The "List 3" threshold *from_sep_smaller_min_nsources_cumul* is
+        determined before looking up the cache, so that the key contains its
+        value, but not *cost_model* and the other arguments used to choose it.
+        For ``"auto_global"``, the traversal without threshold that this
+        requires is itself cached.
+        *extra_queues* does not affect the result and is not part of the key.
+        """
+        def build_unthresholded_trav():
+            return self(queue, tree, wait_for=wait_for, debug=debug,
+                    from_sep_smaller_min_nsources_cumul=0, **kwargs)
+
+        from_sep_smaller_min_nsources_cumul, auto_events = \
+                self.builder._process_from_sep_smaller_min_nsources_cumul(
+                    queue, tree, from_sep_smaller_min_nsources_cumul,
+                    cost_model, level_to_order, calibration_params,
+                    build_unthresholded_trav)
+        if auto_events:
+            wait_for = auto_events
+
+        key_kwargs = tuple(sorted(
+            (name, value) for name, value in kwargs.items()
+            if name not in ["extra_queues"])) + (
+                ("from_sep_smaller_min_nsources_cumul",
+                    from_sep_smaller_min_nsources_cumul),)
+
+        return self._call_cached(queue, (tree, key_kwargs), wait_for,
+                lambda: self.builder(queue, tree, wait_for=wait_for, debug=debug,
+                    from_sep_smaller_min_nsources_cumul=(
+                        from_sep_smaller_min_nsources_cumul),
+                    **kwargs))
+
+
+class CachedPeerListFinder(_CachedBuilderBase):
+    """Wraps a :class:`boxtree.area_query.PeerListFinder`.
+
+    .. automethod:: __init__
+    .. automethod:: __call__
+    """
+
+    def __init__(self, builder, cache):
+        """
+        :arg builder: a :class:`boxtree.area_query.PeerListFinder`.
+        :arg cache: a :class:`BuildCache`.
+        """
+        super(CachedPeerListFinder, self).__init__(builder, cache)
+
+    def get_builder_key(self):
+        return ()
+
+    def __call__(self, queue, tree, wait_for=None):
+        """Like :meth:`boxtree.area_query.PeerListFinder.__call__`."""
+        return self._call_cached(queue, (tree,), wait_for,
+                lambda: self.builder(queue, tree, wait_for=wait_for))
+
+# }}}
+
+# vim: filetype=pyopencl:fdm=marker
@@ -58,6 +58,13 @@ Cost Model Classes
 .. autoclass:: AbstractFMMCostModel
 
 .. autoclass:: FMMCostModel
+
+Choosing Parameters
+^^^^^^^^^^^^^^^^^^^
+
+.. autofunction:: estimate_fmm_order
+
+.. autofunction:: choose_well_sep_is_n_away
 """
 
 import numpy as np
@@ -71,6 +78,9 @@ from pymbolic import var, evaluate
 from pytools import memoize_method
 import sys
 
+import logging
+logger = logging.getLogger(__name__)
+
 if sys.version_info >= (3, 0):
     Template = partial(Template, strict_undefined=True)
 else:
@@ -210,6 +220,11 @@ class AbstractFMMCostModel(ABC):
 
     .. automethod:: estimate_calibration_params
 
+    Tuning
+    ^^^^^^
+
+    .. automethod:: get_from_sep_smaller_min_nsources_cumul
+
     Utilities
     ^^^^^^^^^
     .. automethod:: aggregate_over_boxes
@@ -687,11 +702,130 @@ class AbstractFMMCostModel(ABC):
 
         return result
 
+    def get_from_sep_smaller_min_nsources_cumul(self, tree, level_to_order,
+            calibration_params, traversal=None):
+        """Choose the *from_sep_smaller_min_nsources_cumul* argument of
+        :meth:`boxtree.traversal.FMMTraversalBuilder.__call__`, i.e. the
+        number of sources below which a "List 3" source box is evaluated
+        directly, so that the predicted cost of the multipole evaluations
+        ("List 3") and of the direct evaluations replacing them is minimal.
+
+        :arg tree: a :class:`boxtree.Tree` object.
+        :arg level_to_order: a :class:`numpy.ndarray` of shape
+            (tree.nlevels,) representing the expansion orders
+            of different levels.
+        :arg calibration_params: a :class:`dict` of calibration parameters.
+        :arg traversal: If *None*, a threshold is chosen for each level
+            independently, as the number of sources for which evaluating a
+            multipole expansion at a target is predicted to be as expensive as
+            evaluating the sources directly. Otherwise, a
+            :class:`boxtree.traversal.FMMTraversalInfo` object for *tree* built
+            without a threshold, for the "List 3" interactions of which a
+            single threshold for all levels is chosen.
+        :return: a :class:`numpy.ndarray` of shape (tree.nlevels,).
+        """
+        calibration_params = calibration_params.copy()
+        for ilevel in range(tree.nlevels):
+            calibration_params["p_fmm_lev%d" % ilevel] = level_to_order[ilevel]
+
+        xlat_cost = self.translation_cost_model_factory(
+            tree.dimensions, tree.nlevels
+        )
+
+        # Evaluate on the host even if the subclass keeps the factors on the
+        # device.
+        translation_cost = (
+            AbstractFMMCostModel.fmm_cost_factors_for_kernels_from_model(
+                self, tree.nlevels, xlat_cost, calibration_params
+            )
+        )
+        m2p_cost = translation_cost["m2p_cost"]
+        p2p_cost = translation_cost["c_p2p"]
+
+        dtype = tree.particle_id_dtype
+
+        if traversal is None:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                thresholds = np.ceil(m2p_cost / p2p_cost)
+
+            return np.clip(
+                np.nan_to_num(thresholds), 0, np.iinfo(dtype).max
+            ).astype(dtype)
+
+        # {{{ gather the list 3 interactions
+
+        tree = traversal.tree
+
+        ntargets = []
+        nsources = []
+        m2p_cost_per_target = []
+
+        for ilevel, level_lists in enumerate(traversal.from_sep_smaller_by_level):
+            target_boxes = (
+                traversal.target_boxes_sep_smaller_by_source_level[ilevel])
+
+            ntargets.append(np.repeat(
+                tree.box_target_counts_nonchild[target_boxes],
+                np.diff(level_lists.starts)))
+            nsources.append(tree.box_source_counts_cumul[level_lists.lists])
+            m2p_cost_per_target.append(
+                np.full(len(level_lists.lists), m2p_cost[ilevel]))
+
+        ntargets = np.concatenate(ntargets).astype(np.float64)
+        nsources = np.concatenate(nsources)
+        m2p_cost_per_target = np.concatenate(m2p_cost_per_target)
+
+        # }}}
+
+        if not len(nsources):
+            return np.zeros(tree.nlevels, dtype=dtype)
+
+        # With a threshold of nsources[i] + 1, the interactions up to and
+        # including i (in order of source counts) are evaluated directly.
+        order = np.argsort(nsources, kind="mergesort")
+        ntargets = ntargets[order]
+        nsources = nsources[order]
+        m2p_cost_per_target = m2p_cost_per_target[order]
+
+        multipole_cost = np.sum(ntargets * m2p_cost_per_target)
+        cost = (
+            np.cumsum(ntargets * nsources * p2p_cost)
+            + multipole_cost
+            - np.cumsum(ntargets * m2p_cost_per_target))
+
+        is_last_with_count = np.append(nsources[1:] != nsources[:-1], True)
+
+        candidate_costs = np.append(multipole_cost, cost[is_last_with_count])
+        candidate_thresholds = np.append(0, nsources[is_last_with_count] + 1)
+
+        return np.full(
+            tree.nlevels,
+            candidate_thresholds[np.argmin(candidate_costs)],
+            dtype=dtype)
+
 # }}}
 
 
 # {{{ FMMCostModel
 
+def _get_box_list_args(lists):
+    """Return a tuple *(delta_dtype, args)*, where *args* are the kernel
+    arguments for the list entries *lists*. If *lists* is a
+    :class:`boxtree.traversal.CompressedBoxList`, these are its deltas and
+    reference boxes, and the kernel decodes the entries as it goes. Otherwise,
+    *delta_dtype* is *None* and *args* holds just *lists*.
+    """
+    from boxtree.traversal import CompressedBoxList
+    if not isinstance(lists, CompressedBoxList):
+        return None, (lists,)
+
+    if lists.reference_boxes is None:
+        raise ValueError("compressed lists without reference boxes "
+                "are not supported")
+
+    return lists.deltas.dtype, (lists.deltas, lists.reference_boxes)
+
+
 class FMMCostModel(AbstractFMMCostModel):
     """An OpenCL-based realization of :class:`AbstractFMMCostModel`.
 
@@ -836,38 +970,53 @@ class FMMCostModel(AbstractFMMCostModel):
     # {{{ direct evaluation to point targets (lists 1, 3 close, 4 close)
 
     @memoize_method
-    def _get_ndirect_sources_knl(self, particle_id_dtype, box_id_dtype):
+    def _get_ndirect_sources_knl(self, particle_id_dtype, box_id_dtype,
+                                 delta_dtype=None):
+        render_vars = dict(
+            particle_id_t=dtype_to_ctype(particle_id_dtype),
+            box_id_t=dtype_to_ctype(box_id_dtype),
+            delta_t=(
+                None if delta_dtype is None else dtype_to_ctype(delta_dtype))
+        )
+
         return ElementwiseKernel(
             self.queue.context,
             Template("""
                 ${particle_id_t} *ndirect_sources_by_itgt_box,
                 ${box_id_t} *source_boxes_starts,
+                %if delta_t is None:
                 ${box_id_t} *source_boxes_lists,
+                %else:
+                ${delta_t} *source_boxes_deltas,
+                ${box_id_t} *source_boxes_reference_boxes,
+                %endif
                 ${particle_id_t} *box_source_counts_nonchild
-            """).render(
-                particle_id_t=dtype_to_ctype(particle_id_dtype),
-                box_id_t=dtype_to_ctype(box_id_dtype)
-            ),
+            """).render(**render_vars),
             Template(r"""
                 ${particle_id_t} nsources = 0;
                 ${box_id_t} source_boxes_start_idx = source_boxes_starts[i];
                 ${box_id_t} source_boxes_end_idx = source_boxes_starts[i + 1];
 
+                %if delta_t is not None:
+                ${box_id_t} cur_source_box = source_boxes_reference_boxes[i];
+                %endif
+
                 for(${box_id_t} cur_source_boxes_idx = source_boxes_start_idx;
                     cur_source_boxes_idx < source_boxes_end_idx;
                     cur_source_boxes_idx++)
                 {
+                    %if delta_t is None:
                     ${box_id_t} cur_source_box = source_boxes_lists[
                         cur_source_boxes_idx
                     ];
+                    %else:
+                    cur_source_box += source_boxes_deltas[cur_source_boxes_idx];
+                    %endif
                     nsources += box_source_counts_nonchild[cur_source_box];
                 }
 
                 ndirect_sources_by_itgt_box[i] += nsources;
-            """).render(
-                particle_id_t=dtype_to_ctype(particle_id_dtype),
-                box_id_t=dtype_to_ctype(box_id_dtype)
-            ),
+            """).render(**render_vars),
             name="get_ndirect_sources"
         )
 
@@ -877,40 +1026,42 @@ class FMMCostModel(AbstractFMMCostModel):
         particle_id_dtype = tree.particle_id_dtype
         box_id_dtype = tree.box_id_dtype
 
-        get_ndirect_sources_knl = self._get_ndirect_sources_knl(
-            particle_id_dtype, box_id_dtype
-        )
-
         ndirect_sources_by_itgt_box = cl.array.zeros(
             self.queue, ntarget_boxes, dtype=particle_id_dtype
         )
 
+        def count_direct_sources(starts, lists):
+            delta_dtype, list_args = _get_box_list_args(lists)
+            get_ndirect_sources_knl = self._get_ndirect_sources_knl(
+                particle_id_dtype, box_id_dtype, delta_dtype
+            )
+
+            get_ndirect_sources_knl(*(
+                (ndirect_sources_by_itgt_box, starts)
+                + list_args
+                + (tree.box_source_counts_nonchild,)
+            ))
+
         # List 1
-        get_ndirect_sources_knl(
-            ndirect_sources_by_itgt_box,
+        count_direct_sources(
             traversal.neighbor_source_boxes_starts,
-            traversal.neighbor_source_boxes_lists,
-            tree.box_source_counts_nonchild
+            traversal.neighbor_source_boxes_lists
         )
 
         # List 3 close
         if traversal.from_sep_close_smaller_starts is not None:
             self.queue.finish()
-            get_ndirect_sources_knl(
-                ndirect_sources_by_itgt_box,
+            count_direct_sources(
                 traversal.from_sep_close_smaller_starts,
-                traversal.from_sep_close_smaller_lists,
-                tree.box_source_counts_nonchild
+                traversal.from_sep_close_smaller_lists
             )
 
         # List 4 close
         if traversal.from_sep_close_bigger_starts is not None:
             self.queue.finish()
-            get_ndirect_sources_knl(
-                ndirect_sources_by_itgt_box,
+            count_direct_sources(
                 traversal.from_sep_close_bigger_starts,
-                traversal.from_sep_close_bigger_lists,
-                tree.box_source_counts_nonchild
+                traversal.from_sep_close_bigger_lists
             )
 
         return ndirect_sources_by_itgt_box
@@ -1044,35 +1195,48 @@ class FMMCostModel(AbstractFMMCostModel):
     # {{{ form locals for separated bigger source boxes ("list 4")
 
     @memoize_method
-    def process_list4_knl(self, box_id_dtype, particle_id_dtype, box_level_dtype):
+    def process_list4_knl(self, box_id_dtype, particle_id_dtype, box_level_dtype,
+                          delta_dtype=None):
+        render_vars = dict(
+            box_id_t=dtype_to_ctype(box_id_dtype),
+            particle_id_t=dtype_to_ctype(particle_id_dtype),
+            box_level_t=dtype_to_ctype(box_level_dtype),
+            delta_t=(
+                None if delta_dtype is None else dtype_to_ctype(delta_dtype))
+        )
+
         return ElementwiseKernel(
             self.queue.context,
             Template(r"""
                 double *nm2p,
                 ${box_id_t} *from_sep_bigger_starts,
+                %if delta_t is None:
                 ${box_id_t} *from_sep_bigger_lists,
+                %else:
+                ${delta_t} *from_sep_bigger_deltas,
+                ${box_id_t} *from_sep_bigger_reference_boxes,
+                %endif
                 ${particle_id_t} *box_source_counts_nonchild,
                 ${box_level_t} *box_levels,
                 double *p2l_cost
-            """).render(
-                box_id_t=dtype_to_ctype(box_id_dtype),
-                particle_id_t=dtype_to_ctype(particle_id_dtype),
-                box_level_t=dtype_to_ctype(box_level_dtype)
-            ),
+            """).render(**render_vars),
             Template(r"""
                 ${box_id_t} start = from_sep_bigger_starts[i];
                 ${box_id_t} end = from_sep_bigger_starts[i+1];
+                %if delta_t is not None:
+                ${box_id_t} src_ibox = from_sep_bigger_reference_boxes[i];
+                %endif
                 for(${box_id_t} idx=start; idx < end; idx++) {
+                    %if delta_t is None:
                     ${box_id_t} src_ibox = from_sep_bigger_lists[idx];
+                    %else:
+                    src_ibox += from_sep_bigger_deltas[idx];
+                    %endif
                     ${particle_id_t} nsources = box_source_counts_nonchild[src_ibox];
                     ${box_level_t} ilevel = box_levels[src_ibox];
                     nm2p[i] += nsources * p2l_cost[ilevel];
                 }
-            """).render(
-                box_id_t=dtype_to_ctype(box_id_dtype),
-                particle_id_t=dtype_to_ctype(particle_id_dtype),
-                box_level_t=dtype_to_ctype(box_level_dtype)
-            ),
+            """).render(**render_vars),
             name="process_list4"
         )
 
@@ -1083,18 +1247,19 @@ class FMMCostModel(AbstractFMMCostModel):
             self.queue, len(target_or_target_parent_boxes), dtype=np.float64
         )
 
+        delta_dtype, list_args = _get_box_list_args(
+            traversal.from_sep_bigger_lists)
+
         process_list4_knl = self.process_list4_knl(
-            tree.box_id_dtype, tree.particle_id_dtype, tree.box_level_dtype
+            tree.box_id_dtype, tree.particle_id_dtype, tree.box_level_dtype,
+            delta_dtype
         )
 
-        process_list4_knl(
-            nm2p,
-            traversal.from_sep_bigger_starts,
-            traversal.from_sep_bigger_lists,
-            tree.box_source_counts_nonchild,
-            tree.box_levels,
-            p2l_cost
-        )
+        process_list4_knl(*(
+            (nm2p, traversal.from_sep_bigger_starts)
+            + list_args
+            + (tree.box_source_counts_nonchild, tree.box_levels, p2l_cost)
+        ))
 
         return nm2p
 
@@ -1207,6 +1372,14 @@ class FMMCostModel(AbstractFMMCostModel):
         else:
             return cl.array.sum(per_box_result).get().reshape(-1)[0]
 
+    def get_from_sep_smaller_min_nsources_cumul(self, tree, level_to_order,
+            calibration_params, traversal=None):
+        if traversal is not None:
+            traversal = traversal.get(self.queue)
+
+        return AbstractFMMCostModel.get_from_sep_smaller_min_nsources_cumul(
+            self, tree, level_to_order, calibration_params, traversal=traversal)
+
     def translation_costs_to_dev(self, translation_costs):
         """This helper function transfers all :class:`numpy.ndarray` fields in
         *translation_costs* to device memory as :class:`pyopencl.array.Array`.
@@ -1232,6 +1405,107 @@ class FMMCostModel(AbstractFMMCostModel):
 # }}}
 
 
+# {{{ well-separatedness selection
+
+def estimate_fmm_order(dimensions, well_sep_is_n_away, tolerance):
+    """Estimate the expansion order needed to reach a relative accuracy of
+    *tolerance* when boxes that are *well_sep_is_n_away* boxes away are
+    considered well-separated.
+
+    The estimate assumes the error of an expansion to decay like
+    :math:`\rho^{p+1}`, where :math:`p` is the order and :math:`\rho` is the
+    ratio of the radius of a box to the distance from its center to the
+    closest point of the nearest well-separated box of the same size.
+
+    :return: an :class:`int`.
+    """
+    radius = np.sqrt(dimensions) / 2
+    rho = radius / (well_sep_is_n_away + 1 - radius)
+
+    if not 0 < rho < 1:
+        raise ValueError("expansions do not converge for "
+                "well_sep_is_n_away=%d in %d dimensions"
+                % (well_sep_is_n_away, dimensions))
+
+    return max(int(np.ceil(np.log(tolerance) / np.log(rho))) - 1, 0)
+
+
+def choose_well_sep_is_n_away(queue, tree, tolerance, cost_model=None,
+        calibration_params=None, candidates=(1, 2), level_to_order_func=None,
+        cache=None, **kwargs):
+    """Choose the *well_sep_is_n_away* argument of
+    :class:`boxtree.traversal.FMMTraversalBuilder` for which the FMM on *tree*
+    is predicted to take the least time at a given accuracy. Larger values
+    lead to more direct interactions, but allow lower expansion orders.
+
+    A traversal is built for each candidate, all on the same *tree*, and its
+    cost predicted using :meth:`AbstractFMMCostModel.cost_per_stage`.
+
+    :arg tolerance: the relative accuracy to be reached.
+    :arg cost_model: an :class:`AbstractFMMCostModel`. Defaults to an
+        :class:`FMMCostModel` running on *queue*.
+    :arg calibration_params: a :class:`dict` of calibration parameters.
+        Defaults to :meth:`AbstractFMMCostModel.get_unit_calibration_params`.
+    :arg candidates: the values of *well_sep_is_n_away* to consider.
+        Defaults to 1 and 2.
+    :arg level_to_order_func: If not *None*, a function taking *tree*,
+        a value of *well_sep_is_n_away* and *tolerance*, and returning a
+        :class:`numpy.ndarray` of shape (tree.nlevels,) of expansion orders.
+        Defaults to using :func:`estimate_fmm_order` on every level.
+    :arg cache: If not *None*, a :class:`boxtree.cache.BuildCache` through
+        which the candidate traversals are built, so that they can be reused
+        across calls.
+    :arg kwargs: passed on to the constructor of
+        :class:`boxtree.traversal.FMMTraversalBuilder`.
+    :return: a tuple *(trav, level_to_order, predicted_costs)*, where *trav*
+        is the :class:`boxtree.traversal.FMMTraversalInfo` for the chosen
+        *well_sep_is_n_away* (available as *trav.well_sep_is_n_away*),
+        *level_to_order* are the expansion orders to use with it, and
+        *predicted_costs* is a :class:`dict` mapping each candidate to its
+        predicted total cost.
+    """
+    from boxtree.traversal import FMMTraversalBuilder
+
+    if cost_model is None:
+        cost_model = FMMCostModel(queue)
+
+    if calibration_params is None:
+        calibration_params = cost_model.get_unit_calibration_params()
+
+    if level_to_order_func is None:
+        def level_to_order_func(tree, well_sep_is_n_away, tolerance):
+            return np.full(tree.nlevels, estimate_fmm_order(
+                tree.dimensions, well_sep_is_n_away, tolerance))
+
+    best = None
+    predicted_costs = {}
+
+    for well_sep_is_n_away in candidates:
+        tg = FMMTraversalBuilder(queue.context,
+                well_sep_is_n_away=well_sep_is_n_away, **kwargs)
+        if cache is not None:
+            from boxtree.cache import CachedFMMTraversalBuilder
+            tg = CachedFMMTraversalBuilder(tg, cache)
+
+        trav, _ = tg(queue, tree)
+
+        level_to_order = level_to_order_func(tree, well_sep_is_n_away, tolerance)
+        cost = sum(cost_model.cost_per_stage(
+            trav, level_to_order, calibration_params.copy()).values())
+
+        logger.info("well_sep_is_n_away=%d: predicted cost %g",
+                well_sep_is_n_away, cost)
+
+        predicted_costs[well_sep_is_n_away] = cost
+        if best is None or cost < best[0]:
+            best = (cost, trav, level_to_order)
+
+    _, trav, level_to_order = best
+    return trav, level_to_order, predicted_costs
+
+# }}}
+
+
 # {{{ _PythonFMMCostModel (undocumented, only used for testing)
 
 class _PythonFMMCostModel(AbstractFMMCostModel):
@@ -34,10 +34,11 @@ except ImportError:
     from collections import Mapping
 
 
-from pytools import ProcessLogger
+from pytools import ProcessLogger, Record
 
 
-def drive_fmm(traversal, expansion_wrangler, src_weights, timing_data=None):
+def drive_fmm(traversal, expansion_wrangler, src_weights, timing_data=None,
+        target_box_tiles=None):
     """Top-level driver routine for a fast multipole calculation.
 
     In part, this is intended as a template for custom FMMs, in the sense that
@@ -56,12 +57,29 @@ def drive_fmm(traversal, expansion_wrangler, src_weights, timing_data=None):
     :arg timing_data: Either *None*, or a :class:`dict` that is populated with
         timing information for the stages of the algorithm (in the form of
         :class:`TimingResult`), if such information is available.
+    :arg target_box_tiles: Either *None*, or a
+        :class:`boxtree.traversal.TargetBoxTiles` instance for *traversal*,
+        on the host, as obtained from
+        :meth:`boxtree.traversal.FMMTraversalInfo.get_target_box_tiles`. If
+        given, the stages working on interaction lists of target boxes (i.e.
+        direct evaluation, multipole evaluation and formation of local
+        expansions) are handed their target boxes tile by tile, in the
+        order given by *target_box_tiles*, for better cache reuse in
+        *expansion_wrangler*.
 
     Returns the potentials computed by *expansion_wrangler*.
 
+    .. versionchanged:: 2019.1
+
+        Added *target_box_tiles*.
     """
     wrangler = expansion_wrangler
 
+    if target_box_tiles is not None:
+        tiled_lists = _get_tiled_target_lists(traversal, target_box_tiles)
+    else:
+        tiled_lists = traversal
+
     # Interface guidelines: Attributes of the tree are assumed to be known
     # to the expansion wrangler and should not be passed.
 
@@ -97,9 +115,9 @@ def drive_fmm(traversal, expansion_wrangler, src_weights, timing_data=None):
     # {{{ "Stage 3:" Direct evaluation from neighbor source boxes ("list 1")
 
     potentials, timing_future = wrangler.eval_direct(
-            traversal.target_boxes,
-            traversal.neighbor_source_boxes_starts,
-            traversal.neighbor_source_boxes_lists,
+            tiled_lists.target_boxes,
+            tiled_lists.neighbor_source_boxes_starts,
+            tiled_lists.neighbor_source_boxes_lists,
             src_weights)
 
     recorder.add("eval_direct", timing_future)
@@ -112,9 +130,9 @@ def drive_fmm(traversal, expansion_wrangler, src_weights, timing_data=None):
 
     local_exps, timing_future = wrangler.multipole_to_local(
             traversal.level_start_target_or_target_parent_box_nrs,
-            traversal.target_or_target_parent_boxes,
-            traversal.from_sep_siblings_starts,
-            traversal.from_sep_siblings_lists,
+            tiled_lists.target_or_target_parent_boxes,
+            tiled_lists.from_sep_siblings_starts,
+            tiled_lists.from_sep_siblings_lists,
             mpole_exps)
 
     recorder.add("multipole_to_local", timing_future)
@@ -129,8 +147,8 @@ def drive_fmm(traversal, expansion_wrangler, src_weights, timing_data=None):
     # contribution *out* of the downward-propagating local expansions)
 
     mpole_result, timing_future = wrangler.eval_multipoles(
-            traversal.target_boxes_sep_smaller_by_source_level,
-            traversal.from_sep_smaller_by_level,
+            tiled_lists.target_boxes_sep_smaller_by_source_level,
+            tiled_lists.from_sep_smaller_by_level,
             mpole_exps)
 
     recorder.add("eval_multipoles", timing_future)
@@ -144,9 +162,9 @@ def drive_fmm(traversal, expansion_wrangler, src_weights, timing_data=None):
                 "('list 3 close')")
 
         direct_result, timing_future = wrangler.eval_direct(
-                traversal.target_boxes,
-                traversal.from_sep_close_smaller_starts,
-                traversal.from_sep_close_smaller_lists,
+                tiled_lists.target_boxes,
+                tiled_lists.from_sep_close_smaller_starts,
+                tiled_lists.from_sep_close_smaller_lists,
                 src_weights)
 
         recorder.add("eval_direct", timing_future)
@@ -159,9 +177,9 @@ def drive_fmm(traversal, expansion_wrangler, src_weights, timing_data=None):
 
     local_result, timing_future = wrangler.form_locals(
             traversal.level_start_target_or_target_parent_box_nrs,
-            traversal.target_or_target_parent_boxes,
-            traversal.from_sep_bigger_starts,
-            traversal.from_sep_bigger_lists,
+            tiled_lists.target_or_target_parent_boxes,
+            tiled_lists.from_sep_bigger_starts,
+            tiled_lists.from_sep_bigger_lists,
             src_weights)
 
     recorder.add("form_locals", timing_future)
@@ -170,9 +188,9 @@ def drive_fmm(traversal, expansion_wrangler, src_weights, timing_data=None):
 
     if traversal.from_sep_close_bigger_starts is not None:
         direct_result, timing_future = wrangler.eval_direct(
-                traversal.target_boxes,
-                traversal.from_sep_close_bigger_starts,
-                traversal.from_sep_close_bigger_lists,
+                tiled_lists.target_boxes,
+                tiled_lists.from_sep_close_bigger_starts,
+                tiled_lists.from_sep_close_bigger_lists,
                 src_weights)
 
         recorder.add("eval_direct", timing_future)
@@ -217,6 +235,185 @@ def drive_fmm(traversal, expansion_wrangler, src_weights, timing_data=None):
     return result
 
 
+def drive_treecode(traversal, expansion_wrangler, src_weights, timing_data=None):
+    """Top-level driver routine for a Barnes-Hut-style treecode, in which
+    multipole expansions of far-away source boxes are evaluated directly at
+    the targets and no local expansions are formed.
+
+    Only :meth:`ExpansionWranglerInterface.form_multipoles`,
+    :meth:`ExpansionWranglerInterface.coarsen_multipoles`,
+    :meth:`ExpansionWranglerInterface.eval_multipoles`, and
+    :meth:`ExpansionWranglerInterface.eval_direct` (in addition to the
+    reordering and finalization methods) of *expansion_wrangler* are used.
+
+    :arg traversal: A :class:`boxtree.traversal.TreecodeTraversalInfo` instance.
+    :arg expansion_wrangler: An object exhibiting the
+        :class:`ExpansionWranglerInterface`.
+    :arg src_weights: Source 'density/weights/charges'.
+        Passed unmodified to *expansion_wrangler*.
+    :arg timing_data: Either *None*, or a :class:`dict` that is populated with
+        timing information for the stages of the algorithm (in the form of
+        :class:`TimingResult`), if such information is available.
+
+    Returns the potentials computed by *expansion_wrangler*.
+
+    .. versionadded:: 2019.1
+    """
+    wrangler = expansion_wrangler
+
+    treecode_proc = ProcessLogger(logger, "treecode")
+    recorder = TimingRecorder()
+
+    src_weights = wrangler.reorder_sources(src_weights)
+
+    # {{{ form multipoles and propagate them upward
+
+    mpole_exps, timing_future = wrangler.form_multipoles(
+            traversal.level_start_source_box_nrs,
+            traversal.source_boxes,
+            src_weights)
+
+    recorder.add("form_multipoles", timing_future)
+
+    mpole_exps, timing_future = wrangler.coarsen_multipoles(
+            traversal.level_start_source_parent_box_nrs,
+            traversal.source_parent_boxes,
+            mpole_exps)
+
+    recorder.add("coarsen_multipoles", timing_future)
+
+    # }}}
+
+    # {{{ direct evaluation from near-field source boxes
+
+    potentials, timing_future = wrangler.eval_direct(
+            traversal.target_boxes,
+            traversal.near_field_source_boxes_starts,
+            traversal.near_field_source_boxes_lists,
+            src_weights)
+
+    recorder.add("eval_direct", timing_future)
+
+    # }}}
+
+    # {{{ evaluate accepted source boxes' multipoles at particles
+
+    mpole_result, timing_future = wrangler.eval_multipoles(
+            traversal.target_boxes_accepted_by_source_level,
+            traversal.accepted_source_boxes_by_level,
+            mpole_exps)
+
+    recorder.add("eval_multipoles", timing_future)
+
+    potentials = potentials + mpole_result
+
+    # }}}
+
+    result = wrangler.reorder_potentials(potentials)
+
+    result = wrangler.finalize_potentials(result)
+
+    treecode_proc.done()
+
+    if timing_data is not None:
+        timing_data.update(recorder.summarize())
+
+    return result
+
+
+# {{{ tiled target box order
+
+def _reorder_csr(order, starts, lists):
+    """Return *(starts, lists)* for the lists in :ref:`csr` given by
+    *starts* and *lists*, taken in the order given by the list indices
+    *order*.
+    """
+    import numpy as np
+
+    # also decodes compressed lists
+    lists = np.asarray(lists)
+
+    lengths = np.diff(starts)[order]
+    new_starts = np.zeros(len(order) + 1, dtype=starts.dtype)
+    np.cumsum(lengths, out=new_starts[1:])
+
+    indices = (
+            np.repeat(starts[:-1][order] - new_starts[:-1], lengths)
+            + np.arange(new_starts[-1], dtype=starts.dtype))
+
+    return new_starts, lists[indices]
+
+
+class _TiledTargetLists(Record):
+    pass
+
+
+def _get_tiled_target_lists(traversal, target_box_tiles):
+    """Return a :class:`_TiledTargetLists` with the attributes of *traversal*
+    describing interaction lists of target boxes (and of target or target
+    parent boxes), with the boxes in the order given by *target_box_tiles*.
+    """
+    import numpy as np
+    from pyopencl.algorithm import BuiltList
+
+    result = {}
+
+    for boxes_name, order, list_names in [
+            ("target_boxes", target_box_tiles.target_box_order,
+                ["neighbor_source_boxes", "from_sep_close_smaller",
+                    "from_sep_close_bigger"]),
+            # This order is level-major, and so it agrees with
+            # level_start_target_or_target_parent_box_nrs.
+            ("target_or_target_parent_boxes",
+                target_box_tiles.target_or_target_parent_box_order,
+                ["from_sep_siblings", "from_sep_bigger"]),
+            ]:
+        result[boxes_name] = getattr(traversal, boxes_name)[order]
+
+        for list_name in list_names:
+            starts = getattr(traversal, list_name + "_starts")
+            if starts is None:
+                result[list_name + "_starts"] = None
+                result[list_name + "_lists"] = None
+                continue
+
+            result[list_name + "_starts"], result[list_name + "_lists"] = \
+                    _reorder_csr(order,
+                            starts, getattr(traversal, list_name + "_lists"))
+
+    # {{{ list 3: only target boxes with non-empty lists, on each level
+
+    target_box_order = target_box_tiles.target_box_order
+    target_box_ranks = np.empty_like(target_box_order)
+    target_box_ranks[target_box_order] = np.arange(len(target_box_order))
+
+    result["target_boxes_sep_smaller_by_source_level"] = []
+    result["from_sep_smaller_by_level"] = []
+
+    for level_list in traversal.from_sep_smaller_by_level:
+        level_order = np.argsort(
+                target_box_ranks[level_list.nonempty_indices], kind="stable")
+        starts, lists = _reorder_csr(level_order,
+                level_list.starts, level_list.lists)
+        nonempty_indices = level_list.nonempty_indices[level_order]
+
+        result["target_boxes_sep_smaller_by_source_level"].append(
+                traversal.target_boxes[nonempty_indices])
+        # compressed_indices cannot describe a reordering, so it is omitted.
+        result["from_sep_smaller_by_level"].append(BuiltList(
+                count=level_list.count,
+                starts=starts,
+                lists=lists,
+                num_nonempty_lists=level_list.num_nonempty_lists,
+                nonempty_indices=nonempty_indices))
+
+    # }}}
+
+    return _TiledTargetLists(**result)
+
+# }}}
+
+
 # {{{ expansion wrangler interface
 
 class ExpansionWranglerInterface:
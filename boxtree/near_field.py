@@ -0,0 +1,267 @@
+from __future__ import division
+
+__copyright__ = "Copyright (C) 2019 Andreas Kloeckner"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import numpy as np
+from pytools import memoize_method
+import pyopencl as cl
+import pyopencl.array  # noqa
+from pyopencl.elementwise import ElementwiseTemplate
+from mako.template import Template
+from boxtree.tools import DeviceDataRecord
+
+import logging
+logger = logging.getLogger(__name__)
+
+from pytools import log_process
+
+
+__doc__ = """
+The near field of an FMM ("List 1", along with the "close" lists for particles
+with extent) only changes with the geometry. For iterative solves, it can
+therefore be assembled once into a sparse matrix, making its application a
+single sparse matrix-vector product.
+
+.. autoclass:: NearFieldPattern()
+
+    .. automethod:: get
+
+    .. automethod:: get_sparse_matrix
+
+.. autoclass:: NearFieldPatternBuilder
+
+    .. automethod:: __call__
+"""
+
+
+# {{{ kernels
+
+TARGET_BOX_NUMBER_FINDER_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL//
+    box_id_t *target_boxes,
+    particle_id_t *box_target_starts,
+    particle_id_t *box_target_counts_nonchild,
+    box_id_t *target_box_numbers,
+    """,
+
+    operation=r"""//CL//
+        box_id_t box_id = target_boxes[i];
+
+        particle_id_t start = box_target_starts[box_id];
+        particle_id_t stop = start + box_target_counts_nonchild[box_id];
+
+        for (particle_id_t itgt = start; itgt < stop; ++itgt)
+            target_box_numbers[itgt] = i;
+    """,
+    name="find_target_box_numbers")
+
+
+NEAR_FIELD_PATTERN_TEMPLATE = r"""//CL//
+typedef ${dtype_to_ctype(box_id_dtype)} box_id_t;
+typedef ${dtype_to_ctype(particle_id_dtype)} particle_id_t;
+
+void generate(LIST_ARG_DECL USER_ARG_DECL index_type itgt)
+{
+    box_id_t itarget_box = target_box_numbers[itgt];
+
+    // not in any of the traversal's target boxes
+    if (itarget_box < 0)
+        return;
+
+    box_id_t start = neighbor_source_boxes_starts[itarget_box];
+    box_id_t stop = neighbor_source_boxes_starts[itarget_box + 1];
+
+    for (box_id_t i = start; i < stop; ++i)
+    {
+        box_id_t src_box_id = neighbor_source_boxes_lists[i];
+
+        particle_id_t src_start = box_source_starts[src_box_id];
+        particle_id_t src_stop =
+            src_start + box_source_counts_nonchild[src_box_id];
+
+        for (particle_id_t isrc = src_start; isrc < src_stop; ++isrc)
+            APPEND_source_indices(isrc);
+    }
+}
+"""
+
+# }}}
+
+
+# {{{ near-field pattern
+
+class NearFieldPattern(DeviceDataRecord):
+    """The near-field interactions of a traversal at the particle level, as
+    a sparsity pattern in compressed sparse row (CSR) form. Rows correspond to
+    targets, columns to sources, both in :ref:`tree order
+    <particle-orderings>`. See :ref:`csr`.
+
+    .. attribute:: ntargets
+
+    .. attribute:: nsources
+
+    .. attribute:: target_starts
+
+        ``particle_id_t [ntargets + 1]``
+
+    .. attribute:: source_indices
+
+        ``particle_id_t [*]``
+
+    .. attribute:: nnz
+
+        The number of entries in the pattern.
+    """
+
+    @property
+    def nnz(self):
+        return len(self.source_indices)
+
+    def get_sparse_matrix(self, entry_func=None, dtype=np.float64, queue=None):
+        """Return the pattern as a :class:`scipy.sparse.csr_matrix` of shape
+        *(ntargets, nsources)*. Requires :mod:`scipy`.
+
+        :arg entry_func: If not *None*, a function *entry_func(target_indices,
+            source_indices)* receiving two :class:`numpy.ndarray` instances of
+            tree-order particle indices, one entry per nonzero. It returns an
+            array of the matrix entries for these pairs. If *None*, all
+            entries are set to one.
+        :arg dtype: The data type of the matrix entries.
+        :arg queue: A :class:`pyopencl.CommandQueue` used to transfer the
+            pattern to the host, if it is stored on the device.
+        """
+        from scipy.sparse import csr_matrix
+
+        target_starts = self.target_starts
+        source_indices = self.source_indices
+        if isinstance(target_starts, cl.array.Array):
+            target_starts = target_starts.get(queue=queue)
+            source_indices = source_indices.get(queue=queue)
+
+        if entry_func is None:
+            data = np.ones(len(source_indices), dtype=dtype)
+        else:
+            target_indices = np.repeat(
+                    np.arange(self.ntargets, dtype=source_indices.dtype),
+                    np.diff(target_starts))
+            data = np.asarray(
+                    entry_func(target_indices, source_indices), dtype=dtype)
+
+            if data.shape != source_indices.shape:
+                raise ValueError("entry_func returned an array of shape %s, "
+                        "expected %s" % (data.shape, source_indices.shape))
+
+        return csr_matrix(
+                (data, source_indices, target_starts),
+                shape=(self.ntargets, self.nsources))
+
+
+class NearFieldPatternBuilder(object):
+    """Build the particle-level near-field interaction pattern of a
+    traversal.
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    @memoize_method
+    def get_kernels(self, box_id_dtype, particle_id_dtype):
+        from pyopencl.algorithm import ListOfListsBuilder
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree.tools import VectorArg
+
+        target_box_number_finder = TARGET_BOX_NUMBER_FINDER_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("box_id_t", box_id_dtype),
+                    ("particle_id_t", particle_id_dtype),
+                    ))
+
+        pattern_builder = ListOfListsBuilder(self.context,
+                [("source_indices", particle_id_dtype)],
+                str(Template(NEAR_FIELD_PATTERN_TEMPLATE,
+                    strict_undefined=True).render(
+                        dtype_to_ctype=dtype_to_ctype,
+                        box_id_dtype=box_id_dtype,
+                        particle_id_dtype=particle_id_dtype)),
+                arg_decls=[
+                    VectorArg(box_id_dtype, "target_box_numbers"),
+                    VectorArg(box_id_dtype, "neighbor_source_boxes_starts"),
+                    VectorArg(box_id_dtype, "neighbor_source_boxes_lists"),
+                    VectorArg(particle_id_dtype, "box_source_starts"),
+                    VectorArg(particle_id_dtype, "box_source_counts_nonchild"),
+                    ],
+                name_prefix="near_field_pattern",
+                complex_kernel=True)
+
+        return target_box_number_finder, pattern_builder
+
+    @log_process(logger, "build near-field pattern")
+    def __call__(self, queue, trav, wait_for=None):
+        """
+        :arg trav: A :class:`boxtree.traversal.FMMTraversalInfo` on the
+            device. If it has "close" lists, they are included in the
+            pattern.
+        :returns: a tuple *(pattern, event)*, where *pattern* is a
+            :class:`NearFieldPattern`.
+        """
+        tree = trav.tree
+
+        if trav.periodic_shifts is not None:
+            raise NotImplementedError(
+                    "near-field patterns for periodic traversals")
+
+        if trav.from_sep_close_smaller_starts is not None:
+            trav = trav.merge_close_lists(queue)
+
+        target_box_number_finder, pattern_builder = self.get_kernels(
+                tree.box_id_dtype, tree.particle_id_dtype)
+
+        target_box_numbers = cl.array.empty(
+                queue, tree.ntargets, tree.box_id_dtype)
+        target_box_numbers.fill(-1)
+
+        evt = target_box_number_finder(
+                trav.target_boxes, tree.box_target_starts,
+                tree.box_target_counts_nonchild, target_box_numbers,
+                range=slice(trav.ntarget_boxes),
+                queue=queue, wait_for=wait_for)
+
+        result, evt = pattern_builder(queue, tree.ntargets,
+                target_box_numbers,
+                trav.neighbor_source_boxes_starts,
+                trav.neighbor_source_boxes_lists,
+                tree.box_source_starts,
+                tree.box_source_counts_nonchild,
+                wait_for=[evt])
+
+        return NearFieldPattern(
+                ntargets=tree.ntargets,
+                nsources=tree.nsources,
+                target_starts=result["source_indices"].starts,
+                source_indices=result["source_indices"].lists,
+                ).with_queue(None), evt
+
+# }}}
+
+# vim: filetype=pyopencl:fdm=marker
@@ -142,6 +142,10 @@ class FMMLibExpansionWrangler(object):
             def fmm_level_to_nterms(tree, level):  # noqa pylint:disable=function-redefined
                 return nterms
 
+        if getattr(tree, "periodic", False):
+            raise NotImplementedError(
+                    "pyfmmlib wrangler for periodic trees")
+
         self.tree = tree
 
         if helmholtz_k == 0:
@@ -733,7 +737,11 @@ class FMMLibExpansionWrangler(object):
             if lstart == lstop:
                 continue
 
-            starts_on_lvl = starts[lstart:lstop+1]
+            # Only the part of *lists* for this level is used (and, for
+            # compressed lists, decoded) at a time.
+            lists_start, lists_stop = starts[lstart], starts[lstop]
+            starts_on_lvl = starts[lstart:lstop+1] - lists_start
+            lists_on_lvl = lists[lists_start:lists_stop]
 
             mploc = self.get_translation_routine("%ddmploc", vec_suffix="_imany")
 
@@ -744,6 +752,7 @@ class FMMLibExpansionWrangler(object):
             if self.level_nterms[lev] <= rotmat_order:
                 m2l_rotation_lists = self.rotation_data.m2l_rotation_lists()
                 assert len(m2l_rotation_lists) == len(lists)
+                m2l_rotation_lists = m2l_rotation_lists[lists_start:lists_stop]
 
                 mploc = self.get_translation_routine(
                         "%ddmploc", vec_suffix="2_trunc_imany")
@@ -809,11 +818,11 @@ class FMMLibExpansionWrangler(object):
                     rscale1_starts=src_boxes_starts,
 
                     center1=tree.box_centers,
-                    center1_offsets=lists,
+                    center1_offsets=lists_on_lvl,
                     center1_starts=starts_on_lvl,
 
                     expn1=source_mpoles_view.T,
-                    expn1_offsets=lists - source_level_start_ibox,
+                    expn1_offsets=lists_on_lvl - source_level_start_ibox,
                     expn1_starts=starts_on_lvl,
 
                     rscale2=rscale2,
@@ -882,16 +891,7 @@ class FMMLibExpansionWrangler(object):
         formta = self.get_routine("%ddformta" + self.dp_suffix, suffix="_imany")
 
         sources = self._get_single_sources_array()
-        # sources_starts / sources_lists is a CSR list mapping box centers to
-        # lists of starting indices into the sources array. To get the starting
-        # source indices we have to look at box_source_starts.
-        sources_offsets = self.tree.box_source_starts[lists]
-
-        # nsources_starts / nsources_lists is a CSR list mapping box centers to
-        # lists of indices into nsources, each of which represents a source
-        # count.
         nsources = self.tree.box_source_counts_nonchild
-        nsources_offsets = lists
 
         # centers is indexed into by values of centers_offsets, which is a list
         # mapping box indices to box center indices.
@@ -913,8 +913,22 @@ class FMMLibExpansionWrangler(object):
 
             rscale = self.level_to_rscale(lev)
 
-            sources_starts = starts[lev_start:1 + lev_stop]
+            # Only the part of *lists* for this level is used (and, for
+            # compressed lists, decoded) at a time.
+            lists_start, lists_stop = starts[lev_start], starts[lev_stop]
+            lists_on_lvl = lists[lists_start:lists_stop]
+
+            # sources_starts / sources_lists is a CSR list mapping box centers to
+            # lists of starting indices into the sources array. To get the
+            # starting source indices we have to look at box_source_starts.
+            sources_starts = starts[lev_start:1 + lev_stop] - lists_start
+            sources_offsets = self.tree.box_source_starts[lists_on_lvl]
+
+            # nsources_starts / nsources_lists is a CSR list mapping box centers
+            # to lists of indices into nsources, each of which represents a
+            # source count.
             nsources_starts = sources_starts
+            nsources_offsets = lists_on_lvl
 
             kwargs = {}
             kwargs.update(self.kernel_kwargs)
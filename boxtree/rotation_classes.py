@@ -191,8 +191,78 @@ class RotationClassesInfo(DeviceDataRecord):
         return len(self.from_sep_siblings_rotation_class_to_angle)
 
 
-class RotationClassesBuilder(object):
-    """Build rotation classes for List 2 translations.
+class TranslationClassesInfo(DeviceDataRecord):
+    r"""List 2 interactions, grouped into batches sharing a translation
+    operator. Each batch consists of the box pairs on one level that are
+    related by the same translation vector, so that (for a translation-invariant
+    kernel) one precomputed matrix per batch suffices, which may be applied to
+    the whole batch at once.
+
+    .. attribute:: nfrom_sep_siblings_translation_classes
+
+       The number of distinct translation classes in use.
+
+    .. attribute:: from_sep_siblings_translation_classes
+
+        ``int32 [*]``
+
+        A list, corresponding to *from_sep_siblings_lists* of *trav*, of
+        the translation class of each box pair.
+
+    .. attribute:: from_sep_siblings_translation_class_to_distance_vector
+
+        ``int32 [dimensions, nfrom_sep_siblings_translation_classes]``
+
+        Maps translation classes in *from_sep_siblings_translation_classes*
+        to the vector from the source to the target box center, in units
+        of the box size on the level of the box pair.
+
+    .. attribute:: nbatches
+
+    .. attribute:: batch_starts
+
+        ``int32 [nbatches + 1]``
+
+        Start indices of the batches in :attr:`batch_entry_indices`,
+        :attr:`batch_source_boxes`, and :attr:`batch_target_boxes`.
+        Batches are sorted by level, then by translation class.
+
+    .. attribute:: batch_levels
+
+        ``int32 [nbatches]``
+
+    .. attribute:: batch_translation_classes
+
+        ``int32 [nbatches]``
+
+    .. attribute:: batch_entry_indices
+
+        ``int32 [*]``
+
+        Indices into *from_sep_siblings_lists* of *trav* of the box pairs in
+        each batch.
+
+    .. attribute:: batch_source_boxes
+
+        ``box_id_t [*]``
+
+    .. attribute:: batch_target_boxes
+
+        ``box_id_t [*]``
+    """
+
+    @property
+    def nfrom_sep_siblings_translation_classes(self):
+        return self.from_sep_siblings_translation_class_to_distance_vector.shape[1]
+
+    @property
+    def nbatches(self):
+        return len(self.batch_levels)
+
+
+class TranslationClassesBuilder(object):
+    """Build translation classes for List 2 translations and group List 2
+    by them.
     """
 
     def __init__(self, context):
@@ -231,6 +301,161 @@ class RotationClassesBuilder(object):
 
         return _KernelInfo(translation_class_finder=translation_class_finder)
 
+    @staticmethod
+    def ntranslation_classes(well_sep_is_n_away, dimensions):
+        return (4 * well_sep_is_n_away + 3) ** dimensions
+
+    @staticmethod
+    def translation_class_to_vector(well_sep_is_n_away, dimensions, cls):
+        # This computes the vector for the translation class, using the inverse
+        # of the formula found in get_translation_class() defined in
+        # TRANSLATION_CLASS_FINDER_PREAMBLE_TEMPLATE.
+        result = np.zeros(dimensions, dtype=np.int32)
+        shift = 2 * well_sep_is_n_away + 1
+        base = 4 * well_sep_is_n_away + 3
+        for i in range(dimensions):
+            result[i] = cls % base - shift
+            cls //= base
+        return result
+
+    def find_translation_classes(self, queue, trav, tree, wait_for=None):
+        """
+        :returns: a tuple *(translation_classes_lists,
+            translation_class_is_used, evt)*, where *translation_classes_lists*
+            contains the (uncompressed) translation class of each entry of
+            *from_sep_siblings_lists*, and *translation_class_is_used* is
+            nonzero for each translation class occurring in it.
+        """
+        if trav.periodic_shifts is not None:
+            raise NotImplementedError(
+                    "translation classes for periodic traversals")
+
+        well_sep_is_n_away = trav.well_sep_is_n_away
+        dimensions = tree.dimensions
+        coord_dtype = tree.coord_dtype
+
+        knl_info = self.get_kernel_info(
+                dimensions, well_sep_is_n_away, tree.box_id_dtype,
+                tree.box_level_dtype, coord_dtype)
+
+        ntranslation_classes = (
+                self.ntranslation_classes(well_sep_is_n_away, dimensions))
+
+        translation_classes_lists = cl.array.empty(
+                queue, len(trav.from_sep_siblings_lists), dtype=np.int32)
+
+        translation_class_is_used = cl.array.zeros(
+                queue, ntranslation_classes, dtype=np.int32)
+
+        error_flag = cl.array.zeros(queue, 1, dtype=np.int32)
+
+        evt = knl_info.translation_class_finder(
+                trav.from_sep_siblings_lists,
+                trav.from_sep_siblings_starts,
+                trav.target_or_target_parent_boxes,
+                trav.ntarget_or_target_parent_boxes,
+                tree.box_centers,
+                tree.aligned_nboxes,
+                tree.root_extent,
+                tree.box_levels,
+                well_sep_is_n_away,
+                translation_classes_lists,
+                translation_class_is_used,
+                error_flag,
+                queue=queue, wait_for=wait_for)
+
+        if (error_flag.get()):
+            raise ValueError("could not compute translation classes")
+
+        return translation_classes_lists, translation_class_is_used, evt
+
+    @log_process(logger, "build m2l translation classes")
+    def __call__(self, queue, trav, tree, wait_for=None):
+        """Returns a pair *info*, *evt* where info is a
+        :class:`TranslationClassesInfo`.
+        """
+        well_sep_is_n_away = trav.well_sep_is_n_away
+        dimensions = tree.dimensions
+
+        translation_classes_lists, translation_class_is_used, evt = \
+                self.find_translation_classes(queue, trav, tree, wait_for)
+
+        # {{{ compress translation classes
+
+        used_translation_classes = (
+                np.flatnonzero(translation_class_is_used.get(queue)))
+
+        translation_class_to_compressed = np.empty(
+                self.ntranslation_classes(well_sep_is_n_away, dimensions),
+                dtype=np.int32)
+        translation_class_to_compressed.fill(-1)
+        translation_class_to_compressed[used_translation_classes] = (
+                np.arange(len(used_translation_classes), dtype=np.int32))
+
+        distance_vectors = np.empty(
+                (dimensions, len(used_translation_classes)), dtype=np.int32)
+        for i, cls in enumerate(used_translation_classes):
+            distance_vectors[:, i] = self.translation_class_to_vector(
+                    well_sep_is_n_away, dimensions, cls)
+
+        translation_classes = translation_class_to_compressed[
+                translation_classes_lists.get(queue)]
+
+        # }}}
+
+        # {{{ group into batches
+
+        # The batches are formed on the host, which also already has the
+        # information on used translation classes.
+
+        starts = trav.from_sep_siblings_starts.get(queue)
+        source_boxes = trav.from_sep_siblings_lists.get(queue)
+        target_boxes = np.repeat(
+                trav.target_or_target_parent_boxes.get(queue),
+                np.diff(starts))
+        levels = tree.box_levels.get(queue)[source_boxes].astype(np.int32)
+
+        keys = (
+                levels.astype(np.int64) * len(used_translation_classes)
+                + translation_classes)
+        entry_indices = np.argsort(keys, kind="mergesort").astype(np.int32)
+        sorted_keys = keys[entry_indices]
+
+        is_batch_start = np.empty(len(sorted_keys), dtype=bool)
+        is_batch_start[:1] = True
+        is_batch_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        batch_starts = np.flatnonzero(is_batch_start).astype(np.int32)
+
+        batch_levels = levels[entry_indices[batch_starts]]
+        batch_translation_classes = translation_classes[
+                entry_indices[batch_starts]]
+
+        batch_starts = np.append(
+                batch_starts, np.int32(len(entry_indices)))
+
+        # }}}
+
+        return TranslationClassesInfo(
+                from_sep_siblings_translation_classes=cl.array.to_device(
+                    queue, translation_classes),
+                from_sep_siblings_translation_class_to_distance_vector=(
+                    cl.array.to_device(queue, distance_vectors)),
+                batch_starts=cl.array.to_device(queue, batch_starts),
+                batch_levels=cl.array.to_device(queue, batch_levels),
+                batch_translation_classes=cl.array.to_device(
+                    queue, batch_translation_classes),
+                batch_entry_indices=cl.array.to_device(queue, entry_indices),
+                batch_source_boxes=cl.array.to_device(
+                    queue, source_boxes[entry_indices]),
+                batch_target_boxes=cl.array.to_device(
+                    queue, target_boxes[entry_indices]),
+                ).with_queue(None), evt
+
+
+class RotationClassesBuilder(TranslationClassesBuilder):
+    """Build rotation classes for List 2 translations.
+    """
+
     @staticmethod
     def vec_gcd(vec):
         """Return the GCD of a list of integers."""
@@ -292,68 +517,15 @@ class RotationClassesBuilder(object):
 
         return translation_class_to_rot_class, angles
 
-    @staticmethod
-    def ntranslation_classes(well_sep_is_n_away, dimensions):
-        return (4 * well_sep_is_n_away + 3) ** dimensions
-
-    @staticmethod
-    def translation_class_to_vector(well_sep_is_n_away, dimensions, cls):
-        # This computes the vector for the translation class, using the inverse
-        # of the formula found in get_translation_class() defined in
-        # TRANSLATION_CLASS_FINDER_PREAMBLE_TEMPLATE.
-        result = np.zeros(dimensions, dtype=np.int32)
-        shift = 2 * well_sep_is_n_away + 1
-        base = 4 * well_sep_is_n_away + 3
-        for i in range(dimensions):
-            result[i] = cls % base - shift
-            cls //= base
-        return result
-
     @log_process(logger, "build m2l rotation classes")
     def __call__(self, queue, trav, tree, wait_for=None):
         """Returns a pair *info*, *evt* where info is a :class:`RotationClassesInfo`.
         """
-
-        # {{{ compute translation classes for list 2
-
         well_sep_is_n_away = trav.well_sep_is_n_away
         dimensions = tree.dimensions
-        coord_dtype = tree.coord_dtype
-
-        knl_info = self.get_kernel_info(
-                dimensions, well_sep_is_n_away, tree.box_id_dtype,
-                tree.box_level_dtype, coord_dtype)
-
-        ntranslation_classes = (
-                self.ntranslation_classes(well_sep_is_n_away, dimensions))
-
-        translation_classes_lists = cl.array.empty(
-                queue, len(trav.from_sep_siblings_lists), dtype=np.int32)
-
-        translation_class_is_used = cl.array.zeros(
-                queue, ntranslation_classes, dtype=np.int32)
 
-        error_flag = cl.array.zeros(queue, 1, dtype=np.int32)
-
-        evt = knl_info.translation_class_finder(
-                trav.from_sep_siblings_lists,
-                trav.from_sep_siblings_starts,
-                trav.target_or_target_parent_boxes,
-                trav.ntarget_or_target_parent_boxes,
-                tree.box_centers,
-                tree.aligned_nboxes,
-                tree.root_extent,
-                tree.box_levels,
-                well_sep_is_n_away,
-                translation_classes_lists,
-                translation_class_is_used,
-                error_flag,
-                queue=queue, wait_for=wait_for)
-
-        if (error_flag.get()):
-            raise ValueError("could not compute translation classes")
-
-        # }}}
+        translation_classes_lists, translation_class_is_used, evt = \
+                self.find_translation_classes(queue, trav, tree, wait_for)
 
         # {{{ convert translation classes to rotation classes
 
@@ -694,7 +694,11 @@ class ConstantOneExpansionWrangler(object):
         # 3 is the last relevant source_level.
         # 2 is the last relevant target_level.
         # (because no level 1 box will be well-separated from another)
-        for source_level in range(tree.nlevels-1, 2, -1):
+        #
+        # With periodic images, level 1 and 2 boxes may be well-separated
+        # from images of other boxes, so all levels are relevant.
+        last_source_level = 0 if getattr(tree, "periodic", False) else 2
+        for source_level in range(tree.nlevels-1, last_source_level, -1):
             target_level = source_level - 1
             start, stop = level_start_source_parent_box_nrs[
                             target_level:target_level+2]
@@ -22,6 +22,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import six
 import numpy as np
 from pytools import Record, memoize_method
 import pyopencl as cl
@@ -119,6 +120,36 @@ TRAVERSAL_PREAMBLE_MAKO_DEFS = r"""//CL:mako//
         );
 </%def>
 
+<%def name="apply_periodic_shift(name, shift_code)">
+    %if periodic:
+    {
+        // Move ${name} opposite to the shift of the periodic image of the
+        // source boxes under consideration. The shift codes enumerate the
+        // shifts in lexicographic order, with the last axis varying fastest.
+        int shift_code_rem = ${shift_code};
+        %for i in reversed(range(dimensions)):
+            ${name}.s${i} -= (
+                shift_code_rem % ${2*well_sep_is_n_away + 1}
+                - ${well_sep_is_n_away}) * root_extent;
+            shift_code_rem /= ${2*well_sep_is_n_away + 1};
+        %endfor
+    }
+    %endif
+</%def>
+
+<%def name="periodic_shift_is_zero(shift_code)">
+    (${shift_code} == ${nperiodic_shifts // 2})
+</%def>
+
+<%def name="append_shifted(list_name, box_id, shift_code)">
+    {
+        APPEND_${list_name}(${box_id});
+        %if periodic:
+            APPEND_${list_name}_shifts(${shift_code});
+        %endif
+    }
+</%def>
+
 <%def name="load_true_box_extent(name, box_id, kind, declare=True)">
     %if declare:
         coord_vec_t ${name}_ext_center, ${name}_radii_vec;
@@ -142,6 +173,21 @@ TRAVERSAL_PREAMBLE_MAKO_DEFS = r"""//CL:mako//
     }
 </%def>
 
+<%def name="load_stencil_grid_coords(name, center, level)">
+    // Integer coordinates of the box with the given center on the uniform
+    // grid of boxes on the given level.
+    long ${name}[${dimensions}];
+    {
+        ${load_center("root_center", "0")}
+        coord_t grid_spacing = 2 * LEVEL_TO_RAD(${level});
+        %for i in range(dimensions):
+            ${name}[${i}] = (long) floor(
+                (${center}.s${i} - (root_center.s${i} - root_extent / 2))
+                / grid_spacing);
+        %endfor
+    }
+</%def>
+
 <%def name="check_l_infty_ball_overlap(
         is_overlapping, box_id, ball_radius, ball_center)">
     {
@@ -156,6 +202,24 @@ TRAVERSAL_PREAMBLE_MAKO_DEFS = r"""//CL:mako//
         ${is_overlapping} = max_dist <= size_sum;
     }
 </%def>
+
+<%def name="check_l2_ball_overlap(
+        is_overlapping, box_id, ball_radius, ball_center)">
+    {
+        ${load_center("box_center", box_id)}
+        int box_level = box_levels[${box_id}];
+        coord_t box_rad = LEVEL_TO_RAD(box_level);
+        coord_t dist_sq = 0;
+        %for i in range(dimensions):
+        {
+            coord_t d = fmax((coord_t) 0,
+                fabs(${ball_center}.s${i} - box_center.s${i}) - box_rad);
+            dist_sq += d * d;
+        }
+        %endfor
+        ${is_overlapping} = dist_sq <= ${ball_radius} * ${ball_radius};
+    }
+</%def>
 """
 
 
@@ -265,6 +329,85 @@ inline bool is_adjacent_or_overlapping(
 
 # }}}
 
+# {{{ opening-angle multipole acceptance criterion
+
+MAC_HELPER_FUNCTION_TEMPLATE = r"""//CL//
+
+/*
+Opening-angle ("theta") multipole acceptance criterion, in the style of
+Barnes and Hut. A pair of same-level boxes is considered well-separated
+if
+
+    (r_target + r_source) <= theta * |c_target - c_source|_2
+
+where r is a radius of a ball around the box center containing everything
+in the box, and c is the box center. Boxes that are adjacent or overlapping
+never meet the criterion.
+
+With mac_extent == "static", r is the circumradius of the box. With
+mac_extent == "precise", r is the radius of the smallest ball centered
+at the box center that contains the bounding box of the box's particles
+(including their extent, if any). Note that boxes without particles
+have a radius of zero in that case.
+*/
+
+inline coord_t get_mac_radius(
+    coord_t root_extent,
+    coord_vec_t center, int level,
+    box_id_t box_id, box_id_t aligned_nboxes,
+    __global const coord_t *bbox_min,
+    __global const coord_t *bbox_max)
+{
+    %if mac_extent == "static":
+        return sqrt((coord_t) ${dimensions}) * LEVEL_TO_RAD(level);
+    %elif mac_extent == "precise":
+        coord_t rad_squared = 0;
+        %for i in range(dimensions):
+        {
+            coord_t axis_rad = fmax(
+                center.s${i} - bbox_min[${i} * aligned_nboxes + box_id],
+                bbox_max[${i} * aligned_nboxes + box_id] - center.s${i});
+            rad_squared += square(fmax(axis_rad, (coord_t) 0));
+        }
+        %endfor
+        return sqrt(rad_squared);
+    %endif
+}
+
+inline bool meets_mac(
+    coord_t root_extent,
+    box_id_t aligned_nboxes,
+    coord_vec_t target_center, int target_level, box_id_t target_box_id,
+    __global const coord_t *box_target_bounding_box_min,
+    __global const coord_t *box_target_bounding_box_max,
+    coord_vec_t source_center, int source_level, box_id_t source_box_id,
+    __global const coord_t *box_source_bounding_box_min,
+    __global const coord_t *box_source_bounding_box_max)
+{
+    if (is_adjacent_or_overlapping(root_extent,
+            target_center, target_level, source_center, source_level))
+        return false;
+
+    coord_t rad_sum = (
+        get_mac_radius(root_extent,
+            target_center, target_level, target_box_id, aligned_nboxes,
+            box_target_bounding_box_min, box_target_bounding_box_max)
+        + get_mac_radius(root_extent,
+            source_center, source_level, source_box_id, aligned_nboxes,
+            box_source_bounding_box_min, box_source_bounding_box_max));
+
+    coord_t dist_squared = 0;
+    %for i in range(dimensions):
+        dist_squared += square(target_center.s${i} - source_center.s${i});
+    %endfor
+
+    return rad_sum <= ${repr(mac_theta)} * sqrt(dist_squared);
+}
+
+"""
+
+# }}}
+
 # {{{ sources and their parents, targets
 
 SOURCES_PARENTS_AND_TARGETS_TEMPLATE = r"""//CL//
@@ -279,17 +422,99 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
     if (flags & BOX_HAS_CHILD_SOURCES)
     { APPEND_source_parent_boxes(box_id); }
 
-    %if not sources_are_targets:
-        if (flags & BOX_HAS_OWN_TARGETS)
+    %if have_target_mask:
+        unsigned char mask = target_box_mask[box_id];
+
+        if (mask & ${TARGET_BOX_MASK_SELECTED})
         { APPEND_target_boxes(box_id); }
+        if (mask)
+        { APPEND_target_or_target_parent_boxes(box_id); }
+    %else:
+        %if not sources_are_targets:
+            if (flags & BOX_HAS_OWN_TARGETS)
+            { APPEND_target_boxes(box_id); }
+        %endif
+        if (flags & (BOX_HAS_CHILD_TARGETS | BOX_HAS_OWN_TARGETS))
+        { APPEND_target_or_target_parent_boxes(box_id); }
     %endif
-    if (flags & (BOX_HAS_CHILD_TARGETS | BOX_HAS_OWN_TARGETS))
-    { APPEND_target_or_target_parent_boxes(box_id); }
 }
 """
 
 # }}}
 
+# {{{ target box mask
+
+# A target box mask has one entry per box. Boxes that own selected targets
+# have TARGET_BOX_MASK_SELECTED set, their ancestors have
+# TARGET_BOX_MASK_ANCESTOR set. All other boxes have a zero entry.
+
+TARGET_BOX_MASK_SELECTED = 1
+TARGET_BOX_MASK_ANCESTOR = 2
+
+TARGET_BOX_MASK_FROM_FLAGS_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL:mako//
+    box_flags_t *box_flags,
+    particle_id_t *box_target_starts,
+    particle_id_t *box_target_counts_nonchild,
+    flag_t *flags,
+    unsigned char *target_box_mask,
+    """,
+
+    operation=r"""//CL:mako//
+        box_id_t box_id = i;
+        unsigned char selected = 0;
+
+        if (box_flags[box_id] & ${box_flags_enum.HAS_OWN_TARGETS})
+        {
+            %if per_target_flags:
+                particle_id_t start = box_target_starts[box_id];
+                particle_id_t stop = start + box_target_counts_nonchild[box_id];
+
+                // flags are in tree target order
+                for (particle_id_t itgt = start; itgt < stop; ++itgt)
+                    if (flags[itgt])
+                    {
+                        selected = 1;
+                        break;
+                    }
+            %else:
+                selected = (flags[box_id] != 0);
+            %endif
+        }
+
+        target_box_mask[box_id] = selected ? ${TARGET_BOX_MASK_SELECTED} : 0;
+    """,
+    name="target_box_mask_from_flags")
+
+
+TARGET_BOX_MASK_ANCESTOR_MARKER_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL:mako//
+    box_id_t *box_parent_ids,
+    unsigned char *target_box_mask,
+    """,
+
+    operation=r"""//CL:mako//
+        box_id_t box_id = i;
+
+        if (!(target_box_mask[box_id] & ${TARGET_BOX_MASK_SELECTED}))
+            PYOPENCL_ELWISE_CONTINUE;
+
+        // Concurrent updates only ever set the same bit, so the
+        // unsynchronized read-modify-write is harmless. Once an ancestor
+        // is found marked, whoever marked it also marks the rest of the
+        // chain.
+        while (box_id != 0)
+        {
+            box_id = box_parent_ids[box_id];
+            if (target_box_mask[box_id] & ${TARGET_BOX_MASK_ANCESTOR})
+                break;
+            target_box_mask[box_id] |= ${TARGET_BOX_MASK_ANCESTOR};
+        }
+    """,
+    name="mark_target_box_mask_ancestors")
+
+# }}}
+
 # {{{ level start box nrs
 
 LEVEL_START_BOX_NR_EXTRACTOR_TEMPLATE = ElementwiseTemplate(
@@ -419,6 +644,50 @@ BOX_EXTENTS_FINDER_TEMPLATE = ElementwiseTemplate(
 
 # }}}
 
+# {{{ stencil grids
+
+# For levels in which the tree is (close to) uniform, the same-level
+# non-well-separated boxes and "list 2" are given by a fixed stencil of
+# same-level offsets. To look up the boxes at these offsets, these levels
+# get a dense grid mapping integer box coordinates to box ids, with 0
+# indicating absence of a box.
+
+STENCIL_GRID_BUILDER_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL:mako//
+    coord_t *box_centers,
+    coord_t root_extent,
+    box_level_t *box_levels,
+    box_id_t aligned_nboxes,
+    long *level_stencil_grid_starts,
+    box_id_t *stencil_grid,
+    """,
+
+    operation=TRAVERSAL_PREAMBLE_MAKO_DEFS + r"""//CL:mako//
+        box_id_t box_id = i;
+        int level = box_levels[box_id];
+
+        long grid_start = level_stencil_grid_starts[level];
+        if (grid_start < 0)
+            PYOPENCL_ELWISE_CONTINUE;
+
+        ${load_center("center", "box_id")}
+        ${load_stencil_grid_coords("grid_coords", "center", "level")}
+
+        long grid_index = 0;
+        %for i in range(dimensions):
+            grid_index = (grid_index << level) + grid_coords[${i}];
+        %endfor
+
+        stencil_grid[grid_start + grid_index] = box_id;
+    """,
+    name="build_stencil_grid",
+    preamble=r"""//CL//
+    #define LEVEL_TO_RAD(level) \
+            (root_extent * 1 / (coord_t) (1 << (level + 1)))
+    """)
+
+# }}}
+
 # {{{ same-level non-well-separated boxes (generalization of "colleagues")
 
 SAME_LEVEL_NON_WELL_SEP_BOXES_TEMPLATE = r"""//CL//
@@ -429,14 +698,102 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
 
     if (box_id == 0)
     {
+        %if periodic:
+            // The root's periodic images are the only boxes on its level.
+            for (int shift_code = 0; shift_code < ${nperiodic_shifts};
+                    ++shift_code)
+                if (!${periodic_shift_is_zero("shift_code")})
+                    ${append_shifted(
+                        "same_level_non_well_sep_boxes", "0", "shift_code")}
+        %endif
+
         // The root has no boxes on the same level, nws or not.
         return;
     }
 
+    %if have_target_mask:
+        // Only target boxes and their parents ever look at their
+        // same-level boxes.
+        if (!target_box_mask[box_id])
+            return;
+    %endif
+
     int level = box_levels[box_id];
 
     dbg_printf(("box id: %d level: %d\n", box_id, level));
 
+    %if use_stencils:
+    {
+        long grid_start = level_stencil_grid_starts[level];
+        if (grid_start >= 0)
+        {
+            // This level is uniform enough to have a grid. Look up the
+            // same-level boxes in the n-away neighborhood directly.
+            ${load_stencil_grid_coords("grid_coords", "center", "level")}
+            const long level_grid_size = 1L << level;
+
+            %for i in range(dimensions):
+            for (long offset${i} = -${well_sep_is_n_away};
+                    offset${i} <= ${well_sep_is_n_away}; ++offset${i})
+            %endfor
+            {
+                %for i in range(dimensions):
+                    long nb_coord${i} = grid_coords[${i}] + offset${i};
+                %endfor
+
+                if (
+                    %for i in range(dimensions):
+                        offset${i} == 0 &&
+                    %endfor
+                    true)
+                    continue;
+
+                if (
+                    %for i in range(dimensions):
+                        nb_coord${i} < 0 || nb_coord${i} >= level_grid_size ||
+                    %endfor
+                    false)
+                    continue;
+
+                long grid_index = 0;
+                %for i in range(dimensions):
+                    grid_index = (grid_index << level) + nb_coord${i};
+                %endfor
+
+                box_id_t nb_box_id = stencil_grid[grid_start + grid_index];
+                if (nb_box_id)
+                    APPEND_same_level_non_well_sep_boxes(nb_box_id);
+            }
+
+            return;
+        }
+    }
+    %endif
+
+    %if mac_theta is not None:
+        // With the opening-angle criterion, a box at level k is only
+        // descended into if it fails the criterion with respect to the
+        // level-k ancestor of box_id. This guarantees that each nws box
+        // is a child of an nws box of the parent (or a sibling), which is
+        // what "list 2" relies on.
+        box_id_t ancestor_ids[NLEVELS];
+        {
+            box_id_t ancestor_id = box_id;
+            for (int ancestor_level = level; ancestor_level >= 0; --ancestor_level)
+            {
+                ancestor_ids[ancestor_level] = ancestor_id;
+                ancestor_id = box_parent_ids[ancestor_id];
+            }
+        }
+    %endif
+
+    %if periodic:
+    for (int shift_code = 0; shift_code < ${nperiodic_shifts}; ++shift_code)
+    {
+        ${load_center("center", "box_id", declare=False)}
+        ${apply_periodic_shift("center", "shift_code")}
+    %endif
+
     // To find this box's same-level nws boxes, start at the top of the tree, descend
     // into adjacent (or overlapping) parents.
     ${walk_init(0)}
@@ -452,19 +809,47 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
         {
             ${load_center("walk_center", "walk_box_id")}
 
-            bool a_or_o = is_adjacent_or_overlapping_with_neighborhood(
-                    root_extent,
-                    center, level,
-                    ${well_sep_is_n_away},
-                    walk_center, box_levels[walk_box_id]);
+            %if mac_theta is None:
+                bool a_or_o = is_adjacent_or_overlapping_with_neighborhood(
+                        root_extent,
+                        center, level,
+                        ${well_sep_is_n_away},
+                        walk_center, box_levels[walk_box_id]);
+            %else:
+                box_id_t ancestor_id = ancestor_ids[walk_stack_size+1];
+                ${load_center("ancestor_center", "ancestor_id")}
+
+                bool a_or_o = !meets_mac(
+                        root_extent, aligned_nboxes,
+                        ancestor_center, walk_stack_size+1, ancestor_id,
+                        box_target_bounding_box_min, box_target_bounding_box_max,
+                        walk_center, box_levels[walk_box_id], walk_box_id,
+                        box_source_bounding_box_min, box_source_bounding_box_max);
+            %endif
 
             if (a_or_o)
             {
+                <%def name="is_other_box()">
+                    %if periodic:
+                    (walk_box_id != box_id
+                        || !${periodic_shift_is_zero("shift_code")})
+                    %else:
+                    (walk_box_id != box_id)
+                    %endif
+                </%def>
+
                 // walk_box_id lives on level walk_stack_size+1.
-                if (walk_stack_size+1 == level && walk_box_id != box_id)
+                if (walk_stack_size+1 == level)
                 {
-                    dbg_printf(("    found same-lev nws\n"));
-                    APPEND_same_level_non_well_sep_boxes(walk_box_id);
+                    // Never descend at box_id's own level: box_id's subtree
+                    // holds no same-level boxes, and for the opening-angle
+                    // criterion its ancestors are only known up to its level.
+                    if ${is_other_box()}
+                    {
+                        dbg_printf(("    found same-lev nws\n"));
+                        ${append_shifted("same_level_non_well_sep_boxes",
+                            "walk_box_id", "shift_code")}
+                    }
                 }
                 else
                 {
@@ -485,6 +870,10 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
 
         ${walk_advance()}
     }
+
+    %if periodic:
+    }
+    %endif
 }
 
 """
@@ -508,15 +897,32 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
 
     dbg_printf(("box id: %d level: %d\n", box_id, level));
 
+    %if periodic:
+    for (int shift_code = 0; shift_code < ${nperiodic_shifts}; ++shift_code)
+    {
+        ${load_center("center", "box_id", declare=False)}
+        ${apply_periodic_shift("center", "shift_code")}
+    %endif
+
     // root box is not part of walk, check it up front.
     // Also no need to check for overlap-iness. The root box
     // overlaps *everybody*.
 
     {
         box_flags_t root_flags = box_flags[0];
-        if (root_flags & BOX_HAS_OWN_SOURCES)
+        %if periodic:
+            // ...but its periodic images need not.
+            ${load_center("root_center", "0")}
+            bool root_is_neighbor = ${periodic_shift_is_zero("shift_code")}
+                || is_adjacent_or_overlapping(root_extent,
+                    center, level, root_center, 0);
+        %else:
+            bool root_is_neighbor = true;
+        %endif
+
+        if ((root_flags & BOX_HAS_OWN_SOURCES) && root_is_neighbor)
         {
-            APPEND_neighbor_source_boxes(0);
+            ${append_shifted("neighbor_source_boxes", "0", "shift_code")}
         }
     }
 
@@ -548,7 +954,8 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                 {
                     dbg_printf(("    neighbor source box\n"));
 
-                    APPEND_neighbor_source_boxes(walk_box_id);
+                    ${append_shifted("neighbor_source_boxes",
+                        "walk_box_id", "shift_code")}
                 }
 
                 if (flags & BOX_HAS_CHILD_SOURCES)
@@ -571,6 +978,10 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
 
         ${walk_advance()}
     }
+
+    %if periodic:
+    }
+    %endif
 }
 
 """
@@ -593,6 +1004,67 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
     if (parent == box_id)
         return;
 
+    %if use_stencils:
+    {
+        long grid_start = level_stencil_grid_starts[level];
+        if (grid_start >= 0)
+        {
+            // This level is uniform enough to have a grid. List 2 consists
+            // of the same-level boxes that are not in the n-away
+            // neighborhood of box_id, but whose parents are in the n-away
+            // neighborhood of box_id's parent.
+            ${load_stencil_grid_coords("grid_coords", "center", "level")}
+            const long level_grid_size = 1L << level;
+            <% stencil_rad = 2*well_sep_is_n_away + 1 %>
+
+            %for i in range(dimensions):
+            for (long offset${i} = -${stencil_rad};
+                    offset${i} <= ${stencil_rad}; ++offset${i})
+            %endfor
+            {
+                %for i in range(dimensions):
+                    long sib_coord${i} = grid_coords[${i}] + offset${i};
+                %endfor
+
+                if (
+                    %for i in range(dimensions):
+                        sib_coord${i} < 0 || sib_coord${i} >= level_grid_size ||
+                    %endfor
+                    false)
+                    continue;
+
+                // not well-separated
+                if (
+                    %for i in range(dimensions):
+                        abs(offset${i}) <= ${well_sep_is_n_away} &&
+                    %endfor
+                    true)
+                    continue;
+
+                // parent not in the parent's n-away neighborhood
+                if (
+                    %for i in range(dimensions):
+                        abs((sib_coord${i} >> 1) - (grid_coords[${i}] >> 1))
+                            > ${well_sep_is_n_away} ||
+                    %endfor
+                    false)
+                    continue;
+
+                long grid_index = 0;
+                %for i in range(dimensions):
+                    grid_index = (grid_index << level) + sib_coord${i};
+                %endfor
+
+                box_id_t sib_box_id = stencil_grid[grid_start + grid_index];
+                if (sib_box_id)
+                    APPEND_from_sep_siblings(sib_box_id);
+            }
+
+            return;
+        }
+    }
+    %endif
+
     box_id_t parent_slnf_start = same_level_non_well_sep_boxes_starts[parent];
     box_id_t parent_slnf_stop = same_level_non_well_sep_boxes_starts[parent+1];
 
@@ -601,6 +1073,14 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
     {
         box_id_t parent_nf = same_level_non_well_sep_boxes_lists[i];
 
+        %if periodic:
+            // Consider the periodic image of parent_nf (and hence of its
+            // children) that this entry refers to.
+            int shift_code = same_level_non_well_sep_boxes_shifts[i];
+            ${load_center("center", "box_id", declare=False)}
+            ${apply_periodic_shift("center", "shift_code")}
+        %endif
+
         for (int morton_nr = 0; morton_nr < ${2**dimensions}; ++morton_nr)
         {
             box_id_t sib_box_id = box_child_ids[
@@ -611,15 +1091,24 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 
             ${load_center("sib_center", "sib_box_id")}
 
-            bool sep = !is_adjacent_or_overlapping_with_neighborhood(
-                root_extent,
-                center, level,
-                ${well_sep_is_n_away},
-                sib_center, box_levels[sib_box_id]);
+            %if mac_theta is None:
+                bool sep = !is_adjacent_or_overlapping_with_neighborhood(
+                    root_extent,
+                    center, level,
+                    ${well_sep_is_n_away},
+                    sib_center, box_levels[sib_box_id]);
+            %else:
+                bool sep = meets_mac(
+                    root_extent, aligned_nboxes,
+                    center, level, box_id,
+                    box_target_bounding_box_min, box_target_bounding_box_max,
+                    sib_center, box_levels[sib_box_id], sib_box_id,
+                    box_source_bounding_box_min, box_source_bounding_box_max);
+            %endif
 
             if (sep)
             {
-                APPEND_from_sep_siblings(sib_box_id);
+                ${append_shifted("from_sep_siblings", "sib_box_id", "shift_code")}
             }
         }
     }
@@ -663,7 +1152,20 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
     {
         box_id_t same_lev_nws_box = same_level_non_well_sep_boxes_lists[i];
 
+        %if periodic:
+            // Consider the periodic image of same_lev_nws_box that this entry
+            // refers to.
+            int shift_code = same_level_non_well_sep_boxes_shifts[i];
+            ${load_center("tgt_center", "tgt_box_id", declare=False)}
+            ${apply_periodic_shift("tgt_center", "shift_code")}
+        %endif
+
+        %if periodic:
+        if (same_lev_nws_box == tgt_box_id
+                && ${periodic_shift_is_zero("shift_code")})
+        %else:
         if (same_lev_nws_box == tgt_box_id)
+        %endif
             continue;
 
         // Colleagues (same-level NWS boxes) for 1-away are always adjacent, so
@@ -695,6 +1197,9 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
             // from_sep_close_smaller ("list 3 close") for the interaction to be
             // done by direct evaluation. We also need to descend into that
             // child.
+            //
+            // The same applies if an opening-angle criterion is in use and
+            // the child box fails it.
 
             ${walk_get_box_id()}
 
@@ -838,6 +1343,21 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                             % from_sep_smaller_crit) %>
                     %endif
 
+                    %if mac_theta is not None:
+                        // Non-adjacent boxes failing the opening-angle
+                        // criterion are treated like those too close for
+                        // their stick-out: they go to the "close" list and
+                        // are descended into.
+                        meets_sep_crit = meets_sep_crit && meets_mac(
+                            root_extent, aligned_nboxes,
+                            tgt_center, tgt_level, tgt_box_id,
+                            box_target_bounding_box_min,
+                            box_target_bounding_box_max,
+                            walk_center, walk_level, walk_box_id,
+                            box_source_bounding_box_min,
+                            box_source_bounding_box_max);
+                    %endif
+
                     // We're no longer *immediately* adjacent to our target
                     // box, but our stick-out regions might still have a
                     // non-empty intersection.
@@ -847,23 +1367,24 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                     // This is a performance optimization.
 
                     bool close_lists_exist = ${"true" \
-                        if sources_have_extent or targets_have_extent \
+                        if have_close_lists \
                         else "false"};
 
                     bool force_close_list_for_low_interaction_count =
                         close_lists_exist &&
                         (box_source_counts_cumul[walk_box_id]
-                            < from_sep_smaller_min_nsources_cumul);
+                            < from_sep_smaller_min_nsources_cumul[walk_level]);
 
                     if (meets_sep_crit &&
                         !force_close_list_for_low_interaction_count)
                     {
                         if (from_sep_smaller_source_level == walk_level)
-                            APPEND_from_sep_smaller(walk_box_id);
+                            ${append_shifted("from_sep_smaller",
+                                "walk_box_id", "shift_code")}
                     }
                     else
                     {
-                    %if sources_have_extent or targets_have_extent:
+                    %if have_close_lists:
                         // from_sep_smaller_source_level == -1 means "only build
                         // list 3 close", with sources on any level.
                         // This kernel will be run once per source level to
@@ -942,6 +1463,13 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
 # propagation at this box (noting that this can only happen in the with-extents
 # case), the interaction is added to the (non-downward-propagating) 'list 4
 # close' (from_sep_close_bigger).
+#
+# Case III: Opening-angle criterion
+#
+# The opening-angle criterion (mac_theta) takes the role of the 'separation
+# requirement' of case II. Since it need not be monotone, the kernel checks
+# all ancestors from the level of the source box down to the parent, rather
+# than just the parent.
 
 
 FROM_SEP_BIGGER_TEMPLATE = r"""//CL//
@@ -1044,6 +1572,17 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
         {
             box_id_t slnws_box_id = same_level_non_well_sep_boxes_lists[i];
 
+            %if periodic:
+                // Consider the periodic image of slnws_box_id that this
+                // entry refers to.
+                int shift_code = same_level_non_well_sep_boxes_shifts[i];
+                ${load_center("tgt_box_center", "tgt_ibox", declare=False)}
+                ${apply_periodic_shift("tgt_box_center", "shift_code")}
+                ${load_center("parent_center", "tgt_parent_box_id",
+                    declare=False)}
+                ${apply_periodic_shift("parent_center", "shift_code")}
+            %endif
+
             if (box_flags[slnws_box_id] & BOX_HAS_OWN_SOURCES)
             {
                 ${load_center("slnws_center", "slnws_box_id")}
@@ -1054,6 +1593,65 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 
                 if (!in_list_1)
                 {
+                %if mac_theta is not None:
+                    <%def name="meets_list_4_crit(box_center, box_level, box_id)">
+                        (meets_mac(root_extent, aligned_nboxes,
+                            ${box_center}, ${box_level}, ${box_id},
+                            box_target_bounding_box_min,
+                            box_target_bounding_box_max,
+                            slnws_center, walk_level, slnws_box_id,
+                            box_source_bounding_box_min,
+                            box_source_bounding_box_max)
+                        %if sources_have_extent or targets_have_extent:
+                            && meets_sep_bigger_criterion(root_extent,
+                                ${box_center}, ${box_level},
+                                slnws_center, walk_level,
+                                stick_out_factor)
+                        %endif
+                        )
+                    </%def>
+
+                    /*
+                    With the opening-angle criterion, the interaction enters
+                    the downward propagation at the first box down the chain
+                    of ancestors (starting at walk_level) that meets the
+                    criterion. With mac_extent == "precise", the criterion
+                    is not necessarily monotone, so check the whole chain
+                    rather than just the parent.
+                    */
+                    bool met_by_ancestor = false;
+                    {
+                        box_id_t anc_box_id = tgt_parent_box_id;
+                        for (int anc_level = tgt_parent_level;
+                                anc_level >= walk_level && !met_by_ancestor;
+                                --anc_level)
+                        {
+                            ${load_center("anc_center", "anc_box_id")}
+                            ${apply_periodic_shift("anc_center", "shift_code")}
+
+                            met_by_ancestor = ${meets_list_4_crit(
+                                "anc_center", "anc_level", "anc_box_id")};
+                            anc_box_id = box_parent_ids[anc_box_id];
+                        }
+                    }
+
+                    if (!met_by_ancestor)
+                    {
+                        if (${meets_list_4_crit(
+                                "tgt_box_center", "tgt_box_level", "tgt_ibox")})
+                        {
+                            ${append_shifted("from_sep_bigger",
+                                "slnws_box_id", "shift_code")}
+                        }
+                        else if (tgt_box_flags & BOX_HAS_OWN_TARGETS)
+                        {
+                            // Too close for list 4 proper, and the
+                            // interaction has not entered the downward
+                            // propagation above.
+                            APPEND_from_sep_close_bigger(slnws_box_id);
+                        }
+                    }
+                %else:
                     %if sources_have_extent or targets_have_extent:
                         /*
                         With-extent list 4 separation criterion.
@@ -1139,7 +1737,8 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 
                                 if (!parent_meets_with_ext_sep_criterion)
                                 {
-                                    APPEND_from_sep_bigger(slnws_box_id);
+                                    ${append_shifted("from_sep_bigger",
+                                        "slnws_box_id", "shift_code")}
                                 }
                             %endif
                         }
@@ -1150,9 +1749,11 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
                             away to let the interaction into our local downward
                             propagation.
                             */
-                            APPEND_from_sep_bigger(slnws_box_id);
+                            ${append_shifted("from_sep_bigger",
+                                "slnws_box_id", "shift_code")}
                         }
                     }
+                %endif
                 }
             }
         }
@@ -1163,41 +1764,186 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 # }}}
 
 
-# {{{ list merger
+# {{{ treecode ("Barnes-Hut") interactions
 
-LIST_MERGER_TEMPLATE = ElementwiseTemplate(
-    arguments=r"""//CL:mako//
-    /* input: */
+TREECODE_TEMPLATE = r"""//CL//
 
-    box_id_t *output_to_input_box,
+void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
+{
+    // /!\ target_box_number is *not* a box_id, despite the type.
+    // It's the number of the target box we're currently processing.
 
-    %for ilist in range(nlists):
-        box_id_t *list${ilist}_starts,
-    %endfor
+    box_id_t tgt_box_id = target_boxes[target_box_number];
 
-    %if not write_counts:
-    %for ilist in range(nlists):
-        const box_id_t *list${ilist}_lists,
-    %endfor
-        const box_id_t *new_starts,
-    %endif
+    ${load_center("tgt_center", "tgt_box_id")}
 
-    /* output: */
+    int tgt_level = box_levels[tgt_box_id];
 
-    %if not write_counts:
-        box_id_t *new_lists,
-    %else:
-        box_id_t *new_counts,
-    %endif
-    """,
+    // Accepted boxes from all levels go into a single list, which is split
+    // by source level afterwards (see ACCEPTED_LEVEL_SPLITTER_TEMPLATE).
 
-    operation=r"""//CL:mako//
-        /* Compute output and input indices. */
-        const box_id_t ioutput_box = i;
-        const box_id_t ibox = output_to_input_box[ioutput_box];
+    // The root box contains the target box and thus never meets the
+    // criterion.
+    if (box_flags[0] & BOX_HAS_OWN_SOURCES)
+    {
+        APPEND_near_field_source_boxes(0);
+    }
 
-        /* Count the size of the input at the current index. */
-        %for ilist in range(nlists):
+    ${walk_init(0)}
+
+    while (continue_walk)
+    {
+        ${walk_get_box_id()}
+
+        dbg_printf(("  walk parent box id: %d morton: %d child id: %d level: %d\n",
+            walk_parent_box_id, walk_morton_nr, walk_box_id, walk_stack_size));
+
+        if (walk_box_id)
+        {
+            box_flags_t flags = box_flags[walk_box_id];
+
+            // walk_box_id lives on level walk_stack_size+1.
+            int walk_level = walk_stack_size + 1;
+
+            if (flags & (BOX_HAS_OWN_SOURCES | BOX_HAS_CHILD_SOURCES))
+            {
+                ${load_center("walk_center", "walk_box_id")}
+
+                // Expansion wranglers assume that boxes on levels 0 and 1
+                // are never well-separated from anything, and do not
+                // provide multipoles for them.
+                bool accepted = walk_level >= 2 && meets_mac(
+                    root_extent, aligned_nboxes,
+                    tgt_center, tgt_level, tgt_box_id,
+                    box_target_bounding_box_min, box_target_bounding_box_max,
+                    walk_center, walk_level, walk_box_id,
+                    box_source_bounding_box_min, box_source_bounding_box_max);
+
+                if (accepted)
+                {
+                    dbg_printf(("    accepted source box\n"));
+                    APPEND_accepted_source_boxes(walk_box_id);
+                }
+                else
+                {
+                    if (flags & BOX_HAS_OWN_SOURCES)
+                    {
+                        dbg_printf(("    near-field source box\n"));
+                        APPEND_near_field_source_boxes(walk_box_id);
+                    }
+
+                    if (flags & BOX_HAS_CHILD_SOURCES)
+                    {
+                        dbg_printf(("    descend\n"));
+                        ${walk_push("walk_box_id")}
+
+                        continue;
+                    }
+                }
+            }
+        }
+
+        ${walk_advance()}
+    }
+}
+"""
+
+
+# Splits the accepted source box list, which holds boxes from all levels, into
+# one list per source level, using a counting pass and a copying pass. The
+# per-level lists are stored back to back, with key
+# ``source_level * ntarget_boxes + target_box_number``.
+ACCEPTED_LEVEL_SPLITTER_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+    /* input: */
+    int nlevels,
+    box_id_t ntarget_boxes,
+    const box_id_t *accepted_starts,
+    const box_id_t *accepted_lists,
+    const box_level_t *box_levels,
+
+    %if not write_counts:
+        const box_id_t *level_key_starts,
+    %endif
+
+    /* output: */
+
+    %if not write_counts:
+        box_id_t *level_lists,
+    %else:
+        box_id_t *level_key_counts,
+    %endif
+    """,
+
+    operation=r"""//CL:mako//
+        box_id_t level_idx[${max_levels}];
+
+        for (int ilevel = 0; ilevel < nlevels; ++ilevel)
+        %if write_counts:
+            level_idx[ilevel] = 0;
+        %else:
+            level_idx[ilevel] = level_key_starts[ilevel * ntarget_boxes + i];
+        %endif
+
+        for (box_id_t j = accepted_starts[i]; j < accepted_starts[i+1]; ++j)
+        {
+            %if write_counts:
+                ++level_idx[box_levels[accepted_lists[j]]];
+            %else:
+                const box_id_t src_box_id = accepted_lists[j];
+                level_lists[level_idx[box_levels[src_box_id]]++] = src_box_id;
+            %endif
+        }
+
+        %if write_counts:
+            if (i == 0)
+                level_key_counts[0] = 0;
+
+            for (int ilevel = 0; ilevel < nlevels; ++ilevel)
+                level_key_counts[ilevel * ntarget_boxes + i + 1] =
+                    level_idx[ilevel];
+        %endif
+    """,
+
+    name="split_accepted_by_level")
+
+# }}}
+
+# {{{ list merger
+
+LIST_MERGER_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+    /* input: */
+
+    box_id_t *output_to_input_box,
+
+    %for ilist in range(nlists):
+        box_id_t *list${ilist}_starts,
+    %endfor
+
+    %if not write_counts:
+    %for ilist in range(nlists):
+        const box_id_t *list${ilist}_lists,
+    %endfor
+        const box_id_t *new_starts,
+    %endif
+
+    /* output: */
+
+    %if not write_counts:
+        box_id_t *new_lists,
+    %else:
+        box_id_t *new_counts,
+    %endif
+    """,
+
+    operation=r"""//CL:mako//
+        /* Compute output and input indices. */
+        const box_id_t ioutput_box = i;
+        const box_id_t ibox = output_to_input_box[ioutput_box];
+
+        /* Count the size of the input at the current index. */
+        %for ilist in range(nlists):
             const box_id_t list${ilist}_start = list${ilist}_starts[ibox];
             const box_id_t list${ilist}_count =
                 list${ilist}_starts[ibox + 1] - list${ilist}_start;
@@ -1344,591 +2090,2802 @@ class _ListMerger(object):
 # }}}
 
 
-# {{{ traversal info (output)
-
-class FMMTraversalInfo(DeviceDataRecord):
-    r"""Interaction lists needed for a fast-multipole-like linear-time gather of
-    particle interactions.
+# {{{ compressed box lists
 
-    Terminology (largely) follows this article:
+BOX_LIST_DELTA_CODER_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+    const box_id_t *starts,
+    %if have_reference_boxes:
+        const box_id_t *reference_boxes,
+    %endif
+    %if mode == "decode":
+        const delta_t *deltas,
+        box_id_t *lists,
+    %else:
+        const box_id_t *lists,
+        %if mode == "encode":
+            delta_t *deltas,
+        %else:
+            box_id_t *max_abs_deltas,
+        %endif
+    %endif
+    """,
 
-        Carrier, J., Greengard, L. and Rokhlin, V. "A Fast
-        Adaptive Multipole Algorithm for Particle Simulations." SIAM Journal on
-        Scientific and Statistical Computing 9, no. 4 (July 1988): 669-686.
-        `DOI: 10.1137/0909044 <http://dx.doi.org/10.1137/0909044>`_.
+    operation=r"""//CL:mako//
+        const box_id_t start = starts[i];
+        const box_id_t stop = starts[i + 1];
 
-    Unless otherwise indicated, all bulk data in this data structure is stored
-    in a :class:`pyopencl.array.Array`. See also :meth:`get`.
+        %if have_reference_boxes:
+            box_id_t prev_box = reference_boxes[i];
+        %else:
+            box_id_t prev_box = i;
+        %endif
 
-    .. attribute:: tree
+        %if mode == "find_max":
+            box_id_t max_abs_delta = 0;
+        %endif
 
-        An instance of :class:`boxtree.Tree`.
+        for (box_id_t j = start; j < stop; ++j)
+        {
+            %if mode == "find_max":
+                const box_id_t box = lists[j];
+                const box_id_t abs_delta =
+                    (box > prev_box) ? box - prev_box : prev_box - box;
+                if (abs_delta > max_abs_delta)
+                    max_abs_delta = abs_delta;
+                prev_box = box;
+            %elif mode == "encode":
+                /* The caller made sure that delta_t is wide enough. */
+                deltas[j] = (delta_t) (lists[j] - prev_box);
+                prev_box = lists[j];
+            %else:
+                prev_box = (box_id_t) (prev_box + deltas[j]);
+                lists[j] = prev_box;
+            %endif
+        }
 
-    .. attribute:: nboxes
+        %if mode == "find_max":
+            max_abs_deltas[i] = max_abs_delta;
+        %endif
+    """,
 
-        Number of boxe in the tree.
+    name="delta_code_box_lists")
 
-    .. attribute:: nlevels
 
-        Number of levels in the tree.
+class CompressedBoxList(DeviceDataRecord):
+    """A delta-encoded version of an interaction list in :ref:`csr`. Each
+    entry is stored as the (signed) difference from the preceding entry in the
+    same list, and the first entry of each list as the difference from the
+    list's reference box. Since boxes found by the traversal's tree walks
+    tend to be close in box numbering, the differences are stored in the
+    narrowest integer type that can hold all of them.
 
-    .. attribute:: well_sep_is_n_away
+    Once the data lives on the host (see :meth:`get`), an instance can stand
+    in for the ``box_id_t`` array of list entries it encodes: :func:`len`,
+    slicing (as in ``lists[starts[i]:starts[i+1]]``) and conversion by
+    :func:`numpy.asarray` decode the requested entries on the fly.
 
-        The distance (measured in target box diameters in the :math:`l^\infty`
-        norm) from the edge of the target box at which the 'well-separated'
-        (i.e. M2L-handled) 'far-field' starts.
+    See :class:`BoxListCompressor` and :meth:`FMMTraversalInfo.compress_lists`.
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Basic box lists for iteration
-    .. ------------------------------------------------------------------------
+    .. attribute:: starts
 
-    .. attribute:: source_boxes
+        ``box_id_t [nlists+1]``. Same as in the uncompressed list.
 
-        ``box_id_t [*]``
+    .. attribute:: deltas
 
-        List of boxes having sources.
+        ``int8``, ``int16``, ``int32``, or ``int64`` ``[*]``
 
-    .. attribute:: target_boxes
+    .. attribute:: reference_boxes
 
-        ``box_id_t [*]``
+        ``box_id_t [nlists]``, or *None*, in which case the reference box of
+        list *i* is the box with number *i*. Not owned by this object (it
+        is typically one of the box lists of :class:`FMMTraversalInfo`), and
+        therefore not counted in :attr:`nbytes`.
 
-        List of boxes having targets.
-        If :attr:`boxtree.Tree.sources_are_targets`,
-        then ``target_boxes is source_boxes``.
+    .. attribute:: box_id_dtype
 
-    .. attribute:: ntarget_boxes
+    .. attribute:: nbytes
 
-        Number of :attr:`target_boxes`.
+        Number of bytes used by :attr:`starts` and :attr:`deltas`.
 
-    .. attribute:: source_parent_boxes
+    .. attribute:: uncompressed_nbytes
 
-        ``box_id_t [*]``
+        Number of bytes used by the uncompressed *starts* and *lists*.
 
-        List of boxes that are (directly or indirectly) a parent
-        of one of the :attr:`source_boxes`. These boxes may have sources of their
-        own.
+    .. versionadded:: 2019.1
+    """
 
-    .. attribute:: level_start_source_box_nrs
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.deltas.nbytes
 
-        ``box_id_t [nlevels+1]``
+    @property
+    def uncompressed_nbytes(self):
+        return (self.starts.nbytes
+                + len(self.deltas) * np.dtype(self.box_id_dtype).itemsize)
 
-        Indices into :attr:`source_boxes` indicating where
-        each level starts and ends.
+    def get_box_list(self, index):
+        """Decode and return list number *index*. Only works once the data
+        lives on the host, see :meth:`get`.
+        """
+        start, stop = self.starts[index:index+2]
 
-    .. attribute:: level_start_source_parent_box_nrs
+        if self.reference_boxes is None:
+            reference_box = index
+        else:
+            reference_box = self.reference_boxes[index]
 
-        ``box_id_t [nlevels+1]``
+        return (reference_box
+                + np.cumsum(self.deltas[start:stop], dtype=np.int64)
+                ).astype(self.box_id_dtype)
 
-        Indices into :attr:`source_parent_boxes` indicating where
-        each level starts and ends.
+    # {{{ host-side array interface
 
-    .. attribute:: target_or_target_parent_boxes
+    @property
+    def dtype(self):
+        return np.dtype(self.box_id_dtype)
 
-        ``box_id_t [*]``
+    def __len__(self):
+        return len(self.deltas)
 
-        List of boxes that are one of the :attr:`target_boxes`
-        or their (direct or indirect) parents.
+    def _decode(self, start, stop):
+        if start >= stop:
+            return np.empty(0, self.box_id_dtype)
 
-    .. attribute:: ntarget_or_target_parent_boxes
+        starts = self.starts
 
-        Number of :attr:`target_or_target_parent_boxes`.
+        # Decoding needs to begin at the start of the list containing *start*.
+        first_list = np.searchsorted(starts, start, side="right") - 1
+        decode_start = starts[first_list]
 
-    .. attribute:: level_start_target_box_nrs
+        entry_nrs = np.arange(decode_start, stop)
+        entry_lists = np.searchsorted(starts, entry_nrs, side="right") - 1
+        is_list_start = entry_nrs == starts[entry_lists]
 
-        ``box_id_t [nlevels+1]``
+        if self.reference_boxes is None:
+            reference_boxes = entry_lists
+        else:
+            reference_boxes = self.reference_boxes[entry_lists]
 
-        Indices into :attr:`target_boxes` indicating where
-        each level starts and ends.
+        values = self.deltas[decode_start:stop].astype(np.int64)
+        values[is_list_start] += reference_boxes[is_list_start]
 
-    .. attribute:: level_start_target_or_target_parent_box_nrs
+        # cumulative sum, restarted at each list start
+        cumsum = np.cumsum(values)
+        list_start_idx = np.flatnonzero(is_list_start)
+        list_offsets = cumsum[list_start_idx] - values[list_start_idx]
+        values = cumsum - list_offsets[np.cumsum(is_list_start) - 1]
 
-        ``box_id_t [nlevels+1]``
+        return values[start - decode_start:].astype(self.box_id_dtype)
 
-        Indices into :attr:`target_or_target_parent_boxes` indicating where
-        each level starts and ends.
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError("%s only supports slicing" % type(self).__name__)
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Particle-adaptive box extents
-    .. ------------------------------------------------------------------------
+        start, stop, stride = index.indices(len(self))
+        if stride != 1:
+            raise ValueError("strided slices are not supported")
 
-    The attributes in this section are only available if the respective
-    particle type (source/target) has extents. These capture the maximum extent
-    of particles (including the particle's extents) inside of the box.  If the
-    box is empty, both *min* and *max* will reflect the box center.  The
-    purpose of this information is to reduce the cost of some interactions
-    through knowledge that some boxes are partially empty.
-    (See the *from_sep_smaller_crit* argument to the constructor of
-    :class:`FMMTraversalBuilder` for an example.)
+        return self._decode(start, stop)
 
-    .. note::
+    def __array__(self, dtype=None, copy=None):
+        result = self._decode(0, len(self))
+        if dtype is not None:
+            result = result.astype(dtype)
+        return result
 
-        To obtain the overall, non-adaptive box extent, use
-        :attr:`Tree.box_centers` along with :attr:`Tree.box_levels`.
+    # }}}
 
-    If they are not available, the corresponding attributes will be *None*.
 
-    .. attribute:: box_source_bounding_box_min
+class BoxListCompressor(object):
+    """Converts interaction lists in :ref:`csr` to and from
+    :class:`CompressedBoxList`.
 
-        ``coordt_t [dimensions, aligned_nboxes]``
+    .. versionadded:: 2019.1
+    """
 
-    .. attribute:: box_source_bounding_box_max
+    def __init__(self, context):
+        self.context = context
 
-        ``coordt_t [dimensions, aligned_nboxes]``
+    @memoize_method
+    def get_coder_kernel(self, box_id_dtype, delta_dtype, have_reference_boxes,
+            mode):
+        return BOX_LIST_DELTA_CODER_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("box_id_t", box_id_dtype),
+                    ("delta_t", delta_dtype),
+                ),
+                var_values=(
+                    ("have_reference_boxes", have_reference_boxes),
+                    ("mode", mode),
+                ))
 
-    .. attribute:: box_target_bounding_box_min
+    def __call__(self, queue, starts, lists, reference_boxes=None,
+            wait_for=None):
+        """
+        :arg starts: ``box_id_t [nlists+1]``
+        :arg lists: ``box_id_t [*]``
+        :arg reference_boxes: ``box_id_t [nlists]``, the box that each list
+            belongs to, or *None* if list *i* belongs to box *i*.
+        :returns: A tuple *(compressed_list, event)*, where *compressed_list*
+            is a :class:`CompressedBoxList`.
+        """
+        box_id_dtype = lists.dtype
+        nlists = len(starts) - 1
 
-        ``coordt_t [dimensions, aligned_nboxes]``
+        list_args = (
+                (starts,)
+                + ((reference_boxes,) if reference_boxes is not None else ())
+                + (lists,))
 
-    .. attribute:: box_target_bounding_box_max
+        # {{{ find the narrowest delta type that fits
 
-        ``coordt_t [dimensions, aligned_nboxes]``
+        if len(lists):
+            max_abs_deltas = cl.array.empty(queue, nlists, box_id_dtype)
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Same-level non-well-separated boxes
-    .. ------------------------------------------------------------------------
+            evt = self.get_coder_kernel(
+                    box_id_dtype, box_id_dtype,
+                    reference_boxes is not None, mode="find_max")(
+                        *(list_args + (max_abs_deltas,)),
+                        range=slice(nlists),
+                        queue=queue,
+                        wait_for=wait_for)
 
-    Boxes considered to be within the 'non-well-separated area' according to
-    :attr:`well_sep_is_n_away` that are on the same level as their reference
-    box. See :ref:`csr`.
+            max_abs_delta = int(cl.array.max(
+                max_abs_deltas, queue=queue).get())
+            wait_for = [evt]
+            del max_abs_deltas
+        else:
+            max_abs_delta = 0
 
-    This is a generalization of the "colleagues" concept from the Carrier paper
-    to the case in which :attr:`well_sep_is_n_away` is not 1.
+        for delta_dtype in [np.int8, np.int16, np.int32, np.int64]:
+            if max_abs_delta <= np.iinfo(delta_dtype).max:
+                break
 
-    .. attribute:: same_level_non_well_sep_boxes_starts
+        delta_dtype = np.dtype(delta_dtype)
 
-        ``box_id_t [nboxes+1]``
+        # }}}
 
-    .. attribute:: same_level_non_well_sep_boxes_lists
+        deltas = cl.array.empty(queue, len(lists), delta_dtype)
 
-        ``box_id_t [*]``
+        evt = self.get_coder_kernel(
+                box_id_dtype, delta_dtype,
+                reference_boxes is not None, mode="encode")(
+                    *(list_args + (deltas,)),
+                    range=slice(nlists),
+                    queue=queue,
+                    wait_for=wait_for)
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Neighbor Sources ("List 1")
-    .. ------------------------------------------------------------------------
+        return CompressedBoxList(
+                starts=starts,
+                deltas=deltas,
+                reference_boxes=reference_boxes,
+                box_id_dtype=box_id_dtype,
+                ), evt
 
-    List of source boxes immediately adjacent to each target box. Indexed like
-    :attr:`target_boxes`. Includes the target box itself. See :ref:`csr`.
-    (Note: This list contains global box numbers, not indices into
-    :attr:`source_boxes`.)
+    def decompress(self, queue, compressed_list, wait_for=None):
+        """
+        :arg compressed_list: A :class:`CompressedBoxList` with data on the
+            device.
+        :returns: A tuple *(lists, event)*, where *lists* is the uncompressed
+            ``box_id_t [*]`` array that goes with
+            :attr:`CompressedBoxList.starts`.
+        """
+        reference_boxes = compressed_list.reference_boxes
+        lists = cl.array.empty(queue, len(compressed_list.deltas),
+                compressed_list.box_id_dtype)
+
+        evt = self.get_coder_kernel(
+                compressed_list.box_id_dtype, compressed_list.deltas.dtype,
+                reference_boxes is not None, mode="decode")(*(
+                    (compressed_list.starts,)
+                    + ((reference_boxes,) if reference_boxes is not None else ())
+                    + (compressed_list.deltas, lists)),
+                    range=slice(len(compressed_list.starts) - 1),
+                    queue=queue,
+                    wait_for=wait_for)
 
-    .. attribute:: neighbor_source_boxes_starts
+        return lists, evt
 
-        ``box_id_t [ntarget_boxes+1]``
+# }}}
 
-    .. attribute:: neighbor_source_boxes_lists
 
-        ``box_id_t [*]``
+# {{{ list statistics
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Separated Siblings ("List 2")
-    .. ------------------------------------------------------------------------
+LIST_LENGTHS_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+    const box_id_t *starts,
+    %if have_row_indices:
+        const box_id_t *row_indices,
+    %endif
+    box_id_t *lengths,
+    """,
 
-    Well-separated boxes on the same level.  Indexed like
-    :attr:`target_or_target_parent_boxes`. See :ref:`csr`.
+    operation=r"""//CL:mako//
+        %if have_row_indices:
+            const box_id_t irow = row_indices[i];
+        %else:
+            const box_id_t irow = i;
+        %endif
 
-    .. attribute:: from_sep_siblings_starts
+        // Row indices are unique, so no atomics needed.
+        lengths[irow] += starts[i + 1] - starts[i];
+    """,
 
-        ``box_id_t [ntarget_or_target_parent_boxes+1]``
+    name="find_list_lengths")
 
-    .. attribute:: from_sep_siblings_lists
 
-        ``box_id_t [*]``
+LIST_LENGTH_HISTOGRAM_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+    const box_id_t *lengths,
+    %if have_row_boxes:
+        const box_id_t *row_boxes,
+    %endif
+    const box_level_t *box_levels,
+    box_id_t nbins,
+    unsigned int *histogram,
+    """,
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Separated Smaller Boxes ("List 3")
-    .. ------------------------------------------------------------------------
+    operation=r"""//CL:mako//
+        %if have_row_boxes:
+            const box_id_t row_box = row_boxes[i];
+        %else:
+            const box_id_t row_box = i;
+        %endif
 
-    Smaller source boxes separated from the target box by their own size.
+        atomic_inc(&histogram[box_levels[row_box] * nbins + lengths[i]]);
+    """,
 
-    If :attr:`boxtree.Tree.targets_have_extent`, then
-    :attr:`from_sep_close_smaller_starts` will be non-*None*. It records
-    interactions between boxes that would ordinarily be handled
-    through "List 3", but must be evaluated specially/directly
-    because of :ref:`extent`.
+    name="find_list_length_histogram")
 
-    .. attribute:: target_boxes_sep_smaller_by_source_level
 
-        A list of arrays of global box numbers, one array per level, indicating
-        which boxes are used with the interaction list entries of
-        :attr:`from_sep_smaller_by_level`.
-        ``target_boxes_sep_smaller_by_source_level[i]`` has length
-        ``from_sep_smaller_by_level[i].num_nonempty_lists``.
+class InteractionListStatistics(Record):
+    """Summary of the sizes of one interaction list in :ref:`csr`.
+    See :meth:`FMMTraversalInfo.statistics`.
 
+    .. attribute:: nlists
 
-    .. attribute:: from_sep_smaller_by_level
+        Number of lists, e.g. the number of target boxes for "List 1".
 
-        A list of :attr:`boxtree.Tree.nlevels` (corresponding to the levels on
-        which each listed source box resides) objects, each of which has
-        attributes *count*, *starts*, *lists*, *num_nonempty_lists*, and
-        *nonempty_indices*, which form a CSR list of List 3 source boxes.
+    .. attribute:: nentries
 
-        *starts* has shape/type ``box_id_t [num_nonempty_lists+1]``. *lists* is of
-        type ``box_id_t``.  (Note: This list contains global box numbers, not
-        indices into :attr:`source_boxes`.)
+        Total number of entries in all lists.
 
-        Note *starts* are indexed along with
-        `target_boxes_sep_smaller_by_source_level`. For
-        example, for level *i*, *lists[starts[j]:starts[j+1]]* represents "List 3"
-        source boxes of *target_boxes_sep_smaller_by_source_level[i][j]* on level
-        *i*.
+    .. attribute:: max_length
 
-    .. attribute:: from_sep_close_smaller_starts
+        Length of the longest list.
 
-        Indexed like :attr:`target_boxes`.  See :ref:`csr`.
+    .. attribute:: nbytes
 
-        ``box_id_t [ntarget_boxes+1]`` (or *None*)
+        Number of bytes used to store the list (*starts* and *lists*).
 
-    .. attribute:: from_sep_close_smaller_lists
+    .. attribute:: length_histogram_by_level
 
-        ``box_id_t [*]`` (or *None*)
+        A :class:`numpy.ndarray` of shape ``(nlevels, max_length+1)``. Entry
+        ``[ilevel, n]`` is the number of boxes on level *ilevel* whose list
+        has length *n*.
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Separated Bigger Boxes ("List 4")
-    .. ------------------------------------------------------------------------
+    .. versionadded:: 2019.1
+    """
 
-    Bigger source boxes separated from the target box by the (smaller) target
-    box's size.
-    (Note: This list contains global box numbers, not indices into
-    :attr:`source_boxes`.)
 
-    If :attr:`boxtree.Tree.sources_have_extent` or
-    :attr:`boxtree.Tree.targets_have_extent`, then
-    :attr:`from_sep_close_bigger_starts` will be non-*None*. It records
-    interactions between boxes that would ordinarily be handled through "List
-    4", but must be evaluated specially/directly because of :ref:`extent`.
+class _ListStatisticsCollector(object):
+    """Utility class for gathering :class:`InteractionListStatistics`."""
 
-    *from_sep_bigger_starts* is indexed like
-    :attr:`target_or_target_parent_boxes`. Similar to the other "close" lists,
-    *from_sep_close_bigger_starts* is indexed like :attr:`target_boxes`. See
-    :ref:`csr`.
+    def __init__(self, context, box_id_dtype, box_level_dtype):
+        self.context = context
+        self.box_id_dtype = box_id_dtype
+        self.box_level_dtype = box_level_dtype
 
-    .. attribute:: from_sep_bigger_starts
+    @memoize_method
+    def get_lengths_kernel(self, have_row_indices):
+        return LIST_LENGTHS_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("box_id_t", self.box_id_dtype),
+                ),
+                var_values=(
+                    ("have_row_indices", have_row_indices),
+                ))
 
-        ``box_id_t [ntarget_or_target_parent_boxes+1]``
+    @memoize_method
+    def get_histogram_kernel(self, have_row_boxes):
+        return LIST_LENGTH_HISTOGRAM_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("box_id_t", self.box_id_dtype),
+                    ("box_level_t", self.box_level_dtype),
+                ),
+                var_values=(
+                    ("have_row_boxes", have_row_boxes),
+                ))
 
-    .. attribute:: from_sep_bigger_lists
+    def __call__(self, queue, tree, parts, row_boxes, nlists):
+        """
+        :arg parts: A list of tuples *(starts, lists, row_indices)* whose
+            list lengths are added up. *row_indices* may be *None* if
+            list *i* of *starts* belongs to row *i*.
+        :arg row_boxes: The box for each row, or *None* if row *i* belongs
+            to box *i*.
+        :returns: An :class:`InteractionListStatistics`.
+        """
+        lengths = cl.array.zeros(queue, nlists, self.box_id_dtype)
+        nbytes = 0
 
-        ``box_id_t [*]``
+        for starts, lists, row_indices in parts:
+            nbytes += starts.nbytes + lists.nbytes
 
-    .. attribute:: from_sep_close_bigger_starts
+            if len(starts) <= 1:
+                continue
 
-        ``box_id_t [ntarget_boxes+1]`` (or *None*)
+            self.get_lengths_kernel(row_indices is not None)(*(
+                    (starts,)
+                    + ((row_indices,) if row_indices is not None else ())
+                    + (lengths,)),
+                    range=slice(len(starts) - 1),
+                    queue=queue)
 
-    .. attribute:: from_sep_close_bigger_lists
+        if nlists:
+            max_length = int(cl.array.max(lengths, queue=queue).get())
+            nentries = int(cl.array.sum(lengths, queue=queue,
+                dtype=np.int64).get())
+        else:
+            max_length = 0
+            nentries = 0
+
+        nbins = max_length + 1
+        histogram = cl.array.zeros(queue, tree.nlevels * nbins, np.uint32)
+
+        if nlists:
+            self.get_histogram_kernel(row_boxes is not None)(*(
+                    (lengths,)
+                    + ((row_boxes,) if row_boxes is not None else ())
+                    + (tree.box_levels, nbins, histogram)),
+                    range=slice(nlists),
+                    queue=queue)
 
-        ``box_id_t [*]`` (or *None*)
+        return InteractionListStatistics(
+                nlists=nlists,
+                nentries=nentries,
+                max_length=max_length,
+                nbytes=nbytes,
+                length_histogram_by_level=histogram.get(queue=queue).reshape(
+                    tree.nlevels, nbins))
 
-    .. versionchanged:: 2018.2
+# }}}
 
-        Changed index style of *from_sep_close_bigger_starts* from
-        :attr:`target_or_target_parent_boxes` to :attr:`target_boxes`.
 
-    """
+# {{{ target box tiles
 
-    # {{{ "close" list merging -> "unified list 1"
+class TargetBoxTiles(DeviceDataRecord):
+    """A spatially coherent processing order for :attr:`FMMTraversalInfo.\
+target_boxes` and :attr:`FMMTraversalInfo.target_or_target_parent_boxes`,
+    split into tiles. Target boxes are ordered depth-first, target or
+    target parent boxes are ordered by level and then depth-first, so that
+    boxes close to each other in the order are close in space and share
+    many of their interaction list entries. Each tile consists of the boxes
+    in a subtree with at most :attr:`max_tile_ntargets` targets (restricted
+    to one level for target or target parent boxes), or of a single box if
+    it owns more targets than that.
 
-    def merge_close_lists(self, queue, debug=False):
-        """Return a new :class:`FMMTraversalInfo` instance with the contents of
-        :attr:`from_sep_close_smaller_starts` and
-        :attr:`from_sep_close_bigger_starts` merged into
-        :attr:`neighbor_source_boxes_starts` and these two attributes set to
-        *None*.
-        """
+    .. attribute:: max_tile_ntargets
 
-        list_merger = _ListMerger(queue.context, self.tree.box_id_dtype)
+    .. attribute:: target_box_order
 
-        result, evt = (
-                list_merger(
-                    queue,
-                    # starts
-                    (self.neighbor_source_boxes_starts,
-                     self.from_sep_close_smaller_starts,
-                     self.from_sep_close_bigger_starts),
-                    # lists
-                    (self.neighbor_source_boxes_lists,
-                     self.from_sep_close_smaller_lists,
-                     self.from_sep_close_bigger_lists),
-                    # input index styles
-                    _IndexStyle.TARGET_BOXES,
-                    # output index style
-                    _IndexStyle.TARGET_BOXES,
-                    # box and tree data
-                    self.target_boxes,
-                    self.target_or_target_parent_boxes,
-                    self.tree.nboxes,
-                    debug))
+        ``box_id_t [ntarget_boxes]``
 
-        cl.wait_for_events([evt])
+        Indices into :attr:`FMMTraversalInfo.target_boxes` in processing
+        order.
 
-        return self.copy(
-                neighbor_source_boxes_starts=result["starts"],
-                neighbor_source_boxes_lists=result["lists"],
-                from_sep_close_smaller_starts=None,
-                from_sep_close_smaller_lists=None,
-                from_sep_close_bigger_starts=None,
-                from_sep_close_bigger_lists=None)
+    .. attribute:: target_box_tile_starts
 
-    # }}}
+        ``box_id_t [ntiles+1]``
 
-    # {{{ debugging aids
+        Start indices of the tiles in :attr:`target_box_order`.
 
-    def get_box_list(self, what, index):
-        starts = getattr(self, what+"_starts")
-        lists = getattr(self, what+"_lists")
-        start, stop = starts[index:index+2]
-        return lists[start:stop]
+    .. attribute:: target_or_target_parent_box_order
 
-    # }}}
+        ``box_id_t [ntarget_or_target_parent_boxes]``
 
-    @property
-    def nboxes(self):
-        return self.tree.nboxes
+        Indices into :attr:`FMMTraversalInfo.target_or_target_parent_boxes`
+        in processing order.
 
-    @property
-    def nlevels(self):
-        return self.tree.nlevels
+    .. attribute:: target_or_target_parent_box_tile_starts
 
-    @property
-    def ntarget_boxes(self):
-        return len(self.target_boxes)
+        ``box_id_t [ntiles+1]``
 
-    @property
-    def ntarget_or_target_parent_boxes(self):
-        return len(self.target_or_target_parent_boxes)
+        Start indices of the tiles in :attr:`target_or_target_parent_box_order`.
 
-# }}}
+    .. versionadded:: 2019.1
+    """
 
 
-class _KernelInfo(Record):
-    pass
+def _get_tiled_box_order(box_list, tile_roots, box_target_starts, box_levels,
+        box_id_dtype, level_major):
+    # In tree target order, a box's own targets precede those of its
+    # children, so sorting by target start (then level, for boxes without
+    # own targets) gives a depth-first ordering of the boxes. With
+    # *level_major*, boxes are sorted by level first, giving a Morton order
+    # within each level.
+    levels = box_levels[box_list]
+    if level_major:
+        order = np.lexsort((box_target_starts[box_list], levels))
+    else:
+        order = np.lexsort((levels, box_target_starts[box_list]))
+    order = order.astype(box_id_dtype)
+
+    sorted_tile_roots = tile_roots[order]
+    sorted_levels = levels[order]
+    is_tile_start = np.ones(len(order), dtype=bool)
+    is_tile_start[1:] = sorted_tile_roots[1:] != sorted_tile_roots[:-1]
+    if level_major:
+        is_tile_start[1:] |= sorted_levels[1:] != sorted_levels[:-1]
+    tile_starts = np.flatnonzero(is_tile_start)
+
+    return order, np.append(tile_starts, len(order)).astype(box_id_dtype)
 
+# }}}
 
-class FMMTraversalBuilder:
-    def __init__(self, context, well_sep_is_n_away=1, from_sep_smaller_crit=None):
-        """
-        :arg well_sep_is_n_away: Either An integer 1 or greater.
-            (Only 1 and 2 are tested.)
-            The spacing between boxes that is considered "well-separated" for
-            :attr:`from_sep_siblings` (List 2).
-        :arg from_sep_smaller_crit: The criterion used to determine separation
-            box dimensions and separation for :attr:`from_sep_smaller_by_level`
-            (List 3). May be one of ``"static_linf"`` (use the box square,
-            possibly enlarged by :attr:`Tree.stick_out_factor`), ``"precise_linf"`
-            (use the precise extent of targets in the box, including their radii),
-            or ``"static_l2"`` (use the circumcircle of the box,
-            possibly enlarged by :attr:`Tree.stick_out_factor`).
-        """
-        self.context = context
-        self.well_sep_is_n_away = well_sep_is_n_away
-        self.from_sep_smaller_crit = from_sep_smaller_crit
 
-    # {{{ kernel builder
+# {{{ traversal info (output)
 
-    @memoize_method
-    @log_process(logger)
-    def get_kernel_info(self, dimensions, particle_id_dtype, box_id_dtype,
-            coord_dtype, box_level_dtype, max_levels,
-            sources_are_targets, sources_have_extent, targets_have_extent,
-            extent_norm):
+class FMMTraversalInfo(DeviceDataRecord):
+    r"""Interaction lists needed for a fast-multipole-like linear-time gather of
+    particle interactions.
 
-        # {{{ process from_sep_smaller_crit
+    Terminology (largely) follows this article:
 
-        from_sep_smaller_crit = self.from_sep_smaller_crit
+        Carrier, J., Greengard, L. and Rokhlin, V. "A Fast
+        Adaptive Multipole Algorithm for Particle Simulations." SIAM Journal on
+        Scientific and Statistical Computing 9, no. 4 (July 1988): 669-686.
+        `DOI: 10.1137/0909044 <http://dx.doi.org/10.1137/0909044>`_.
 
-        if from_sep_smaller_crit is None:
-            from_sep_smaller_crit = "precise_linf"
+    Unless otherwise indicated, all bulk data in this data structure is stored
+    in a :class:`pyopencl.array.Array`. See also :meth:`get`.
 
-        if extent_norm == "linf":
-            # no special checks needed
-            pass
+    .. attribute:: tree
 
-        elif extent_norm == "l2":
-            if from_sep_smaller_crit == "static_linf":
-                # Not technically necessary, but static linf will assume box
-                # bounds that are not guaranteed to contain all particle
-                # extents.
-                raise ValueError(
-                        "The static l^inf from-sep-smaller criterion "
-                        "cannot be used with the l^2 extent norm")
+        An instance of :class:`boxtree.Tree`.
 
-        elif extent_norm is None:
-            assert not (sources_have_extent or targets_have_extent)
+    .. attribute:: nboxes
 
-            if from_sep_smaller_crit is None:
-                # doesn't matter
-                from_sep_smaller_crit = "static_linf"
+        Number of boxe in the tree.
 
-        else:
-            raise ValueError("unexpected value of 'extent_norm': %s"
-                    % extent_norm)
+    .. attribute:: nlevels
 
-        if from_sep_smaller_crit not in [
-                "static_linf", "precise_linf",
-                "static_l2",
-                ]:
-            raise ValueError("unexpected value of 'from_sep_smaller_crit': %s"
-                    % from_sep_smaller_crit)
+        Number of levels in the tree.
 
-        # }}}
+    .. attribute:: well_sep_is_n_away
 
-        debug = False
+        The distance (measured in target box diameters in the :math:`l^\infty`
+        norm) from the edge of the target box at which the 'well-separated'
+        (i.e. M2L-handled) 'far-field' starts.
 
-        from pyopencl.tools import dtype_to_ctype
-        from boxtree.tree import box_flags_enum
-        render_vars = dict(
-                np=np,
-                dimensions=dimensions,
-                dtype_to_ctype=dtype_to_ctype,
-                particle_id_dtype=particle_id_dtype,
-                box_id_dtype=box_id_dtype,
-                box_flags_enum=box_flags_enum,
-                coord_dtype=coord_dtype,
-                vec_types=cl.cltypes.vec_types,
-                max_levels=max_levels,
-                AXIS_NAMES=AXIS_NAMES,
-                debug=debug,
-                sources_are_targets=sources_are_targets,
-                sources_have_extent=sources_have_extent,
-                targets_have_extent=targets_have_extent,
-                well_sep_is_n_away=self.well_sep_is_n_away,
-                from_sep_smaller_crit=from_sep_smaller_crit,
-                )
-        from pyopencl.algorithm import ListOfListsBuilder
-        from boxtree.tools import VectorArg, ScalarArg
+        If :attr:`mac_theta` is not *None*, this is an upper bound on that
+        distance implied by the opening-angle criterion, see
+        :meth:`FMMTraversalBuilder.get_effective_well_sep_is_n_away`.
 
-        result = {}
+    .. attribute:: mac_theta
 
-        # {{{ source boxes, their parents, target boxes
+        The opening angle parameter of the multipole acceptance criterion
+        used to determine well-separatedness, or *None* if the fixed spacing
+        given by :attr:`well_sep_is_n_away` was used. See
+        :class:`FMMTraversalBuilder`.
 
-        src = Template(
-                TRAVERSAL_PREAMBLE_TEMPLATE
-                + SOURCES_PARENTS_AND_TARGETS_TEMPLATE,
-                strict_undefined=True).render(**render_vars)
+        .. versionadded:: 2019.1
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Basic box lists for iteration
+    .. ------------------------------------------------------------------------
+
+    .. attribute:: source_boxes
+
+        ``box_id_t [*]``
+
+        List of boxes having sources.
+
+    .. attribute:: target_boxes
+
+        ``box_id_t [*]``
+
+        List of boxes having targets.
+        If :attr:`boxtree.Tree.sources_are_targets` and no target mask
+        was given to :class:`FMMTraversalBuilder`,
+        then ``target_boxes is source_boxes``.
+
+    .. attribute:: ntarget_boxes
+
+        Number of :attr:`target_boxes`.
+
+    .. attribute:: source_parent_boxes
+
+        ``box_id_t [*]``
+
+        List of boxes that are (directly or indirectly) a parent
+        of one of the :attr:`source_boxes`. These boxes may have sources of their
+        own.
+
+    .. attribute:: level_start_source_box_nrs
+
+        ``box_id_t [nlevels+1]``
+
+        Indices into :attr:`source_boxes` indicating where
+        each level starts and ends.
+
+    .. attribute:: level_start_source_parent_box_nrs
+
+        ``box_id_t [nlevels+1]``
+
+        Indices into :attr:`source_parent_boxes` indicating where
+        each level starts and ends.
+
+    .. attribute:: target_or_target_parent_boxes
+
+        ``box_id_t [*]``
+
+        List of boxes that are one of the :attr:`target_boxes`
+        or their (direct or indirect) parents.
+
+    .. attribute:: ntarget_or_target_parent_boxes
+
+        Number of :attr:`target_or_target_parent_boxes`.
+
+    .. attribute:: level_start_target_box_nrs
+
+        ``box_id_t [nlevels+1]``
+
+        Indices into :attr:`target_boxes` indicating where
+        each level starts and ends.
+
+    .. attribute:: level_start_target_or_target_parent_box_nrs
+
+        ``box_id_t [nlevels+1]``
+
+        Indices into :attr:`target_or_target_parent_boxes` indicating where
+        each level starts and ends.
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Particle-adaptive box extents
+    .. ------------------------------------------------------------------------
+
+    The attributes in this section are only available if the respective
+    particle type (source/target) has extents. These capture the maximum extent
+    of particles (including the particle's extents) inside of the box.  If the
+    box is empty, both *min* and *max* will reflect the box center.  The
+    purpose of this information is to reduce the cost of some interactions
+    through knowledge that some boxes are partially empty.
+    (See the *from_sep_smaller_crit* argument to the constructor of
+    :class:`FMMTraversalBuilder` for an example.)
+
+    .. note::
+
+        To obtain the overall, non-adaptive box extent, use
+        :attr:`Tree.box_centers` along with :attr:`Tree.box_levels`.
+
+    If they are not available, the corresponding attributes will be *None*.
+
+    .. attribute:: box_source_bounding_box_min
+
+        ``coordt_t [dimensions, aligned_nboxes]``
+
+    .. attribute:: box_source_bounding_box_max
+
+        ``coordt_t [dimensions, aligned_nboxes]``
+
+    .. attribute:: box_target_bounding_box_min
+
+        ``coordt_t [dimensions, aligned_nboxes]``
+
+    .. attribute:: box_target_bounding_box_max
+
+        ``coordt_t [dimensions, aligned_nboxes]``
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Same-level non-well-separated boxes
+    .. ------------------------------------------------------------------------
+
+    Boxes considered to be within the 'non-well-separated area' according to
+    :attr:`well_sep_is_n_away` that are on the same level as their reference
+    box. See :ref:`csr`.
+
+    This is a generalization of the "colleagues" concept from the Carrier paper
+    to the case in which :attr:`well_sep_is_n_away` is not 1.
+
+    .. attribute:: same_level_non_well_sep_boxes_starts
+
+        ``box_id_t [nboxes+1]``
+
+    .. attribute:: same_level_non_well_sep_boxes_lists
+
+        ``box_id_t [*]``
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Neighbor Sources ("List 1")
+    .. ------------------------------------------------------------------------
+
+    List of source boxes immediately adjacent to each target box. Indexed like
+    :attr:`target_boxes`. Includes the target box itself. See :ref:`csr`.
+    (Note: This list contains global box numbers, not indices into
+    :attr:`source_boxes`.)
+
+    .. attribute:: neighbor_source_boxes_starts
+
+        ``box_id_t [ntarget_boxes+1]``
+
+    .. attribute:: neighbor_source_boxes_lists
+
+        ``box_id_t [*]``
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Separated Siblings ("List 2")
+    .. ------------------------------------------------------------------------
+
+    Well-separated boxes on the same level.  Indexed like
+    :attr:`target_or_target_parent_boxes`. See :ref:`csr`.
+
+    .. attribute:: from_sep_siblings_starts
+
+        ``box_id_t [ntarget_or_target_parent_boxes+1]``
+
+    .. attribute:: from_sep_siblings_lists
+
+        ``box_id_t [*]``
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Separated Smaller Boxes ("List 3")
+    .. ------------------------------------------------------------------------
+
+    Smaller source boxes separated from the target box by their own size.
+
+    If :attr:`boxtree.Tree.targets_have_extent` or :attr:`mac_theta` is not
+    *None*, then :attr:`from_sep_close_smaller_starts` will be non-*None*. It
+    records interactions between boxes that would ordinarily be handled
+    through "List 3", but must be evaluated specially/directly
+    because of :ref:`extent` or because they fail the opening-angle
+    criterion.
+
+    .. attribute:: target_boxes_sep_smaller_by_source_level
+
+        A list of arrays of global box numbers, one array per level, indicating
+        which boxes are used with the interaction list entries of
+        :attr:`from_sep_smaller_by_level`.
+        ``target_boxes_sep_smaller_by_source_level[i]`` has length
+        ``from_sep_smaller_by_level[i].num_nonempty_lists``.
+
+
+    .. attribute:: from_sep_smaller_by_level
+
+        A list of :attr:`boxtree.Tree.nlevels` (corresponding to the levels on
+        which each listed source box resides) objects, each of which has
+        attributes *count*, *starts*, *lists*, *num_nonempty_lists*, and
+        *nonempty_indices*, which form a CSR list of List 3 source boxes.
+
+        *starts* has shape/type ``box_id_t [num_nonempty_lists+1]``. *lists* is of
+        type ``box_id_t``.  (Note: This list contains global box numbers, not
+        indices into :attr:`source_boxes`.)
+
+        Note *starts* are indexed along with
+        `target_boxes_sep_smaller_by_source_level`. For
+        example, for level *i*, *lists[starts[j]:starts[j+1]]* represents "List 3"
+        source boxes of *target_boxes_sep_smaller_by_source_level[i][j]* on level
+        *i*.
+
+    .. attribute:: from_sep_close_smaller_starts
+
+        Indexed like :attr:`target_boxes`.  See :ref:`csr`.
+
+        ``box_id_t [ntarget_boxes+1]`` (or *None*)
+
+    .. attribute:: from_sep_close_smaller_lists
+
+        ``box_id_t [*]`` (or *None*)
+
+    .. attribute:: from_sep_smaller_min_nsources_cumul
+
+        ``particle_id_t [nlevels]``, a :class:`numpy.ndarray`. Source boxes on
+        level *i* with fewer than ``from_sep_smaller_min_nsources_cumul[i]``
+        sources (including those of their descendants) were evaluated directly
+        through :attr:`from_sep_close_smaller_starts` instead of through
+        "List 3". Since this requires the "close" lists, all entries are zero
+        if these do not exist. See the *from_sep_smaller_min_nsources_cumul*
+        argument of :meth:`FMMTraversalBuilder.__call__`.
+
+        .. versionadded:: 2019.1
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Separated Bigger Boxes ("List 4")
+    .. ------------------------------------------------------------------------
+
+    Bigger source boxes separated from the target box by the (smaller) target
+    box's size.
+    (Note: This list contains global box numbers, not indices into
+    :attr:`source_boxes`.)
+
+    If :attr:`boxtree.Tree.sources_have_extent`,
+    :attr:`boxtree.Tree.targets_have_extent`, or if :attr:`mac_theta` is not
+    *None*, then :attr:`from_sep_close_bigger_starts` will be non-*None*. It
+    records interactions between boxes that would ordinarily be handled
+    through "List 4", but must be evaluated specially/directly because of
+    :ref:`extent` or because they fail the opening-angle criterion.
+
+    *from_sep_bigger_starts* is indexed like
+    :attr:`target_or_target_parent_boxes`. Similar to the other "close" lists,
+    *from_sep_close_bigger_starts* is indexed like :attr:`target_boxes`. See
+    :ref:`csr`.
+
+    .. attribute:: from_sep_bigger_starts
+
+        ``box_id_t [ntarget_or_target_parent_boxes+1]``
+
+    .. attribute:: from_sep_bigger_lists
+
+        ``box_id_t [*]``
+
+    .. attribute:: from_sep_close_bigger_starts
+
+        ``box_id_t [ntarget_boxes+1]`` (or *None*)
+
+    .. attribute:: from_sep_close_bigger_lists
+
+        ``box_id_t [*]`` (or *None*)
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Periodic images
+    .. ------------------------------------------------------------------------
+
+    The attributes in this section are only available (i.e. not *None*) if
+    the tree is :attr:`boxtree.Tree.periodic`. In this case, each of the
+    lists above may contain the same box more than once, once for each of
+    its periodic images that takes part in the interaction. Only images
+    shifted by at most :attr:`well_sep_is_n_away` root box extents along each
+    axis are considered. Interactions with images further away are left to
+    the expansion wrangler.
+
+    Of the consumers of traversals in :mod:`boxtree`, only
+    :class:`boxtree.tools.ConstantOneExpansionWrangler` and the cost models in
+    :mod:`boxtree.cost` support periodic traversals. The others, such as
+    :class:`boxtree.near_field.NearFieldPatternBuilder`, the builders in
+    :mod:`boxtree.rotation_classes` and
+    :class:`boxtree.pyfmmlib_integration.FMMLibExpansionWrangler`, raise
+    :exc:`NotImplementedError`.
+
+    .. attribute:: periodic_shifts
+
+        ``numpy.int32 [nshifts, dimensions]``, a host array. Row *i*
+        contains the shift of the source image referred to by shift code *i*,
+        in multiples of the root box extent.
+
+    .. attribute:: same_level_non_well_sep_boxes_shifts
+
+        ``int16 [*]``, the shift code of each entry of
+        :attr:`same_level_non_well_sep_boxes_lists`.
+
+    .. attribute:: neighbor_source_boxes_shifts
+
+        ``int16 [*]``, the shift code of each entry of
+        :attr:`neighbor_source_boxes_lists`.
+
+    .. attribute:: from_sep_siblings_shifts
+
+        ``int16 [*]``, the shift code of each entry of
+        :attr:`from_sep_siblings_lists`.
+
+    .. attribute:: from_sep_smaller_shifts_by_level
+
+        A list of :attr:`boxtree.Tree.nlevels` ``int16 [*]`` arrays, the
+        shift codes of the entries of the lists in
+        :attr:`from_sep_smaller_by_level`.
+
+    .. attribute:: from_sep_bigger_shifts
+
+        ``int16 [*]``, the shift code of each entry of
+        :attr:`from_sep_bigger_lists`.
+
+    .. versionadded:: 2019.1
+
+    .. versionchanged:: 2018.2
+
+        Changed index style of *from_sep_close_bigger_starts* from
+        :attr:`target_or_target_parent_boxes` to :attr:`target_boxes`.
+
+    """
+
+    # {{{ "close" list merging -> "unified list 1"
+
+    def merge_close_lists(self, queue, debug=False):
+        """Return a new :class:`FMMTraversalInfo` instance with the contents of
+        :attr:`from_sep_close_smaller_starts` and
+        :attr:`from_sep_close_bigger_starts` merged into
+        :attr:`neighbor_source_boxes_starts` and these two attributes set to
+        *None*.
+        """
+
+        list_merger = _ListMerger(queue.context, self.tree.box_id_dtype)
+
+        result, evt = (
+                list_merger(
+                    queue,
+                    # starts
+                    (self.neighbor_source_boxes_starts,
+                     self.from_sep_close_smaller_starts,
+                     self.from_sep_close_bigger_starts),
+                    # lists
+                    (self.neighbor_source_boxes_lists,
+                     self.from_sep_close_smaller_lists,
+                     self.from_sep_close_bigger_lists),
+                    # input index styles
+                    _IndexStyle.TARGET_BOXES,
+                    # output index style
+                    _IndexStyle.TARGET_BOXES,
+                    # box and tree data
+                    self.target_boxes,
+                    self.target_or_target_parent_boxes,
+                    self.tree.nboxes,
+                    debug))
+
+        cl.wait_for_events([evt])
+
+        return self.copy(
+                neighbor_source_boxes_starts=result["starts"],
+                neighbor_source_boxes_lists=result["lists"],
+                from_sep_close_smaller_starts=None,
+                from_sep_close_smaller_lists=None,
+                from_sep_close_bigger_starts=None,
+                from_sep_close_bigger_lists=None)
+
+    # }}}
+
+    # {{{ compressed lists
+
+    def compress_lists(self, queue, wait_for=None):
+        """Return a copy of this traversal in which the interaction lists are
+        delta-encoded, e.g. to reduce their memory footprint. Each
+        ``*_lists`` attribute (including the *lists* of each entry of
+        :attr:`from_sep_smaller_by_level`) is replaced by a
+        :class:`CompressedBoxList`. All other data is shared with this
+        traversal, which may be dropped afterwards to release the
+        uncompressed lists.
+
+        The compressed traversal can be passed to :func:`boxtree.fmm.drive_fmm`
+        (once it lives on the host) and to :class:`boxtree.cost.FMMCostModel`,
+        which decode the lists as they consume them. Lists may also be
+        restored in full using :meth:`BoxListCompressor.decompress`.
+
+        .. versionadded:: 2019.1
+        """
+        compressor = BoxListCompressor(queue.context)
+
+        result = {}
+        events = []
+
+        def compress(starts, lists, reference_boxes):
+            compressed, evt = compressor(queue, starts, lists,
+                    reference_boxes=reference_boxes, wait_for=wait_for)
+            events.append(evt)
+            return compressed.with_queue(None)
+
+        for list_name, reference_boxes in [
+                ("same_level_non_well_sep_boxes", None),
+                ("neighbor_source_boxes", self.target_boxes),
+                ("from_sep_siblings", self.target_or_target_parent_boxes),
+                ("from_sep_close_smaller", self.target_boxes),
+                ("from_sep_bigger", self.target_or_target_parent_boxes),
+                ("from_sep_close_bigger", self.target_boxes),
+                ]:
+            starts = getattr(self, list_name + "_starts")
+            if starts is None:
+                continue
+
+            result[list_name + "_lists"] = compress(
+                    starts, getattr(self, list_name + "_lists"),
+                    reference_boxes)
+
+        from pyopencl.algorithm import BuiltList
+        result["from_sep_smaller_by_level"] = [
+                BuiltList(
+                    count=level_list.count,
+                    starts=level_list.starts,
+                    lists=compress(
+                        level_list.starts, level_list.lists, target_boxes),
+                    num_nonempty_lists=level_list.num_nonempty_lists,
+                    nonempty_indices=level_list.nonempty_indices,
+                    compressed_indices=level_list.compressed_indices)
+                for level_list, target_boxes in zip(
+                    self.from_sep_smaller_by_level,
+                    self.target_boxes_sep_smaller_by_source_level)]
+
+        cl.wait_for_events(events)
+
+        return self.copy(**result)
+
+    # }}}
+
+    # {{{ statistics
+
+    def statistics(self, queue):
+        """Gather the sizes of the interaction lists in this traversal, e.g.
+        to spot geometries that lead to excessive list sizes before running
+        an FMM. The data of this traversal must live on the device.
+
+        :returns: A :class:`dict` mapping list names to instances of
+            :class:`InteractionListStatistics`. The keys are
+            ``"same_level_non_well_sep_boxes"``, ``"neighbor_source_boxes"``,
+            ``"from_sep_siblings"``, ``"from_sep_smaller"`` (which combines
+            :attr:`from_sep_smaller_by_level` across all source levels),
+            ``"from_sep_bigger"``, and, if present,
+            ``"from_sep_close_smaller"`` and ``"from_sep_close_bigger"``.
+            Histograms are by the level of the box owning the list.
+
+        .. versionadded:: 2019.1
+        """
+        tree = self.tree
+        collector = _ListStatisticsCollector(queue.context,
+                tree.box_id_dtype, tree.box_level_dtype)
+
+        result = {}
+
+        for list_name, row_boxes in [
+                ("same_level_non_well_sep_boxes", None),
+                ("neighbor_source_boxes", self.target_boxes),
+                ("from_sep_siblings", self.target_or_target_parent_boxes),
+                ("from_sep_close_smaller", self.target_boxes),
+                ("from_sep_bigger", self.target_or_target_parent_boxes),
+                ("from_sep_close_bigger", self.target_boxes),
+                ]:
+            starts = getattr(self, list_name + "_starts")
+            if starts is None:
+                continue
+
+            result[list_name] = collector(queue, tree,
+                    [(starts, getattr(self, list_name + "_lists"), None)],
+                    row_boxes,
+                    tree.nboxes if row_boxes is None else len(row_boxes))
+
+        result["from_sep_smaller"] = collector(queue, tree,
+                [(level_list.starts, level_list.lists, level_list.nonempty_indices)
+                    for level_list in self.from_sep_smaller_by_level],
+                self.target_boxes, self.ntarget_boxes)
+
+        return result
+
+    # }}}
+
+    # {{{ target box tiles
+
+    def get_target_box_tiles(self, queue, max_tile_ntargets=2048):
+        """Find a spatially coherent order in which to process the target
+        boxes, for better cache reuse in wranglers. The data of this
+        traversal must live on the device. Once on the host, the result can
+        be passed to :func:`boxtree.fmm.drive_fmm` as *target_box_tiles*.
+
+        :arg max_tile_ntargets: The maximum number of targets in a tile
+            (unless the tile consists of a single box).
+        :returns: A :class:`TargetBoxTiles` instance.
+
+        .. versionadded:: 2019.1
+        """
+        tree = self.tree
+
+        box_parent_ids = tree.box_parent_ids.get(queue=queue)
+        box_target_counts_cumul = tree.box_target_counts_cumul.get(queue=queue)
+        box_target_starts = tree.box_target_starts.get(queue=queue)
+        box_levels = tree.box_levels.get(queue=queue)
+
+        # {{{ find tile roots
+
+        # The tile root of a box is its topmost ancestor (or itself) with at
+        # most max_tile_ntargets targets.
+
+        tile_roots = np.arange(tree.nboxes, dtype=tree.box_id_dtype)
+
+        for _ in range(tree.nlevels):
+            parents = box_parent_ids[tile_roots]
+            move_up = (
+                    (tile_roots != 0)
+                    & (box_target_counts_cumul[parents] <= max_tile_ntargets))
+            if not move_up.any():
+                break
+
+            tile_roots = np.where(move_up, parents, tile_roots)
+
+        # }}}
+
+        result = {}
+        for name, box_list, level_major in [
+                # Target boxes occur on all levels, and their List 1
+                # entries are shared across levels.
+                ("target_box", self.target_boxes, False),
+                # List 2 (M2L) only involves boxes on one level, so process
+                # the levels one after another.
+                ("target_or_target_parent_box",
+                    self.target_or_target_parent_boxes, True),
+                ]:
+            box_list = box_list.get(queue=queue)
+            order, tile_starts = _get_tiled_box_order(
+                    box_list, tile_roots[box_list], box_target_starts,
+                    box_levels, tree.box_id_dtype, level_major)
+
+            result[name + "_order"] = cl.array.to_device(queue, order)
+            result[name + "_tile_starts"] = cl.array.to_device(
+                    queue, tile_starts)
+
+        return TargetBoxTiles(
+                max_tile_ntargets=max_tile_ntargets,
+                **result).with_queue(None)
+
+    # }}}
+
+    # {{{ debugging aids
+
+    def get_box_list(self, what, index):
+        starts = getattr(self, what+"_starts")
+        lists = getattr(self, what+"_lists")
+        start, stop = starts[index:index+2]
+        return lists[start:stop]
+
+    # }}}
+
+    @property
+    def nboxes(self):
+        return self.tree.nboxes
+
+    @property
+    def nlevels(self):
+        return self.tree.nlevels
+
+    @property
+    def ntarget_boxes(self):
+        return len(self.target_boxes)
+
+    @property
+    def ntarget_or_target_parent_boxes(self):
+        return len(self.target_or_target_parent_boxes)
+
+# }}}
+
+
+# {{{ treecode traversal info (output)
+
+class TreecodeTraversalInfo(DeviceDataRecord):
+    """Interaction lists for a Barnes-Hut-style treecode, in which each target
+    box interacts with (the multipole expansions of) source boxes that meet an
+    opening-angle criterion, and directly with all other source boxes it
+    encounters. No local expansions are used. See
+    :class:`TreecodeTraversalBuilder` and :func:`boxtree.fmm.drive_treecode`.
+
+    Unless otherwise indicated, all bulk data in this data structure is stored
+    in a :class:`pyopencl.array.Array`. See also :meth:`get`.
+
+    .. attribute:: tree
+
+        An instance of :class:`boxtree.Tree`.
+
+    .. attribute:: mac_theta
+
+        The opening angle parameter used to accept source boxes.
+
+    .. attribute:: source_boxes
+
+        ``box_id_t [*]``
+
+        List of boxes having sources.
+
+    .. attribute:: target_boxes
+
+        ``box_id_t [*]``
+
+        List of boxes having targets.
+        If :attr:`boxtree.Tree.sources_are_targets`,
+        then ``target_boxes is source_boxes``.
+
+    .. attribute:: source_parent_boxes
+
+        ``box_id_t [*]``
+
+        List of boxes that are (directly or indirectly) a parent
+        of one of the :attr:`source_boxes`.
+
+    .. attribute:: level_start_source_box_nrs
+
+        ``box_id_t [nlevels+1]``
+
+        Indices into :attr:`source_boxes` indicating where
+        each level starts and ends.
+
+    .. attribute:: level_start_target_box_nrs
+
+        ``box_id_t [nlevels+1]``
+
+        Indices into :attr:`target_boxes` indicating where
+        each level starts and ends.
+
+    .. attribute:: level_start_source_parent_box_nrs
+
+        ``box_id_t [nlevels+1]``
+
+        Indices into :attr:`source_parent_boxes` indicating where
+        each level starts and ends.
+
+    .. attribute:: box_source_bounding_box_min
+
+        ``coordt_t [dimensions, aligned_nboxes]``
+
+    .. attribute:: box_source_bounding_box_max
+
+        ``coordt_t [dimensions, aligned_nboxes]``
+
+    .. attribute:: box_target_bounding_box_min
+
+        ``coordt_t [dimensions, aligned_nboxes]``
+
+    .. attribute:: box_target_bounding_box_max
+
+        ``coordt_t [dimensions, aligned_nboxes]``
+
+    .. attribute:: near_field_source_boxes_starts
+
+        ``box_id_t [ntarget_boxes+1]``
+
+    .. attribute:: near_field_source_boxes_lists
+
+        ``box_id_t [*]``
+
+        Source boxes with own sources that do not meet the criterion with
+        respect to a target box, and whose interaction with it is therefore
+        evaluated directly. Indexed like :attr:`target_boxes`.
+        See :ref:`csr`.
+
+    .. attribute:: accepted_source_boxes_by_level
+
+        A list of :attr:`boxtree.Tree.nlevels` (corresponding to the levels on
+        which the source boxes reside) objects, each of which has subattributes
+        *count*, *starts*, *lists*, *num_nonempty_lists*, and
+        *nonempty_indices*, like
+        :attr:`FMMTraversalInfo.from_sep_smaller_by_level`. These source boxes
+        meet the criterion with respect to the target box, and their multipole
+        expansions are evaluated at its targets. Boxes on levels 0 and 1 are
+        never accepted.
+
+    .. attribute:: target_boxes_accepted_by_source_level
+
+        A list of arrays of global box numbers, one array per level, indicating
+        which boxes are used with the interaction list entries of
+        :attr:`accepted_source_boxes_by_level`.
+        ``target_boxes_accepted_by_source_level[i]`` has length
+        ``accepted_source_boxes_by_level[i].num_nonempty_lists``.
+
+    .. versionadded:: 2019.1
+    """
+
+    # {{{ debugging aids
+
+    def get_box_list(self, what, index):
+        starts = getattr(self, what+"_starts")
+        lists = getattr(self, what+"_lists")
+        start, stop = starts[index:index+2]
+        return lists[start:stop]
+
+    # }}}
+
+    @property
+    def nboxes(self):
+        return self.tree.nboxes
+
+    @property
+    def nlevels(self):
+        return self.tree.nlevels
+
+    @property
+    def ntarget_boxes(self):
+        return len(self.target_boxes)
+
+# }}}
+
+
+class _KernelInfo(Record):
+    pass
+
+
+# {{{ basic box lists
+
+class _BasicBoxLists(Record):
+    pass
+
+
+def _make_basic_kernels(context, render_vars, box_level_dtype):
+    """Build the kernels used by :func:`_build_basic_box_lists`. Shared
+    between the traversal builders in this module.
+    """
+    dimensions = render_vars["dimensions"]
+    particle_id_dtype = render_vars["particle_id_dtype"]
+    box_id_dtype = render_vars["box_id_dtype"]
+    coord_dtype = render_vars["coord_dtype"]
+    sources_are_targets = render_vars["sources_are_targets"]
+    sources_have_extent = render_vars["sources_have_extent"]
+    targets_have_extent = render_vars["targets_have_extent"]
+    debug = render_vars["debug"]
+
+    from pyopencl.algorithm import ListOfListsBuilder
+    from boxtree.tools import VectorArg
+    from boxtree.tree import box_flags_enum
+
+    result = {}
+
+    have_target_mask = render_vars["have_target_mask"]
+
+    src = Template(
+            TRAVERSAL_PREAMBLE_TEMPLATE
+            + SOURCES_PARENTS_AND_TARGETS_TEMPLATE,
+            strict_undefined=True).render(
+                TARGET_BOX_MASK_SELECTED=TARGET_BOX_MASK_SELECTED,
+                **render_vars)
+
+    result["sources_parents_and_targets_builder"] = \
+            ListOfListsBuilder(context,
+                    [
+                        ("source_parent_boxes", box_id_dtype),
+                        ("source_boxes", box_id_dtype),
+                        ("target_or_target_parent_boxes", box_id_dtype)
+                        ] + (
+                            [("target_boxes", box_id_dtype)]
+                            if not sources_are_targets or have_target_mask
+                            else []),
+                    str(src),
+                    arg_decls=[
+                        VectorArg(box_flags_enum.dtype, "box_flags"),
+                        ] + (
+                            [VectorArg(np.uint8, "target_box_mask")]
+                            if have_target_mask
+                            else []),
+                    debug=debug,
+                    name_prefix="sources_parents_and_targets")
+
+    result["box_extents_finder"] = \
+            BOX_EXTENTS_FINDER_TEMPLATE.build(context,
+                type_aliases=(
+                    ("box_id_t", box_id_dtype),
+                    ("coord_t", coord_dtype),
+                    ("coord_vec_t", cl.cltypes.vec_types[
+                        coord_dtype, dimensions]),
+                    ("particle_id_t", particle_id_dtype),
+                    ),
+                var_values=(
+                    ("dimensions", dimensions),
+                    ("AXIS_NAMES", AXIS_NAMES),
+                    ("sources_have_extent", sources_have_extent),
+                    ("targets_have_extent", targets_have_extent),
+                    ),
+                )
+
+    result["level_start_box_nrs_extractor"] = \
+            LEVEL_START_BOX_NR_EXTRACTOR_TEMPLATE.build(context,
+                type_aliases=(
+                    ("box_id_t", box_id_dtype),
+                    ("box_level_t", box_level_dtype),
+                    ),
+                )
+
+    return _KernelInfo(**result)
+
+
+def _build_basic_box_lists(queue, tree, knl_info, fin_debug, wait_for,
+        target_box_mask=None):
+    """Find the source boxes, their parents, the target boxes and their
+    parents, along with their level starts, and the bounding boxes of the
+    particles in each box.
+
+    :arg target_box_mask: If not *None*, a target box mask (see
+        ``TARGET_BOX_MASK_SELECTED``) restricting the target boxes and
+        their parents. Must match the kernels in *knl_info*.
+    :returns: a tuple *(basic_lists, wait_for)*, where *basic_lists* is a
+        :class:`_BasicBoxLists`.
+    """
+
+    # {{{ source boxes, their parents, and target boxes
+
+    fin_debug("building list of source boxes, their parents, and target boxes")
+
+    result, evt = knl_info.sources_parents_and_targets_builder(
+            queue, tree.nboxes, tree.box_flags,
+            *((target_box_mask,) if target_box_mask is not None else ()),
+            wait_for=wait_for)
+    wait_for = [evt]
+
+    source_parent_boxes = result["source_parent_boxes"].lists
+    source_boxes = result["source_boxes"].lists
+    target_or_target_parent_boxes = result["target_or_target_parent_boxes"].lists
+
+    if not tree.sources_are_targets or target_box_mask is not None:
+        target_boxes = result["target_boxes"].lists
+    else:
+        target_boxes = source_boxes
+
+    # }}}
+
+    # {{{ figure out level starts in *_parent_boxes
+
+    def extract_level_start_box_nrs(box_list, wait_for):
+        result = cl.array.empty(queue,
+                tree.nlevels+1, tree.box_id_dtype) \
+                        .fill(len(box_list))
+        evt = knl_info.level_start_box_nrs_extractor(
+                tree.level_start_box_nrs_dev,
+                tree.box_levels,
+                box_list,
+                result,
+                range=slice(0, len(box_list)),
+                queue=queue, wait_for=wait_for)
+
+        result = result.get()
+
+        # Postprocess result for unoccupied levels
+        prev_start = len(box_list)
+        for ilev in range(tree.nlevels-1, -1, -1):
+            result[ilev] = prev_start = \
+                    min(result[ilev], prev_start)
+
+        return result, evt
+
+    fin_debug("finding level starts in source boxes array")
+    level_start_source_box_nrs, evt_s = \
+            extract_level_start_box_nrs(
+                    source_boxes, wait_for=wait_for)
+
+    fin_debug("finding level starts in source parent boxes array")
+    level_start_source_parent_box_nrs, evt_sp = \
+            extract_level_start_box_nrs(
+                    source_parent_boxes, wait_for=wait_for)
+
+    fin_debug("finding level starts in target boxes array")
+    level_start_target_box_nrs, evt_t = \
+            extract_level_start_box_nrs(
+                    target_boxes, wait_for=wait_for)
+
+    fin_debug("finding level starts in target or target parent boxes array")
+    level_start_target_or_target_parent_box_nrs, evt_tp = \
+            extract_level_start_box_nrs(
+                    target_or_target_parent_boxes, wait_for=wait_for)
+
+    wait_for = [evt_s, evt_sp, evt_t, evt_tp]
+
+    # }}}
+
+    # {{{ box extents
+
+    fin_debug("finding box extents")
+
+    box_source_bounding_box_min = cl.array.empty(
+            queue, (tree.dimensions, tree.aligned_nboxes),
+            dtype=tree.coord_dtype)
+    box_source_bounding_box_max = cl.array.empty(
+            queue, (tree.dimensions, tree.aligned_nboxes),
+            dtype=tree.coord_dtype)
+
+    if tree.sources_are_targets:
+        box_target_bounding_box_min = box_source_bounding_box_min
+        box_target_bounding_box_max = box_source_bounding_box_max
+    else:
+        box_target_bounding_box_min = cl.array.empty(
+                queue, (tree.dimensions, tree.aligned_nboxes),
+                dtype=tree.coord_dtype)
+        box_target_bounding_box_max = cl.array.empty(
+                queue, (tree.dimensions, tree.aligned_nboxes),
+                dtype=tree.coord_dtype)
+
+    bogus_radii_array = cl.array.empty(queue, 1, dtype=tree.coord_dtype)
+
+    # nlevels-1 is the highest valid level index
+    for level in range(tree.nlevels-1, -1, -1):
+        start, stop = tree.level_start_box_nrs[level:level+2]
+
+        for (skip, enable_radii, bbox_min, bbox_max,
+                pstarts, pcounts, radii_tree_attr, particles) in [
+                (
+                    # never skip
+                    False,
+
+                    tree.sources_have_extent,
+                    box_source_bounding_box_min,
+                    box_source_bounding_box_max,
+                    tree.box_source_starts,
+                    tree.box_source_counts_nonchild,
+                    "source_radii",
+                    tree.sources),
+                (
+                    # skip the 'target' round if sources and targets
+                    # are the same.
+                    tree.sources_are_targets,
+
+                    tree.targets_have_extent,
+                    box_target_bounding_box_min,
+                    box_target_bounding_box_max,
+                    tree.box_target_starts,
+                    tree.box_target_counts_nonchild,
+                    "target_radii",
+                    tree.targets),
+                ]:
+
+            if skip:
+                continue
+
+            args = (
+                    (
+                        tree.aligned_nboxes,
+                        tree.box_child_ids,
+                        tree.box_centers,
+                        pstarts, pcounts,)
+                    + tuple(particles)
+                    + (
+                        getattr(tree, radii_tree_attr, bogus_radii_array),
+                        enable_radii,
+
+                        bbox_min,
+                        bbox_max))
+
+            evt = knl_info.box_extents_finder(
+                    *args,
+
+                    range=slice(start, stop),
+                    queue=queue, wait_for=wait_for)
+
+        wait_for = [evt]
+
+    del bogus_radii_array
+
+    # }}}
+
+    return _BasicBoxLists(
+            source_boxes=source_boxes,
+            target_boxes=target_boxes,
+            source_parent_boxes=source_parent_boxes,
+            target_or_target_parent_boxes=target_or_target_parent_boxes,
+
+            level_start_source_box_nrs=level_start_source_box_nrs,
+            level_start_target_box_nrs=level_start_target_box_nrs,
+            level_start_source_parent_box_nrs=level_start_source_parent_box_nrs,
+            level_start_target_or_target_parent_box_nrs=(
+                level_start_target_or_target_parent_box_nrs),
+
+            box_source_bounding_box_min=box_source_bounding_box_min,
+            box_source_bounding_box_max=box_source_bounding_box_max,
+            box_target_bounding_box_min=box_target_bounding_box_min,
+            box_target_bounding_box_max=box_target_bounding_box_max,
+            ), wait_for
+
+# }}}
+
+
+# {{{ concurrent list building
+
+def _run_concurrently(queues, task_groups):
+    """Run list builds spread across *queues*.
+
+    :arg task_groups: a list of lists of tuples *(name, f)*, where *f(queue)*
+        enqueues work on *queue* and returns a tuple *(result, events)*.
+        The groups are handed out round-robin to *queues*, and the tasks
+        of each group run in order.
+    :returns: a tuple *(results, events)*, where *results* maps the task
+        names to their results.
+
+    With more than one queue, each queue is served by its own host thread,
+    so that the host-side waits within a build (e.g. for the list sizes in
+    :class:`pyopencl.algorithm.ListOfListsBuilder`) do not hold up the work
+    on the other queues. Launching the same kernel from multiple threads is
+    not safe, so tasks using the same kernels must be in the same group.
+    """
+    tasks_by_queue = [[] for _ in queues]
+    for igroup, group in enumerate(task_groups):
+        tasks_by_queue[igroup % len(queues)].extend(group)
+
+    results = {}
+    events = []
+
+    def run_tasks(queue, tasks):
+        for name, f in tasks:
+            result, task_events = f(queue)
+            results[name] = result
+            events.extend(task_events)
+
+    if len(queues) == 1:
+        run_tasks(queues[0], tasks_by_queue[0])
+        return results, events
+
+    import sys
+    from threading import Thread
+
+    exc_infos = []
+
+    def run_tasks_in_thread(queue, tasks):
+        try:
+            run_tasks(queue, tasks)
+        except Exception:
+            exc_infos.append(sys.exc_info())
+
+    threads = [
+            Thread(target=run_tasks_in_thread, args=(queue, tasks))
+            for queue, tasks in zip(queues, tasks_by_queue)
+            if tasks]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if exc_infos:
+        six.reraise(*exc_infos[0])
+
+    return results, events
+
+# }}}
+
+
+class FMMTraversalBuilder:
+    def __init__(self, context, well_sep_is_n_away=1, from_sep_smaller_crit=None,
+            mac_theta=None, mac_extent="static", stencil_min_occupancy=None):
+        """
+        :arg well_sep_is_n_away: Either An integer 1 or greater.
+            (Only 1 and 2 are tested.)
+            The spacing between boxes that is considered "well-separated" for
+            :attr:`from_sep_siblings` (List 2).
+        :arg from_sep_smaller_crit: The criterion used to determine separation
+            box dimensions and separation for :attr:`from_sep_smaller_by_level`
+            (List 3). May be one of ``"static_linf"`` (use the box square,
+            possibly enlarged by :attr:`Tree.stick_out_factor`), ``"precise_linf"`
+            (use the precise extent of targets in the box, including their radii),
+            or ``"static_l2"`` (use the circumcircle of the box,
+            possibly enlarged by :attr:`Tree.stick_out_factor`).
+        :arg mac_theta: If not *None*, a number in the open interval
+            :math:`(0, 1)`. Replaces the fixed :attr:`well_sep_is_n_away`
+            spacing by an opening-angle multipole acceptance criterion:
+            two same-level boxes are considered well-separated if they
+            are not adjacent and
+            :math:`r_t + r_s \\le \\theta \\|c_t - c_s\\|_2`, where
+            :math:`r` is a box radius (see *mac_extent*) and :math:`c` a box
+            center. This affects the same-level non-well-separated boxes
+            and Lists 2, 3 and 4. Source boxes in Lists 3 and 4 also have to
+            meet the criterion with respect to the target box. Those that are
+            not adjacent to the target box but fail it are evaluated
+            directly, through the "close" lists of :class:`FMMTraversalInfo`.
+            If given, *well_sep_is_n_away* is ignored.
+        :arg mac_extent: Only used if *mac_theta* is not *None*. Either
+            ``"static"`` (use the circumradius of the box) or ``"precise"``
+            (use the radius of the ball around the box center containing the
+            bounding box of the particles in the box, including their extent).
+        :arg stencil_min_occupancy: If not *None*, a number in the interval
+            :math:`(0, 1]`. Tree levels on which at least this fraction of the
+            :math:`2^{d\\ell}` possible boxes is present are considered
+            uniform. On these levels, the same-level non-well-separated boxes
+            and :attr:`from_sep_siblings` (List 2) are found by looking up a
+            fixed stencil of same-level offsets in a dense grid of boxes,
+            rather than by walking the tree. The entries found are the same,
+            but their order within each list may differ. Useful for
+            ``"non-adaptive"`` trees and other grid-like inputs. Cannot be
+            combined with *mac_theta*.
+
+        .. versionadded:: 2019.1
+
+            *mac_theta*, *mac_extent*, and *stencil_min_occupancy*
+        """
+        if stencil_min_occupancy is not None:
+            if not 0 < stencil_min_occupancy <= 1:
+                raise ValueError("stencil_min_occupancy must be in (0, 1], "
+                        "got '%s'" % stencil_min_occupancy)
+
+            if mac_theta is not None:
+                raise ValueError("stencils cannot be used with an opening-angle "
+                        "criterion")
+
+        if mac_theta is not None:
+            if not 0 < mac_theta < 1:
+                raise ValueError("mac_theta must be between 0 and 1, "
+                        "got '%s'" % mac_theta)
+
+            if mac_extent not in ["static", "precise"]:
+                raise ValueError("unexpected value of 'mac_extent': %s"
+                        % mac_extent)
+
+        self.context = context
+        self.well_sep_is_n_away = well_sep_is_n_away
+        self.from_sep_smaller_crit = from_sep_smaller_crit
+        self.mac_theta = mac_theta
+        self.mac_extent = mac_extent
+        self.stencil_min_occupancy = stencil_min_occupancy
+
+    def get_effective_well_sep_is_n_away(self, dimensions, stick_out_factor=0,
+            extent_norm=None):
+        """Return the smallest *n* such that all same-level
+        non-well-separated boxes are at most *n* boxes away from their
+        reference box (in the :math:`l^\\infty` sense). Equal to
+        :attr:`well_sep_is_n_away` unless an opening-angle criterion is in
+        use, see *mac_theta* in :meth:`__init__`.
+
+        :arg stick_out_factor: See :attr:`boxtree.Tree.stick_out_factor`.
+            Only needed if particles have extent.
+        :arg extent_norm: See :attr:`boxtree.Tree.extent_norm`, or *None* if
+            particles do not have extent.
+
+        .. versionchanged:: 2019.1
+
+            Added *stick_out_factor* and *extent_norm*.
+        """
+        if self.mac_theta is None:
+            return self.well_sep_is_n_away
+
+        from math import ceil, sqrt
+
+        # Upper bound for the criterion's box radius, in units of the
+        # l^inf radius r of the box.
+        rad_factor = sqrt(dimensions)
+        if self.mac_extent == "precise" and extent_norm is not None:
+            # The particle bounding box may stick out of the box.
+            rad_factor *= 1 + stick_out_factor
+            if extent_norm == "l2":
+                # Particles lie in the ball around the enlarged box, whose
+                # bounding box has an l^inf radius larger by sqrt(d).
+                rad_factor *= sqrt(dimensions)
+            elif extent_norm != "linf":
+                raise ValueError("unexpected value of 'extent_norm': %s"
+                        % extent_norm)
+
+        # Boxes failing the criterion have a center distance (in units of
+        # box size 2*r) below rad_factor/theta.
+        return max(1, int(ceil(rad_factor / self.mac_theta)) - 1)
+
+    def _have_close_lists(self, sources_have_extent, targets_have_extent):
+        # Interactions failing the opening-angle criterion in Lists 3 and 4
+        # are evaluated directly, through the "close" lists.
+        return (sources_have_extent or targets_have_extent
+                or self.mac_theta is not None)
+
+    def _get_effective_well_sep_is_n_away_for_tree(self, tree):
+        if tree.sources_have_extent or tree.targets_have_extent:
+            return self.get_effective_well_sep_is_n_away(tree.dimensions,
+                    tree.stick_out_factor, tree.extent_norm)
+        else:
+            return self.get_effective_well_sep_is_n_away(tree.dimensions)
+
+    # {{{ kernel builder
+
+    @memoize_method
+    @log_process(logger)
+    def get_kernel_info(self, dimensions, particle_id_dtype, box_id_dtype,
+            coord_dtype, box_level_dtype, max_levels,
+            sources_are_targets, sources_have_extent, targets_have_extent,
+            extent_norm, have_target_mask=False, periodic=False,
+            well_sep_is_n_away=None):
+
+        if well_sep_is_n_away is None:
+            well_sep_is_n_away = self.get_effective_well_sep_is_n_away(dimensions)
+
+        # {{{ process from_sep_smaller_crit
+
+        from_sep_smaller_crit = self.from_sep_smaller_crit
+
+        if from_sep_smaller_crit is None:
+            from_sep_smaller_crit = "precise_linf"
+
+        if extent_norm == "linf":
+            # no special checks needed
+            pass
+
+        elif extent_norm == "l2":
+            if from_sep_smaller_crit == "static_linf":
+                # Not technically necessary, but static linf will assume box
+                # bounds that are not guaranteed to contain all particle
+                # extents.
+                raise ValueError(
+                        "The static l^inf from-sep-smaller criterion "
+                        "cannot be used with the l^2 extent norm")
+
+        elif extent_norm is None:
+            assert not (sources_have_extent or targets_have_extent)
+
+            if from_sep_smaller_crit is None:
+                # doesn't matter
+                from_sep_smaller_crit = "static_linf"
+
+        else:
+            raise ValueError("unexpected value of 'extent_norm': %s"
+                    % extent_norm)
+
+        if from_sep_smaller_crit not in [
+                "static_linf", "precise_linf",
+                "static_l2",
+                ]:
+            raise ValueError("unexpected value of 'from_sep_smaller_crit': %s"
+                    % from_sep_smaller_crit)
+
+        # }}}
+
+        debug = False
+
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree.tree import box_flags_enum
+        render_vars = dict(
+                np=np,
+                dimensions=dimensions,
+                dtype_to_ctype=dtype_to_ctype,
+                particle_id_dtype=particle_id_dtype,
+                box_id_dtype=box_id_dtype,
+                box_flags_enum=box_flags_enum,
+                coord_dtype=coord_dtype,
+                vec_types=cl.cltypes.vec_types,
+                max_levels=max_levels,
+                AXIS_NAMES=AXIS_NAMES,
+                debug=debug,
+                sources_are_targets=sources_are_targets,
+                sources_have_extent=sources_have_extent,
+                targets_have_extent=targets_have_extent,
+                well_sep_is_n_away=well_sep_is_n_away,
+                from_sep_smaller_crit=from_sep_smaller_crit,
+                mac_theta=self.mac_theta,
+                mac_extent=self.mac_extent,
+                have_close_lists=self._have_close_lists(
+                    sources_have_extent, targets_have_extent),
+                use_stencils=self.stencil_min_occupancy is not None,
+                have_target_mask=have_target_mask,
+                periodic=periodic,
+                nperiodic_shifts=(
+                    (2*well_sep_is_n_away + 1)**dimensions if periodic else 1),
+                )
+        from pyopencl.algorithm import ListOfListsBuilder
+        from boxtree.tools import VectorArg, ScalarArg
+
+        result = _make_basic_kernels(self.context, render_vars,
+                box_level_dtype).get_copy_kwargs()
+
+        if self.stencil_min_occupancy is not None:
+            result["stencil_grid_builder"] = \
+                    STENCIL_GRID_BUILDER_TEMPLATE.build(self.context,
+                        type_aliases=(
+                            ("box_id_t", box_id_dtype),
+                            ("coord_t", coord_dtype),
+                            ("coord_vec_t", cl.cltypes.vec_types[
+                                coord_dtype, dimensions]),
+                            ("box_level_t", box_level_dtype),
+                            ),
+                        var_values=(
+                            ("dimensions", dimensions),
+                            ),
+                        )
+
+            stencil_args = [
+                    VectorArg(np.int64, "level_stencil_grid_starts"),
+                    VectorArg(box_id_dtype, "stencil_grid"),
+                    ]
+        else:
+            stencil_args = []
+
+        if have_target_mask:
+            target_mask_args = [VectorArg(np.uint8, "target_box_mask")]
+        else:
+            target_mask_args = []
+
+        if periodic:
+            periodic_args = [
+                    VectorArg(np.int16, "same_level_non_well_sep_boxes_shifts")]
+        else:
+            periodic_args = []
+
+        # {{{ build list N builders
+
+        base_args = [
+                VectorArg(coord_dtype, "box_centers", with_offset=False),
+                ScalarArg(coord_dtype, "root_extent"),
+                VectorArg(np.uint8, "box_levels"),
+                ScalarArg(box_id_dtype, "aligned_nboxes"),
+                VectorArg(box_id_dtype, "box_child_ids", with_offset=False),
+                VectorArg(box_flags_enum.dtype, "box_flags"),
+                ]
+
+        mac_args = [
+                VectorArg(coord_dtype, "box_source_bounding_box_min",
+                    with_offset=False),
+                VectorArg(coord_dtype, "box_source_bounding_box_max",
+                    with_offset=False),
+                VectorArg(coord_dtype, "box_target_bounding_box_min",
+                    with_offset=False),
+                VectorArg(coord_dtype, "box_target_bounding_box_max",
+                    with_offset=False),
+                ]
+
+        for list_name, template, extra_args, extra_lists, eliminate_empty_list in [
+                ("same_level_non_well_sep_boxes",
+                    SAME_LEVEL_NON_WELL_SEP_BOXES_TEMPLATE,
+                        [
+                            VectorArg(box_id_dtype, "box_parent_ids",
+                                with_offset=False),
+                            ] + mac_args + stencil_args + target_mask_args,
+                        [], []),
+                ("neighbor_source_boxes", NEIGBHOR_SOURCE_BOXES_TEMPLATE,
+                        [
+                            VectorArg(box_id_dtype, "target_boxes"),
+                            ], [], []),
+                ("from_sep_siblings", FROM_SEP_SIBLINGS_TEMPLATE,
+                        [
+                            VectorArg(box_id_dtype, "target_or_target_parent_boxes"),
+                            VectorArg(box_id_dtype, "box_parent_ids",
+                                with_offset=False),
+                            VectorArg(box_id_dtype,
+                                "same_level_non_well_sep_boxes_starts"),
+                            VectorArg(box_id_dtype,
+                                "same_level_non_well_sep_boxes_lists"),
+                            ] + mac_args + stencil_args + periodic_args, [], []),
+                ("from_sep_smaller", FROM_SEP_SMALLER_TEMPLATE,
+                        [
+                            ScalarArg(coord_dtype, "stick_out_factor"),
+                            VectorArg(box_id_dtype, "target_boxes"),
+                            VectorArg(box_id_dtype,
+                                "same_level_non_well_sep_boxes_starts"),
+                            VectorArg(box_id_dtype,
+                                "same_level_non_well_sep_boxes_lists"),
+                            VectorArg(coord_dtype, "box_target_bounding_box_min",
+                                with_offset=False),
+                            VectorArg(coord_dtype, "box_target_bounding_box_max",
+                                with_offset=False),
+                            VectorArg(coord_dtype, "box_source_bounding_box_min",
+                                with_offset=False),
+                            VectorArg(coord_dtype, "box_source_bounding_box_max",
+                                with_offset=False),
+                            VectorArg(particle_id_dtype, "box_source_counts_cumul"),
+                            VectorArg(particle_id_dtype,
+                                "from_sep_smaller_min_nsources_cumul"),
+                            ScalarArg(box_id_dtype, "from_sep_smaller_source_level"),
+                            ] + periodic_args,
+                            ["from_sep_close_smaller"]
+                            if render_vars["have_close_lists"]
+                            else [], ["from_sep_smaller"]),
+                ("from_sep_bigger", FROM_SEP_BIGGER_TEMPLATE,
+                        [
+                            ScalarArg(coord_dtype, "stick_out_factor"),
+                            VectorArg(box_id_dtype, "target_or_target_parent_boxes"),
+                            VectorArg(box_id_dtype, "box_parent_ids",
+                                with_offset=False),
+                            VectorArg(box_id_dtype,
+                                "same_level_non_well_sep_boxes_starts"),
+                            VectorArg(box_id_dtype,
+                                "same_level_non_well_sep_boxes_lists"),
+                            ] + mac_args + periodic_args,
+                            ["from_sep_close_bigger"]
+                            if render_vars["have_close_lists"]
+                            else [], []),
+                ]:
+            src = Template(
+                    TRAVERSAL_PREAMBLE_TEMPLATE
+                    + HELPER_FUNCTION_TEMPLATE
+                    + (MAC_HELPER_FUNCTION_TEMPLATE
+                        if self.mac_theta is not None
+                        else "")
+                    + template,
+                    strict_undefined=True).render(**render_vars)
+
+            # For periodic trees, each entry comes with the shift code of
+            # the periodic image of the box that it refers to.
+            result[list_name+"_builder"] = ListOfListsBuilder(self.context,
+                    [(list_name, box_id_dtype)]
+                    + ([(list_name + "_shifts", np.int16)] if periodic else [])
+                    + [(extra_list_name, box_id_dtype)
+                        for extra_list_name in extra_lists],
+                    str(src),
+                    arg_decls=base_args + extra_args,
+                    debug=debug, name_prefix=list_name,
+                    complex_kernel=True,
+                    eliminate_empty_output_lists=eliminate_empty_list)
+
+        # }}}
+
+        return _KernelInfo(**result)
+
+    # }}}
+
+    # {{{ target box mask
+
+    @memoize_method
+    def get_target_box_mask_kernels(self, particle_id_dtype, box_id_dtype,
+            flags_dtype, per_target_flags):
+        from boxtree.tree import box_flags_enum
+
+        mask_from_flags = TARGET_BOX_MASK_FROM_FLAGS_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("box_id_t", box_id_dtype),
+                    ("particle_id_t", particle_id_dtype),
+                    ("box_flags_t", box_flags_enum.dtype),
+                    ("flag_t", flags_dtype),
+                    ),
+                var_values=(
+                    ("per_target_flags", per_target_flags),
+                    ("box_flags_enum", box_flags_enum),
+                    ("TARGET_BOX_MASK_SELECTED", TARGET_BOX_MASK_SELECTED),
+                    ),
+                )
+
+        ancestor_marker = TARGET_BOX_MASK_ANCESTOR_MARKER_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("box_id_t", box_id_dtype),
+                    ),
+                var_values=(
+                    ("TARGET_BOX_MASK_SELECTED", TARGET_BOX_MASK_SELECTED),
+                    ("TARGET_BOX_MASK_ANCESTOR", TARGET_BOX_MASK_ANCESTOR),
+                    ),
+                )
+
+        return mask_from_flags, ancestor_marker
+
+    def _build_target_box_mask(self, queue, tree, flags, per_target_flags,
+            wait_for):
+        """
+        :returns: a tuple *(target_box_mask, wait_for)*.
+        """
+        expected_len = tree.ntargets if per_target_flags else tree.nboxes
+        if len(flags) != expected_len:
+            raise ValueError("target mask has length %d, expected %d"
+                    % (len(flags), expected_len))
+
+        mask_from_flags, ancestor_marker = self.get_target_box_mask_kernels(
+                tree.particle_id_dtype, tree.box_id_dtype, flags.dtype,
+                per_target_flags)
+
+        if per_target_flags:
+            tree_order_flags = cl.array.empty(queue, tree.ntargets, flags.dtype)
+            tree_order_flags[tree.sorted_target_ids] = flags
+            flags = tree_order_flags
+
+        target_box_mask = cl.array.empty(queue, tree.nboxes, np.uint8)
+
+        evt = mask_from_flags(
+                tree.box_flags, tree.box_target_starts,
+                tree.box_target_counts_nonchild,
+                flags, target_box_mask,
+                range=slice(tree.nboxes),
+                queue=queue, wait_for=wait_for)
+
+        evt = ancestor_marker(
+                tree.box_parent_ids, target_box_mask,
+                range=slice(tree.nboxes),
+                queue=queue, wait_for=[evt])
+
+        return target_box_mask, [evt]
+
+    # }}}
+
+    # {{{ stencil grids
+
+    def _build_stencil_grids(self, queue, tree, knl_info, wait_for):
+        """
+        :returns: a tuple *(stencil_args, wait_for)*, where *stencil_args*
+            are the extra arguments for the list builders using stencils.
+        """
+        level_stencil_grid_starts = np.empty(tree.nlevels, np.int64)
+        level_stencil_grid_starts.fill(-1)
+
+        grid_size = 0
+
+        # The root level has no same-level boxes or list 2.
+        for level in range(1, tree.nlevels):
+            nlevel_boxes = (
+                    tree.level_start_box_nrs[level + 1]
+                    - tree.level_start_box_nrs[level])
+            level_grid_size = 2**(tree.dimensions * level)
+
+            if nlevel_boxes >= self.stencil_min_occupancy * level_grid_size:
+                level_stencil_grid_starts[level] = grid_size
+                grid_size += level_grid_size
+
+        logger.debug("stencil grids: levels %s, %d grid entries",
+                np.nonzero(level_stencil_grid_starts >= 0)[0], grid_size)
+
+        level_stencil_grid_starts = cl.array.to_device(
+                queue, level_stencil_grid_starts)
+        stencil_grid = cl.array.zeros(queue, max(grid_size, 1),
+                tree.box_id_dtype)
+
+        evt = knl_info.stencil_grid_builder(
+                tree.box_centers, tree.root_extent, tree.box_levels,
+                tree.aligned_nboxes, level_stencil_grid_starts, stencil_grid,
+                range=slice(tree.nboxes),
+                queue=queue, wait_for=wait_for)
+
+        return (level_stencil_grid_starts, stencil_grid), [evt]
+
+    # }}}
+
+    # {{{ list 3 threshold
+
+    def _process_from_sep_smaller_min_nsources_cumul(self, queue, tree,
+            from_sep_smaller_min_nsources_cumul, cost_model, level_to_order,
+            calibration_params, build_unthresholded_trav):
+        """Turn the *from_sep_smaller_min_nsources_cumul* argument of
+        :meth:`__call__` into a per-level :class:`numpy.ndarray`.
+
+        :arg build_unthresholded_trav: a function returning a tuple
+            *(trav, event)* with a traversal built without a threshold,
+            called for ``"auto_global"``.
+        :returns: a tuple *(thresholds, events)*, where *events* is a
+            (possibly empty) list of events the build has to wait for.
+        """
+        events = []
+
+        if from_sep_smaller_min_nsources_cumul is None:
+            # default to old no-threshold behavior
+            from_sep_smaller_min_nsources_cumul = 0
+
+        if not self._have_close_lists(
+                tree.sources_have_extent, tree.targets_have_extent):
+            # There are no "close" lists to move interactions into.
+            from_sep_smaller_min_nsources_cumul = 0
+
+        elif isinstance(from_sep_smaller_min_nsources_cumul, six.string_types):
+            if level_to_order is None:
+                raise ValueError("level_to_order must be given to choose "
+                        "from_sep_smaller_min_nsources_cumul automatically")
+
+            if cost_model is None:
+                from boxtree.cost import FMMCostModel
+                cost_model = FMMCostModel(queue)
+
+            if calibration_params is None:
+                calibration_params = cost_model.get_unit_calibration_params()
+
+            if from_sep_smaller_min_nsources_cumul == "auto":
+                unthresholded_trav = None
+            elif from_sep_smaller_min_nsources_cumul == "auto_global":
+                unthresholded_trav, evt = build_unthresholded_trav()
+                events.append(evt)
+            else:
+                raise ValueError("unexpected value of "
+                        "'from_sep_smaller_min_nsources_cumul': %s"
+                        % from_sep_smaller_min_nsources_cumul)
+
+            from_sep_smaller_min_nsources_cumul = (
+                    cost_model.get_from_sep_smaller_min_nsources_cumul(
+                        tree, level_to_order, calibration_params,
+                        traversal=unthresholded_trav))
+            del unthresholded_trav
+
+        return np.array(np.broadcast_to(
+                np.asarray(from_sep_smaller_min_nsources_cumul,
+                    dtype=tree.particle_id_dtype),
+                (tree.nlevels,))), events
+
+    # }}}
+
+    # {{{ driver
+
+    def __call__(self, queue, tree, wait_for=None, debug=False,
+            _from_sep_smaller_min_nsources_cumul=None,
+            target_mask=None, target_box_mask=None, extra_queues=None,
+            from_sep_smaller_min_nsources_cumul=None, cost_model=None,
+            level_to_order=None, calibration_params=None):
+        """
+        :arg queue: A :class:`pyopencl.CommandQueue` instance.
+        :arg tree: A :class:`boxtree.Tree` instance.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            exeuction.
+        :arg extra_queues: If not *None*, a list of further
+            :class:`pyopencl.CommandQueue` instances in the context of
+            *queue* (possibly for other devices). The interaction lists
+            that do not depend on each other are then built concurrently,
+            spread across *queue* and these, with one host thread per
+            queue.
+        :arg target_mask: If not *None*, an array of length
+            :attr:`boxtree.Tree.ntargets` of integers which indicate by
+            being nonzero that the corresponding target (in user target
+            order) is of interest. Only target boxes containing such targets,
+            and their parents, are included in the traversal. Potentials of
+            targets in other boxes are not computed by
+            :func:`boxtree.fmm.drive_fmm`.
+        :arg target_box_mask: Like *target_mask*, but an array of length
+            :attr:`boxtree.Tree.nboxes` indicating the target boxes of
+            interest. Cannot be combined with *target_mask*.
+        :arg from_sep_smaller_min_nsources_cumul: Source boxes with fewer
+            than this many sources (including those of their descendants) are
+            moved from "List 3" into the "close" lists, to be evaluated
+            directly. This only has an effect if the "close" lists exist,
+            i.e. if the particles have extent or *mac_theta* was given to
+            the constructor. May be an integer, a sequence
+            of integers with one entry per level of the source box, or one
+            of the strings ``"auto"`` and ``"auto_global"``. With these, the
+            threshold is chosen using *cost_model* to minimize the predicted
+            cost of the multipole evaluations ("List 3") and the direct
+            evaluations replacing them, either per level or, at the price of
+            building the traversal twice, as a single threshold for all
+            levels. See
+            :meth:`boxtree.cost.AbstractFMMCostModel.get_from_sep_smaller_min_nsources_cumul`.
+            The value used is recorded in
+            :attr:`FMMTraversalInfo.from_sep_smaller_min_nsources_cumul`.
+            Defaults to zero.
+        :arg cost_model: An instance of
+            :class:`boxtree.cost.AbstractFMMCostModel` used to choose
+            *from_sep_smaller_min_nsources_cumul* automatically. Defaults to
+            a :class:`boxtree.cost.FMMCostModel` running on *queue*.
+        :arg level_to_order: A :class:`numpy.ndarray` of the expansion orders
+            of the tree levels. Required to choose
+            *from_sep_smaller_min_nsources_cumul* automatically.
+        :arg calibration_params: A :class:`dict` of calibration parameters for
+            *cost_model*. Defaults to
+            :meth:`boxtree.cost.AbstractFMMCostModel.get_unit_calibration_params`.
+        :return: A tuple *(trav, event)*, where *trav* is a new instance of
+            :class:`FMMTraversalInfo` and *event* is a :class:`pyopencl.Event`
+            for dependency management.
+
+        If *tree* is :attr:`boxtree.Tree.periodic`, the lists also contain
+        the periodic images of the source boxes that are not well-separated
+        from the root box. See the "Periodic images" section of
+        :class:`FMMTraversalInfo`.
+
+        .. versionchanged:: 2019.1
+
+            Added support for periodic trees.
+        """
+
+        if not tree._is_pruned:
+            raise ValueError("tree must be pruned for traversal generation")
+
+        if tree.sources_have_extent:
+            # YAGNI
+            raise NotImplementedError(
+                    "trees with source extent are not supported for "
+                    "traversal generation")
+
+        if tree.periodic:
+            if (self.mac_theta is not None
+                    or self.stencil_min_occupancy is not None):
+                raise NotImplementedError("periodic traversals with an "
+                        "opening-angle criterion or with stencils")
+
+        # {{{ process from_sep_smaller_min_nsources_cumul
+
+        if _from_sep_smaller_min_nsources_cumul is not None:
+            if from_sep_smaller_min_nsources_cumul is not None:
+                raise TypeError("may not specify both "
+                        "'_from_sep_smaller_min_nsources_cumul' and "
+                        "'from_sep_smaller_min_nsources_cumul'")
+
+            from_sep_smaller_min_nsources_cumul = \
+                    _from_sep_smaller_min_nsources_cumul
+
+        from_sep_smaller_min_nsources_cumul, auto_events = \
+                self._process_from_sep_smaller_min_nsources_cumul(
+                    queue, tree, from_sep_smaller_min_nsources_cumul,
+                    cost_model, level_to_order, calibration_params,
+                    lambda: self(queue, tree,
+                        wait_for=wait_for, debug=debug,
+                        target_mask=target_mask,
+                        target_box_mask=target_box_mask,
+                        extra_queues=extra_queues))
+        if auto_events:
+            wait_for = auto_events
+
+        # }}}
+
+        # Generated code shouldn't depend on the *exact* number of tree levels.
+        # So round up to the next multiple of 5.
+        from pytools import div_ceil
+        max_levels = div_ceil(tree.nlevels, 5) * 5
+
+        if target_mask is not None and target_box_mask is not None:
+            raise TypeError("may not specify both target_mask and "
+                    "target_box_mask")
+
+        have_target_mask = (
+                target_mask is not None or target_box_mask is not None)
+
+        knl_info = self.get_kernel_info(
+                tree.dimensions, tree.particle_id_dtype, tree.box_id_dtype,
+                tree.coord_dtype, tree.box_level_dtype, max_levels,
+                tree.sources_are_targets,
+                tree.sources_have_extent, tree.targets_have_extent,
+                tree.extent_norm, have_target_mask, tree.periodic,
+                self._get_effective_well_sep_is_n_away_for_tree(tree))
 
-        result["sources_parents_and_targets_builder"] = \
-                ListOfListsBuilder(self.context,
-                        [
-                            ("source_parent_boxes", box_id_dtype),
-                            ("source_boxes", box_id_dtype),
-                            ("target_or_target_parent_boxes", box_id_dtype)
-                            ] + (
-                                [("target_boxes", box_id_dtype)]
-                                if not sources_are_targets
-                                else []),
-                        str(src),
-                        arg_decls=[
-                            VectorArg(box_flags_enum.dtype, "box_flags"),
-                            ],
-                        debug=debug,
-                        name_prefix="sources_parents_and_targets")
-
-        result["box_extents_finder"] = \
-                BOX_EXTENTS_FINDER_TEMPLATE.build(self.context,
-                    type_aliases=(
-                        ("box_id_t", box_id_dtype),
-                        ("coord_t", coord_dtype),
-                        ("coord_vec_t", cl.cltypes.vec_types[
-                            coord_dtype, dimensions]),
-                        ("particle_id_t", particle_id_dtype),
-                        ),
-                    var_values=(
-                        ("dimensions", dimensions),
-                        ("AXIS_NAMES", AXIS_NAMES),
-                        ("sources_have_extent", sources_have_extent),
-                        ("targets_have_extent", targets_have_extent),
-                        ),
-                    )
-
-        result["level_start_box_nrs_extractor"] = \
-                LEVEL_START_BOX_NR_EXTRACTOR_TEMPLATE.build(self.context,
-                    type_aliases=(
-                        ("box_id_t", box_id_dtype),
-                        ("box_level_t", box_level_dtype),
-                        ),
-                    )
+        queues = [queue] + list(extra_queues or [])
+
+        def fin_debug(s):
+            if debug:
+                for q in queues:
+                    q.finish()
+
+            logger.debug(s)
+
+        traversal_plog = ProcessLogger(logger, "build traversal")
+
+        if have_target_mask:
+            fin_debug("building target box mask")
+
+            if target_mask is not None:
+                box_mask, wait_for = self._build_target_box_mask(
+                        queue, tree, target_mask, True, wait_for)
+            else:
+                box_mask, wait_for = self._build_target_box_mask(
+                        queue, tree, target_box_mask, False, wait_for)
+
+            target_mask_args = (box_mask,)
+        else:
+            box_mask = None
+            target_mask_args = ()
+
+        basic_lists, wait_for = _build_basic_box_lists(
+                queue, tree, knl_info, fin_debug, wait_for,
+                target_box_mask=box_mask)
+
+        source_boxes = basic_lists.source_boxes
+        target_boxes = basic_lists.target_boxes
+        source_parent_boxes = basic_lists.source_parent_boxes
+        target_or_target_parent_boxes = basic_lists.target_or_target_parent_boxes
+
+        level_start_source_box_nrs = basic_lists.level_start_source_box_nrs
+        level_start_target_box_nrs = basic_lists.level_start_target_box_nrs
+        level_start_source_parent_box_nrs = \
+                basic_lists.level_start_source_parent_box_nrs
+        level_start_target_or_target_parent_box_nrs = \
+                basic_lists.level_start_target_or_target_parent_box_nrs
+
+        box_source_bounding_box_min = basic_lists.box_source_bounding_box_min
+        box_source_bounding_box_max = basic_lists.box_source_bounding_box_max
+        box_target_bounding_box_min = basic_lists.box_target_bounding_box_min
+        box_target_bounding_box_max = basic_lists.box_target_bounding_box_max
+
+        # {{{ same-level non-well-separated boxes
+
+        # If well_sep_is_n_away is 1, this agrees with the definition of
+        # 'colleagues' from the classical FMM literature.
+
+        fin_debug("finding same-level near-field boxes")
+
+        mac_args = (
+                box_source_bounding_box_min.data,
+                box_source_bounding_box_max.data,
+                box_target_bounding_box_min.data,
+                box_target_bounding_box_max.data)
+
+        if self.stencil_min_occupancy is not None:
+            stencil_args, wait_for = self._build_stencil_grids(
+                    queue, tree, knl_info, wait_for)
+        else:
+            stencil_args = ()
+
+        # The builds below only depend on the basic box lists or on the
+        # same-level lists, and so they are only ordered by these
+        # dependencies. This matters when they are spread across multiple
+        # queues.
+        basic_lists_wait_for = wait_for
+
+        result, evt = knl_info.same_level_non_well_sep_boxes_builder(
+                queue, tree.nboxes,
+                tree.box_centers.data, tree.root_extent, tree.box_levels,
+                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                tree.box_parent_ids.data,
+                *(mac_args + stencil_args + target_mask_args),
+                wait_for=wait_for)
+        same_level_wait_for = [evt]
+        same_level_non_well_sep_boxes = result["same_level_non_well_sep_boxes"]
+
+        def get_shifts(result, list_name):
+            if tree.periodic:
+                return result[list_name + "_shifts"].lists
+            else:
+                return None
+
+        same_level_non_well_sep_boxes_shifts = get_shifts(
+                result, "same_level_non_well_sep_boxes")
+        if tree.periodic:
+            periodic_args = (same_level_non_well_sep_boxes_shifts,)
+        else:
+            periodic_args = ()
 
         # }}}
 
-        # {{{ build list N builders
+        with_close_lists = self._have_close_lists(
+                tree.sources_have_extent, tree.targets_have_extent)
 
-        base_args = [
-                VectorArg(coord_dtype, "box_centers", with_offset=False),
-                ScalarArg(coord_dtype, "root_extent"),
-                VectorArg(np.uint8, "box_levels"),
-                ScalarArg(box_id_dtype, "aligned_nboxes"),
-                VectorArg(box_id_dtype, "box_child_ids", with_offset=False),
-                VectorArg(box_flags_enum.dtype, "box_flags"),
-                ]
+        # {{{ neighbor source boxes ("list 1")
 
-        for list_name, template, extra_args, extra_lists, eliminate_empty_list in [
-                ("same_level_non_well_sep_boxes",
-                    SAME_LEVEL_NON_WELL_SEP_BOXES_TEMPLATE, [], [], []),
-                ("neighbor_source_boxes", NEIGBHOR_SOURCE_BOXES_TEMPLATE,
-                        [
-                            VectorArg(box_id_dtype, "target_boxes"),
-                            ], [], []),
-                ("from_sep_siblings", FROM_SEP_SIBLINGS_TEMPLATE,
-                        [
-                            VectorArg(box_id_dtype, "target_or_target_parent_boxes"),
-                            VectorArg(box_id_dtype, "box_parent_ids",
-                                with_offset=False),
-                            VectorArg(box_id_dtype,
-                                "same_level_non_well_sep_boxes_starts"),
-                            VectorArg(box_id_dtype,
-                                "same_level_non_well_sep_boxes_lists"),
-                            ], [], []),
-                ("from_sep_smaller", FROM_SEP_SMALLER_TEMPLATE,
-                        [
-                            ScalarArg(coord_dtype, "stick_out_factor"),
-                            VectorArg(box_id_dtype, "target_boxes"),
-                            VectorArg(box_id_dtype,
-                                "same_level_non_well_sep_boxes_starts"),
-                            VectorArg(box_id_dtype,
-                                "same_level_non_well_sep_boxes_lists"),
-                            VectorArg(coord_dtype, "box_target_bounding_box_min",
-                                with_offset=False),
-                            VectorArg(coord_dtype, "box_target_bounding_box_max",
-                                with_offset=False),
-                            VectorArg(particle_id_dtype, "box_source_counts_cumul"),
-                            ScalarArg(particle_id_dtype,
-                                "from_sep_smaller_min_nsources_cumul"),
-                            ScalarArg(box_id_dtype, "from_sep_smaller_source_level"),
-                            ],
-                            ["from_sep_close_smaller"]
-                            if sources_have_extent or targets_have_extent
-                            else [], ["from_sep_smaller"]),
-                ("from_sep_bigger", FROM_SEP_BIGGER_TEMPLATE,
-                        [
-                            ScalarArg(coord_dtype, "stick_out_factor"),
-                            VectorArg(box_id_dtype, "target_or_target_parent_boxes"),
-                            VectorArg(box_id_dtype, "box_parent_ids",
-                                with_offset=False),
-                            VectorArg(box_id_dtype,
-                                "same_level_non_well_sep_boxes_starts"),
-                            VectorArg(box_id_dtype,
-                                "same_level_non_well_sep_boxes_lists"),
-                            ],
-                            ["from_sep_close_bigger"]
-                            if sources_have_extent or targets_have_extent
-                            else [], []),
-                ]:
-            src = Template(
-                    TRAVERSAL_PREAMBLE_TEMPLATE
-                    + HELPER_FUNCTION_TEMPLATE
-                    + template,
-                    strict_undefined=True).render(**render_vars)
+        def build_neighbor_source_boxes(build_queue):
+            fin_debug("finding neighbor source boxes ('list 1')")
+
+            result, evt = knl_info.neighbor_source_boxes_builder(
+                    build_queue, len(target_boxes),
+                    tree.box_centers.data, tree.root_extent, tree.box_levels,
+                    tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                    target_boxes,
+                    wait_for=basic_lists_wait_for)
+
+            return (
+                    (result["neighbor_source_boxes"],
+                        get_shifts(result, "neighbor_source_boxes")),
+                    [evt])
+
+        # }}}
+
+        # {{{ well-separated siblings ("list 2")
+
+        def build_from_sep_siblings(build_queue):
+            fin_debug("finding well-separated siblings ('list 2')")
+
+            result, evt = knl_info.from_sep_siblings_builder(
+                    build_queue, len(target_or_target_parent_boxes),
+                    tree.box_centers.data, tree.root_extent, tree.box_levels,
+                    tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                    target_or_target_parent_boxes, tree.box_parent_ids.data,
+                    same_level_non_well_sep_boxes.starts,
+                    same_level_non_well_sep_boxes.lists,
+                    *(mac_args + stencil_args + periodic_args),
+                    wait_for=same_level_wait_for)
+
+            return (
+                    (result["from_sep_siblings"],
+                        get_shifts(result, "from_sep_siblings")),
+                    [evt])
+
+        # }}}
+
+        # {{{ separated smaller ("list 3")
+
+        from_sep_smaller_base_args = (
+                len(target_boxes),
+                tree.box_centers.data, tree.root_extent, tree.box_levels,
+                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                tree.stick_out_factor, target_boxes,
+                same_level_non_well_sep_boxes.starts,
+                same_level_non_well_sep_boxes.lists,
+                box_target_bounding_box_min.data,
+                box_target_bounding_box_max.data,
+                box_source_bounding_box_min.data,
+                box_source_bounding_box_max.data,
+                tree.box_source_counts_cumul,
+                cl.array.to_device(queue, from_sep_smaller_min_nsources_cumul),
+                )
+
+        def build_from_sep_smaller(build_queue, ilevel):
+            fin_debug("finding separated smaller ('list 3 level %d')" % ilevel)
+
+            result, evt = knl_info.from_sep_smaller_builder(
+                    *((build_queue,) + from_sep_smaller_base_args + (ilevel,)
+                        + periodic_args),
+                    omit_lists=(
+                        ("from_sep_close_smaller",) if with_close_lists else ()),
+                    wait_for=same_level_wait_for)
+
+            target_boxes_sep_smaller = cl.array.take(
+                    target_boxes.with_queue(build_queue),
+                    result["from_sep_smaller"].nonempty_indices
+                    .with_queue(build_queue),
+                    queue=build_queue, wait_for=[evt])
+
+            return (
+                    (result["from_sep_smaller"],
+                        get_shifts(result, "from_sep_smaller"),
+                        target_boxes_sep_smaller),
+                    [cl.enqueue_marker(build_queue)])
+
+        def build_from_sep_close_smaller(build_queue):
+            fin_debug("finding separated smaller close ('list 3 close')")
+
+            result, evt = knl_info.from_sep_smaller_builder(
+                    *((build_queue,) + from_sep_smaller_base_args + (-1,)
+                        + periodic_args),
+                    omit_lists=("from_sep_smaller",),
+                    wait_for=same_level_wait_for)
+
+            return result["from_sep_close_smaller"], [evt]
+
+        # }}}
+
+        # {{{ separated bigger ("list 4")
+
+        def build_from_sep_bigger(build_queue):
+            fin_debug("finding separated bigger ('list 4')")
+
+            result, evt = knl_info.from_sep_bigger_builder(
+                    build_queue, len(target_or_target_parent_boxes),
+                    tree.box_centers.data, tree.root_extent, tree.box_levels,
+                    tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                    tree.stick_out_factor, target_or_target_parent_boxes,
+                    tree.box_parent_ids.data,
+                    same_level_non_well_sep_boxes.starts,
+                    same_level_non_well_sep_boxes.lists,
+                    *(mac_args + periodic_args),
+                    wait_for=same_level_wait_for)
+
+            wait_for = [evt]
+            from_sep_bigger = result["from_sep_bigger"]
+            from_sep_bigger_shifts = get_shifts(result, "from_sep_bigger")
+
+            if not with_close_lists:
+                return (
+                        (from_sep_bigger, from_sep_bigger_shifts, None, None),
+                        wait_for)
+
+            # These are indexed by target_or_target_parent boxes; we rewrite
+            # them to be indexed by target_boxes.
+            list_merger = _ListMerger(queue.context, tree.box_id_dtype)
+            result, evt = list_merger(
+                    build_queue,
+                    # starts
+                    (result["from_sep_close_bigger"].starts,),
+                    # lists
+                    (result["from_sep_close_bigger"].lists,),
+                    # input index style
+                    _IndexStyle.TARGET_OR_TARGET_PARENT_BOXES,
+                    # output index style
+                    _IndexStyle.TARGET_BOXES,
+                    # box and tree data
+                    target_boxes,
+                    target_or_target_parent_boxes,
+                    tree.nboxes,
+                    debug,
+                    wait_for=wait_for)
+
+            return (
+                    (from_sep_bigger, from_sep_bigger_shifts,
+                        result["starts"], result["lists"]),
+                    [evt])
+
+        # }}}
+
+        # {{{ run the builds
+
+        # The List 3 builds share their kernels, so they go into one group.
+        list_3_group = [
+                (("from_sep_smaller", ilevel),
+                    lambda build_queue, ilevel=ilevel: build_from_sep_smaller(
+                        build_queue, ilevel))
+                for ilevel in range(tree.nlevels)]
+        if with_close_lists:
+            list_3_group.append(
+                    ("from_sep_close_smaller", build_from_sep_close_smaller))
+
+        results, all_events = _run_concurrently(queues, [
+                [("neighbor_source_boxes", build_neighbor_source_boxes)],
+                [("from_sep_siblings", build_from_sep_siblings)],
+                list_3_group,
+                [("from_sep_bigger", build_from_sep_bigger)],
+                ])
+
+        neighbor_source_boxes, neighbor_source_boxes_shifts = \
+                results["neighbor_source_boxes"]
+        from_sep_siblings, from_sep_siblings_shifts = \
+                results["from_sep_siblings"]
+
+        from_sep_smaller_by_level = []
+        from_sep_smaller_shifts_by_level = []
+        target_boxes_sep_smaller_by_source_level = []
+        for ilevel in range(tree.nlevels):
+            level_list, level_shifts, target_boxes_sep_smaller = \
+                    results["from_sep_smaller", ilevel]
+            from_sep_smaller_by_level.append(level_list)
+            from_sep_smaller_shifts_by_level.append(level_shifts)
+            target_boxes_sep_smaller_by_source_level.append(
+                    target_boxes_sep_smaller)
+
+        if not tree.periodic:
+            from_sep_smaller_shifts_by_level = None
+
+        if with_close_lists:
+            from_sep_close_smaller_starts = \
+                    results["from_sep_close_smaller"].starts
+            from_sep_close_smaller_lists = \
+                    results["from_sep_close_smaller"].lists
+        else:
+            from_sep_close_smaller_starts = None
+            from_sep_close_smaller_lists = None
+
+        (from_sep_bigger,
+                from_sep_bigger_shifts,
+                from_sep_close_bigger_starts,
+                from_sep_close_bigger_lists) = results["from_sep_bigger"]
+
+        # }}}
+
+        well_sep_is_n_away = self._get_effective_well_sep_is_n_away_for_tree(
+                tree)
+
+        if well_sep_is_n_away == 1:
+            colleagues_starts = same_level_non_well_sep_boxes.starts
+            colleagues_lists = same_level_non_well_sep_boxes.lists
+        else:
+            colleagues_starts = None
+            colleagues_lists = None
+
+        if tree.periodic:
+            from itertools import product
+            periodic_shifts = np.array(list(product(
+                    range(-well_sep_is_n_away, well_sep_is_n_away + 1),
+                    repeat=tree.dimensions)), dtype=np.int32)
+        else:
+            periodic_shifts = None
+
+        evt = cl.enqueue_marker(queue, wait_for=all_events)
+
+        traversal_plog.done(
+                "from_sep_smaller_crit: %s, "
+                "from_sep_smaller_min_nsources_cumul: %s",
+                self.from_sep_smaller_crit,
+                from_sep_smaller_min_nsources_cumul)
+
+        return FMMTraversalInfo(
+                tree=tree,
+                well_sep_is_n_away=well_sep_is_n_away,
+                mac_theta=self.mac_theta,
+
+                source_boxes=source_boxes,
+                target_boxes=target_boxes,
+
+                level_start_source_box_nrs=level_start_source_box_nrs,
+                level_start_target_box_nrs=level_start_target_box_nrs,
+
+                source_parent_boxes=source_parent_boxes,
+                level_start_source_parent_box_nrs=level_start_source_parent_box_nrs,
+
+                target_or_target_parent_boxes=target_or_target_parent_boxes,
+                level_start_target_or_target_parent_box_nrs=(
+                    level_start_target_or_target_parent_box_nrs),
+
+                box_source_bounding_box_min=box_source_bounding_box_min,
+                box_source_bounding_box_max=box_source_bounding_box_max,
+                box_target_bounding_box_min=box_target_bounding_box_min,
+                box_target_bounding_box_max=box_target_bounding_box_max,
+
+                same_level_non_well_sep_boxes_starts=(
+                    same_level_non_well_sep_boxes.starts),
+                same_level_non_well_sep_boxes_lists=(
+                    same_level_non_well_sep_boxes.lists),
+                # Deprecated, but we'll keep these alive for the time being.
+                colleagues_starts=colleagues_starts,
+                colleagues_lists=colleagues_lists,
+
+                neighbor_source_boxes_starts=neighbor_source_boxes.starts,
+                neighbor_source_boxes_lists=neighbor_source_boxes.lists,
+
+                from_sep_siblings_starts=from_sep_siblings.starts,
+                from_sep_siblings_lists=from_sep_siblings.lists,
+
+                from_sep_smaller_by_level=from_sep_smaller_by_level,
+                target_boxes_sep_smaller_by_source_level=(
+                    target_boxes_sep_smaller_by_source_level),
+
+                from_sep_close_smaller_starts=from_sep_close_smaller_starts,
+                from_sep_close_smaller_lists=from_sep_close_smaller_lists,
+                from_sep_smaller_min_nsources_cumul=(
+                    from_sep_smaller_min_nsources_cumul),
+
+                from_sep_bigger_starts=from_sep_bigger.starts,
+                from_sep_bigger_lists=from_sep_bigger.lists,
+
+                from_sep_close_bigger_starts=from_sep_close_bigger_starts,
+                from_sep_close_bigger_lists=from_sep_close_bigger_lists,
+
+                periodic_shifts=periodic_shifts,
+                same_level_non_well_sep_boxes_shifts=(
+                    same_level_non_well_sep_boxes_shifts),
+                neighbor_source_boxes_shifts=neighbor_source_boxes_shifts,
+                from_sep_siblings_shifts=from_sep_siblings_shifts,
+                from_sep_smaller_shifts_by_level=(
+                    from_sep_smaller_shifts_by_level),
+                from_sep_bigger_shifts=from_sep_bigger_shifts,
+                ).with_queue(None), evt
+
+    # }}}
+
+
+# {{{ treecode traversal builder
+
+class TreecodeTraversalBuilder:
+    """Builds a :class:`TreecodeTraversalInfo` for a Barnes-Hut-style
+    treecode, i.e. particle-box interactions only.
+
+    .. versionadded:: 2019.1
+    """
+
+    def __init__(self, context, mac_theta=0.5, mac_extent="static"):
+        """
+        :arg mac_theta: A number in the open interval :math:`(0, 1)`.
+            A source box is accepted for a target box if the two boxes are
+            not adjacent and
+            :math:`r_t + r_s \\le \\theta \\|c_t - c_s\\|_2`. Smaller
+            values result in more accurate, but more expensive treecodes.
+        :arg mac_extent: Either ``"static"`` or ``"precise"``. Determines
+            the box radii :math:`r`, see :class:`FMMTraversalBuilder`.
+        """
+        if not 0 < mac_theta < 1:
+            raise ValueError("mac_theta must be between 0 and 1, "
+                    "got '%s'" % mac_theta)
+
+        if mac_extent not in ["static", "precise"]:
+            raise ValueError("unexpected value of 'mac_extent': %s"
+                    % mac_extent)
+
+        self.context = context
+        self.mac_theta = mac_theta
+        self.mac_extent = mac_extent
+
+    # {{{ kernel builder
+
+    @memoize_method
+    @log_process(logger)
+    def get_kernel_info(self, dimensions, particle_id_dtype, box_id_dtype,
+            coord_dtype, box_level_dtype, max_levels,
+            sources_are_targets, sources_have_extent, targets_have_extent):
+
+        debug = False
 
-            result[list_name+"_builder"] = ListOfListsBuilder(self.context,
-                    [(list_name, box_id_dtype)]
-                    + [(extra_list_name, box_id_dtype)
-                        for extra_list_name in extra_lists],
-                    str(src),
-                    arg_decls=base_args + extra_args,
-                    debug=debug, name_prefix=list_name,
-                    complex_kernel=True,
-                    eliminate_empty_output_lists=eliminate_empty_list)
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree.tree import box_flags_enum
+        render_vars = dict(
+                np=np,
+                dimensions=dimensions,
+                dtype_to_ctype=dtype_to_ctype,
+                particle_id_dtype=particle_id_dtype,
+                box_id_dtype=box_id_dtype,
+                box_flags_enum=box_flags_enum,
+                coord_dtype=coord_dtype,
+                vec_types=cl.cltypes.vec_types,
+                max_levels=max_levels,
+                AXIS_NAMES=AXIS_NAMES,
+                debug=debug,
+                sources_are_targets=sources_are_targets,
+                sources_have_extent=sources_have_extent,
+                targets_have_extent=targets_have_extent,
+                mac_theta=self.mac_theta,
+                mac_extent=self.mac_extent,
+                have_target_mask=False,
+                periodic=False,
+                )
+        from pyopencl.algorithm import ListOfListsBuilder
+        from boxtree.tools import VectorArg, ScalarArg
 
-        # }}}
+        result = _make_basic_kernels(self.context, render_vars,
+                box_level_dtype).get_copy_kwargs()
+
+        src = Template(
+                TRAVERSAL_PREAMBLE_TEMPLATE
+                + HELPER_FUNCTION_TEMPLATE
+                + MAC_HELPER_FUNCTION_TEMPLATE
+                + TREECODE_TEMPLATE,
+                strict_undefined=True).render(**render_vars)
+
+        result["treecode_builder"] = ListOfListsBuilder(self.context,
+                [
+                    ("accepted_source_boxes", box_id_dtype),
+                    ("near_field_source_boxes", box_id_dtype),
+                    ],
+                str(src),
+                arg_decls=[
+                    VectorArg(coord_dtype, "box_centers", with_offset=False),
+                    ScalarArg(coord_dtype, "root_extent"),
+                    VectorArg(np.uint8, "box_levels"),
+                    ScalarArg(box_id_dtype, "aligned_nboxes"),
+                    VectorArg(box_id_dtype, "box_child_ids", with_offset=False),
+                    VectorArg(box_flags_enum.dtype, "box_flags"),
+                    VectorArg(box_id_dtype, "target_boxes"),
+                    VectorArg(coord_dtype, "box_source_bounding_box_min",
+                        with_offset=False),
+                    VectorArg(coord_dtype, "box_source_bounding_box_max",
+                        with_offset=False),
+                    VectorArg(coord_dtype, "box_target_bounding_box_min",
+                        with_offset=False),
+                    VectorArg(coord_dtype, "box_target_bounding_box_max",
+                        with_offset=False),
+                    ],
+                debug=debug, name_prefix="treecode",
+                complex_kernel=True)
+
+        for write_counts in [True, False]:
+            result["accepted_level_splitter_" + (
+                    "count" if write_counts else "write")] = \
+                    ACCEPTED_LEVEL_SPLITTER_TEMPLATE.build(self.context,
+                        type_aliases=(
+                            ("box_id_t", box_id_dtype),
+                            ("box_level_t", box_level_dtype),
+                            ),
+                        var_values=(
+                            ("max_levels", max_levels),
+                            ("write_counts", write_counts),
+                            ))
 
         return _KernelInfo(**result)
 
@@ -1936,8 +4893,7 @@ class FMMTraversalBuilder:
 
     # {{{ driver
 
-    def __call__(self, queue, tree, wait_for=None, debug=False,
-            _from_sep_smaller_min_nsources_cumul=None):
+    def __call__(self, queue, tree, wait_for=None, debug=False):
         """
         :arg queue: A :class:`pyopencl.CommandQueue` instance.
         :arg tree: A :class:`boxtree.Tree` instance.
@@ -1945,14 +4901,10 @@ class FMMTraversalBuilder:
             instances for whose completion this command waits before starting
             exeuction.
         :return: A tuple *(trav, event)*, where *trav* is a new instance of
-            :class:`FMMTraversalInfo` and *event* is a :class:`pyopencl.Event`
-            for dependency management.
+            :class:`TreecodeTraversalInfo` and *event* is a
+            :class:`pyopencl.Event` for dependency management.
         """
 
-        if _from_sep_smaller_min_nsources_cumul is None:
-            # default to old no-threshold behavior
-            _from_sep_smaller_min_nsources_cumul = 0
-
         if not tree._is_pruned:
             raise ValueError("tree must be pruned for traversal generation")
 
@@ -1962,6 +4914,11 @@ class FMMTraversalBuilder:
                     "trees with source extent are not supported for "
                     "traversal generation")
 
+        if tree.targets_have_extent and self.mac_extent != "precise":
+            # The static box radius does not account for target extent.
+            raise ValueError("trees with target extent require "
+                    "mac_extent='precise'")
+
         # Generated code shouldn't depend on the *exact* number of tree levels.
         # So round up to the next multiple of 5.
         from pytools import div_ceil
@@ -1971,8 +4928,7 @@ class FMMTraversalBuilder:
                 tree.dimensions, tree.particle_id_dtype, tree.box_id_dtype,
                 tree.coord_dtype, tree.box_level_dtype, max_levels,
                 tree.sources_are_targets,
-                tree.sources_have_extent, tree.targets_have_extent,
-                tree.extent_norm)
+                tree.sources_have_extent, tree.targets_have_extent)
 
         def fin_debug(s):
             if debug:
@@ -1980,348 +4936,708 @@ class FMMTraversalBuilder:
 
             logger.debug(s)
 
-        traversal_plog = ProcessLogger(logger, "build traversal")
+        traversal_plog = ProcessLogger(logger, "build treecode traversal")
 
-        # {{{ source boxes, their parents, and target boxes
+        basic_lists, wait_for = _build_basic_box_lists(
+                queue, tree, knl_info, fin_debug, wait_for)
 
-        fin_debug("building list of source boxes, their parents, and target boxes")
+        target_boxes = basic_lists.target_boxes
 
-        result, evt = knl_info.sources_parents_and_targets_builder(
-                queue, tree.nboxes, tree.box_flags, wait_for=wait_for)
-        wait_for = [evt]
+        # {{{ accepted and near-field source boxes
+
+        treecode_base_args = (
+                queue, len(target_boxes),
+                tree.box_centers.data, tree.root_extent, tree.box_levels,
+                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                target_boxes,
+                basic_lists.box_source_bounding_box_min.data,
+                basic_lists.box_source_bounding_box_max.data,
+                basic_lists.box_target_bounding_box_min.data,
+                basic_lists.box_target_bounding_box_max.data,
+                )
 
-        source_parent_boxes = result["source_parent_boxes"].lists
-        source_boxes = result["source_boxes"].lists
-        target_or_target_parent_boxes = result["target_or_target_parent_boxes"].lists
+        fin_debug("finding accepted and near-field source boxes")
 
-        if not tree.sources_are_targets:
-            target_boxes = result["target_boxes"].lists
-        else:
-            target_boxes = source_boxes
+        result, evt = knl_info.treecode_builder(
+                *treecode_base_args, wait_for=wait_for)
+        near_field_source_boxes = result["near_field_source_boxes"]
+        accepted = result["accepted_source_boxes"]
 
         # }}}
 
-        # {{{ figure out level starts in *_parent_boxes
-
-        def extract_level_start_box_nrs(box_list, wait_for):
-            result = cl.array.empty(queue,
-                    tree.nlevels+1, tree.box_id_dtype) \
-                            .fill(len(box_list))
-            evt = knl_info.level_start_box_nrs_extractor(
-                    tree.level_start_box_nrs_dev,
-                    tree.box_levels,
-                    box_list,
-                    result,
-                    range=slice(0, len(box_list)),
-                    queue=queue, wait_for=wait_for)
+        # {{{ split accepted source boxes by source level
 
-            result = result.get()
+        fin_debug("splitting accepted source boxes by level")
 
-            # Postprocess result for unoccupied levels
-            prev_start = len(box_list)
-            for ilev in range(tree.nlevels-1, -1, -1):
-                result[ilev] = prev_start = \
-                        min(result[ilev], prev_start)
+        ntarget_boxes = len(target_boxes)
+        split_args = (
+                tree.nlevels, ntarget_boxes, accepted.starts, accepted.lists,
+                tree.box_levels)
 
-            return result, evt
+        level_key_counts = cl.array.empty(
+                queue, tree.nlevels * ntarget_boxes + 1, tree.box_id_dtype)
+        evt = knl_info.accepted_level_splitter_count(
+                *(split_args + (level_key_counts,)),
+                range=slice(ntarget_boxes), queue=queue, wait_for=[evt])
 
-        fin_debug("finding level starts in source boxes array")
-        level_start_source_box_nrs, evt_s = \
-                extract_level_start_box_nrs(
-                        source_boxes, wait_for=wait_for)
+        level_key_starts = cl.array.cumsum(level_key_counts)
+        del level_key_counts
 
-        fin_debug("finding level starts in source parent boxes array")
-        level_start_source_parent_box_nrs, evt_sp = \
-                extract_level_start_box_nrs(
-                        source_parent_boxes, wait_for=wait_for)
+        level_lists = cl.array.empty(queue, accepted.count, tree.box_id_dtype)
+        evt = knl_info.accepted_level_splitter_write(
+                *(split_args + (level_key_starts, level_lists)),
+                range=slice(ntarget_boxes), queue=queue)
+        del accepted
 
-        fin_debug("finding level starts in target boxes array")
-        level_start_target_box_nrs, evt_t = \
-                extract_level_start_box_nrs(
-                        target_boxes, wait_for=wait_for)
+        level_key_starts = level_key_starts.get(queue=queue)
 
-        fin_debug("finding level starts in target or target parent boxes array")
-        level_start_target_or_target_parent_box_nrs, evt_tp = \
-                extract_level_start_box_nrs(
-                        target_or_target_parent_boxes, wait_for=wait_for)
+        from pyopencl.algorithm import BuiltList
+        accepted_source_boxes_by_level = []
+        target_boxes_accepted_by_source_level = []
 
-        wait_for = [evt_s, evt_sp, evt_t, evt_tp]
+        for ilevel in range(tree.nlevels):
+            starts = level_key_starts[
+                    ilevel*ntarget_boxes:(ilevel+1)*ntarget_boxes+1]
+            level_start = starts[0]
+            starts = starts - level_start
+
+            nonempty_indices = np.flatnonzero(
+                    np.diff(starts) > 0).astype(tree.box_id_dtype)
+
+            accepted_source_boxes_by_level.append(BuiltList(
+                    count=int(starts[-1]),
+                    starts=cl.array.to_device(queue,
+                        np.append(starts[nonempty_indices], starts[-1])
+                        .astype(tree.box_id_dtype)),
+                    lists=level_lists[level_start:level_start+starts[-1]].copy(),
+                    num_nonempty_lists=len(nonempty_indices),
+                    nonempty_indices=cl.array.to_device(queue, nonempty_indices)))
+            target_boxes_accepted_by_source_level.append(
+                    target_boxes[accepted_source_boxes_by_level[-1]
+                        .nonempty_indices])
 
         # }}}
 
-        # {{{ box extents
+        evt = cl.enqueue_marker(queue)
 
-        fin_debug("finding box extents")
+        traversal_plog.done("mac_theta: %s", self.mac_theta)
 
-        box_source_bounding_box_min = cl.array.empty(
-                queue, (tree.dimensions, tree.aligned_nboxes),
-                dtype=tree.coord_dtype)
-        box_source_bounding_box_max = cl.array.empty(
-                queue, (tree.dimensions, tree.aligned_nboxes),
-                dtype=tree.coord_dtype)
+        return TreecodeTraversalInfo(
+                tree=tree,
+                mac_theta=self.mac_theta,
 
-        if tree.sources_are_targets:
-            box_target_bounding_box_min = box_source_bounding_box_min
-            box_target_bounding_box_max = box_source_bounding_box_max
-        else:
-            box_target_bounding_box_min = cl.array.empty(
-                    queue, (tree.dimensions, tree.aligned_nboxes),
-                    dtype=tree.coord_dtype)
-            box_target_bounding_box_max = cl.array.empty(
-                    queue, (tree.dimensions, tree.aligned_nboxes),
-                    dtype=tree.coord_dtype)
+                source_boxes=basic_lists.source_boxes,
+                target_boxes=target_boxes,
+                source_parent_boxes=basic_lists.source_parent_boxes,
+
+                level_start_source_box_nrs=(
+                    basic_lists.level_start_source_box_nrs),
+                level_start_target_box_nrs=(
+                    basic_lists.level_start_target_box_nrs),
+                level_start_source_parent_box_nrs=(
+                    basic_lists.level_start_source_parent_box_nrs),
+
+                box_source_bounding_box_min=(
+                    basic_lists.box_source_bounding_box_min),
+                box_source_bounding_box_max=(
+                    basic_lists.box_source_bounding_box_max),
+                box_target_bounding_box_min=(
+                    basic_lists.box_target_bounding_box_min),
+                box_target_bounding_box_max=(
+                    basic_lists.box_target_bounding_box_max),
+
+                near_field_source_boxes_starts=near_field_source_boxes.starts,
+                near_field_source_boxes_lists=near_field_source_boxes.lists,
+
+                accepted_source_boxes_by_level=accepted_source_boxes_by_level,
+                target_boxes_accepted_by_source_level=(
+                    target_boxes_accepted_by_source_level),
+                ).with_queue(None), evt
 
-        bogus_radii_array = cl.array.empty(queue, 1, dtype=tree.coord_dtype)
+    # }}}
 
-        # nlevels-1 is the highest valid level index
-        for level in range(tree.nlevels-1, -1, -1):
-            start, stop = tree.level_start_box_nrs[level:level+2]
+# }}}
 
-            for (skip, enable_radii, bbox_min, bbox_max,
-                    pstarts, pcounts, radii_tree_attr, particles) in [
-                    (
-                        # never skip
-                        False,
-
-                        tree.sources_have_extent,
-                        box_source_bounding_box_min,
-                        box_source_bounding_box_max,
-                        tree.box_source_starts,
-                        tree.box_source_counts_nonchild,
-                        "source_radii",
-                        tree.sources),
-                    (
-                        # skip the 'target' round if sources and targets
-                        # are the same.
-                        tree.sources_are_targets,
-
-                        tree.targets_have_extent,
-                        box_target_bounding_box_min,
-                        box_target_bounding_box_max,
-                        tree.box_target_starts,
-                        tree.box_target_counts_nonchild,
-                        "target_radii",
-                        tree.targets),
-                    ]:
-
-                if skip:
-                    continue
-
-                args = (
-                        (
-                            tree.aligned_nboxes,
-                            tree.box_child_ids,
-                            tree.box_centers,
-                            pstarts, pcounts,)
-                        + tuple(particles)
-                        + (
-                            getattr(tree, radii_tree_attr, bogus_radii_array),
-                            enable_radii,
-
-                            bbox_min,
-                            bbox_max))
-
-                evt = knl_info.box_extents_finder(
-                        *args,
-
-                        range=slice(start, stop),
-                        queue=queue, wait_for=wait_for)
 
-            wait_for = [evt]
+# {{{ host-side traversal builder
 
-        del bogus_radii_array
+def _concatenate(arrays):
+    if not arrays:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(arrays)
 
-        # }}}
 
-        # {{{ same-level non-well-separated boxes
+def _get_csr_entries(starts, lists, rows):
+    """Return a tuple *(row_indices, entries)* of all entries in the rows
+    *rows* of the list in compressed sparse row form given by *starts* and
+    *lists*. *row_indices* refers to positions in *rows*.
+    """
+    counts = starts[rows + 1] - starts[rows]
+    row_indices = np.repeat(np.arange(len(rows)), counts)
+    offsets = (
+            np.arange(np.sum(counts))
+            - np.repeat(np.cumsum(counts) - counts, counts))
+    return row_indices, lists[starts[rows][row_indices] + offsets]
+
+
+def _make_csr(nrows, rows, entries, sort_keys, dtype):
+    """Return a tuple *(starts, lists)* of the list in compressed sparse
+    row form with the entries *entries* in the rows *rows*. Within each row,
+    the entries are ordered by *sort_keys*, a list of arrays in decreasing
+    order of significance.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    entries = np.asarray(entries, dtype=np.int64)
+    order = np.lexsort(tuple(reversed([rows] + list(sort_keys))))
 
-        # If well_sep_is_n_away is 1, this agrees with the definition of
-        # 'colleagues' from the classical FMM literature.
+    starts = np.zeros(nrows + 1, dtype=dtype)
+    starts[1:] = np.cumsum(np.bincount(rows, minlength=nrows))
 
-        fin_debug("finding same-level near-field boxes")
+    return starts, entries[order].astype(dtype)
 
-        result, evt = knl_info.same_level_non_well_sep_boxes_builder(
-                queue, tree.nboxes,
-                tree.box_centers.data, tree.root_extent, tree.box_levels,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
-                wait_for=wait_for)
-        wait_for = [evt]
-        same_level_non_well_sep_boxes = result["same_level_non_well_sep_boxes"]
 
-        # }}}
+class _HostBoxGeometry(object):
+    """Integer coordinates and the depth-first order of the boxes of a tree
+    on the host.
 
-        # {{{ neighbor source boxes ("list 1")
+    .. attribute:: level_coords
 
-        fin_debug("finding neighbor source boxes ('list 1')")
+        ``int64 [dimensions, nboxes]``, the integer coordinates of each box on
+        the uniform grid of boxes on its level.
 
-        result, evt = knl_info.neighbor_source_boxes_builder(
-                queue, len(target_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
-                target_boxes, wait_for=wait_for)
+    .. attribute:: centers
 
-        wait_for = [evt]
-        neighbor_source_boxes = result["neighbor_source_boxes"]
+        ``int64 [dimensions, nboxes]``, the box centers in units of half the
+        size of the boxes on the finest level. In these units, box radii are
+        powers of two, and all adjacency tests are exact.
+
+    .. attribute:: radii
+
+        ``int64 [nboxes]``
+
+    .. attribute:: dfs_ranks
+
+        ``int64 [nboxes]``, the position of each box in a depth-first
+        traversal of the tree that visits the children of a box in Morton
+        order. This is the order in which the traversal kernels find boxes.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+
+        nboxes = tree.nboxes
+        nlevels = tree.nlevels
+        level_start_box_nrs = tree.level_start_box_nrs
+
+        self.box_levels = tree.box_levels[:nboxes].astype(np.int64)
+
+        box_centers = np.array([
+            tree.box_centers[iaxis][:nboxes]
+            for iaxis in range(tree.dimensions)])
+        root_min = box_centers[:, 0] - tree.root_extent / 2
+        level_box_sizes = tree.root_extent / 2.0**self.box_levels
+        self.level_coords = np.floor(
+                (box_centers - root_min[:, np.newaxis]) / level_box_sizes
+                ).astype(np.int64)
+
+        self.radii = np.left_shift(1, nlevels - 1 - self.box_levels)
+        self.centers = 2 * self.level_coords * self.radii + self.radii
+
+        # {{{ per-level lookup from grid coordinates to box ids
+
+        self.level_lookup = []
+        for level in range(nlevels):
+            start, stop = level_start_box_nrs[level:level+2]
+            keys = self._linearize(self.level_coords[:, start:stop], level)
+            order = np.argsort(keys)
+            self.level_lookup.append((keys[order], start + order))
 
         # }}}
 
-        # {{{ well-separated siblings ("list 2")
+        # {{{ depth-first ranks
 
-        fin_debug("finding well-separated siblings ('list 2')")
+        box_parent_ids = tree.box_parent_ids[:nboxes]
+        box_child_ids = tree.box_child_ids[:, :nboxes]
 
-        result, evt = knl_info.from_sep_siblings_builder(
-                queue, len(target_or_target_parent_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
-                target_or_target_parent_boxes, tree.box_parent_ids.data,
-                same_level_non_well_sep_boxes.starts,
-                same_level_non_well_sep_boxes.lists,
-                wait_for=wait_for)
-        wait_for = [evt]
-        from_sep_siblings = result["from_sep_siblings"]
+        subtree_sizes = np.ones(nboxes, dtype=np.int64)
+        for level in range(nlevels-1, 0, -1):
+            start, stop = level_start_box_nrs[level:level+2]
+            np.add.at(subtree_sizes, box_parent_ids[start:stop],
+                    subtree_sizes[start:stop])
+
+        self.dfs_ranks = np.zeros(nboxes, dtype=np.int64)
+        for level in range(nlevels-1):
+            start, stop = level_start_box_nrs[level:level+2]
+            children = box_child_ids[:, start:stop]
+            has_child = children != 0
+            child_sizes = np.where(has_child, subtree_sizes[children], 0)
+            child_ranks = (
+                    self.dfs_ranks[start:stop]
+                    + 1 + np.cumsum(child_sizes, axis=0) - child_sizes)
+            self.dfs_ranks[children[has_child]] = child_ranks[has_child]
 
         # }}}
 
-        with_extent = tree.sources_have_extent or tree.targets_have_extent
+    @staticmethod
+    def _linearize(coords, level):
+        result = np.zeros(coords.shape[1], dtype=np.int64)
+        for iaxis in range(coords.shape[0]):
+            result = (result << level) + coords[iaxis]
+        return result
 
-        # {{{ separated smaller ("list 3")
+    def find_boxes(self, level, coords):
+        """Return the ids of the boxes on *level* with the grid coordinates
+        *coords*, or -1 where there is no such box.
+        """
+        level_keys, level_box_ids = self.level_lookup[level]
+        in_bounds = np.all((coords >= 0) & (coords < (1 << level)), axis=0)
+        if not len(level_keys):
+            return np.full(coords.shape[1], -1, dtype=np.int64)
+
+        keys = self._linearize(np.where(in_bounds, coords, 0), level)
+        indices = np.minimum(
+                np.searchsorted(level_keys, keys), len(level_keys) - 1)
+        found = in_bounds & (level_keys[indices] == keys)
+        return np.where(found, level_box_ids[indices], -1)
+
+    def is_adjacent_or_overlapping(self, target_boxes, source_boxes,
+            target_box_neighborhood_size=1):
+        """Like the function of the same name in the traversal kernels, for
+        arrays of box pairs.
+        """
+        target_rad = self.radii[target_boxes]
+        source_rad = self.radii[source_boxes]
+        slack = (
+                (2*(target_box_neighborhood_size-1) + 1) * target_rad
+                + source_rad
+                + np.minimum(target_rad, source_rad))
 
-        fin_debug("finding separated smaller ('list 3')")
+        l_inf_dist = np.max(np.abs(
+            self.centers[:, target_boxes] - self.centers[:, source_boxes]),
+            axis=0)
 
-        from_sep_smaller_base_args = (
-                queue, len(target_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
-                tree.stick_out_factor, target_boxes,
-                same_level_non_well_sep_boxes.starts,
-                same_level_non_well_sep_boxes.lists,
-                box_target_bounding_box_min.data,
-                box_target_bounding_box_max.data,
-                tree.box_source_counts_cumul,
-                _from_sep_smaller_min_nsources_cumul,
-                )
+        return l_inf_dist <= slack
 
-        from_sep_smaller_wait_for = []
-        from_sep_smaller_by_level = []
-        target_boxes_sep_smaller_by_source_level = []
+    def get_adjacent_boxes_on_level(self, boxes, level):
+        """Find the boxes on *level* that are adjacent to or overlapping with
+        *boxes*, all of which must be on *level* or finer.
 
-        for ilevel in range(tree.nlevels):
-            fin_debug("finding separated smaller ('list 3 level %d')" % ilevel)
+        :returns: a tuple *(indices, adjacent_boxes)* of pairs, where
+            *indices* refers to positions in *boxes*.
+        """
+        coords = (self.level_coords[:, boxes]
+                >> (self.box_levels[boxes] - level))
+
+        from itertools import product
+        indices = []
+        adjacent_boxes = []
+        for offset in product((-1, 0, 1), repeat=coords.shape[0]):
+            found = self.find_boxes(
+                    level, coords + np.array(offset)[:, np.newaxis])
+            found_indices, = np.nonzero(found >= 0)
+            found = found[found_indices]
+
+            is_adjacent = self.is_adjacent_or_overlapping(
+                    boxes[found_indices], found)
+            indices.append(found_indices[is_adjacent])
+            adjacent_boxes.append(found[is_adjacent])
+
+        return np.concatenate(indices), np.concatenate(adjacent_boxes)
+
+    def get_ancestors(self, boxes, level):
+        """Return the ancestors on *level* of *boxes*, all of which must be
+        on *level* or finer.
+        """
+        result = boxes.copy()
+        while True:
+            too_fine, = np.nonzero(self.box_levels[result] > level)
+            if not len(too_fine):
+                return result
+            result[too_fine] = self.tree.box_parent_ids[result[too_fine]]
+
+
+class HostFMMTraversalBuilder(object):
+    """Build the same :class:`FMMTraversalInfo` as :class:`FMMTraversalBuilder`
+    for a tree on the host, using :mod:`numpy` instead of OpenCL kernels.
+    Neighbors are found by lookups of integer box coordinates, which is
+    vectorized across boxes, but not across tree levels. This is
+    intended for small trees (up to about 10,000 boxes), for which it avoids
+    the cost of compiling the traversal kernels.
+
+    Only trees without particle extent, periodicity or opening-angle
+    criteria are supported.
+
+    .. versionadded:: 2019.1
+    """
 
-            result, evt = knl_info.from_sep_smaller_builder(
-                    *(from_sep_smaller_base_args + (ilevel,)),
-                    omit_lists=("from_sep_close_smaller",) if with_extent else (),
-                    wait_for=wait_for)
+    def __init__(self, well_sep_is_n_away=1):
+        """
+        :arg well_sep_is_n_away: See :class:`FMMTraversalBuilder`.
+        """
+        self.well_sep_is_n_away = well_sep_is_n_away
 
-            target_boxes_sep_smaller = target_boxes[
-                result["from_sep_smaller"].nonempty_indices]
+    def get_effective_well_sep_is_n_away(self, dimensions):
+        return self.well_sep_is_n_away
 
-            from_sep_smaller_by_level.append(result["from_sep_smaller"])
-            target_boxes_sep_smaller_by_source_level.append(target_boxes_sep_smaller)
-            from_sep_smaller_wait_for.append(evt)
+    @log_process(logger, "build traversal on host")
+    def __call__(self, tree):
+        """
+        :arg tree: A :class:`boxtree.Tree` instance on the host, as obtained
+            from :meth:`boxtree.Tree.get`.
+        :return: A new instance of :class:`FMMTraversalInfo`, with all bulk
+            data in :class:`numpy.ndarray` instances.
+        """
 
-        if with_extent:
-            fin_debug("finding separated smaller close ('list 3 close')")
-            result, evt = knl_info.from_sep_smaller_builder(
-                    *(from_sep_smaller_base_args + (-1,)),
-                    omit_lists=("from_sep_smaller",),
-                    wait_for=wait_for)
-            from_sep_close_smaller_starts = result["from_sep_close_smaller"].starts
-            from_sep_close_smaller_lists = result["from_sep_close_smaller"].lists
+        if isinstance(tree.box_flags, cl.array.Array):
+            raise TypeError("tree must be on the host")
+
+        if not tree._is_pruned:
+            raise ValueError("tree must be pruned for traversal generation")
+
+        if tree.sources_have_extent or tree.targets_have_extent:
+            raise NotImplementedError(
+                    "trees with particle extent are not supported for "
+                    "host-side traversal generation")
+
+        if getattr(tree, "periodic", False):
+            raise NotImplementedError(
+                    "periodic trees are not supported for host-side "
+                    "traversal generation")
+
+        from boxtree.tree import box_flags_enum
+
+        nboxes = tree.nboxes
+        nlevels = tree.nlevels
+        dimensions = tree.dimensions
+        box_id_dtype = tree.box_id_dtype
+        box_flags = tree.box_flags[:nboxes]
+        box_parent_ids = tree.box_parent_ids[:nboxes]
+        box_child_ids = tree.box_child_ids[:, :nboxes]
+        well_sep_is_n_away = self.well_sep_is_n_away
+
+        geo = _HostBoxGeometry(tree)
+        box_levels = geo.box_levels
+
+        def has_flags(boxes, flags):
+            return (box_flags[boxes] & flags) != 0
+
+        all_boxes = np.arange(nboxes)
+
+        # {{{ basic box lists
+
+        def find_boxes_with_flags(flags):
+            return np.flatnonzero(has_flags(all_boxes, flags)).astype(
+                    box_id_dtype)
 
-            from_sep_smaller_wait_for.append(evt)
+        source_boxes = find_boxes_with_flags(box_flags_enum.HAS_OWN_SOURCES)
+        source_parent_boxes = find_boxes_with_flags(
+                box_flags_enum.HAS_CHILD_SOURCES)
+        if tree.sources_are_targets:
+            target_boxes = source_boxes
         else:
-            from_sep_close_smaller_starts = None
-            from_sep_close_smaller_lists = None
+            target_boxes = find_boxes_with_flags(
+                    box_flags_enum.HAS_OWN_TARGETS)
+        target_or_target_parent_boxes = find_boxes_with_flags(
+                box_flags_enum.HAS_OWN_TARGETS
+                | box_flags_enum.HAS_CHILD_TARGETS)
+
+        def get_level_start_box_nrs(box_list):
+            return np.searchsorted(
+                    box_list, tree.level_start_box_nrs).astype(box_id_dtype)
 
         # }}}
 
-        wait_for = from_sep_smaller_wait_for
-        del from_sep_smaller_wait_for
+        # {{{ box extents
 
-        # {{{ separated bigger ("list 4")
+        def get_bounding_boxes(particles, box_starts, box_counts_nonchild):
+            bbox_min = np.zeros(
+                    (dimensions, tree.aligned_nboxes), dtype=tree.coord_dtype)
+            bbox_max = bbox_min.copy()
+
+            counts = box_counts_nonchild[:nboxes]
+            particle_boxes = np.repeat(all_boxes, counts)
+            particle_ids = (
+                    np.repeat(box_starts[:nboxes], counts)
+                    + np.arange(len(particle_boxes))
+                    - np.repeat(np.cumsum(counts) - counts, counts))
+
+            for iaxis in range(dimensions):
+                bbox_min[iaxis, :nboxes] = tree.box_centers[iaxis][:nboxes]
+                bbox_max[iaxis, :nboxes] = tree.box_centers[iaxis][:nboxes]
+
+                coords = particles[iaxis][particle_ids]
+                np.minimum.at(bbox_min[iaxis], particle_boxes, coords)
+                np.maximum.at(bbox_max[iaxis], particle_boxes, coords)
+
+            # nlevels-1 is the highest valid level index
+            for level in range(nlevels-1, 0, -1):
+                start, stop = tree.level_start_box_nrs[level:level+2]
+                parents = box_parent_ids[start:stop]
+                for iaxis in range(dimensions):
+                    np.minimum.at(bbox_min[iaxis], parents,
+                            bbox_min[iaxis, start:stop])
+                    np.maximum.at(bbox_max[iaxis], parents,
+                            bbox_max[iaxis, start:stop])
+
+            return bbox_min, bbox_max
+
+        box_source_bounding_box_min, box_source_bounding_box_max = \
+                get_bounding_boxes(tree.sources, tree.box_source_starts,
+                        tree.box_source_counts_nonchild)
 
-        fin_debug("finding separated bigger ('list 4')")
+        if tree.sources_are_targets:
+            box_target_bounding_box_min = box_source_bounding_box_min
+            box_target_bounding_box_max = box_source_bounding_box_max
+        else:
+            box_target_bounding_box_min, box_target_bounding_box_max = \
+                    get_bounding_boxes(tree.targets, tree.box_target_starts,
+                            tree.box_target_counts_nonchild)
 
-        result, evt = knl_info.from_sep_bigger_builder(
-                queue, len(target_or_target_parent_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
-                tree.stick_out_factor, target_or_target_parent_boxes,
-                tree.box_parent_ids.data,
-                same_level_non_well_sep_boxes.starts,
-                same_level_non_well_sep_boxes.lists,
-                wait_for=wait_for)
+        # }}}
 
-        wait_for = [evt]
-        from_sep_bigger = result["from_sep_bigger"]
+        # {{{ same-level non-well-separated boxes
 
-        if with_extent:
-            # These are indexed by target_or_target_parent boxes; we rewrite
-            # them to be indexed by target_boxes.
-            from_sep_close_bigger_starts_raw = result["from_sep_close_bigger"].starts
-            from_sep_close_bigger_lists_raw = result["from_sep_close_bigger"].lists
+        from itertools import product
+        offsets = np.array(list(product(
+                range(-well_sep_is_n_away, well_sep_is_n_away + 1),
+                repeat=dimensions)))
+        offsets = offsets[np.any(offsets != 0, axis=1)]
 
-            list_merger = _ListMerger(queue.context, tree.box_id_dtype)
-            result, evt = list_merger(
-                    queue,
-                    # starts
-                    (from_sep_close_bigger_starts_raw,),
-                    # lists
-                    (from_sep_close_bigger_lists_raw,),
-                    # input index style
-                    _IndexStyle.TARGET_OR_TARGET_PARENT_BOXES,
-                    # output index style
-                    _IndexStyle.TARGET_BOXES,
-                    # box and tree data
-                    target_boxes,
-                    target_or_target_parent_boxes,
-                    tree.nboxes,
-                    debug,
-                    wait_for=wait_for)
+        rows = []
+        entries = []
+        # The root has no boxes on the same level.
+        for level in range(1, nlevels):
+            start, stop = tree.level_start_box_nrs[level:level+2]
+            level_boxes = np.arange(start, stop)
+            for offset in offsets:
+                found = geo.find_boxes(level,
+                        geo.level_coords[:, level_boxes]
+                        + offset[:, np.newaxis])
+                rows.append(level_boxes[found >= 0])
+                entries.append(found[found >= 0])
+
+        rows = _concatenate(rows)
+        entries = _concatenate(entries)
+        same_level_non_well_sep_boxes_starts, \
+                same_level_non_well_sep_boxes_lists = _make_csr(
+                        nboxes, rows, entries, [geo.dfs_ranks[entries]],
+                        box_id_dtype)
 
-            wait_for = [evt]
+        # }}}
 
-            del from_sep_close_bigger_starts_raw
-            del from_sep_close_bigger_lists_raw
+        # {{{ neighbor source boxes ("list 1")
 
-            from_sep_close_bigger_starts = result["starts"]
-            from_sep_close_bigger_lists = result["lists"]
-        else:
-            from_sep_close_bigger_starts = None
-            from_sep_close_bigger_lists = None
+        # Pairs are found starting from the smaller box of the two.
+
+        target_box_numbers = np.full(nboxes, -1, dtype=np.int64)
+        target_box_numbers[target_boxes] = np.arange(len(target_boxes))
+
+        rows = []
+        entries = []
+        for level in range(nlevels):
+            # sources at least as big as the target box
+            boxes = target_boxes[box_levels[target_boxes] >= level]
+            indices, found = geo.get_adjacent_boxes_on_level(boxes, level)
+            is_source = has_flags(found, box_flags_enum.HAS_OWN_SOURCES)
+            rows.append(target_box_numbers[boxes[indices[is_source]]])
+            entries.append(found[is_source])
+
+            # sources smaller than the target box
+            boxes = source_boxes[box_levels[source_boxes] > level]
+            indices, found = geo.get_adjacent_boxes_on_level(boxes, level)
+            is_target = target_box_numbers[found] >= 0
+            rows.append(target_box_numbers[found[is_target]])
+            entries.append(boxes[indices[is_target]])
+
+        rows = _concatenate(rows)
+        entries = _concatenate(entries)
+        neighbor_source_boxes_starts, neighbor_source_boxes_lists = _make_csr(
+                len(target_boxes), rows, entries, [geo.dfs_ranks[entries]],
+                box_id_dtype)
 
         # }}}
 
-        if self.well_sep_is_n_away == 1:
-            colleagues_starts = same_level_non_well_sep_boxes.starts
-            colleagues_lists = same_level_non_well_sep_boxes.lists
+        # {{{ well-separated siblings ("list 2")
+
+        # The root has no parent, and hence no list 2.
+        has_parent, = np.nonzero(target_or_target_parent_boxes != 0)
+        indices, parent_nws_boxes = _get_csr_entries(
+                same_level_non_well_sep_boxes_starts,
+                same_level_non_well_sep_boxes_lists,
+                box_parent_ids[target_or_target_parent_boxes[has_parent]])
+        indices = has_parent[indices]
+
+        rows = []
+        entries = []
+        for morton_nr in range(2**dimensions):
+            children = box_child_ids[morton_nr, parent_nws_boxes]
+            has_child, = np.nonzero(children != 0)
+            children = children[has_child]
+
+            is_sep = ~geo.is_adjacent_or_overlapping(
+                    target_or_target_parent_boxes[indices[has_child]],
+                    children, well_sep_is_n_away)
+            rows.append(indices[has_child][is_sep])
+            entries.append(children[is_sep])
+
+        rows = _concatenate(rows)
+        entries = _concatenate(entries)
+        from_sep_siblings_starts, from_sep_siblings_lists = _make_csr(
+                len(target_or_target_parent_boxes), rows, entries,
+                [geo.dfs_ranks[entries]], box_id_dtype)
+
+        # }}}
+
+        # {{{ separated smaller ("list 3")
+
+        # Descend into the same-level non-well-separated boxes of each
+        # target box as long as boxes are adjacent to the target box.
+        # Non-adjacent boxes found along the way are in list 3.
+
+        walk_rows, walk_boxes = _get_csr_entries(
+                same_level_non_well_sep_boxes_starts,
+                same_level_non_well_sep_boxes_lists,
+                target_boxes)
+
+        rows = []
+        entries = []
+        while len(walk_rows):
+            next_walk_rows = []
+            next_walk_boxes = []
+
+            for morton_nr in range(2**dimensions):
+                children = box_child_ids[morton_nr, walk_boxes]
+                has_sources, = np.nonzero((children != 0) & has_flags(children,
+                    box_flags_enum.HAS_OWN_SOURCES
+                    | box_flags_enum.HAS_CHILD_SOURCES))
+                child_rows = walk_rows[has_sources]
+                children = children[has_sources]
+
+                is_adjacent = geo.is_adjacent_or_overlapping(
+                        target_boxes[child_rows], children)
+                descend = is_adjacent & has_flags(
+                        children, box_flags_enum.HAS_CHILD_SOURCES)
+
+                next_walk_rows.append(child_rows[descend])
+                next_walk_boxes.append(children[descend])
+                rows.append(child_rows[~is_adjacent])
+                entries.append(children[~is_adjacent])
+
+            walk_rows = _concatenate(next_walk_rows)
+            walk_boxes = _concatenate(next_walk_boxes)
+
+        rows = _concatenate(rows)
+        entries = _concatenate(entries)
+
+        from pyopencl.algorithm import BuiltList
+
+        from_sep_smaller_by_level = []
+        target_boxes_sep_smaller_by_source_level = []
+        for level in range(nlevels):
+            on_level = box_levels[entries] == level
+            level_entries = entries[on_level]
+            starts, lists = _make_csr(
+                    len(target_boxes), rows[on_level], level_entries,
+                    [geo.dfs_ranks[level_entries]], box_id_dtype)
+
+            # Only keep the rows of target boxes with a non-empty list.
+            is_nonempty = np.diff(starts) > 0
+            nonempty_indices = np.flatnonzero(is_nonempty).astype(box_id_dtype)
+            compressed_indices = np.zeros(
+                    len(target_boxes) + 1, dtype=box_id_dtype)
+            compressed_indices[1:] = np.cumsum(is_nonempty)
+
+            from_sep_smaller_by_level.append(BuiltList(
+                    count=len(lists),
+                    starts=np.append(
+                        starts[nonempty_indices], starts[-1]).astype(
+                            box_id_dtype),
+                    lists=lists,
+                    num_nonempty_lists=np.dtype(box_id_dtype).type(
+                        len(nonempty_indices)),
+                    nonempty_indices=nonempty_indices,
+                    compressed_indices=compressed_indices))
+            target_boxes_sep_smaller_by_source_level.append(
+                    target_boxes[nonempty_indices])
+
+        # }}}
+
+        # {{{ separated bigger ("list 4")
+
+        # Walk up from each target or target parent box, looking at the
+        # same-level non-well-separated boxes of its ancestors. In a 1-away
+        # FMM, the box's own ones are adjacent and hence never in list 4.
+        first_ancestor_offset = 1 if well_sep_is_n_away == 1 else 0
+        tgt_levels = box_levels[target_or_target_parent_boxes]
+
+        rows = []
+        entries = []
+        walk_levels = []
+        # The root has no same-level boxes.
+        for walk_level in range(1, nlevels):
+            has_walk_level, = np.nonzero(
+                    tgt_levels - first_ancestor_offset >= walk_level)
+            tgt_boxes = target_or_target_parent_boxes[has_walk_level]
+
+            indices, nws_boxes = _get_csr_entries(
+                    same_level_non_well_sep_boxes_starts,
+                    same_level_non_well_sep_boxes_lists,
+                    geo.get_ancestors(tgt_boxes, walk_level))
+            is_source = has_flags(nws_boxes, box_flags_enum.HAS_OWN_SOURCES)
+            indices = indices[is_source]
+            nws_boxes = nws_boxes[is_source]
+            tgt_boxes = tgt_boxes[indices]
+
+            in_list_1 = geo.is_adjacent_or_overlapping(tgt_boxes, nws_boxes)
+            in_parent_list_1 = geo.is_adjacent_or_overlapping(
+                    box_parent_ids[tgt_boxes], nws_boxes)
+
+            is_in_list_4 = ~in_list_1 & in_parent_list_1
+            if well_sep_is_n_away > 1:
+                # Same-level boxes are not in the parent's list 4.
+                is_in_list_4 |= ~in_list_1 & (
+                        box_levels[tgt_boxes] == walk_level)
+
+            rows.append(has_walk_level[indices[is_in_list_4]])
+            entries.append(nws_boxes[is_in_list_4])
+            walk_levels.append(np.full(np.sum(is_in_list_4), walk_level))
+
+        rows = _concatenate(rows)
+        entries = _concatenate(entries)
+        walk_levels = _concatenate(walk_levels)
+        from_sep_bigger_starts, from_sep_bigger_lists = _make_csr(
+                len(target_or_target_parent_boxes), rows, entries,
+                [-walk_levels, geo.dfs_ranks[entries]], box_id_dtype)
+
+        # }}}
+
+        if well_sep_is_n_away == 1:
+            colleagues_starts = same_level_non_well_sep_boxes_starts
+            colleagues_lists = same_level_non_well_sep_boxes_lists
         else:
             colleagues_starts = None
             colleagues_lists = None
 
-        evt, = wait_for
-
-        traversal_plog.done(
-                "from_sep_smaller_crit: %s",
-                self.from_sep_smaller_crit)
-
         return FMMTraversalInfo(
                 tree=tree,
-                well_sep_is_n_away=self.well_sep_is_n_away,
+                well_sep_is_n_away=well_sep_is_n_away,
+                mac_theta=None,
 
                 source_boxes=source_boxes,
                 target_boxes=target_boxes,
 
-                level_start_source_box_nrs=level_start_source_box_nrs,
-                level_start_target_box_nrs=level_start_target_box_nrs,
+                level_start_source_box_nrs=get_level_start_box_nrs(
+                    source_boxes),
+                level_start_target_box_nrs=get_level_start_box_nrs(
+                    target_boxes),
 
                 source_parent_boxes=source_parent_boxes,
-                level_start_source_parent_box_nrs=level_start_source_parent_box_nrs,
+                level_start_source_parent_box_nrs=get_level_start_box_nrs(
+                    source_parent_boxes),
 
                 target_or_target_parent_boxes=target_or_target_parent_boxes,
                 level_start_target_or_target_parent_box_nrs=(
-                    level_start_target_or_target_parent_box_nrs),
+                    get_level_start_box_nrs(target_or_target_parent_boxes)),
 
                 box_source_bounding_box_min=box_source_bounding_box_min,
                 box_source_bounding_box_max=box_source_bounding_box_max,
@@ -2329,33 +5645,42 @@ class FMMTraversalBuilder:
                 box_target_bounding_box_max=box_target_bounding_box_max,
 
                 same_level_non_well_sep_boxes_starts=(
-                    same_level_non_well_sep_boxes.starts),
+                    same_level_non_well_sep_boxes_starts),
                 same_level_non_well_sep_boxes_lists=(
-                    same_level_non_well_sep_boxes.lists),
+                    same_level_non_well_sep_boxes_lists),
                 # Deprecated, but we'll keep these alive for the time being.
                 colleagues_starts=colleagues_starts,
                 colleagues_lists=colleagues_lists,
 
-                neighbor_source_boxes_starts=neighbor_source_boxes.starts,
-                neighbor_source_boxes_lists=neighbor_source_boxes.lists,
+                neighbor_source_boxes_starts=neighbor_source_boxes_starts,
+                neighbor_source_boxes_lists=neighbor_source_boxes_lists,
 
-                from_sep_siblings_starts=from_sep_siblings.starts,
-                from_sep_siblings_lists=from_sep_siblings.lists,
+                from_sep_siblings_starts=from_sep_siblings_starts,
+                from_sep_siblings_lists=from_sep_siblings_lists,
 
                 from_sep_smaller_by_level=from_sep_smaller_by_level,
                 target_boxes_sep_smaller_by_source_level=(
                     target_boxes_sep_smaller_by_source_level),
 
-                from_sep_close_smaller_starts=from_sep_close_smaller_starts,
-                from_sep_close_smaller_lists=from_sep_close_smaller_lists,
+                from_sep_close_smaller_starts=None,
+                from_sep_close_smaller_lists=None,
+                from_sep_smaller_min_nsources_cumul=np.zeros(
+                    nlevels, dtype=tree.particle_id_dtype),
 
-                from_sep_bigger_starts=from_sep_bigger.starts,
-                from_sep_bigger_lists=from_sep_bigger.lists,
+                from_sep_bigger_starts=from_sep_bigger_starts,
+                from_sep_bigger_lists=from_sep_bigger_lists,
 
-                from_sep_close_bigger_starts=from_sep_close_bigger_starts,
-                from_sep_close_bigger_lists=from_sep_close_bigger_lists,
-                ).with_queue(None), evt
+                from_sep_close_bigger_starts=None,
+                from_sep_close_bigger_lists=None,
+
+                periodic_shifts=None,
+                same_level_non_well_sep_boxes_shifts=None,
+                neighbor_source_boxes_shifts=None,
+                from_sep_siblings_shifts=None,
+                from_sep_smaller_shifts_by_level=None,
+                from_sep_bigger_shifts=None,
+                )
 
-    # }}}
+# }}}
 
 # vim: filetype=pyopencl:fdm=marker
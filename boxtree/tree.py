@@ -143,6 +143,14 @@ class Tree(DeviceDataRecord):
         of the tree. Note that this may be slightly larger
         than what is required to contain all particles.
 
+    .. attribute:: periodic
+
+        *True* if the particles repeat periodically, with the root box as the
+        unit cell. See the *periodic* argument of
+        :meth:`boxtree.TreeBuilder.__call__`.
+
+        .. versionadded:: 2019.1
+
     .. attribute:: level_start_box_nrs
 
         ``box_id_t [nlevels+1]``
@@ -83,7 +83,7 @@ class TreeBuilder(object):
             targets=None, source_radii=None, target_radii=None,
             stick_out_factor=None, refine_weights=None,
             max_leaf_refine_weight=None, wait_for=None,
-            extent_norm=None, bbox=None,
+            extent_norm=None, bbox=None, periodic=False,
             **kwargs):
         """
         :arg queue: a :class:`pyopencl.CommandQueue` instance
@@ -134,6 +134,12 @@ class TreeBuilder(object):
             that scaled coordinates are always < 1).
             When supplied, the bounding box must be square and have all the
             particles in its closure.
+        :arg periodic: If *True*, the particles are taken to repeat
+            periodically, with *bbox* (which must then be given) as the unit
+            cell. Traversals of such trees include the interactions with
+            nearby periodic images of the particles, see
+            :class:`boxtree.traversal.FMMTraversalBuilder`. Particles with
+            extent are not supported in this case.
         :arg kwargs: Used internally for debugging.
 
         :returns: a tuple ``(tree, event)``, where *tree* is an instance of
@@ -179,6 +185,14 @@ class TreeBuilder(object):
             raise ValueError("must specify targets when specifying "
                     "any kind of radii")
 
+        if periodic:
+            if bbox is None:
+                raise ValueError("must specify bbox for periodic trees")
+
+            if srcntgts_have_extent:
+                raise NotImplementedError("periodic trees with particles "
+                        "that have extent")
+
         from pytools import single_valued
         particle_id_dtype = np.int32
         box_id_dtype = np.int32
@@ -1644,6 +1658,7 @@ class TreeBuilder(object):
                 extent_norm=srcntgts_extent_norm,
 
                 bounding_box=(bbox_min, bbox_max),
+                periodic=periodic,
                 level_start_box_nrs=level_start_box_nrs,
                 level_start_box_nrs_dev=level_start_box_nrs_dev,
 
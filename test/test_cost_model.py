@@ -624,6 +624,45 @@ def test_cost_model_op_counts_agree_with_constantone_wrangler(
 # }}}
 
 
+# {{{ test_choose_well_sep_is_n_away
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_choose_well_sep_is_n_away(ctx_factory, dims):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    from boxtree.tools import make_normal_particle_array as p_normal
+    sources = p_normal(queue, 5000, dims, np.float64, seed=16)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, max_particles_in_box=30, debug=True)
+
+    from boxtree.cost import choose_well_sep_is_n_away, estimate_fmm_order
+
+    # looser separation should never need higher orders
+    orders = [estimate_fmm_order(dims, n, 1e-8) for n in (1, 2, 3)]
+    assert orders == sorted(orders, reverse=True)
+
+    cost_model = FMMCostModel(queue)
+    trav, level_to_order, predicted_costs = choose_well_sep_is_n_away(
+            queue, tree, 1e-8, cost_model=cost_model)
+
+    assert set(predicted_costs) == {1, 2}
+    assert predicted_costs[trav.well_sep_is_n_away] == min(
+            predicted_costs.values())
+
+    assert (level_to_order
+            == estimate_fmm_order(dims, trav.well_sep_is_n_away, 1e-8)).all()
+    assert predicted_costs[trav.well_sep_is_n_away] == sum(
+            cost_model.cost_per_stage(
+                trav, level_to_order,
+                FMMCostModel.get_unit_calibration_params()).values())
+
+# }}}
+
+
 # You can test individual routines by typing
 # $ python test_cost_model.py 'test_routine(cl.create_some_context)'
 
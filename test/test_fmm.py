@@ -378,6 +378,310 @@ def test_fmm_completeness(ctx_factory, dims, nsources_req, ntargets_req,
 
     assert good
 
+
+@pytest.mark.parametrize(("dims", "who_has_extent", "mac_theta", "mac_extent"), [
+    (2, "", 0.5, "static"),
+    (2, "", 0.7, "precise"),
+    (3, "", 0.6, "static"),
+    (3, "t", 0.6, "precise"),
+    (2, "t", 0.4, "precise"),
+    ])
+def test_fmm_completeness_with_mac_theta(ctx_factory, dims, who_has_extent,
+        mac_theta, mac_extent):
+    """Tests whether the traversal built with an opening-angle multipole
+    acceptance criterion completely captures all interactions.
+    """
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 3 * 10**4
+    ntargets = 2 * 10**4
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=16)
+
+    if "t" in who_has_extent:
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=12)
+        target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
+    else:
+        target_radii = None
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, target_radii=target_radii,
+            max_particles_in_box=30, stick_out_factor=0.25, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx, mac_theta=mac_theta, mac_extent=mac_extent)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    assert trav.mac_theta == mac_theta
+    if who_has_extent:
+        assert (trav.well_sep_is_n_away
+                == tbuild.get_effective_well_sep_is_n_away(
+                    dims, tree.stick_out_factor, tree.extent_norm))
+    else:
+        assert (trav.well_sep_is_n_away
+                == tbuild.get_effective_well_sep_is_n_away(dims))
+
+    host_trav = trav.get(queue=queue)
+    host_tree = host_trav.tree
+
+    # {{{ check the bound on the distance of same-level nws boxes
+
+    for ibox in range(host_tree.nboxes):
+        start, end = host_trav.same_level_non_well_sep_boxes_starts[ibox:ibox+2]
+        nws_boxes = host_trav.same_level_non_well_sep_boxes_lists[start:end]
+
+        box_size = host_tree.root_extent / 2**host_tree.box_levels[ibox]
+        offsets = np.abs(
+                host_tree.box_centers[:, nws_boxes]
+                - host_tree.box_centers[:, ibox].reshape(-1, 1)) / box_size
+        assert (np.round(offsets) <= host_trav.well_sep_is_n_away).all()
+
+    # }}}
+
+    # {{{ check that list 2 meets the criterion
+
+    if mac_extent == "static":
+        for itgt_box, tgt_ibox in enumerate(
+                host_trav.target_or_target_parent_boxes):
+            sep_boxes = host_trav.get_box_list("from_sep_siblings", itgt_box)
+            if not len(sep_boxes):
+                continue
+
+            rad = np.sqrt(dims) * host_tree.root_extent / (
+                    2**(host_tree.box_levels[tgt_ibox] + 1))
+            dists = la.norm(
+                    host_tree.box_centers[:, sep_boxes]
+                    - host_tree.box_centers[:, tgt_ibox].reshape(-1, 1),
+                    axis=0)
+            assert (2 * rad <= mac_theta * dists * (1 + 1e-12)).all()
+
+    # }}}
+
+    # {{{ check that lists 3 and 4 meet the criterion
+
+    def get_mac_radii(boxes, kind):
+        if mac_extent == "static":
+            return np.sqrt(dims) * host_tree.root_extent / (
+                    2.**(host_tree.box_levels[boxes] + 1))
+
+        centers = host_tree.box_centers[:, boxes]
+        bbox_min = getattr(host_trav, "box_%s_bounding_box_min" % kind)
+        bbox_max = getattr(host_trav, "box_%s_bounding_box_max" % kind)
+        axis_rads = np.maximum(
+                np.maximum(
+                    centers - bbox_min[:, boxes],
+                    bbox_max[:, boxes] - centers),
+                0)
+        return la.norm(axis_rads, axis=0)
+
+    def check_mac(tgt_ibox, src_boxes):
+        if not len(src_boxes):
+            return
+
+        dists = la.norm(
+                host_tree.box_centers[:, src_boxes]
+                - host_tree.box_centers[:, tgt_ibox].reshape(-1, 1),
+                axis=0)
+        rad_sums = (
+                get_mac_radii(np.array([tgt_ibox]), "target")
+                + get_mac_radii(src_boxes, "source"))
+        assert (rad_sums <= mac_theta * dists * (1 + 1e-12)).all()
+
+    for ilevel, level_list in enumerate(host_trav.from_sep_smaller_by_level):
+        for itgt, tgt_ibox in enumerate(
+                host_trav.target_boxes_sep_smaller_by_source_level[ilevel]):
+            start, end = level_list.starts[itgt:itgt+2]
+            check_mac(tgt_ibox, level_list.lists[start:end])
+
+    for itgt_box, tgt_ibox in enumerate(host_trav.target_or_target_parent_boxes):
+        check_mac(tgt_ibox, host_trav.get_box_list("from_sep_bigger", itgt_box))
+
+    # Non-adjacent boxes failing the criterion are evaluated directly.
+    assert host_trav.from_sep_close_smaller_starts is not None
+    assert host_trav.from_sep_close_bigger_starts is not None
+
+    # }}}
+
+    weights = np.ones(nsources)
+
+    from boxtree.fmm import drive_fmm
+    wrangler = ConstantOneExpansionWrangler(host_tree)
+    pot = drive_fmm(host_trav, wrangler, weights)
+
+    assert la.norm((pot - nsources) / nsources) < 1e-8
+
+    # The direct evaluations must not double-count.
+    host_trav = trav.merge_close_lists(queue).get(queue=queue)
+    pot = drive_fmm(host_trav, ConstantOneExpansionWrangler(host_tree), weights)
+
+    assert la.norm((pot - nsources) / nsources) < 1e-8
+
+
+@pytest.mark.parametrize(("dims", "sources_are_targets", "mask_kind"), [
+    (2, False, "targets"),
+    (2, True, "targets"),
+    (3, False, "boxes"),
+    ])
+def test_fmm_with_target_mask(ctx_factory, dims, sources_are_targets,
+        mask_kind):
+    """Tests whether a traversal restricted by a target mask gets the
+    potentials of the selected targets right.
+    """
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 3 * 10**4
+    ntargets = 2 * 10**4
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    if sources_are_targets:
+        targets = None
+        ntargets = nsources
+    else:
+        targets = p_normal(queue, ntargets, dims, dtype, seed=16)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    full_trav, _ = tbuild(queue, tree, debug=True)
+
+    rng = np.random.RandomState(17)
+    host_tree = tree.get(queue=queue)
+
+    user_target_ids = np.empty(ntargets, host_tree.particle_id_dtype)
+    user_target_ids[host_tree.sorted_target_ids] = np.arange(ntargets)
+
+    if mask_kind == "targets":
+        flags = (rng.rand(ntargets) < 0.01).astype(np.int8)
+        trav, _ = tbuild(queue, tree, debug=True,
+                target_mask=cl.array.to_device(queue, flags))
+
+        selected = flags.astype(bool)
+    else:
+        box_flags = (rng.rand(tree.nboxes) < 0.05).astype(np.int8)
+        trav, _ = tbuild(queue, tree, debug=True,
+                target_box_mask=cl.array.to_device(queue, box_flags))
+
+        selected = np.zeros(ntargets, bool)
+        for ibox in np.nonzero(box_flags)[0]:
+            start = host_tree.box_target_starts[ibox]
+            stop = start + host_tree.box_target_counts_nonchild[ibox]
+            selected[user_target_ids[start:stop]] = True
+
+    host_trav = trav.get(queue=queue)
+    host_full_trav = full_trav.get(queue=queue)
+
+    # {{{ check box lists
+
+    full_target_boxes = host_full_trav.target_boxes
+    is_selected_box = np.zeros(tree.nboxes, bool)
+    for ibox in full_target_boxes:
+        start = host_tree.box_target_starts[ibox]
+        stop = start + host_tree.box_target_counts_nonchild[ibox]
+        is_selected_box[ibox] = selected[user_target_ids[start:stop]].any()
+
+    assert (host_trav.target_boxes == np.nonzero(is_selected_box)[0]).all()
+
+    needed = is_selected_box.copy()
+    for ibox in np.nonzero(is_selected_box)[0]:
+        while ibox:
+            ibox = host_tree.box_parent_ids[ibox]
+            needed[ibox] = True
+
+    assert (host_trav.target_or_target_parent_boxes
+            == np.nonzero(needed)[0]).all()
+    assert host_trav.ntarget_boxes < host_full_trav.ntarget_boxes
+
+    # }}}
+
+    weights = np.ones(nsources)
+
+    from boxtree.fmm import drive_fmm
+    wrangler = ConstantOneExpansionWrangler(host_tree)
+    pot = drive_fmm(host_trav, wrangler, weights)
+
+    assert selected.any()
+    assert (pot[selected] == nsources).all()
+
+
+@pytest.mark.parametrize(("dims", "who_has_extent", "mac_theta", "mac_extent"), [
+    (2, "", 0.5, "static"),
+    (3, "", 0.7, "precise"),
+    (3, "t", 0.5, "precise"),
+    ])
+def test_treecode_completeness(ctx_factory, dims, who_has_extent,
+        mac_theta, mac_extent):
+    """Tests whether the treecode traversal and driver completely capture all
+    interactions.
+    """
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 2 * 10**4
+    ntargets = 10**4
+
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=16)
+
+    if "t" in who_has_extent:
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=12)
+        target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
+    else:
+        target_radii = None
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, target_radii=target_radii,
+            max_particles_in_box=30, stick_out_factor=0.25, debug=True)
+
+    from boxtree.traversal import TreecodeTraversalBuilder
+    tbuild = TreecodeTraversalBuilder(ctx,
+            mac_theta=mac_theta, mac_extent=mac_extent)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    host_trav = trav.get(queue=queue)
+    host_tree = host_trav.tree
+
+    for ilevel, level_list in enumerate(host_trav.accepted_source_boxes_by_level):
+        assert (host_tree.box_levels[level_list.lists] == ilevel).all()
+        assert (
+                host_trav.target_boxes_accepted_by_source_level[ilevel]
+                == host_trav.target_boxes[level_list.nonempty_indices]).all()
+        assert (np.diff(level_list.starts) > 0).all()
+
+    weights = np.ones(nsources)
+
+    from boxtree.fmm import drive_treecode
+    wrangler = ConstantOneExpansionWrangler(host_tree)
+    timing_data = {}
+    pot = drive_treecode(host_trav, wrangler, weights, timing_data=timing_data)
+
+    assert la.norm((pot - nsources) / nsources) < 1e-8
+    assert set(timing_data) <= set([
+        "form_multipoles", "coarsen_multipoles", "eval_direct",
+        "eval_multipoles"])
+
 # }}}
 
 
@@ -661,6 +965,181 @@ def test_interaction_list_particle_count_thresholding(ctx_factory, enable_extent
 
     assert (pot == weights_sum).all()
 
+
+@pytest.mark.parametrize("mode", ["auto", "auto_global"])
+def test_automatic_particle_count_thresholding(ctx_factory, mode):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    nsources = 1000
+    ntargets = 1000
+    dtype = np.float64
+
+    from boxtree.fmm import drive_fmm
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    targets = p_normal(queue, ntargets, dims, dtype, seed=15)
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=12)
+    target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, target_radii=target_radii,
+            debug=True, stick_out_factor=0.25)
+
+    from boxtree.cost import FMMCostModel
+    cost_model = FMMCostModel(queue)
+    level_to_order = np.full(tree.nlevels, 10)
+    calibration_params = cost_model.get_unit_calibration_params()
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True,
+            from_sep_smaller_min_nsources_cumul=mode,
+            cost_model=cost_model, level_to_order=level_to_order,
+            calibration_params=calibration_params)
+
+    thresholds = trav.from_sep_smaller_min_nsources_cumul
+    assert thresholds.shape == (tree.nlevels,)
+
+    if mode == "auto":
+        # one multipole evaluation costs as much as this many direct ones
+        ncoeffs = 10 + 1
+        assert (thresholds == ncoeffs).all()
+    else:
+        assert (thresholds == thresholds[0]).all()
+
+        # The chosen threshold should not be predicted to be slower than
+        # not using one.
+        def get_predicted_cost(trav):
+            cost = cost_model.cost_per_stage(
+                    trav, level_to_order, calibration_params)
+            return cost["eval_direct"] + cost["eval_multipoles"]
+
+        unthresholded_trav, _ = tbuild(queue, tree)
+        assert (get_predicted_cost(trav)
+                <= get_predicted_cost(unthresholded_trav) * (1 + 1e-12))
+
+    weights = np.ones(nsources)
+
+    host_trav = trav.get(queue=queue)
+    wrangler = ConstantOneExpansionWrangler(host_trav.tree)
+    pot = drive_fmm(host_trav, wrangler, weights)
+
+    assert (pot == np.sum(weights)).all()
+
+# }}}
+
+
+# {{{ test periodic fmm
+
+@pytest.mark.parametrize(("dims", "well_sep_is_n_away", "kind"), [
+    (2, 1, "adaptive"),
+    (2, 2, "non-adaptive"),
+    (3, 1, "adaptive-level-restricted"),
+    ])
+def test_periodic_fmm(ctx_factory, dims, well_sep_is_n_away, kind):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    nparticles = 1000
+    dtype = np.float64
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=15)
+    from pytools.obj_array import make_obj_array
+    particles = make_obj_array([
+        rng.uniform(queue, nparticles, dtype=dtype, a=0, b=1)**2
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, particles, max_particles_in_box=30,
+            bbox=np.array([[0, 1]] * dims, dtype=dtype),
+            periodic=True, kind=kind, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx, well_sep_is_n_away=well_sep_is_n_away)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    host_trav = trav.get(queue=queue)
+    assert host_trav.periodic_shifts.shape == (
+            (2*well_sep_is_n_away + 1)**dims, dims)
+
+    # The entries with zero shift are those of the non-periodic traversal.
+    zero_shift = len(host_trav.periodic_shifts) // 2
+    assert not host_trav.periodic_shifts[zero_shift].any()
+
+    nonperiodic_tree, _ = tb(queue, particles, max_particles_in_box=30,
+            bbox=np.array([[0, 1]] * dims, dtype=dtype), kind=kind)
+    nonperiodic_trav, _ = tbuild(queue, nonperiodic_tree)
+    nonperiodic_trav = nonperiodic_trav.get(queue=queue)
+
+    def get_rows(starts, lists, shifts=None, row_indices=None):
+        if row_indices is None:
+            row_indices = range(len(starts) - 1)
+
+        rows = {}
+        for i, row_index in enumerate(row_indices):
+            row = lists[starts[i]:starts[i+1]]
+            if shifts is not None:
+                row = row[shifts[starts[i]:starts[i+1]] == zero_shift]
+            rows[row_index] = row.tolist()
+        return rows
+
+    for list_name in ["same_level_non_well_sep_boxes", "neighbor_source_boxes",
+            "from_sep_siblings", "from_sep_bigger"]:
+        assert get_rows(
+                getattr(host_trav, list_name + "_starts"),
+                getattr(host_trav, list_name + "_lists"),
+                getattr(host_trav, list_name + "_shifts")) == get_rows(
+                getattr(nonperiodic_trav, list_name + "_starts"),
+                getattr(nonperiodic_trav, list_name + "_lists")), list_name
+
+    for ilevel in range(tree.nlevels):
+        level_list = host_trav.from_sep_smaller_by_level[ilevel]
+        periodic_rows = get_rows(level_list.starts, level_list.lists,
+                host_trav.from_sep_smaller_shifts_by_level[ilevel],
+                level_list.nonempty_indices)
+        level_list = nonperiodic_trav.from_sep_smaller_by_level[ilevel]
+        nonperiodic_rows = get_rows(level_list.starts, level_list.lists,
+                row_indices=level_list.nonempty_indices)
+        assert {i: row for i, row in periodic_rows.items() if row} \
+                == nonperiodic_rows
+
+    # Every particle interacts with each of the periodic images of every
+    # particle.
+    weights = np.ones(nparticles)
+    wrangler = ConstantOneExpansionWrangler(host_trav.tree)
+    from boxtree.fmm import drive_fmm
+    pot = drive_fmm(host_trav, wrangler, weights)
+
+    assert (pot == (2*well_sep_is_n_away + 1)**dims * np.sum(weights)).all()
+
+    from boxtree.cost import FMMCostModel
+    cost_model = FMMCostModel(queue)
+    cost_model.cost_per_stage(trav, np.full(tree.nlevels, 10),
+            FMMCostModel.get_unit_calibration_params())
+
+    # Consumers that depend on box positions do not apply the shifts.
+    from boxtree.near_field import NearFieldPatternBuilder
+    with pytest.raises(NotImplementedError):
+        NearFieldPatternBuilder(ctx)(queue, trav)
+
+    from boxtree.rotation_classes import TranslationClassesBuilder
+    with pytest.raises(NotImplementedError):
+        TranslationClassesBuilder(ctx)(queue, trav, tree)
+
+    from boxtree.pyfmmlib_integration import FMMLibExpansionWrangler
+    with pytest.raises(NotImplementedError):
+        FMMLibExpansionWrangler(host_trav.tree, 0,
+                fmm_level_to_nterms=lambda tree, level: 10)
+
 # }}}
 
 
@@ -429,6 +429,730 @@ def test_from_sep_siblings_rotation_classes(ctx_factory, well_sep_is_n_away):
 # }}}
 
 
+# {{{ test_from_sep_siblings_translation_class_batches
+
+@pytest.mark.parametrize("well_sep_is_n_away", (1, 2))
+def test_from_sep_siblings_translation_class_batches(ctx_factory,
+        well_sep_is_n_away):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 3
+    nparticles = 10**4
+    dtype = np.float64
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=15)
+
+    from pytools.obj_array import make_obj_array
+    particles = make_obj_array([
+        rng.normal(queue, nparticles, dtype=dtype)
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    from boxtree.rotation_classes import TranslationClassesBuilder
+
+    tg = FMMTraversalBuilder(ctx, well_sep_is_n_away=well_sep_is_n_away)
+    trav, _ = tg(queue, tree)
+
+    result, _ = TranslationClassesBuilder(ctx)(queue, trav, tree)
+    result = result.get(queue=queue)
+
+    tree = tree.get(queue=queue)
+    trav = trav.get(queue=queue)
+
+    # every List 2 entry is in exactly one batch
+    assert (np.sort(result.batch_entry_indices)
+            == np.arange(len(trav.from_sep_siblings_lists))).all()
+    assert (trav.from_sep_siblings_lists[result.batch_entry_indices]
+            == result.batch_source_boxes).all()
+
+    batch_keys = set()
+    for ibatch in range(result.nbatches):
+        start, end = result.batch_starts[ibatch:ibatch+2]
+        assert start < end
+
+        level = result.batch_levels[ibatch]
+        cls = result.batch_translation_classes[ibatch]
+        batch_keys.add((level, cls))
+
+        src_boxes = result.batch_source_boxes[start:end]
+        tgt_boxes = result.batch_target_boxes[start:end]
+        assert (tree.box_levels[src_boxes] == level).all()
+        assert (tree.box_levels[tgt_boxes] == level).all()
+        assert (result.from_sep_siblings_translation_classes[
+            result.batch_entry_indices[start:end]] == cls).all()
+
+        diam = tree.root_extent / 2**level
+        dist_vecs = (
+                tree.box_centers[:, tgt_boxes]
+                - tree.box_centers[:, src_boxes]) / diam
+        assert np.allclose(
+                dist_vecs,
+                result.from_sep_siblings_translation_class_to_distance_vector[
+                    :, cls].reshape(-1, 1))
+
+    assert len(batch_keys) == result.nbatches
+
+# }}}
+
+
+# {{{ test_compressed_lists
+
+@pytest.mark.parametrize("dims", (2, 3))
+def test_compressed_lists(ctx_factory, dims):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    nparticles = 10**4
+    dtype = np.float64
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=15)
+
+    from pytools.obj_array import make_obj_array
+    particles = make_obj_array([
+        rng.normal(queue, nparticles, dtype=dtype)
+        for i in range(dims)])
+    target_radii = 2**rng.uniform(queue, nparticles, dtype=dtype, a=-10, b=0)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, particles, targets=particles, target_radii=target_radii,
+            max_particles_in_box=30, stick_out_factor=0.25, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder, BoxListCompressor
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree)
+
+    compressed_trav = trav.compress_lists(queue)
+
+    host_trav = trav.get(queue=queue)
+    host_compressed_trav = compressed_trav.get(queue=queue)
+    compressor = BoxListCompressor(ctx)
+
+    from boxtree.traversal import CompressedBoxList
+
+    for list_name in ["same_level_non_well_sep_boxes", "neighbor_source_boxes",
+            "from_sep_siblings", "from_sep_close_smaller", "from_sep_bigger",
+            "from_sep_close_bigger", "from_sep_smaller_by_level"]:
+        if list_name == "from_sep_smaller_by_level":
+            compressed = [
+                    level_list.lists
+                    for level_list in compressed_trav.from_sep_smaller_by_level]
+            host_compressed = [
+                    level_list.lists
+                    for level_list in host_compressed_trav.from_sep_smaller_by_level]
+            uncompressed_lists = [
+                    level_list.lists
+                    for level_list in host_trav.from_sep_smaller_by_level]
+        else:
+            compressed = [getattr(compressed_trav, list_name + "_lists")]
+            host_compressed = [getattr(host_compressed_trav, list_name + "_lists")]
+            uncompressed_lists = [getattr(host_trav, list_name + "_lists")]
+
+        for compressed_list, host_compressed_list, uncompressed in zip(
+                compressed, host_compressed, uncompressed_lists):
+            assert isinstance(compressed_list, CompressedBoxList)
+            assert compressed_list.nbytes <= compressed_list.uncompressed_nbytes
+
+            # decompress on the device
+            lists, _ = compressor.decompress(queue, compressed_list)
+            assert (lists.get() == uncompressed).all()
+
+            # decode on the host
+            assert len(host_compressed_list) == len(uncompressed)
+            assert (np.asarray(host_compressed_list) == uncompressed).all()
+
+            starts = host_compressed_list.starts
+            for i in range(len(starts) - 1):
+                assert (host_compressed_list.get_box_list(i)
+                        == uncompressed[starts[i]:starts[i+1]]).all()
+                assert (host_compressed_list[starts[i]:starts[i+1]]
+                        == uncompressed[starts[i]:starts[i+1]]).all()
+
+            # ranges that do not start at a list start
+            mid = len(uncompressed) // 2
+            assert (host_compressed_list[mid:] == uncompressed[mid:]).all()
+
+    # everything but the lists themselves is carried over unchanged
+    for list_name in ["same_level_non_well_sep_boxes", "neighbor_source_boxes",
+            "from_sep_siblings", "from_sep_close_smaller", "from_sep_bigger",
+            "from_sep_close_bigger"]:
+        assert (getattr(host_compressed_trav, list_name + "_starts")
+                == getattr(host_trav, list_name + "_starts")).all()
+
+    for level_list, compressed_level_list in zip(
+            host_trav.from_sep_smaller_by_level,
+            host_compressed_trav.from_sep_smaller_by_level):
+        assert compressed_level_list.count == level_list.count
+        for field in ["starts", "num_nonempty_lists", "nonempty_indices",
+                "compressed_indices"]:
+            assert (np.asarray(getattr(compressed_level_list, field))
+                    == np.asarray(getattr(level_list, field))).all(), field
+
+    # {{{ consumers decode the lists as they go
+
+    from boxtree.fmm import drive_fmm
+    from boxtree.tools import ConstantOneExpansionWrangler
+    weights = np.ones(nparticles)
+    ref_pot = drive_fmm(
+            host_trav, ConstantOneExpansionWrangler(host_trav.tree), weights)
+    pot = drive_fmm(
+            host_compressed_trav,
+            ConstantOneExpansionWrangler(host_compressed_trav.tree), weights)
+    assert (pot == ref_pot).all()
+
+    from boxtree.cost import FMMCostModel
+    cost_model = FMMCostModel(queue)
+    level_to_order = np.full(tree.nlevels, 10, dtype=np.int32)
+    ref_cost = cost_model.cost_per_stage(trav, level_to_order,
+            FMMCostModel.get_unit_calibration_params())
+    cost = cost_model.cost_per_stage(compressed_trav, level_to_order,
+            FMMCostModel.get_unit_calibration_params())
+    for stage, stage_cost in ref_cost.items():
+        assert cost[stage] == stage_cost, stage
+
+    # }}}
+
+# }}}
+
+
+# {{{ test_traversal_statistics
+
+def test_traversal_statistics(ctx_factory):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 3
+    nparticles = 10**4
+    dtype = np.float64
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=15)
+
+    from pytools.obj_array import make_obj_array
+    particles = make_obj_array([
+        rng.normal(queue, nparticles, dtype=dtype)
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree)
+
+    stats = trav.statistics(queue)
+
+    host_trav = trav.get(queue=queue)
+    host_tree = host_trav.tree
+
+    list3_lengths = np.zeros(host_trav.ntarget_boxes, np.intp)
+    for level_list in host_trav.from_sep_smaller_by_level:
+        list3_lengths[level_list.nonempty_indices] += np.diff(level_list.starts)
+
+    for list_name, row_boxes, lengths in [
+            ("same_level_non_well_sep_boxes", np.arange(host_tree.nboxes),
+                np.diff(host_trav.same_level_non_well_sep_boxes_starts)),
+            ("neighbor_source_boxes", host_trav.target_boxes,
+                np.diff(host_trav.neighbor_source_boxes_starts)),
+            ("from_sep_siblings", host_trav.target_or_target_parent_boxes,
+                np.diff(host_trav.from_sep_siblings_starts)),
+            ("from_sep_smaller", host_trav.target_boxes, list3_lengths),
+            ("from_sep_bigger", host_trav.target_or_target_parent_boxes,
+                np.diff(host_trav.from_sep_bigger_starts)),
+            ]:
+        list_stats = stats[list_name]
+
+        assert list_stats.nlists == len(lengths)
+        assert list_stats.nentries == lengths.sum()
+        assert list_stats.max_length == lengths.max()
+
+        histogram = np.zeros((host_tree.nlevels, lengths.max() + 1), np.intp)
+        np.add.at(histogram, (host_tree.box_levels[row_boxes], lengths), 1)
+        assert (list_stats.length_histogram_by_level == histogram).all()
+
+    assert "from_sep_close_smaller" not in stats
+
+# }}}
+
+
+# {{{ test_stencil_traversal
+
+@pytest.mark.parametrize("well_sep_is_n_away", (1, 2))
+@pytest.mark.parametrize(("dims", "kind", "stencil_min_occupancy"), [
+    (2, "non-adaptive", 0.5),
+    (3, "non-adaptive", 0.5),
+    (2, "adaptive", 0.1),
+    (3, "adaptive", 0.1),
+    ])
+def test_stencil_traversal(ctx_factory, dims, kind, stencil_min_occupancy,
+        well_sep_is_n_away):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    nparticles = 10**4
+    dtype = np.float64
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=15)
+
+    from pytools.obj_array import make_obj_array
+    particles = make_obj_array([
+        rng.uniform(queue, nparticles, dtype=dtype)
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, particles, max_particles_in_box=30, kind=kind,
+            debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    trav, _ = FMMTraversalBuilder(ctx,
+            well_sep_is_n_away=well_sep_is_n_away)(queue, tree)
+    stencil_trav, _ = FMMTraversalBuilder(ctx,
+            well_sep_is_n_away=well_sep_is_n_away,
+            stencil_min_occupancy=stencil_min_occupancy)(queue, tree)
+
+    trav = trav.get(queue=queue)
+    stencil_trav = stencil_trav.get(queue=queue)
+
+    for list_name, nlists in [
+            ("same_level_non_well_sep_boxes", trav.nboxes),
+            ("from_sep_siblings", trav.ntarget_or_target_parent_boxes),
+            ("from_sep_bigger", trav.ntarget_or_target_parent_boxes),
+            ]:
+        starts = getattr(trav, list_name + "_starts")
+        stencil_starts = getattr(stencil_trav, list_name + "_starts")
+        assert (starts == stencil_starts).all()
+
+        for i in range(nlists):
+            assert (
+                    sorted(trav.get_box_list(list_name, i))
+                    == sorted(stencil_trav.get_box_list(list_name, i)))
+
+# }}}
+
+
+# {{{ test_target_box_tiles
+
+@pytest.mark.parametrize("dims", (2, 3))
+def test_target_box_tiles(ctx_factory, dims):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    nparticles = 2 * 10**4
+    dtype = np.float64
+    max_tile_ntargets = 500
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree)
+
+    tiles = trav.get_target_box_tiles(queue,
+            max_tile_ntargets=max_tile_ntargets).get(queue=queue)
+
+    trav = trav.get(queue=queue)
+    tree = trav.tree
+
+    for box_list, order, tile_starts in [
+            (trav.target_boxes, tiles.target_box_order,
+                tiles.target_box_tile_starts),
+            (trav.target_or_target_parent_boxes,
+                tiles.target_or_target_parent_box_order,
+                tiles.target_or_target_parent_box_tile_starts),
+            ]:
+        assert (np.sort(order) == np.arange(len(box_list))).all()
+        assert tile_starts[0] == 0
+        assert tile_starts[-1] == len(box_list)
+
+        for itile in range(len(tile_starts) - 1):
+            tile_boxes = box_list[order[tile_starts[itile]:tile_starts[itile+1]]]
+            assert len(tile_boxes)
+
+            if len(tile_boxes) == 1:
+                continue
+
+            # a subtree with few enough targets, stored contiguously
+            tgt_starts = tree.box_target_starts[tile_boxes]
+            tgt_stops = tgt_starts + tree.box_target_counts_cumul[tile_boxes]
+            assert tgt_stops.max() - tgt_starts.min() <= max_tile_ntargets
+
+    # List 2 is processed level by level.
+    assert (np.diff(tree.box_levels[trav.target_or_target_parent_boxes[
+        tiles.target_or_target_parent_box_order]].astype(int)) >= 0).all()
+
+    # {{{ the FMM processes the target boxes in tile order
+
+    from boxtree.fmm import drive_fmm
+    from boxtree.tools import ConstantOneExpansionWrangler
+
+    class RecordingWrangler(ConstantOneExpansionWrangler):
+        def __init__(self, tree):
+            ConstantOneExpansionWrangler.__init__(self, tree)
+            self.direct_target_boxes = []
+
+        def eval_direct(self, target_boxes, *args):
+            self.direct_target_boxes.append(target_boxes)
+            return ConstantOneExpansionWrangler.eval_direct(
+                    self, target_boxes, *args)
+
+    weights = np.ones(nparticles)
+
+    pot = drive_fmm(trav, ConstantOneExpansionWrangler(tree), weights)
+
+    wrangler = RecordingWrangler(tree)
+    tiled_pot = drive_fmm(trav, wrangler, weights, target_box_tiles=tiles)
+
+    assert (tiled_pot == pot).all()
+    assert (pot == nparticles).all()
+    assert (wrangler.direct_target_boxes[0]
+            == trav.target_boxes[tiles.target_box_order]).all()
+
+    # }}}
+
+# }}}
+
+
+# {{{ test_traversal_on_multiple_queues
+
+@pytest.mark.parametrize("targets_have_extent", (False, True))
+def test_traversal_on_multiple_queues(ctx_factory, targets_have_extent):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 3
+    nsources = 5000
+    ntargets = 3000
+    dtype = np.float64
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=15)
+
+    from pytools.obj_array import make_obj_array
+    sources = make_obj_array([
+        rng.normal(queue, nsources, dtype=dtype)
+        for i in range(dims)])
+    targets = make_obj_array([
+        rng.normal(queue, ntargets, dtype=dtype)
+        for i in range(dims)])
+
+    if targets_have_extent:
+        target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
+    else:
+        target_radii = None
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, target_radii=target_radii,
+            max_particles_in_box=30, stick_out_factor=0.25, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+
+    ref_trav, _ = tg(queue, tree)
+    ref_trav = ref_trav.get(queue=queue)
+
+    extra_queues = [cl.CommandQueue(ctx) for i in range(2)]
+    trav, evt = tg(queue, tree, extra_queues=extra_queues)
+    evt.wait()
+    trav = trav.get(queue=queue)
+
+    for name in ref_trav.get_copy_kwargs().keys():
+        ref_value = getattr(ref_trav, name)
+        if (name.endswith(("_boxes", "_starts", "_lists"))
+                and isinstance(ref_value, np.ndarray)):
+            assert (getattr(trav, name) == ref_value).all(), name
+
+    for ilevel in range(tree.nlevels):
+        ref_level = ref_trav.from_sep_smaller_by_level[ilevel]
+        level = trav.from_sep_smaller_by_level[ilevel]
+        assert (level.starts == ref_level.starts).all()
+        assert (level.lists == ref_level.lists).all()
+        assert (ref_trav.target_boxes_sep_smaller_by_source_level[ilevel]
+                == trav.target_boxes_sep_smaller_by_source_level[ilevel]).all()
+
+    # The extra queues are not part of the cache key.
+    from boxtree.cache import BuildCache, CachedFMMTraversalBuilder
+    cached_tg = CachedFMMTraversalBuilder(tg, BuildCache())
+    cached_trav, _ = cached_tg(queue, tree, extra_queues=extra_queues)
+    assert cached_tg(queue, tree)[0] is cached_trav
+
+
+def test_list_builds_run_concurrently(ctx_factory):
+    ctx = ctx_factory()
+    queues = [cl.CommandQueue(ctx) for i in range(2)]
+
+    from threading import Event
+    from boxtree.traversal import _run_concurrently
+
+    second_started = Event()
+
+    def first(queue):
+        # Only finishes if the second task runs at the same time.
+        return second_started.wait(30), [cl.enqueue_marker(queue)]
+
+    def second(queue):
+        second_started.set()
+        return queue, [cl.enqueue_marker(queue)]
+
+    def third(queue):
+        return queue, []
+
+    results, events = _run_concurrently(queues, [
+        [("first", first)], [("second", second)], [("third", third)]])
+
+    assert results["first"]
+    assert results["second"] is queues[1]
+    # Groups are handed out round-robin.
+    assert results["third"] is queues[0]
+    assert len(events) == 2
+
+    def failing(queue):
+        raise RuntimeError("failing build")
+
+    with pytest.raises(RuntimeError):
+        _run_concurrently(queues, [[("second", second)], [("failing", failing)]])
+
+# }}}
+
+
+# {{{ test_near_field_pattern
+
+@pytest.mark.parametrize("dims", (2, 3))
+@pytest.mark.parametrize("targets_have_extent", (False, True))
+def test_near_field_pattern(ctx_factory, dims, targets_have_extent):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 5000
+    ntargets = 3000
+    dtype = np.float64
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=15)
+
+    from pytools.obj_array import make_obj_array
+    sources = make_obj_array([
+        rng.normal(queue, nsources, dtype=dtype)
+        for i in range(dims)])
+    targets = make_obj_array([
+        rng.normal(queue, ntargets, dtype=dtype)
+        for i in range(dims)])
+
+    if targets_have_extent:
+        target_radii = 2**rng.uniform(queue, ntargets, dtype=dtype, a=-10, b=0)
+    else:
+        target_radii = None
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, target_radii=target_radii,
+            max_particles_in_box=30, stick_out_factor=0.25, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree)
+
+    from boxtree.near_field import NearFieldPatternBuilder
+    pattern, _ = NearFieldPatternBuilder(ctx)(queue, trav)
+    pattern = pattern.get(queue=queue)
+
+    # {{{ compare with the box-level lists
+
+    if targets_have_extent:
+        trav = trav.merge_close_lists(queue)
+
+    host_trav = trav.get(queue=queue)
+    host_tree = host_trav.tree
+
+    def source_range(ibox):
+        start = host_tree.box_source_starts[ibox]
+        return np.arange(
+                start, start + host_tree.box_source_counts_nonchild[ibox])
+
+    ref_nnz = 0
+    for itgt_box, tgt_ibox in enumerate(host_trav.target_boxes):
+        ref_sources = np.concatenate([
+            source_range(src_ibox)
+            for src_ibox in host_trav.get_box_list(
+                "neighbor_source_boxes", itgt_box)])
+
+        start = host_tree.box_target_starts[tgt_ibox]
+        for itgt in range(
+                start, start + host_tree.box_target_counts_nonchild[tgt_ibox]):
+            assert (
+                    pattern.source_indices[
+                        pattern.target_starts[itgt]:pattern.target_starts[itgt+1]]
+                    == ref_sources).all()
+            ref_nnz += len(ref_sources)
+
+    assert pattern.nnz == ref_nnz
+
+    # }}}
+
+    pytest.importorskip("scipy")
+
+    def entry_func(target_indices, source_indices):
+        return (
+                1000 * target_indices.astype(np.float64)
+                + source_indices)
+
+    mat = pattern.get_sparse_matrix(entry_func)
+    assert mat.shape == (ntargets, nsources)
+    assert mat.nnz == pattern.nnz
+
+    mat = mat.tocoo()
+    assert (mat.data == 1000 * mat.row + mat.col).all()
+
+# }}}
+
+
+# {{{ test_host_traversal
+
+@pytest.mark.parametrize(("dims", "sources_are_targets", "kind"), [
+    (2, True, "adaptive"),
+    (2, False, "non-adaptive"),
+    (3, False, "adaptive"),
+    (3, True, "adaptive-level-restricted"),
+    ])
+@pytest.mark.parametrize("well_sep_is_n_away", (1, 2))
+def test_host_traversal(ctx_factory, dims, sources_are_targets, kind,
+        well_sep_is_n_away):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 3000
+    ntargets = 2000
+    dtype = np.float64
+
+    from boxtree.tools import make_normal_particle_array as p_normal
+    sources = p_normal(queue, nsources, dims, dtype, seed=15)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = p_normal(queue, ntargets, dims, dtype, seed=18)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            kind=kind, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder, HostFMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx, well_sep_is_n_away=well_sep_is_n_away)
+    ref_trav, _ = tg(queue, tree)
+    ref_trav = ref_trav.get(queue=queue)
+
+    host_tg = HostFMMTraversalBuilder(well_sep_is_n_away=well_sep_is_n_away)
+    trav = host_tg(tree.get(queue=queue))
+
+    for name in ref_trav.get_copy_kwargs().keys():
+        ref_value = getattr(ref_trav, name)
+        if not isinstance(ref_value, np.ndarray):
+            continue
+
+        value = getattr(trav, name)
+        if "bounding_box" in name:
+            # Only the entries for actual boxes are meaningful.
+            ref_value = ref_value[:, :tree.nboxes]
+            value = value[:, :tree.nboxes]
+
+        assert value.shape == ref_value.shape, name
+        assert (value == ref_value).all(), name
+
+    for ilevel in range(tree.nlevels):
+        ref_level = ref_trav.from_sep_smaller_by_level[ilevel]
+        level = trav.from_sep_smaller_by_level[ilevel]
+        assert (level.starts == ref_level.starts).all()
+        assert (level.lists == ref_level.lists).all()
+        assert (level.nonempty_indices == ref_level.nonempty_indices).all()
+        assert (ref_trav.target_boxes_sep_smaller_by_source_level[ilevel]
+                == trav.target_boxes_sep_smaller_by_source_level[ilevel]).all()
+
+# }}}
+
+
+# {{{ test_same_level_walk
+
+@pytest.mark.parametrize("dims", (2, 3))
+@pytest.mark.parametrize("well_sep_is_n_away", (1, 2))
+def test_same_level_walk(ctx_factory, dims, well_sep_is_n_away):
+    # The same-level walk does not descend into the box's own subtree. Check
+    # that this leaves the same-level list and lists 1 and 2 as they were.
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    from boxtree.tools import make_normal_particle_array as p_normal
+    sources = p_normal(queue, 3000, dims, dtype, seed=15)
+    targets = p_normal(queue, 2000, dims, dtype, seed=18)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder, HostFMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx, well_sep_is_n_away=well_sep_is_n_away)
+    trav, _ = tg(queue, tree)
+    trav = trav.get(queue=queue)
+    tree = trav.tree
+
+    # {{{ same-level non-well-separated boxes, by brute force
+
+    for ibox in range(tree.nboxes):
+        level = tree.box_levels[ibox]
+        box_size = tree.root_extent / (1 << level)
+
+        same_level, = np.where(tree.box_levels == level)
+        offsets = np.round(np.abs(
+            tree.box_centers[:, same_level]
+            - tree.box_centers[:, ibox, np.newaxis]) / box_size)
+        ref_nws = same_level[
+                (np.max(offsets, axis=0) <= well_sep_is_n_away)
+                & (same_level != ibox)]
+
+        start, end = trav.same_level_non_well_sep_boxes_starts[ibox:ibox+2]
+        nws = trav.same_level_non_well_sep_boxes_lists[start:end]
+        assert sorted(nws) == sorted(ref_nws), ibox
+
+    # }}}
+
+    # {{{ lists 1 and 2, against the host traversal
+
+    host_trav = HostFMMTraversalBuilder(
+            well_sep_is_n_away=well_sep_is_n_away)(tree)
+
+    for name in [
+            "neighbor_source_boxes_starts", "neighbor_source_boxes_lists",
+            "from_sep_siblings_starts", "from_sep_siblings_lists"]:
+        assert (getattr(trav, name) == getattr(host_trav, name)).all(), name
+
+    # }}}
+
+# }}}
+
+
 # You can test individual routines by typing
 # $ python test_traversal.py 'test_routine(cl.create_some_context)'
 
@@ -659,7 +659,8 @@ def test_extent_tree(ctx_factory, dims, extent_norm, do_plot=False):
 @pytest.mark.opencl
 @pytest.mark.geo_lookup
 @pytest.mark.parametrize("dims", [2, 3])
-def test_leaves_to_balls_query(ctx_factory, dims, do_plot=False):
+@pytest.mark.parametrize("sort_by", [None, "distance"])
+def test_leaves_to_balls_query(ctx_factory, dims, sort_by, do_plot=False):
     logging.basicConfig(level=logging.INFO)
 
     ctx = ctx_factory()
@@ -687,7 +688,7 @@ def test_leaves_to_balls_query(ctx_factory, dims, do_plot=False):
     from boxtree.area_query import LeavesToBallsLookupBuilder
     lblb = LeavesToBallsLookupBuilder(ctx)
 
-    lbl, _ = lblb(queue, tree, ball_centers, ball_radii)
+    lbl, _ = lblb(queue, tree, ball_centers, ball_radii, sort_by=sort_by)
 
     # get data to host for test
     tree = tree.get(queue=queue)
@@ -712,25 +713,36 @@ def test_leaves_to_balls_query(ctx_factory, dims, do_plot=False):
         near_circles, = np.where(linf_circle_dists - ball_radii < box_rad)
 
         start, end = lbl.balls_near_box_starts[ibox:ibox+2]
-        assert sorted(lbl.balls_near_box_lists[start:end]) == sorted(near_circles)
+        found = lbl.balls_near_box_lists[start:end]
+        assert sorted(found) == sorted(near_circles)
+
+        if sort_by is None:
+            assert (np.diff(found) > 0).all()
+        elif sort_by == "distance":
+            dists = np.sum((ball_centers[found] - box_center)**2, axis=-1)
+            assert (np.diff(dists) >= 0).all()
+            assert (np.diff(found)[np.diff(dists) == 0] > 0).all()
 
 # }}}
 
 
 # {{{ area query test
 
-def run_area_query_test(ctx, queue, tree, ball_centers, ball_radii):
+def run_area_query_test(ctx, queue, tree, ball_centers, ball_radii,
+        norm="linf"):
     """
     Performs an area query and checks that the result is as expected.
     """
     from boxtree.area_query import AreaQueryBuilder
     aqb = AreaQueryBuilder(ctx)
 
-    area_query, _ = aqb(queue, tree, ball_centers, ball_radii)
+    area_query, _ = aqb(queue, tree, ball_centers, ball_radii, norm=norm)
+    counts, _ = aqb.count(queue, tree, ball_centers, ball_radii, norm=norm)
 
     # Get data to host for test.
     tree = tree.get(queue=queue)
     area_query = area_query.get(queue=queue)
+    counts = counts.get(queue=queue)
     ball_centers = np.array([x.get() for x in ball_centers]).T
     ball_radii = ball_radii.get()
 
@@ -749,9 +761,17 @@ def run_area_query_test(ctx, queue, tree, ball_centers, ball_radii):
 
     for ball_nr, (ball_center, ball_radius) \
             in enumerate(zip(ball_centers, ball_radii)):
-        linf_box_dists = np.max(np.abs(ball_center - leaf_box_centers), axis=-1)
-        near_leaves_indices, \
-            = np.where(linf_box_dists < ball_radius + leaf_box_radii)
+        if norm == "linf":
+            linf_box_dists = np.max(
+                    np.abs(ball_center - leaf_box_centers), axis=-1)
+            near_leaves_indices, \
+                = np.where(linf_box_dists < ball_radius + leaf_box_radii)
+        else:
+            # distance from the ball center to the closest point of each box
+            l2_box_dists = np.sqrt(np.sum(np.maximum(0,
+                np.abs(ball_center - leaf_box_centers)
+                - leaf_box_radii[:, np.newaxis])**2, axis=-1))
+            near_leaves_indices, = np.where(l2_box_dists < ball_radius)
         near_leaves = leaf_boxes[near_leaves_indices]
 
         start, end = area_query.leaves_near_ball_starts[ball_nr:ball_nr+2]
@@ -759,11 +779,18 @@ def run_area_query_test(ctx, queue, tree, ball_centers, ball_radii):
         actual = near_leaves
         assert set(found) == set(actual), (found, actual)
 
+        assert counts.leaf_counts[ball_nr] == end - start
+        assert counts.source_counts[ball_nr] == np.sum(
+                tree.box_source_counts_nonchild[found])
+        assert counts.target_counts[ball_nr] == np.sum(
+                tree.box_target_counts_nonchild[found])
+
 
 @pytest.mark.opencl
 @pytest.mark.area_query
 @pytest.mark.parametrize("dims", [2, 3])
-def test_area_query(ctx_factory, dims, do_plot=False):
+@pytest.mark.parametrize("norm", ["linf", "l2"])
+def test_area_query(ctx_factory, dims, norm, do_plot=False):
     ctx = ctx_factory()
     queue = cl.CommandQueue(ctx)
 
@@ -786,7 +813,7 @@ def test_area_query(ctx_factory, dims, do_plot=False):
     ball_centers = make_normal_particle_array(queue, nballs, dims, dtype)
     ball_radii = cl.array.empty(queue, nballs, dtype).fill(0.1)
 
-    run_area_query_test(ctx, queue, tree, ball_centers, ball_radii)
+    run_area_query_test(ctx, queue, tree, ball_centers, ball_radii, norm)
 
 
 @pytest.mark.opencl
@@ -829,6 +856,322 @@ def test_area_query_balls_outside_bbox(ctx_factory, dims, do_plot=False):
     run_area_query_test(ctx, queue, tree, ball_centers, ball_radii)
 
 
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("balls_on_host", [False, True])
+def test_area_query_chunks(ctx_factory, balls_on_host):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 3
+    nparticles = 10**4
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    nballs = 2500
+    ball_centers = make_normal_particle_array(queue, nballs, dims, dtype)
+    ball_radii = cl.array.empty(queue, nballs, dtype).fill(0.1)
+
+    from boxtree.area_query import AreaQueryBuilder
+    aqb = AreaQueryBuilder(ctx)
+
+    ref_aq, _ = aqb(queue, tree, ball_centers, ball_radii)
+    ref_aq = ref_aq.get(queue=queue)
+
+    if balls_on_host:
+        ball_centers = np.array([bc.get() for bc in ball_centers])
+        ball_radii = ball_radii.get()
+
+    chunk_size = 1000
+    chunk_starts = []
+    for chunk, aq, evt in aqb.iter_chunks(
+            queue, tree, ball_centers, ball_radii, chunk_size):
+        evt.wait()
+        aq = aq.get(queue=queue)
+        chunk_starts.append(chunk.start)
+
+        ref_starts = ref_aq.leaves_near_ball_starts[chunk.start:chunk.stop+1]
+        assert (aq.leaves_near_ball_starts == ref_starts - ref_starts[0]).all()
+        assert (aq.leaves_near_ball_lists
+                == ref_aq.leaves_near_ball_lists[
+                    ref_starts[0]:ref_starts[-1]]).all()
+
+    assert chunk_starts == list(range(0, nballs, chunk_size))
+
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize(("dims", "nneighbors"), [(2, 5), (3, 32)])
+def test_k_nearest_neighbor_query(ctx_factory, dims, nneighbors):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 10**4
+    npoints = 500
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, max_particles_in_box=30, debug=True)
+
+    # Some of the points are outside the tree.
+    points = make_normal_particle_array(queue, npoints, dims, dtype, seed=13)
+    points = [2 * pt for pt in points]
+
+    from boxtree.area_query import KNearestNeighborQueryBuilder
+    knnb = KNearestNeighborQueryBuilder(ctx)
+
+    knn, _ = knnb(queue, tree, points, nneighbors)
+    knn = knn.get(queue=queue)
+
+    tree_knn, _ = knnb(queue, tree, points, nneighbors, source_order="tree")
+    tree_knn = tree_knn.get(queue=queue)
+
+    host_tree = tree.get(queue=queue)
+    assert (host_tree.user_source_ids[tree_knn.neighbor_lists]
+            == knn.neighbor_lists).all()
+
+    sources = np.array([src.get() for src in sources]).T
+    points = np.array([pt.get() for pt in points]).T
+
+    for ipoint, point in enumerate(points):
+        dists = np.sqrt(np.sum((sources - point)**2, axis=1))
+        ref_neighbors = np.argsort(dists)[:nneighbors]
+
+        start, end = knn.neighbor_starts[ipoint:ipoint+2]
+        assert (knn.neighbor_lists[start:end] == ref_neighbors).all()
+        assert np.allclose(
+                knn.neighbor_distances[start:end], dists[ref_neighbors])
+
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+def test_k_nearest_neighbor_query_without_sources(ctx_factory):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    npoints = 50
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 0, dims, dtype)
+    targets = make_normal_particle_array(queue, 1000, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+    assert tree.nsources == 0
+
+    points = make_normal_particle_array(queue, npoints, dims, dtype, seed=13)
+
+    from boxtree.area_query import KNearestNeighborQueryBuilder
+    knnb = KNearestNeighborQueryBuilder(ctx)
+
+    knn, evt = knnb(queue, tree, points, 5)
+    evt.wait()
+    knn = knn.get(queue=queue)
+
+    assert knn.nneighbors == 0
+    assert (knn.neighbor_starts == 0).all()
+    assert len(knn.neighbor_starts) == npoints + 1
+    assert len(knn.neighbor_lists) == 0
+    assert len(knn.neighbor_distances) == 0
+
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("source_order", ["user", "tree"])
+def test_range_query(ctx_factory, dims, source_order):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    nparticles = 10**4
+    nranges = 500
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    # Ranges with unequal side lengths, some of them sticking out of the tree.
+    rng = np.random.RandomState(17)
+    range_mins = rng.normal(size=(dims, nranges))
+    range_maxs = range_mins + rng.uniform(0, 0.5, size=(dims, nranges))
+
+    from boxtree.area_query import RangeQueryBuilder
+    rqb = RangeQueryBuilder(ctx)
+
+    rq, _ = rqb(queue, tree,
+            [cl.array.to_device(queue, ary) for ary in range_mins],
+            [cl.array.to_device(queue, ary) for ary in range_maxs],
+            return_sources=True, source_order=source_order)
+    rq = rq.get(queue=queue)
+
+    host_tree = tree.get(queue=queue)
+    if source_order == "user":
+        sources = np.array([pt.get() for pt in particles])
+    else:
+        sources = np.array([src for src in host_tree.sources])
+
+    from boxtree import box_flags_enum
+    leaf_boxes, = (
+            host_tree.box_flags & box_flags_enum.HAS_CHILDREN == 0).nonzero()
+    leaf_lows, leaf_highs = np.array(
+            [host_tree.get_box_extent(ibox) for ibox in leaf_boxes]).transpose(
+                    1, 2, 0)
+
+    for irange in range(nranges):
+        range_min = range_mins[:, irange, np.newaxis]
+        range_max = range_maxs[:, irange, np.newaxis]
+
+        ref_leaves = leaf_boxes[np.all(
+            (range_min <= leaf_highs) & (leaf_lows <= range_max), axis=0)]
+        start, end = rq.leaves_in_range_starts[irange:irange+2]
+        assert (np.sort(rq.leaves_in_range_lists[start:end]) == ref_leaves).all()
+
+        ref_sources, = np.where(np.all(
+            (range_min <= sources) & (sources <= range_max), axis=0))
+        start, end = rq.sources_in_range_starts[irange:irange+2]
+        assert (np.sort(rq.sources_in_range_lists[start:end])
+                == ref_sources).all()
+
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("source_order", ["user", "tree"])
+@pytest.mark.parametrize("half_list", [False, True])
+def test_radius_neighbor_query(ctx_factory, dims, source_order, half_list):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 3000
+    dtype = np.float64
+    radius = 0.15
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, sources, max_particles_in_box=30, debug=True)
+
+    from boxtree.area_query import RadiusNeighborQueryBuilder
+    rnqb = RadiusNeighborQueryBuilder(ctx)
+
+    rnn, _ = rnqb(queue, tree, radius, half_list=half_list,
+            source_order=source_order)
+    rnn = rnn.get(queue=queue)
+
+    if source_order == "user":
+        sources = np.array([src.get() for src in sources]).T
+    else:
+        sources = np.array([src.get(queue=queue) for src in tree.sources]).T
+
+    assert len(rnn.neighbor_starts) == nsources + 1
+
+    for isrc, src in enumerate(sources):
+        dists = np.sqrt(np.sum((sources - src)**2, axis=1))
+        ref_neighbors = np.flatnonzero(dists <= radius)
+        if half_list:
+            ref_neighbors = ref_neighbors[ref_neighbors > isrc]
+        else:
+            ref_neighbors = ref_neighbors[ref_neighbors != isrc]
+
+        start, end = rnn.neighbor_starts[isrc:isrc+2]
+        assert (np.sort(rnn.neighbor_lists[start:end]) == ref_neighbors).all()
+
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("dims", [2, 3])
+def test_leaf_box_finder(ctx_factory, dims):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    nparticles = 10**4
+    npoints = 2000
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    from boxtree.area_query import LeafBoxFinder
+    lbf = LeafBoxFinder(ctx)
+
+    host_tree = tree.get(queue=queue)
+
+    # {{{ particles of the tree are found in their own boxes
+
+    box_ids, _ = lbf(queue, tree, tree.sources)
+    box_ids = box_ids.get(queue=queue)
+
+    ref_box_ids = np.empty(tree.nsources, tree.box_id_dtype)
+    for ibox in range(tree.nboxes):
+        start = host_tree.box_source_starts[ibox]
+        ref_box_ids[
+                start:start + host_tree.box_source_counts_nonchild[ibox]] = ibox
+
+    assert (box_ids == ref_box_ids).all()
+
+    # }}}
+
+    # {{{ arbitrary points, some of them outside the tree
+
+    points = make_normal_particle_array(queue, npoints, dims, dtype, seed=13)
+    points = [2 * pt for pt in points]
+
+    box_ids, _ = lbf(queue, tree, points)
+    box_ids = box_ids.get(queue=queue)
+
+    points = np.array([pt.get() for pt in points])
+
+    root_low, root_high = host_tree.get_box_extent(0)
+    in_root = np.all(
+            (root_low[:, np.newaxis] <= points)
+            & (points < root_high[:, np.newaxis]), axis=0)
+    assert ((box_ids == -1) == ~in_root).all()
+
+    def contains(ibox, point):
+        low, high = host_tree.get_box_extent(ibox)
+        return np.all((low <= point) & (point < high))
+
+    for ipoint in np.flatnonzero(in_root):
+        point = points[:, ipoint]
+        ibox = box_ids[ipoint]
+        assert contains(ibox, point)
+
+        for child in host_tree.box_child_ids[:, ibox]:
+            if child:
+                assert not contains(child, point)
+
+    # }}}
+
+
 @pytest.mark.opencl
 @pytest.mark.area_query
 @pytest.mark.parametrize("dims", [2, 3])
@@ -1045,6 +1388,45 @@ def test_space_invader_query(ctx_factory, dims, dtype, do_plot=False):
 
     assert np.allclose(siq, outer_space_invader_dist)
 
+
+@pytest.mark.opencl
+@pytest.mark.geo_lookup
+@pytest.mark.parametrize("dims", [2, 3])
+def test_space_invader_query_multiple_radii(ctx_factory, dims):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.dtype(np.float64)
+    nparticles = 10**4
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    queue.finish()
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+
+    nballs = 10**3
+    ball_centers = make_normal_particle_array(queue, nballs, dims, dtype)
+
+    rng = np.random.RandomState(13)
+    base_radii = rng.uniform(0.02, 0.1, nballs)
+    ball_radii = cl.array.to_device(queue,
+            np.array([scale * base_radii for scale in [1, 0.5, 2, 0.25]]))
+
+    from boxtree.area_query import SpaceInvaderQueryBuilder
+    siqb = SpaceInvaderQueryBuilder(ctx)
+
+    siq, _ = siqb(queue, tree, ball_centers, ball_radii)
+    siq = siq.get(queue=queue)
+    assert siq.shape == (len(ball_radii), tree.nboxes)
+
+    for iset in range(len(ball_radii)):
+        ref_siq, _ = siqb(queue, tree, ball_centers,
+                cl.array.to_device(queue, ball_radii[iset].get(queue)))
+        assert (siq[iset] == ref_siq.get(queue=queue)).all()
+
 # }}}
 
 
@@ -1126,6 +1508,259 @@ def test_max_levels_error(ctx_factory):
 # }}}
 
 
+# {{{ test_build_cache
+
+def test_build_cache(ctx_factory, tmpdir, monkeypatch):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 3
+    nparticles = 10**4
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    from boxtree.traversal import FMMTraversalBuilder
+    from boxtree.area_query import PeerListFinder
+    from boxtree.cache import (BuildCache, CachedTreeBuilder,
+            CachedFMMTraversalBuilder, CachedPeerListFinder)
+
+    def make_builders(cache):
+        return (
+                CachedTreeBuilder(TreeBuilder(ctx), cache),
+                CachedFMMTraversalBuilder(FMMTraversalBuilder(ctx), cache),
+                CachedPeerListFinder(PeerListFinder(ctx), cache))
+
+    def build_all(builders, max_particles_in_box=30):
+        tb, tg, plf = builders
+        tree, _ = tb(queue, particles, max_particles_in_box=max_particles_in_box)
+        trav, _ = tg(queue, tree)
+        peer_lists, _ = plf(queue, tree)
+        return tree, trav, peer_lists
+
+    cache = BuildCache(persistent_dir=str(tmpdir))
+    builders = make_builders(cache)
+
+    tree, trav, peer_lists = build_all(builders)
+    assert (cache.nhits, cache.nmisses) == (0, 3)
+
+    # {{{ in-memory hits
+
+    tree2, trav2, peer_lists2 = build_all(builders)
+    assert (cache.nhits, cache.nmisses) == (3, 3)
+    assert tree2 is tree
+    assert trav2 is trav
+    assert peer_lists2 is peer_lists
+
+    # changed parameters lead to a rebuild
+    tree3, _, _ = build_all(builders, max_particles_in_box=20)
+    assert tree3 is not tree
+    assert cache.nmisses == 6
+
+    # }}}
+
+    # {{{ on-disk hits
+
+    cache = BuildCache(persistent_dir=str(tmpdir))
+    disk_tree, disk_trav, disk_peer_lists = build_all(make_builders(cache))
+    assert (cache.nhits, cache.nmisses) == (3, 0)
+
+    host_trav = trav.get(queue=queue)
+    host_disk_trav = disk_trav.get(queue=queue)
+
+    assert isinstance(disk_tree.box_centers, cl.array.Array)
+    assert isinstance(disk_tree.level_start_box_nrs, np.ndarray)
+    assert (host_disk_trav.tree.box_centers == host_trav.tree.box_centers).all()
+    for list_name in ["neighbor_source_boxes", "from_sep_siblings",
+            "from_sep_bigger"]:
+        for suffix in ["_starts", "_lists"]:
+            assert (getattr(host_disk_trav, list_name + suffix)
+                    == getattr(host_trav, list_name + suffix)).all()
+
+    assert (disk_peer_lists.peer_lists.get(queue)
+            == peer_lists.peer_lists.get(queue)).all()
+
+    # }}}
+
+    # {{{ entries written in another format are not used
+
+    import boxtree.cache
+    monkeypatch.setattr(boxtree.cache, "_CACHE_FORMAT_VERSION",
+            boxtree.cache._CACHE_FORMAT_VERSION + 1)
+
+    cache = BuildCache(persistent_dir=str(tmpdir))
+    build_all(make_builders(cache))
+    assert (cache.nhits, cache.nmisses) == (0, 3)
+
+    monkeypatch.undo()
+
+    # }}}
+
+    # {{{ eviction
+
+    cache = BuildCache(max_nbytes=1)
+    tb, _, _ = make_builders(cache)
+    tb(queue, particles, max_particles_in_box=30)
+    tb(queue, particles, max_particles_in_box=30)
+    assert (cache.nhits, cache.nmisses) == (0, 2)
+
+    # }}}
+
+# }}}
+
+
+# {{{ test_build_cache_hit_waits_for_build
+
+def test_build_cache_hit_waits_for_build(ctx_factory):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+    other_queue = cl.CommandQueue(ctx)
+
+    from boxtree.cache import BuildCache
+    cache = BuildCache()
+
+    # a build that is still running
+    user_evt = cl.UserEvent(ctx)
+    build_evt = cl.enqueue_marker(queue, wait_for=[user_evt])
+
+    obj = cl.array.zeros(queue, 10, np.int32)
+    built_obj, evt = cache.get_or_build(queue, "key", lambda: (obj, build_evt))
+    assert built_obj is obj
+    assert evt is build_evt
+
+    def fail():
+        raise AssertionError("unexpected rebuild")
+
+    hit_obj, hit_evt = cache.get_or_build(other_queue, "key", fail)
+    other_queue.flush()
+
+    assert hit_obj is obj
+    assert (hit_evt.command_execution_status
+            != cl.command_execution_status.COMPLETE)
+
+    user_evt.set_status(cl.command_execution_status.COMPLETE)
+    hit_evt.wait()
+
+# }}}
+
+
+# {{{ test_build_cache_traversal_kwargs
+
+@pytest.mark.parametrize("mode", ["auto", "auto_global"])
+def test_build_cache_traversal_kwargs(ctx_factory, mode):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    nparticles = 2000
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, nparticles, dims, dtype, seed=15)
+    targets = make_normal_particle_array(queue, nparticles, dims, dtype, seed=16)
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(queue.context, seed=12)
+    target_radii = 2**rng.uniform(queue, nparticles, dtype=dtype, a=-10, b=0)
+
+    from boxtree import TreeBuilder
+    tree, _ = TreeBuilder(ctx)(queue, sources, targets=targets,
+            target_radii=target_radii, max_particles_in_box=30,
+            stick_out_factor=0.25)
+
+    from boxtree.cost import FMMCostModel
+    from boxtree.traversal import FMMTraversalBuilder
+    from boxtree.cache import BuildCache, CachedFMMTraversalBuilder
+
+    level_to_order = np.full(tree.nlevels, 10)
+
+    cache = BuildCache()
+    tg = CachedFMMTraversalBuilder(FMMTraversalBuilder(ctx), cache)
+
+    trav, _ = tg(queue, tree, from_sep_smaller_min_nsources_cumul=mode,
+            cost_model=FMMCostModel(queue), level_to_order=level_to_order)
+    nmisses = cache.nmisses
+
+    # Equivalent cost models lead to the same threshold, and to a hit.
+    trav2, _ = tg(queue, tree, from_sep_smaller_min_nsources_cumul=mode,
+            cost_model=FMMCostModel(queue), level_to_order=level_to_order,
+            calibration_params=FMMCostModel.get_unit_calibration_params())
+    assert trav2 is trav
+    assert cache.nmisses == nmisses
+
+    ref_trav, _ = FMMTraversalBuilder(ctx)(queue, tree,
+            from_sep_smaller_min_nsources_cumul=mode,
+            cost_model=FMMCostModel(queue), level_to_order=level_to_order)
+    assert (trav.from_sep_smaller_min_nsources_cumul
+            == ref_trav.from_sep_smaller_min_nsources_cumul).all()
+    assert (trav.from_sep_close_smaller_lists.get(queue)
+            == ref_trav.from_sep_close_smaller_lists.get(queue)).all()
+
+    # A cost model without an automatic threshold does not affect the key.
+    plain_trav, _ = tg(queue, tree)
+    plain_trav2, _ = tg(queue, tree, cost_model=FMMCostModel(queue))
+    assert plain_trav2 is plain_trav
+
+# }}}
+
+
+# {{{ test_peer_list_cache
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+def test_peer_list_cache(ctx_factory):
+    ctx = ctx_factory()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    nparticles = 10**4
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, particles, max_particles_in_box=30)
+
+    from boxtree.area_query import PeerListFinder
+
+    plf = PeerListFinder(ctx)
+    peer_lists, _ = plf(queue, tree)
+
+    # reused by the same finder, which waits for the build on a cache hit
+    from pyopencl import UserEvent
+    user_evt = UserEvent(ctx)
+    peer_lists2, evt = plf(queue, tree, wait_for=(user_evt,))
+    assert peer_lists2.peer_lists is peer_lists.peer_lists
+    assert peer_lists2.tree is tree
+    assert evt.command_execution_status != cl.command_execution_status.COMPLETE
+    user_evt.set_status(cl.command_execution_status.COMPLETE)
+    evt.wait()
+
+    # not shared with copies of the tree or with other finders
+    tree_copy = tree.copy()
+    peer_lists_copy, _ = plf(queue, tree_copy)
+    assert peer_lists_copy.peer_lists is not peer_lists.peer_lists
+
+    peer_lists3, _ = PeerListFinder(ctx)(queue, tree)
+    assert peer_lists3.peer_lists is not peer_lists.peer_lists
+    assert (peer_lists3.peer_lists.get(queue)
+            == peer_lists.peer_lists.get(queue)).all()
+
+    # the stored peer lists do not keep their tree alive
+    import weakref
+    tree_ref = weakref.ref(tree)
+    del tree, peer_lists, peer_lists2, peer_lists3
+    import gc
+    gc.collect()
+    assert tree_ref() is None
+
+    # ...and are dropped along with it
+    assert list(plf._peer_list_cache) == [id(tree_copy)]
+
+# }}}
+
+
 # You can test individual routines by typing
 # $ python test_tree.py 'test_routine(cl.create_some_context)'
 